@@ -127,6 +127,12 @@ if not exist "libs\lib_xiaohongshu_publish.pyc" ( echo   [MISSING] libs\lib_xiao
 if not exist "libs\lib_kuaishou_publish.pyc" ( echo   [MISSING] libs\lib_kuaishou_publish.pyc & set MISSING=1 )
 if not exist "libs\lib_pip.pyc" ( echo   [MISSING] libs\lib_pip.pyc & set MISSING=1 )
 if not exist "libs\lib_pip_websocket.pyc" ( echo   [MISSING] libs\lib_pip_websocket.pyc & set MISSING=1 )
+if not exist "libs\lib_download.pyc" ( echo   [MISSING] libs\lib_download.pyc & set MISSING=1 )
+if not exist "libs\lib_heygem_worker.pyc" ( echo   [MISSING] libs\lib_heygem_worker.pyc & set MISSING=1 )
+if not exist "libs\lib_model_residency.pyc" ( echo   [MISSING] libs\lib_model_residency.pyc & set MISSING=1 )
+if not exist "libs\lib_batch_pipeline.pyc" ( echo   [MISSING] libs\lib_batch_pipeline.pyc & set MISSING=1 )
+if not exist "libs\lib_tts_stream.pyc" ( echo   [MISSING] libs\lib_tts_stream.pyc & set MISSING=1 )
+if not exist "libs\lib_tts_cache.pyc" ( echo   [MISSING] libs\lib_tts_cache.pyc & set MISSING=1 )
 if not exist "libs\veo_video.pyc" ( echo   [MISSING] libs\veo_video.pyc & set MISSING=1 )
 
 if %MISSING%==1 (
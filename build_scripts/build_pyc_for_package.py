@@ -34,6 +34,12 @@ LIBS_FILES = [
     "lib_kuaishou_publish.py",
     "lib_pip.py",
     "lib_pip_websocket.py",
+    "lib_download.py",
+    "lib_heygem_worker.py",
+    "lib_model_residency.py",
+    "lib_batch_pipeline.py",
+    "lib_tts_stream.py",
+    "lib_tts_cache.py",
     "veo_video.py",
 ]
 
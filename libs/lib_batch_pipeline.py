@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+lib_batch_pipeline.py — 批量任务流水线执行器
+
+原批量任务（_bt_run）严格串行：任务 N 的 TTS → 口型合成 → 下一个任务。在线合成时，本机在等 GPU 服务器
+出片的几分钟里什么都不做，GPU 服务器在本机做 TTS 时也闲着。
+
+Pipeline：
+- 每个阶段（Stage）一组工作线程，阶段之间用有界队列连接（下游处理不过来时上游自动等待，不会堆积大量中间文件）
+- 每个阶段独立的并发上限；resources 声明阶段占用的共享资源（例如本地版 TTS 与本地口型合成都占 "gpu"，
+  同一时间只有一个在跑，与 _release_tts_gpu / _restore_tts_gpu 的约束一致）
+- 单个任务失败只标记该任务（后续阶段跳过），其它任务继续
+- 批量状态写入 state_path（JSON，每完成一个阶段原子替换一次）；同一批任务再次运行时已完成的阶段直接跳过，
+  只补做失败 / 未完成的部分
+- run() 是生成器，逐个产出阶段事件（界面线程据此刷新进度）；stop() 让未开始的任务不再启动
+
+自测（模拟阶段耗时，50 个任务对比串行与流水线的总耗时 + 失败隔离 + 断点续跑）：
+  python libs/lib_batch_pipeline.py
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+_DONE = object()  # 队列结束标记
+
+
+class Stage(NamedTuple):
+    """流水线阶段
+
+    fn(ctx) 处理一个任务：ctx 为该任务的状态字典（可读取上游阶段写入的字段并写入本阶段结果），抛异常即失败。
+    check(ctx) 在断点续跑时判断已完成阶段的结果是否仍然有效（例如输出文件仍存在），返回 False 则重做。
+    """
+    name: str
+    fn: Callable[[Dict], None]
+    concurrency: int = 1
+    resources: tuple = ()
+    queue_size: int = 2
+    check: Optional[Callable[[Dict], bool]] = None
+
+
+class Pipeline:
+    """多阶段流水线（线程）执行器"""
+
+    def __init__(self, stages: Iterable[Stage], resources: Optional[Dict[str, int]] = None,
+                 state_path: str = "", signature: str = ""):
+        """
+        Args:
+            stages: 按顺序执行的阶段
+            resources: 共享资源名 -> 同时可占用数（未列出的资源按 1 处理）
+            state_path: 批量状态文件（空 = 不保存，不能断点续跑）
+            signature: 批量任务指纹；与状态文件记录的不一致时丢弃旧状态
+        """
+        self.stages: List[Stage] = list(stages)
+        names = {r for s in self.stages for r in s.resources}
+        resources = dict(resources or {})
+        self._resources = {r: threading.Semaphore(int(resources.get(r, 1))) for r in sorted(names)}
+        self.state_path = state_path
+        self.signature = signature
+        self._state_lock = threading.Lock()
+        self._events: "queue.Queue" = queue.Queue()
+        self._stop = threading.Event()
+        self.tasks: List[Dict] = []
+        self.busy = {s.name: 0.0 for s in self.stages}
+        self.makespan = 0.0
+
+    # ── 状态文件 ──
+
+    def load_state(self) -> Dict[str, Dict]:
+        """读取上次运行保存的任务状态（task_id -> ctx），指纹不一致或文件损坏时返回空"""
+        if not self.state_path or not os.path.exists(self.state_path):
+            return {}
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if data.get("signature") != self.signature:
+            return {}
+        return {str(t.get("id")): t for t in data.get("tasks", [])}
+
+    def _save_state(self):
+        if not self.state_path:
+            return
+        with self._state_lock:
+            try:
+                # 其它阶段线程可能正在往任务字典里写字段：先拷贝快照再序列化，
+                # 保存失败也不能让工作线程退出（否则结束标记发不出去，run() 永远等待）
+                snapshot = [dict(t) for t in self.tasks]
+                for t in snapshot:
+                    t["done_stages"] = list(t.get("done_stages", []))
+                text = json.dumps({"signature": self.signature, "updated": time.time(), "tasks": snapshot},
+                                  ensure_ascii=False, indent=1, default=str)
+                tmp = self.state_path + ".tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    f.write(text)
+                os.replace(tmp, self.state_path)
+            except Exception:
+                pass
+
+    # ── 执行 ──
+
+    def stop(self):
+        """不再启动新的阶段（正在执行的阶段会跑完）"""
+        self._stop.set()
+
+    @property
+    def stopped(self) -> bool:
+        """是否已调用 stop()"""
+        return self._stop.is_set()
+
+    def run(self, tasks: Iterable[Dict]) -> Iterator[Dict]:
+        """执行全部任务，逐个产出事件：
+        {"task": id, "index": i, "stage": name, "status": "start" | "done" | "skip" | "failed", "error": str}
+        结束时产出 {"status": "finished", "makespan": 秒}
+
+        每个任务字典需要有唯一的 "id"；任务状态（done_stages / error / 各阶段写入的字段）保存在 self.tasks。
+        """
+        previous = self.load_state()
+        self.tasks = []
+        for t in tasks:
+            ctx = dict(previous.get(str(t["id"]), {}))
+            ctx.update({k: v for k, v in t.items() if k not in ctx or k == "id"})
+            ctx.setdefault("done_stages", [])
+            ctx["error"] = ""
+            ctx["failed_stage"] = ""
+            self.tasks.append(ctx)
+        self._save_state()
+
+        t0 = time.perf_counter()
+        queues = [queue.Queue(maxsize=max(1, s.queue_size)) for s in self.stages]
+        remaining = [s.concurrency for s in self.stages]
+        remaining_lock = threading.Lock()
+        threads = []
+
+        def _worker(k: int):
+            stage = self.stages[k]
+            q_in = queues[k]
+            q_out = queues[k + 1] if k + 1 < len(self.stages) else None
+            while True:
+                item = q_in.get()
+                if item is _DONE:
+                    break
+                self._process(stage, item)
+                if q_out is not None:
+                    q_out.put(item)
+            with remaining_lock:
+                remaining[k] -= 1
+                last = remaining[k] == 0
+            if last and q_out is not None:
+                for _ in range(self.stages[k + 1].concurrency):
+                    q_out.put(_DONE)
+
+        for k, stage in enumerate(self.stages):
+            for _ in range(max(1, stage.concurrency)):
+                th = threading.Thread(target=_worker, args=(k,), daemon=True, name=f"pipeline-{stage.name}")
+                th.start()
+                threads.append(th)
+
+        def _feed():
+            for i in range(len(self.tasks)):
+                queues[0].put(i)
+            for _ in range(self.stages[0].concurrency):
+                queues[0].put(_DONE)
+
+        threading.Thread(target=_feed, daemon=True, name="pipeline-feed").start()
+
+        def _join():
+            for th in threads:
+                th.join()
+            self._events.put(None)
+
+        threading.Thread(target=_join, daemon=True, name="pipeline-join").start()
+        while True:
+            ev = self._events.get()
+            if ev is None:
+                break
+            yield ev
+        self.makespan = time.perf_counter() - t0
+        self._save_state()
+        yield {"status": "finished", "makespan": self.makespan}
+
+    def _process(self, stage: Stage, i: int):
+        ctx = self.tasks[i]
+        if ctx["error"]:
+            return  # 上游阶段已失败
+        if stage.name in ctx["done_stages"]:
+            valid = True
+            if stage.check is not None:
+                try:
+                    valid = bool(stage.check(ctx))
+                except Exception:
+                    valid = False
+            if valid:
+                self._events.put({"task": ctx["id"], "index": i, "stage": stage.name, "status": "skip"})
+                return
+            ctx["done_stages"].remove(stage.name)
+        if self._stop.is_set():
+            ctx["error"] = "已停止"
+            ctx["failed_stage"] = stage.name
+            self._events.put({"task": ctx["id"], "index": i, "stage": stage.name, "status": "failed",
+                              "error": ctx["error"]})
+            return
+        held = []
+        try:
+            for r in stage.resources:
+                self._resources[r].acquire()
+                held.append(r)
+            self._events.put({"task": ctx["id"], "index": i, "stage": stage.name, "status": "start"})
+            t0 = time.perf_counter()
+            try:
+                stage.fn(ctx)
+            finally:
+                self.busy[stage.name] += time.perf_counter() - t0
+            ctx["done_stages"].append(stage.name)
+            self._events.put({"task": ctx["id"], "index": i, "stage": stage.name, "status": "done"})
+        except Exception as e:
+            ctx["error"] = str(e) or type(e).__name__
+            ctx["failed_stage"] = stage.name
+            self._events.put({"task": ctx["id"], "index": i, "stage": stage.name, "status": "failed",
+                              "error": ctx["error"]})
+        finally:
+            for r in reversed(held):
+                self._resources[r].release()
+            self._save_state()
+
+    def summary(self) -> Dict:
+        ok = sum(1 for t in self.tasks if not t["error"])
+        return {"total": len(self.tasks), "ok": ok, "failed": len(self.tasks) - ok,
+                "makespan": round(self.makespan, 3), "busy": {k: round(v, 3) for k, v in self.busy.items()}}
+
+
+# 自测：模拟阶段（sleep），时间单位 UNIT 秒
+if __name__ == "__main__":
+    import random
+    import shutil
+    import sys
+    import tempfile
+
+    UNIT = 0.01
+    N = 50
+    # 阶段耗时（单位）：本地 TTS / 上传 / 服务器口型合成 / 后期（字幕等） / 发布
+    COST = {"tts": 6, "upload": 2, "lipsync": 10, "post": 3, "publish": 1}
+
+    def _sim(name, fail=()):
+        def fn(ctx):
+            if ctx["id"] in fail:
+                raise RuntimeError(f"{name} 模拟失败")
+            time.sleep(COST[name] * UNIT * random.uniform(0.8, 1.2))
+            ctx[name] = f"{ctx['id']}.{name}"
+        return fn
+
+    def _stages(fail=(), online=True):
+        gpu = () if online else ("gpu",)
+        return [
+            Stage("tts", _sim("tts", fail), 1, ("gpu",)),
+            Stage("upload", _sim("upload"), 2),
+            Stage("lipsync", _sim("lipsync"), 2 if online else 1, gpu),
+            Stage("post", _sim("post"), 2),
+            Stage("publish", _sim("publish"), 1),
+        ]
+
+    random.seed(0)
+    tasks = [{"id": f"t{i:02d}"} for i in range(N)]
+    serial = N * sum(COST.values()) * UNIT
+    ok = True
+
+    p = Pipeline(_stages())
+    for _ in p.run(tasks):
+        pass
+    s = p.summary()
+    bottleneck = max(COST["tts"], COST["lipsync"] / 2) * UNIT * N
+    print(f"{N} 个任务  串行 {serial:.2f}s  流水线（在线合成）{s['makespan']:.2f}s  "
+          f"加速 {serial / s['makespan']:.1f}x（瓶颈阶段理论下限 {bottleneck:.2f}s）")
+    ok = ok and s["ok"] == N and s["makespan"] < serial / 2
+
+    p = Pipeline(_stages(online=False))
+    for _ in p.run(tasks):
+        pass
+    s_local = p.summary()
+    gpu_serial = N * (COST["tts"] + COST["lipsync"]) * UNIT
+    print(f"本地合成（TTS 与口型合成共用 gpu）{s_local['makespan']:.2f}s（gpu 串行部分 {gpu_serial:.2f}s）")
+    ok = ok and s_local["makespan"] >= gpu_serial * 0.9
+
+    tmp = tempfile.mkdtemp()
+    try:
+        state = os.path.join(tmp, "batch_state.json")
+        failing = {"t03", "t17", "t42"}
+        p = Pipeline(_stages(fail=failing), state_path=state, signature="batch-1")
+        events = list(p.run(tasks))
+        s1 = p.summary()
+        failed_ids = {e["task"] for e in events if e.get("status") == "failed"}
+        print(f"失败隔离: 成功 {s1['ok']} 失败 {s1['failed']} {sorted(failed_ids)}")
+        ok = ok and failed_ids == failing and s1["ok"] == N - len(failing)
+
+        # 断点续跑：只重做失败的任务
+        p = Pipeline(_stages(), state_path=state, signature="batch-1")
+        events = list(p.run(tasks))
+        started = {e["task"] for e in events if e.get("status") == "start"}
+        s2 = p.summary()
+        print(f"断点续跑: 重新执行 {sorted(started)}，耗时 {s2['makespan']:.2f}s，成功 {s2['ok']}/{N}")
+        ok = ok and started == failing and s2["ok"] == N
+
+        # 保存状态时其它阶段线程正在往任务字典里加字段：不能让工作线程异常退出导致 run() 卡住
+        def _grow(name):
+            def fn(ctx):
+                for n in range(2000):
+                    ctx[f"{name}_{n}"] = n
+                    if n % 100 == 0:
+                        time.sleep(0)
+            return fn
+
+        p = Pipeline([Stage("a", _grow("a"), 2), Stage("b", _grow("b"), 2)],
+                     state_path=os.path.join(tmp, "grow_state.json"), signature="grow")
+        result = {}
+        th = threading.Thread(target=lambda: result.update(events=list(p.run(tasks))), daemon=True)
+        th.start()
+        th.join(30)
+        finished = not th.is_alive() and p.summary()["ok"] == N
+        print(f"并发写任务字段时保存状态: 正常结束={finished}")
+        ok = ok and finished
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    print("自测通过" if ok else "自测失败")
+    sys.exit(0 if ok else 1)
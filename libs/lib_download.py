@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+"""
+lib_download.py — 可断点续传的结果视频下载
+
+在线合成的结果视频动辄几百 MB，原先一次 GET 流式写文件，网络中断就只能整段重下。
+download_resumable()：
+- 写入 <out>.part，中断后按已下载大小发 Range 续传（If-Range = ETag，服务器文件变化时自动从头下载）
+- ETag 为内容 MD5（服务器 range_file.py），下载完成后校验，不一致则丢弃重下
+- parallel > 1 且文件较大时按区间并发下载（每段各自续传），最后拼接
+- 连接断开 / 超时 / 5xx 自动重试（有进展时重置重试计数）；4xx 与 JSON 错误直接抛出
+
+自测（本地 HTTP 服务随机截断连接）：
+  python libs/lib_download.py
+"""
+
+import hashlib
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Tuple
+
+import requests
+
+CHUNK_SIZE = 256 * 1024
+PARALLEL_MIN_SIZE = 16 * 1024 * 1024  # 小于此大小不拆分区间
+
+_RETRYABLE = (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+              requests.exceptions.ChunkedEncodingError)
+
+
+class DownloadError(Exception):
+    """服务器返回了错误信息（JSON）而非文件；msg 为服务器的错误描述"""
+
+
+class _Restart(Exception):
+    """服务器文件已变化（If-Range 不匹配 / 校验失败），需要从头下载"""
+
+
+def _clean_etag(value: str) -> str:
+    value = (value or "").strip()
+    if value.startswith("W/"):
+        value = value[2:]
+    return value.strip('"')
+
+
+def _json_error(resp) -> str:
+    try:
+        data = resp.json()
+        return data.get("msg") or data.get("message") or data.get("error") or str(data)
+    except Exception:
+        return "服务器返回了非视频数据"
+
+
+def _check_response(resp):
+    """4xx / JSON 错误直接抛出；5xx 交给重试"""
+    if "application/json" in resp.headers.get("Content-Type", ""):
+        if resp.status_code >= 500:
+            resp.raise_for_status()
+        raise DownloadError(_json_error(resp))
+    if resp.status_code != 416:
+        resp.raise_for_status()
+
+
+def _total_from_content_range(value: str) -> Optional[int]:
+    m = re.match(r"bytes\s+(?:\d+-\d+|\*)/(\d+)", value or "")
+    return int(m.group(1)) if m else None
+
+
+def _md5_of(path: str) -> str:
+    h = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _read_meta(meta_path: str) -> str:
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def _write_meta(meta_path: str, etag: str):
+    with open(meta_path, "w", encoding="utf-8") as f:
+        f.write(etag)
+
+
+def _remove(*paths):
+    for p in paths:
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+
+
+class _Progress:
+    def __init__(self, cb: Optional[Callable[[int, int], None]], total: int = 0):
+        self.cb = cb
+        self.total = total
+        self.done = 0
+        self._lock = threading.Lock()
+
+    def add(self, n: int):
+        with self._lock:
+            self.done += n
+            done, total = self.done, self.total
+        if self.cb:
+            try:
+                self.cb(done, total)
+            except Exception:
+                pass
+
+
+def _fetch_range(session, url, params, headers, timeout, path, start, end, etag, progress,
+                 meta: str = "") -> Tuple[str, int]:
+    """把 [start + 已有大小, end] 追加到 path（end = None 表示到文件末尾）；返回 (etag, 文件总大小)
+
+    服务器忽略 Range（200）时：起点为 0 直接写，否则 _Restart。meta 非空时收到响应头即记录 ETag，
+    传输中断后下次仍可续传。
+    """
+    have = os.path.getsize(path) if os.path.exists(path) else 0
+    offset = start + have
+    if end is not None and offset > end:
+        return etag, 0
+    req_headers = dict(headers or {})
+    if offset > 0 or end is not None:
+        req_headers["Range"] = f"bytes={offset}-{'' if end is None else end}"
+        if etag:
+            req_headers["If-Range"] = f'"{etag}"'
+    with session.get(url, params=params, headers=req_headers, timeout=timeout, stream=True) as resp:
+        _check_response(resp)
+        new_etag = _clean_etag(resp.headers.get("ETag", ""))
+        if resp.status_code == 416:
+            total = _total_from_content_range(resp.headers.get("Content-Range", ""))
+            if end is None and total is not None and total == offset:
+                return new_etag or etag, total  # 上次已下载完整
+            raise _Restart()
+        if resp.status_code == 200:
+            if offset > 0:
+                raise _Restart()  # 文件已变化或服务器不支持 Range
+            total = int(resp.headers.get("Content-Length", 0) or 0)
+            expected = total or None
+        else:
+            total = _total_from_content_range(resp.headers.get("Content-Range", "")) or 0
+            if etag and new_etag and new_etag != etag:
+                raise _Restart()
+            expected = int(resp.headers.get("Content-Length", 0) or 0) or None
+        if meta and new_etag and new_etag != etag:
+            _write_meta(meta, new_etag)
+        got = 0
+        with open(path, "ab" if have else "wb") as f:
+            for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+                if chunk:
+                    f.write(chunk)
+                    got += len(chunk)
+                    progress.add(len(chunk))
+        if expected is not None and got < expected:
+            raise requests.exceptions.ChunkedEncodingError(f"连接提前结束: {got}/{expected} bytes")
+        return new_etag or etag, total
+
+
+def _probe(session, url, params, headers, timeout) -> Tuple[str, int, bool]:
+    """请求第一个字节，得到 (etag, 总大小, 是否支持 Range)"""
+    req_headers = dict(headers or {})
+    req_headers["Range"] = "bytes=0-0"
+    with session.get(url, params=params, headers=req_headers, timeout=timeout, stream=True) as resp:
+        _check_response(resp)
+        etag = _clean_etag(resp.headers.get("ETag", ""))
+        if resp.status_code == 206:
+            return etag, _total_from_content_range(resp.headers.get("Content-Range", "")) or 0, True
+        return etag, int(resp.headers.get("Content-Length", 0) or 0), False
+
+
+def _download_parallel(session, url, params, headers, timeout, part, etag, total, parallel, progress):
+    """按区间并发下载到 <part>.<i>，全部完成后拼接到 part"""
+    step = -(-total // parallel)
+    ranges = [(i, i * step, min(total, (i + 1) * step) - 1) for i in range(parallel) if i * step < total]
+    seg_paths = [f"{part}.{i}" for i, _, _ in ranges]
+    progress.add(sum(os.path.getsize(p) for p in seg_paths if os.path.exists(p)))
+
+    def _one(i, start, end):
+        _fetch_range(session, url, params, headers, timeout, seg_paths[i], start, end, etag, progress)
+        if os.path.getsize(seg_paths[i]) != end - start + 1:
+            raise requests.exceptions.ChunkedEncodingError(f"区间 {i} 未下载完整")
+
+    with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+        futures = [pool.submit(_one, *r) for r in ranges]
+        errors = [f.exception() for f in futures]
+    for e in errors:
+        if e is not None:
+            raise e
+    with open(part, "wb") as out:
+        for p in seg_paths:
+            with open(p, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    out.write(chunk)
+    _remove(*seg_paths)
+
+
+def download_resumable(url: str, out_path: str, params: Optional[Dict] = None,
+                       headers: Optional[Dict] = None, timeout=(15, 600), parallel: int = 1,
+                       max_retries: int = 5, progress_cb: Optional[Callable[[int, int], None]] = None,
+                       session: Optional[requests.Session] = None) -> int:
+    """下载 url 到 out_path，中断后续传；返回文件大小
+
+    progress_cb(已下载字节, 总字节)；服务器返回 JSON 错误时抛 DownloadError，
+    重试耗尽后抛出最后一次的 requests 异常。
+    """
+    part = out_path + ".part"
+    meta = part + ".etag"
+    session = session or requests.Session()
+    parallel = min(64, max(1, int(parallel)))
+    failures = 0
+
+    while True:
+        etag = _read_meta(meta)
+        if not etag:
+            _remove(part)
+        seg_paths = [p for p in (f"{part}.{i}" for i in range(64)) if os.path.exists(p)]
+        mark = (os.path.getsize(part) if os.path.exists(part) else 0) + \
+            sum(os.path.getsize(p) for p in seg_paths)
+        try:
+            if parallel > 1 and not os.path.exists(part):
+                probe_etag, total, ranged = _probe(session, url, params, headers, timeout)
+                if probe_etag != etag:
+                    _remove(*seg_paths)
+                    etag = probe_etag
+                    _write_meta(meta, etag)
+                progress = _Progress(progress_cb, total)
+                if ranged and total >= PARALLEL_MIN_SIZE:
+                    _download_parallel(session, url, params, headers, timeout, part, etag, total, parallel, progress)
+                else:
+                    _remove(*seg_paths)
+                    etag, total = _fetch_range(session, url, params, headers, timeout, part, 0, None, etag, progress,
+                                               meta=meta)
+            else:
+                have = os.path.getsize(part) if os.path.exists(part) else 0
+                progress = _Progress(progress_cb)
+                progress.add(have)
+                etag, total = _fetch_range(session, url, params, headers, timeout, part, 0, None, etag, progress,
+                                           meta=meta)
+            size = os.path.getsize(part) if os.path.exists(part) else 0
+            if total and size != total:
+                raise requests.exceptions.ChunkedEncodingError(f"文件大小不符: {size}/{total} bytes")
+            if re.fullmatch(r"[0-9a-f]{32}", etag or "") and _md5_of(part) != etag:
+                raise _Restart()
+            os.replace(part, out_path)
+            _remove(meta)
+            return size
+        except _Restart:
+            _remove(part, meta, *[f"{part}.{i}" for i in range(64)])
+            failures += 1
+            if failures > max_retries:
+                raise DownloadError("下载的文件校验失败（服务器文件已变化或传输损坏）")
+        except requests.exceptions.HTTPError as e:
+            if e.response is None or e.response.status_code < 500:
+                raise
+            failures += 1
+            if failures > max_retries:
+                raise
+        except _RETRYABLE:
+            now = (os.path.getsize(part) if os.path.exists(part) else 0) + \
+                sum(os.path.getsize(p) for p in (f"{part}.{i}" for i in range(64)) if os.path.exists(p))
+            failures = 0 if now > mark else failures + 1
+            if failures > max_retries:
+                raise
+        time.sleep(min(10.0, 0.5 * (2 ** failures)) if failures else 0.2)
+
+
+# ── 自测：本地 HTTP 服务（支持 Range / If-Range / ETag），随机截断连接 ──
+
+def _serve(data_ref, truncate_ratio):
+    import random
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *a):
+            pass
+
+        def do_GET(self):
+            data = data_ref[0]
+            etag = '"%s"' % hashlib.md5(data).hexdigest()
+            size = len(data)
+            start, end, status = 0, size - 1, 200
+            rng = self.headers.get("Range", "")
+            if_range = self.headers.get("If-Range", "")
+            m = re.match(r"bytes=(\d+)-(\d*)$", rng)
+            if m and (not if_range or if_range == etag):
+                start = int(m.group(1))
+                end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+                if start >= size:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                status = 206
+            body = data[start:end + 1]
+            self.send_response(status)
+            self.send_header("Content-Type", "video/mp4")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etag)
+            self.send_header("Accept-Ranges", "bytes")
+            if status == 206:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            self.end_headers()
+            try:
+                if len(body) > 1 and random.random() < truncate_ratio:
+                    self.wfile.write(body[:random.randrange(1, len(body))])
+                    self.close_connection = True
+                    data_ref[1] += 1
+                    return
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+
+    class Server(ThreadingHTTPServer):
+        def handle_error(self, request, client_address):
+            pass  # 客户端在截断后断开
+
+    server = Server(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    data_ref = [os.urandom(40 * 1024 * 1024 + 12345), 0]
+    server = _serve(data_ref, truncate_ratio=0.7)
+    url = f"http://127.0.0.1:{server.server_address[1]}/api/heygem/download"
+    expected = hashlib.md5(data_ref[0]).hexdigest()
+    with tempfile.TemporaryDirectory() as d:
+        for parallel in (1, 4):
+            out = os.path.join(d, f"p{parallel}.mp4")
+            t0 = time.time()
+            size = download_resumable(url, out, parallel=parallel, max_retries=20)
+            ok = _md5_of(out) == expected and not os.path.exists(out + ".part")
+            print(f"parallel={parallel}: {size} bytes, {time.time() - t0:.2f}s, 截断 {data_ref[1]} 次, "
+                  f"md5 {'OK' if ok else 'MISMATCH'}")
+            data_ref[1] = 0
+            assert ok
+
+        # 中途中断后服务器文件变化：If-Range 不匹配，应从头下载新文件
+        out = os.path.join(d, "changed.mp4")
+        with open(out + ".part", "wb") as f:
+            f.write(data_ref[0][:1000000])
+        _write_meta(out + ".part.etag", expected)
+        data_ref[0] = os.urandom(3 * 1024 * 1024)
+        download_resumable(url, out, max_retries=20)
+        assert _md5_of(out) == hashlib.md5(data_ref[0]).hexdigest()
+        print("服务器文件变化后重新下载: OK")
+    server.shutdown()
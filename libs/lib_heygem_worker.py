@@ -0,0 +1,629 @@
+# -*- coding: utf-8 -*-
+"""
+lib_heygem_worker.py — 常驻 HeyGem 进程（本地版口型合成）
+
+原 run_heygem 每个任务都用 heygem-win-50/py39 启动一个新解释器执行 cy_app.VideoProcessor，
+再用正则抓 stdout 推进度；_warmup_heygem 还要额外起一个一次性进程。每条视频都重新加载模型、
+重新创建 CUDA 上下文，批量合成 N 条就付 N 次启动开销。
+
+HeyGemWorker：
+- 子进程（HeyGem 内置 python，-c 传入 _WORKER_CODE）只创建一次 VideoProcessor，之后循环接任务
+- RPC：stdin 收 JSON 行请求（run / cancel / ping / shutdown），原 stdout 复制出来专门发 JSON 事件
+  （ready / progress / log / done / error / cancelled）；fd 1/2 改指向管道，引擎（及其子进程）的打印
+  在 worker 内按原正则解析成结构化进度事件（phase + cur/total）
+- 取消：worker 在 process_video 每次 yield 时检查取消标记并关闭生成器；超过 cancel_grace 秒仍未停下
+  则结束进程（下一个任务自动重启）
+- 守护：进程意外退出后自动重启（restart_window 内最多 max_restarts 次，防止启动即崩溃的死循环）；
+  空闲超过 idle_timeout 秒退出以归还显存，下一个任务再按需启动（idle_timeout=0 = 每个任务一个进程）
+
+自测（stub VideoProcessor，对比常驻进程与每任务启动进程的单任务开销 + 取消 + 崩溃重启 + 空闲退出 + 让出显存）：
+  python libs/lib_heygem_worker.py
+"""
+
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Optional
+
+# 子进程代码（在 HeyGem 的 py39 中执行，只用标准库；本模块打包为 .pyc，不能直接作为脚本交给 py39）
+_WORKER_CODE = r'''
+import json, os, re, sys, threading, time, traceback
+
+HEYGEM_DIR = sys.argv[1]
+os.chdir(HEYGEM_DIR)
+if HEYGEM_DIR not in sys.path:
+    sys.path.insert(0, HEYGEM_DIR)
+
+# RPC 通道 = 原 stdout 的副本；fd 1/2 改指向日志管道（引擎及其子进程的输出都进管道）
+_rpc = os.fdopen(os.dup(1), "w", encoding="utf-8", buffering=1)
+_log_r, _log_w = os.pipe()
+sys.stdout.flush()
+sys.stderr.flush()
+os.dup2(_log_w, 1)
+os.dup2(_log_w, 2)
+os.close(_log_w)
+_emit_lock = threading.Lock()
+_job = {"id": None, "cancel": False, "total": 0}
+_drained = threading.Event()
+_DRAIN = "\x00heygem-drain"
+
+
+def emit(**ev):
+    with _emit_lock:
+        _rpc.write(json.dumps(ev, ensure_ascii=False) + "\n")
+        _rpc.flush()
+
+
+def parse(line):
+    """引擎日志 -> (phase, cur, total)，不认识的行返回 None"""
+    low = line.lower()
+    if "drivered_video_pn" in line:
+        m = re.search(r"progress:\s*(\d+)/(\d+)", line)
+        if m:
+            cur, total = int(m.group(1)), int(m.group(2))
+            _job["total"] = max(_job["total"], total)
+            return "prepare", cur, total
+    elif "audio_transfer" in line and "frameid" in low:
+        m = re.search(r"frameId[:\s]*(\d+)", line, re.IGNORECASE)
+        if m:
+            return "infer", int(m.group(1)), _job["total"]
+    elif "文件下载耗时" in line or ("下载" in line and "耗时" in line):
+        return "download", 1, 1
+    elif "format" in low and ("video" in low or "audio" in low or "帧率" in line or "fps" in low):
+        return "format", 1, 1
+    elif "batch_size" in low or "batch size" in low:
+        return "load", 0, 0
+    elif "executing ffmpeg command" in low or ("ffmpeg" in low and "command" in low):
+        return "encode", 0, 0
+    elif "video result saved" in low:
+        return "save", 1, 1
+    return None
+
+
+def pump():
+    with os.fdopen(_log_r, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            line = line.strip()
+            if line == _DRAIN.strip():
+                _drained.set()
+                continue
+            if not line:
+                continue
+            job = _job["id"]
+            emit(type="log", job=job, line=line)
+            p = parse(line) if job else None
+            if p:
+                emit(type="progress", job=job, phase=p[0], cur=p[1], total=p[2])
+
+
+def drain():
+    """等日志管道里已写出的行都转成事件后再发结束事件（否则最后几条进度会落在 done 之后）"""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    _drained.clear()
+    os.write(1, (_DRAIN + "\n").encode("utf-8"))
+    _drained.wait(5)
+
+
+def run_job(vp, req):
+    job = req["job"]
+    t0 = time.time()
+    try:
+        gen = vp.process_video(1, req["audio"], req["video"], int(req.get("steps") or 12),
+                               bool(req.get("if_gfpgan")), output_filename=req["output"])
+        for x in gen:
+            print(x, flush=True)
+            if _job["cancel"]:
+                gen.close()
+                drain()
+                emit(type="cancelled", job=job)
+                return
+        drain()
+        emit(type="done", job=job, result=req["output"], seconds=round(time.time() - t0, 3))
+    except BaseException as e:
+        drain()
+        emit(type="error", job=job, error=repr(e), trace=traceback.format_exc()[-2000:])
+    finally:
+        sys.stdout.flush()
+        _job["id"] = None
+
+
+threading.Thread(target=pump, daemon=True).start()
+t0 = time.time()
+try:
+    import cy_app
+    vp = cy_app.VideoProcessor()
+except BaseException as e:
+    emit(type="fatal", error=repr(e), trace=traceback.format_exc()[-2000:])
+    sys.stdout.flush()
+    os._exit(3)
+emit(type="ready", pid=os.getpid(), load_s=round(time.time() - t0, 3))
+
+worker = None
+for raw in sys.stdin:
+    try:
+        req = json.loads(raw)
+    except ValueError:
+        continue
+    op = req.get("op")
+    if op == "run":
+        if worker is not None:
+            worker.join(timeout=5)  # 上一个任务刚发出结束事件，线程还在收尾
+        if worker is not None and worker.is_alive():
+            emit(type="error", job=req.get("job"), error="busy")
+            continue
+        _job.update(id=req["job"], cancel=False, total=0)
+        worker = threading.Thread(target=run_job, args=(vp, req), daemon=True)
+        worker.start()
+    elif op == "cancel":
+        if _job["id"] and _job["id"] == req.get("job"):
+            _job["cancel"] = True
+    elif op == "ping":
+        emit(type="pong", job=req.get("job"))
+    elif op == "shutdown":
+        break
+if worker is not None:
+    worker.join(timeout=5)
+sys.stdout.flush()
+os._exit(0)
+'''
+
+
+class HeyGemWorkerError(RuntimeError):
+    """HeyGem 进程启动失败 / 任务失败 / 进程在任务中途退出"""
+
+
+class HeyGemCancelled(HeyGemWorkerError):
+    """任务被取消"""
+
+
+class HeyGemProgress:
+    """把 worker 的结构化进度事件换算成界面上的 总进度 / 阶段 / 步骤进度（与原 stdout 正则解析的数值一致）"""
+
+    def __init__(self):
+        self.stage = "准备中"
+        self.stage_pct = 8
+        self.step_label = ""
+        self.step_pct = 0
+        self.prog = 0.08
+
+    def update(self, ev: Dict) -> bool:
+        """应用一个 progress 事件，返回是否认识该阶段"""
+        phase, cur, total = ev.get("phase"), int(ev.get("cur") or 0), int(ev.get("total") or 0)
+        frac = min(1.0, cur / total) if total > 0 else 0.0
+        if phase == "download":
+            self._set("准备素材", 5, 0.05, "下载文件", 100)
+        elif phase == "format":
+            self._set("分析音视频", 8, 0.08, "格式转换", 100)
+        elif phase == "load":
+            self._set("初始化推理", 10, 0.10, "加载模型", 0)
+        elif phase == "prepare":
+            if total > 0:
+                self._set("准备数据", int(10 + frac * 20), 0.10 + frac * 0.20, f"帧数据 {cur}/{total}", int(frac * 100))
+        elif phase == "infer":
+            if total > 0:
+                self._set("生成口型", int(30 + frac * 55), 0.30 + frac * 0.55, f"推理帧 {cur}/{total}", int(frac * 100))
+            else:
+                self._set("生成口型", min(80, self.stage_pct + 3), min(0.80, self.prog + 0.03),
+                          f"推理帧 {cur}", min(self.step_pct + 5, 95))
+        elif phase == "encode":
+            self._set("合成输出", 88, 0.88, "ffmpeg 合并", 50)
+        elif phase == "save":
+            self._set("完成", 95, 0.95, "保存文件", 100)
+        else:
+            return False
+        return True
+
+    def _set(self, stage, stage_pct, prog, step_label, step_pct):
+        self.stage = stage
+        self.stage_pct = max(self.stage_pct, stage_pct)
+        self.prog = max(self.prog, prog)
+        self.step_label = step_label
+        self.step_pct = step_pct
+
+
+class HeyGemWorker:
+    """常驻 HeyGem 进程的守护与 RPC 客户端（任务串行执行：同一时间只有一个任务占用 GPU）"""
+
+    def __init__(self, python: str, heygem_dir: str, env: Optional[Dict[str, str]] = None,
+                 idle_timeout: float = 600, cancel_grace: float = 15, start_timeout: float = 600,
+                 max_restarts: int = 3, restart_window: float = 300, creationflags: int = 0,
+                 log: Callable[[str], None] = print):
+        """
+        Args:
+            python: HeyGem 内置解释器（heygem-win-50/py39/python.exe）
+            heygem_dir: HeyGem 目录（子进程 cwd，cy_app 所在目录）
+            env: 子进程环境变量（_build_heygem_env）
+            idle_timeout: 空闲多少秒后退出进程归还显存（0 = 每个任务结束即退出，等同原每任务启动进程）
+            cancel_grace: 取消后等待引擎停下的秒数，超时结束进程
+            start_timeout: 等待 VideoProcessor 加载完成的秒数
+            max_restarts / restart_window: 意外退出后自动重启的次数上限（窗口内）
+        """
+        self.python = python
+        self.heygem_dir = heygem_dir
+        self.env = env
+        self.idle_timeout = idle_timeout
+        self.cancel_grace = cancel_grace
+        self.start_timeout = start_timeout
+        self.max_restarts = max_restarts
+        self.restart_window = restart_window
+        self.creationflags = creationflags
+        self.log = log
+        self._proc: Optional[subprocess.Popen] = None
+        self._ready = threading.Event()
+        self._fatal = ""
+        self._state_lock = threading.Lock()
+        self._job_lock = threading.Lock()  # 任务串行
+        self._current = None  # (job_id, queue)
+        self._cancel_deadline = 0.0
+        self._stopping = False
+        self._crashes = []  # 意外退出时间
+        self._last_active = time.time()
+        self.stats_data = {"jobs": 0, "spawns": 0, "restarts": 0, "cancelled": 0, "load_s": 0.0}
+        threading.Thread(target=self._monitor, daemon=True).start()
+
+    # ── 进程管理 ──
+
+    def start(self, wait: bool = False) -> bool:
+        """确保进程已启动（预热时 wait=False 立即返回）；wait=True 时等到 ready，失败抛 HeyGemWorkerError"""
+        with self._state_lock:
+            if self._proc is None or self._proc.poll() is not None:
+                self._spawn()
+        if not wait:
+            return self._ready.is_set()
+        deadline = time.time() + self.start_timeout
+        while not self._ready.wait(0.2):
+            with self._state_lock:
+                proc, fatal = self._proc, self._fatal
+            if fatal:
+                raise HeyGemWorkerError("HeyGem 加载失败: " + fatal)
+            if proc is None or proc.poll() is not None:
+                raise HeyGemWorkerError(f"HeyGem 进程启动后退出 (rc={proc.poll() if proc else None})")
+            if time.time() > deadline:
+                self._kill()
+                raise HeyGemWorkerError(f"HeyGem 加载超时（{self.start_timeout:.0f}s）")
+        return True
+
+    def _spawn(self):
+        """启动子进程（调用方持有 _state_lock）"""
+        self._ready.clear()
+        self._fatal = ""
+        self._stopping = False
+        proc = subprocess.Popen(
+            [self.python, "-u", "-c", _WORKER_CODE, self.heygem_dir],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            cwd=self.heygem_dir, env=self.env, text=True, encoding="utf-8", errors="replace",
+            creationflags=self.creationflags, bufsize=1,
+        )
+        self._proc = proc
+        self.stats_data["spawns"] += 1
+        self._last_active = time.time()
+        threading.Thread(target=self._read_loop, args=(proc,), daemon=True).start()
+        self.log(f"[HEYGEM-WORKER] 启动进程 pid={proc.pid}")
+
+    def _read_loop(self, proc: subprocess.Popen):
+        for line in proc.stdout:
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            try:
+                ev = json.loads(line)
+            except ValueError:
+                ev = None
+            if not isinstance(ev, dict):
+                # RPC 通道建立前的输出（例如解释器启动报错）
+                self.log("[HEYGEM] " + line)
+                continue
+            t = ev.get("type")
+            if t == "ready":
+                self.stats_data["load_s"] = ev.get("load_s", 0.0)
+                self.log(f"[HEYGEM-WORKER] 模型加载完成 pid={ev.get('pid')} ({ev.get('load_s')}s)")
+                self._ready.set()
+                continue
+            if t == "fatal":
+                self._fatal = ev.get("error", "")
+                self.log("[HEYGEM-WORKER] 加载失败: " + ev.get("trace", self._fatal))
+                continue
+            if t == "log" and ev.get("job") is None:
+                self.log("[HEYGEM] " + ev.get("line", ""))
+                continue
+            cur = self._current
+            if cur and ev.get("job") == cur[0]:
+                cur[1].put(ev)
+            elif t == "log":
+                self.log("[HEYGEM] " + ev.get("line", ""))
+        rc = proc.wait()
+        self._on_exit(proc, rc)
+
+    def _on_exit(self, proc: subprocess.Popen, rc: int):
+        with self._state_lock:
+            if proc is not self._proc:
+                return
+            self._proc = None
+            self._ready.clear()
+            expected = self._stopping
+        cur = self._current
+        if cur:
+            cur[1].put({"type": "exit", "job": cur[0], "rc": rc})
+        if expected or self._fatal:
+            return
+        # 意外退出：窗口内未超过重启上限则立即重启（下一个任务拿到的是热进程）
+        now = time.time()
+        self._crashes = [t for t in self._crashes if now - t < self.restart_window] + [now]
+        self.log(f"[HEYGEM-WORKER] 进程意外退出 rc={rc}")
+        if len(self._crashes) <= self.max_restarts:
+            self.stats_data["restarts"] += 1
+            with self._state_lock:
+                if self._proc is None:
+                    self._spawn()
+        else:
+            self.log(f"[HEYGEM-WORKER] {self.restart_window:.0f}s 内退出 {len(self._crashes)} 次，停止自动重启")
+
+    def _send(self, **req):
+        proc = self._proc
+        if proc is None or proc.poll() is not None:
+            raise HeyGemWorkerError("HeyGem 进程未运行")
+        try:
+            proc.stdin.write(json.dumps(req, ensure_ascii=False) + "\n")
+            proc.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise HeyGemWorkerError(f"HeyGem 进程通信失败: {e}")
+
+    def _kill(self):
+        with self._state_lock:
+            proc = self._proc
+            self._stopping = True
+        if proc is not None and proc.poll() is None:
+            try:
+                proc.kill()
+            except Exception:
+                pass
+
+    def shutdown(self, timeout: float = 10):
+        """结束进程（空闲退出 / 应用退出）"""
+        with self._state_lock:
+            proc = self._proc
+            self._stopping = True
+        if proc is None:
+            return
+        try:
+            self._send(op="shutdown")
+            proc.wait(timeout=timeout)
+        except Exception:
+            self._kill()
+
+    def _monitor(self):
+        """取消超时强制结束 + 空闲退出"""
+        while True:
+            time.sleep(0.5)
+            if self._cancel_deadline and time.time() > self._cancel_deadline:
+                self.log("[HEYGEM-WORKER] 取消超时，结束进程")
+                self._cancel_deadline = 0.0
+                self._kill()
+            if self.idle_timeout <= 0 or self._proc is None:
+                continue
+            # 持有 _job_lock 判定并退出：否则判定空闲后新 run() 抢先开始，会被随后的 shutdown() 杀掉
+            # （shutdown 不取 _job_lock；期间到来的 run() 阻塞到退出完成后重新拉起进程）
+            if not self._job_lock.acquire(blocking=False):
+                continue
+            try:
+                if (self._proc is not None and self._current is None
+                        and time.time() - self._last_active > self.idle_timeout):
+                    self.log(f"[HEYGEM-WORKER] 空闲 {self.idle_timeout:.0f}s，退出进程释放显存")
+                    self.shutdown()
+            finally:
+                self._job_lock.release()
+
+    # ── 任务 ──
+
+    def run(self, audio: str, video: str, output: str, steps: int = 12, if_gfpgan: bool = False,
+            on_event: Optional[Callable[[Dict], None]] = None,
+            should_cancel: Optional[Callable[[], bool]] = None) -> str:
+        """执行一个合成任务，返回输出路径；进度 / 日志事件交给 on_event
+
+        取消：另一线程调用 cancel()，或 should_cancel() 返回 True（每 0.5s 检查一次），抛 HeyGemCancelled。
+        """
+        with self._job_lock:
+            self.start(wait=True)
+            job = uuid.uuid4().hex[:12]
+            q: "queue.Queue[Dict]" = queue.Queue()
+            self._current = (job, q)
+            self.stats_data["jobs"] += 1
+            try:
+                self._send(op="run", job=job, audio=audio, video=video, output=output,
+                           steps=int(steps or 12), if_gfpgan=bool(if_gfpgan))
+                while True:
+                    try:
+                        ev = q.get(timeout=0.5)
+                    except queue.Empty:
+                        if should_cancel is not None and not self._cancel_deadline and should_cancel():
+                            self.cancel()
+                        continue
+                    t = ev.get("type")
+                    if t == "done":
+                        return ev.get("result") or output
+                    if t == "cancelled":
+                        self.stats_data["cancelled"] += 1
+                        raise HeyGemCancelled("已取消")
+                    if t == "error":
+                        raise HeyGemWorkerError(ev.get("error") or "unknown error")
+                    if t == "exit":
+                        if self._cancel_deadline or self._stopping:
+                            self.stats_data["cancelled"] += 1
+                            raise HeyGemCancelled("已取消（引擎未响应，进程已结束）")
+                        raise HeyGemWorkerError(f"HeyGem 进程异常退出 (rc={ev.get('rc')})")
+                    if on_event is not None:
+                        try:
+                            on_event(ev)
+                        except Exception:
+                            pass
+            finally:
+                self._current = None
+                self._cancel_deadline = 0.0
+                self._last_active = time.time()
+                if self.idle_timeout == 0:
+                    self.shutdown()
+
+    def cancel(self) -> bool:
+        """取消当前任务（没有任务时返回 False）"""
+        cur = self._current
+        if not cur:
+            return False
+        self._cancel_deadline = time.time() + self.cancel_grace
+        try:
+            self._send(op="cancel", job=cur[0])
+        except HeyGemWorkerError:
+            pass
+        return True
+
+    def stop_if_idle(self, wait: bool = False) -> bool:
+        """结束进程把显存让给其它模型（下一个任务按需重新启动），返回进程是否已不在运行
+
+        wait=False 时有任务在执行则不结束、返回 False；wait=True 时等当前任务结束后再结束进程。
+        """
+        if not self._job_lock.acquire(blocking=wait):
+            return False
+        try:
+            if self.running:
+                self.log("[HEYGEM-WORKER] 让出显存，结束进程")
+                self.shutdown()
+            return True
+        finally:
+            self._job_lock.release()
+
+    @property
+    def busy(self) -> bool:
+        return self._current is not None
+
+    @property
+    def running(self) -> bool:
+        proc = self._proc
+        return proc is not None and proc.poll() is None
+
+    def stats(self) -> dict:
+        return dict(self.stats_data, running=self.running, ready=self._ready.is_set(), busy=self.busy)
+
+
+# 自测：stub cy_app.VideoProcessor（构造耗时模拟模型加载 + CUDA 初始化，process_video 打印与 HeyGem 相同格式的日志）
+if __name__ == "__main__":
+    import shutil
+    import statistics
+    import tempfile
+
+    STUB = r'''
+import os, time
+LOAD_S = float(os.environ.get("STUB_LOAD_S", "1.5"))
+FRAMES = int(os.environ.get("STUB_FRAMES", "20"))
+
+class VideoProcessor:
+    def __init__(self):
+        time.sleep(LOAD_S)
+
+    def process_video(self, _n, audio, video, steps, if_gfpgan, output_filename=None):
+        if os.path.basename(audio) == "crash.wav":
+            os._exit(9)
+        for i in range(1, FRAMES + 1):
+            print("drivered_video_pn >>> progress: %d/%d" % (i, FRAMES), flush=True)
+        for i in range(1, FRAMES + 1):
+            time.sleep(0.5 if os.path.basename(audio) == "slow.wav" else 0.005)
+            print("audio_transfer >>> frameId:%d" % i, flush=True)
+            yield "frame %d" % i
+        print("executing ffmpeg command", flush=True)
+        with open(output_filename, "w") as f:
+            f.write("ok")
+        print("video result saved", flush=True)
+        yield output_filename
+'''
+    tmp = tempfile.mkdtemp()
+    ok = True
+    try:
+        with open(os.path.join(tmp, "cy_app.py"), "w", encoding="utf-8") as f:
+            f.write(STUB)
+        for name in ("a.wav", "v.mp4", "slow.wav", "crash.wav"):
+            open(os.path.join(tmp, name), "w").close()
+        env = dict(os.environ, STUB_LOAD_S="1.5")
+        quiet = lambda msg: None  # noqa: E731
+        N = 5
+
+        def bench(idle_timeout):
+            w = HeyGemWorker(sys.executable, tmp, env=env, idle_timeout=idle_timeout, log=quiet)
+            times, progress = [], HeyGemProgress()
+            for i in range(N):
+                t0 = time.perf_counter()
+                out = w.run(os.path.join(tmp, "a.wav"), os.path.join(tmp, "v.mp4"),
+                            os.path.join(tmp, f"out_{idle_timeout}_{i}.mp4"), on_event=lambda ev: (
+                                progress.update(ev) if ev.get("type") == "progress" else None))
+                times.append(time.perf_counter() - t0)
+                assert os.path.exists(out)
+            w.shutdown()
+            return times, progress, w.stats()
+
+        spawn_t, _, spawn_st = bench(0)
+        pers_t, prog, pers_st = bench(600)
+        print(f"每任务启动进程: 单任务 {statistics.mean(spawn_t):.2f}s (spawns={spawn_st['spawns']})")
+        print(f"常驻进程:       首个 {pers_t[0]:.2f}s, 之后平均 {statistics.mean(pers_t[1:]):.3f}s "
+              f"(spawns={pers_st['spawns']}) -> 每任务节省 {statistics.mean(spawn_t) - statistics.mean(pers_t[1:]):.2f}s")
+        print(f"结构化进度: stage={prog.stage} {prog.stage_pct}% step={prog.step_label}")
+        ok = ok and pers_st["spawns"] == 1 and spawn_st["spawns"] == N and prog.stage == "完成"
+
+        # 取消 + 崩溃重启
+        w = HeyGemWorker(sys.executable, tmp, env=env, log=quiet)
+        w.start(wait=True)
+        t0 = time.perf_counter()
+        threading.Timer(1.0, w.cancel).start()
+        try:
+            w.run(os.path.join(tmp, "slow.wav"), os.path.join(tmp, "v.mp4"), os.path.join(tmp, "c.mp4"))
+            cancelled = False
+        except HeyGemCancelled:
+            cancelled = True
+        t_cancel = time.perf_counter() - t0
+        try:
+            w.run(os.path.join(tmp, "crash.wav"), os.path.join(tmp, "v.mp4"), os.path.join(tmp, "x.mp4"))
+            crashed = False
+        except HeyGemCancelled:
+            crashed = False
+        except HeyGemWorkerError:
+            crashed = True
+        w._ready.wait(10)
+        after = w.run(os.path.join(tmp, "a.wav"), os.path.join(tmp, "v.mp4"), os.path.join(tmp, "y.mp4"))
+        st = w.stats()
+        w.shutdown()
+        print(f"取消: {cancelled} ({t_cancel:.2f}s); 崩溃报错: {crashed}, 自动重启后任务成功: "
+              f"{os.path.exists(after)} (restarts={st['restarts']}, spawns={st['spawns']})")
+        ok = ok and cancelled and t_cancel < 3 and crashed and st["restarts"] == 1
+
+        # 空闲退出：持有 _job_lock（任务已开始、_current 尚未设置）时不得退出，释放后才退出
+        w = HeyGemWorker(sys.executable, tmp, env=env, idle_timeout=5, log=quiet)
+        w.start(wait=True)
+        with w._job_lock:
+            w._last_active = time.time() - 60
+            time.sleep(1.5)
+            kept = w._proc is not None and w._proc.poll() is None
+        deadline = time.time() + 10
+        while w._proc is not None and time.time() < deadline:
+            time.sleep(0.1)
+        idle_exit = w._proc is None
+        print(f"空闲退出: 任务进行中保留进程={kept}, 空闲后退出={idle_exit}")
+        ok = ok and kept and idle_exit
+
+        # 让出显存：任务执行中 stop_if_idle() 不结束进程，wait=True 时等任务结束后结束
+        w = HeyGemWorker(sys.executable, tmp, env=env, log=quiet)
+        w.start(wait=True)
+        th = threading.Thread(target=w.run, args=(os.path.join(tmp, "slow.wav"), os.path.join(tmp, "v.mp4"),
+                                                   os.path.join(tmp, "s.mp4")))
+        th.start()
+        time.sleep(0.5)
+        busy_kept = not w.stop_if_idle() and w.running
+        stopped = w.stop_if_idle(wait=True) and not w.running and os.path.exists(os.path.join(tmp, "s.mp4"))
+        th.join()
+        print(f"让出显存: 任务中不结束={busy_kept}, 任务结束后结束={stopped}")
+        ok = ok and busy_kept and stopped
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    print("自测通过" if ok else "自测失败")
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+"""
+lib_tts_cache.py — 句子级 TTS 缓存（本地版 / 在线版通用）
+
+批量生产的文案大量套模板：开场白、结尾、引导关注的句子在上百条视频里反复出现，但 generate_speech_local /
+generate_speech_online_concurrent 每次都把整段文案重新合成一遍。
+
+TTSSegmentCache：
+- key = md5(规范化句子文本 + 音色（参考音频内容 hash / 在线模型 ID）+ 语速 + 引擎版本 + 影响输出的合成参数)
+- 每句存为裸 PCM 文件（root/xx/<key>.pcm），SQLite 索引记录声道 / 位宽 / 采样率 / 帧数 / 大小 / 最近访问时间
+- byte_budget 超出时按最近访问时间淘汰（本次合成正在用的句子不淘汰）
+synthesize_cached()：逐句查缓存，只把未命中的句子交给引擎合成（结果写回缓存），再按顺序写出整段 WAV
+（句间可插入固定静音，与整段合成时引擎插入的句间停顿一致）。
+
+自测（fake TTS 引擎统计调用次数）：
+  python libs/lib_tts_cache.py
+"""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import uuid
+import wave
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+
+class Segment(NamedTuple):
+    """一句音频：PCM 数据 + 格式"""
+    pcm: bytes
+    channels: int
+    sampwidth: int
+    rate: int
+
+    @property
+    def frames(self) -> int:
+        return len(self.pcm) // (self.channels * self.sampwidth)
+
+
+def normalize_text(text: str) -> str:
+    """缓存用的句子规范化：全角字母数字转半角（NFKC）、合并空白、去首尾空白"""
+    text = unicodedata.normalize("NFKC", text or "")
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def segment_key(text: str, voice: str, speed: float = 1.0, engine: str = "", params: Optional[dict] = None) -> str:
+    """句子缓存 key"""
+    raw = json.dumps([normalize_text(text), str(voice), round(float(speed), 3), engine, params or {}],
+                     ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.md5(raw.encode("utf-8")).hexdigest()
+
+
+_digest_memo: Dict[Tuple[str, int, float], str] = {}
+
+
+def file_digest(path: str) -> str:
+    """文件内容 md5（按 路径 + 大小 + 修改时间 记忆，参考音频不会每句都重读）"""
+    if not path:
+        return ""
+    path = str(path)
+    st = os.stat(path)
+    memo = (os.path.abspath(path), st.st_size, st.st_mtime)
+    if memo not in _digest_memo:
+        h = hashlib.md5()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        _digest_memo[memo] = h.hexdigest()
+    return _digest_memo[memo]
+
+
+def read_wav(path: str) -> Segment:
+    """读取一句音频（PCM WAV 直接读取，其它格式经 pydub 解码）"""
+    try:
+        with wave.open(path, "rb") as r:
+            return Segment(r.readframes(r.getnframes()), r.getnchannels(), r.getsampwidth(), r.getframerate())
+    except wave.Error:
+        from pydub import AudioSegment
+        seg = AudioSegment.from_file(path)
+        return Segment(seg.raw_data, seg.channels, seg.sample_width, seg.frame_rate)
+
+
+def write_wav(path: str, segments: Sequence[Segment], gap_ms: int = 0) -> int:
+    """按顺序把各句 PCM 写入一个 WAV（格式以第一句为准），句间插入 gap_ms 毫秒静音；返回总帧数"""
+    first = segments[0]
+    fmt = (first.channels, first.sampwidth, first.rate)
+    gap = b"\0" * (int(first.rate * gap_ms / 1000) * first.channels * first.sampwidth)
+    frames = 0
+    tmp = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    with wave.open(tmp, "wb") as w:
+        w.setnchannels(fmt[0])
+        w.setsampwidth(fmt[1])
+        w.setframerate(fmt[2])
+        for n, seg in enumerate(segments):
+            pcm = seg.pcm
+            if (seg.channels, seg.sampwidth, seg.rate) != fmt:
+                from pydub import AudioSegment
+                conv = AudioSegment(data=pcm, sample_width=seg.sampwidth, frame_rate=seg.rate, channels=seg.channels)
+                pcm = conv.set_channels(fmt[0]).set_sample_width(fmt[1]).set_frame_rate(fmt[2]).raw_data
+            if n and gap:
+                w.writeframesraw(gap)
+                frames += len(gap) // (fmt[0] * fmt[1])
+            w.writeframesraw(pcm)
+            frames += len(pcm) // (fmt[0] * fmt[1])
+    os.replace(tmp, path)
+    return frames
+
+
+class TTSSegmentCache:
+    """句子音频缓存：单连接 + 自有锁（check_same_thread=False，多个合成线程共用）"""
+
+    def __init__(self, root: str, byte_budget: int = 0, db_path: str = ""):
+        """
+        Args:
+            root: PCM 文件目录（按 key 前两位分子目录）
+            byte_budget: PCM 文件总字节上限（0 = 不限制），超出按最近访问时间淘汰
+            db_path: 索引 SQLite 文件路径（默认 root/segments.db）
+        """
+        self.root = root
+        self.byte_budget = byte_budget
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path or os.path.join(root, "segments.db"),
+                                     check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+        CREATE TABLE IF NOT EXISTS segments (
+            seg_key TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            channels INTEGER NOT NULL,
+            sampwidth INTEGER NOT NULL,
+            rate INTEGER NOT NULL,
+            frames INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            text TEXT NOT NULL DEFAULT '',
+            hits INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            last_access REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_segments_lru ON segments(last_access);
+        """)
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.pcm")
+
+    def get(self, key: str) -> Optional[Segment]:
+        """命中返回 Segment 并刷新访问时间；文件已丢失的条目顺带删除"""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM segments WHERE seg_key=?", (key,)).fetchone()
+            if row is not None:
+                try:
+                    with open(row["path"], "rb") as f:
+                        pcm = f.read()
+                except OSError:
+                    pcm = None
+                if pcm is not None and len(pcm) == row["size"]:
+                    self._conn.execute("UPDATE segments SET last_access=?, hits=hits+1 WHERE seg_key=?",
+                                       (time.time(), key))
+                    self.hits += 1
+                    return Segment(pcm, row["channels"], row["sampwidth"], row["rate"])
+                self._conn.execute("DELETE FROM segments WHERE seg_key=?", (key,))
+            self.misses += 1
+            return None
+
+    def put(self, key: str, seg: Segment, text: str = "", protect: Sequence[str] = ()) -> None:
+        """写入一句（先写临时文件再 rename），然后淘汰到字节预算以内（protect 中的 key 不淘汰）"""
+        dst = self.entry_path(key)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = f"{dst}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(seg.pcm)
+        os.replace(tmp, dst)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO segments (seg_key, path, channels, sampwidth, rate, frames, size, text, created_at, "
+                "last_access) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(seg_key) DO UPDATE SET "
+                "path=excluded.path, channels=excluded.channels, sampwidth=excluded.sampwidth, rate=excluded.rate, "
+                "frames=excluded.frames, size=excluded.size, last_access=excluded.last_access",
+                (key, dst, seg.channels, seg.sampwidth, seg.rate, seg.frames, len(seg.pcm), normalize_text(text)[:200],
+                 now, now))
+        self.evict(protect=set(protect) | {key})
+
+    def evict(self, protect: Sequence[str] = ()) -> int:
+        """淘汰到字节预算以内，返回删除条数"""
+        if self.byte_budget <= 0:
+            return 0
+        removed = 0
+        with self._lock:
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM segments").fetchone()[0]
+            if total <= self.byte_budget:
+                return 0
+            for row in self._conn.execute("SELECT seg_key, path, size FROM segments ORDER BY last_access").fetchall():
+                if total <= self.byte_budget:
+                    break
+                if row["seg_key"] in protect:
+                    continue
+                try:
+                    os.remove(row["path"])
+                except OSError:
+                    pass
+                self._conn.execute("DELETE FROM segments WHERE seg_key=?", (row["seg_key"],))
+                total -= row["size"]
+                removed += 1
+        return removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            row = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM segments").fetchone()
+        return {"entries": row[0], "bytes": row[1], "budget": self.byte_budget, "hits": self.hits,
+                "misses": self.misses}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def synthesize_cached(cache: Optional[TTSSegmentCache], sentences: List[str], keys: List[str],
+                      render: Callable[[List[Tuple[int, str]], Callable[[int, str], None]], None],
+                      out_path: str, gap_ms: int = 0) -> Dict[str, int]:
+    """逐句查缓存，只合成未命中的句子，按顺序写出 out_path
+
+    Args:
+        cache: 句子缓存（None = 不使用缓存，全部交给 render）
+        sentences / keys: 句子及对应的缓存 key（segment_key）
+        render(misses, on_segment)：合成 misses = [(句子序号, 文本), ...]，每合成好一句调用
+            on_segment(句子序号, wav 路径)（调用返回后该文件可删除）
+        gap_ms: 句间静音
+    Returns:
+        {"sentences": 句数, "hits": 命中数, "misses": 合成数}
+    """
+    if not sentences:
+        raise ValueError("没有要合成的文本")
+    segs: List[Optional[Segment]] = [cache.get(k) if cache is not None else None for k in keys]
+    misses = [(i, sentences[i]) for i, s in enumerate(segs) if s is None]
+
+    def on_segment(i: int, wav_path: str):
+        seg = read_wav(wav_path)
+        segs[i] = seg
+        if cache is not None:
+            cache.put(keys[i], seg, sentences[i], protect=keys)
+
+    if misses:
+        render(misses, on_segment)
+    missing = [i for i, s in enumerate(segs) if s is None]
+    if missing:
+        raise RuntimeError(f"段落{missing[0] + 1}未合成")
+    write_wav(out_path, segs, gap_ms=gap_ms)
+    return {"sentences": len(sentences), "hits": len(sentences) - len(misses), "misses": len(misses)}
+
+
+# 自测：fake TTS 引擎（输出由 文本 + 音色 + 语速 决定的 PCM），统计引擎调用次数
+if __name__ == "__main__":
+    import shutil
+    import struct
+    import sys
+    import tempfile
+    import zlib
+
+    SR = 22050
+
+    class FakeTTS:
+        def __init__(self):
+            self.calls = 0
+            self.texts = []
+
+        def pcm(self, text, voice, speed):
+            n = int(SR * 0.05 * len(text) / speed)
+            seed = zlib.crc32(f"{normalize_text(text)}|{voice}|{speed}".encode("utf-8")) % 997
+            return struct.pack("<%dh" % n, *[(seed * 31 + k) % 4000 - 2000 for k in range(n)])
+
+        def infer(self, text, voice, speed, output_path):
+            self.calls += 1
+            self.texts.append(text)
+            with wave.open(output_path, "wb") as w:
+                w.setnchannels(1)
+                w.setsampwidth(2)
+                w.setframerate(SR)
+                w.writeframes(self.pcm(text, voice, speed))
+
+    def split(text):
+        parts = re.split(r"([。！？!?；;])", text)
+        out = [parts[i] + (parts[i + 1] if i + 1 < len(parts) else "") for i in range(0, len(parts), 2)]
+        return [s.strip() for s in out if s.strip()]
+
+    tmp = tempfile.mkdtemp()
+    ok = True
+    try:
+        engine = FakeTTS()
+        cache = TTSSegmentCache(os.path.join(tmp, "cache"))
+
+        def run(text, voice="v1", speed=1.0, version="fake-1", c=None):
+            sentences = split(text)
+            keys = [segment_key(s, voice, speed, version) for s in sentences]
+            out = os.path.join(tmp, f"out_{uuid.uuid4().hex[:6]}.wav")
+
+            def render(misses, on_segment):
+                for i, s in misses:
+                    part = f"{out}.part{i}.wav"
+                    engine.infer(s, voice, speed, part)
+                    on_segment(i, part)
+                    os.remove(part)
+
+            st = synthesize_cached(c or cache, sentences, keys, render, out, gap_ms=200)
+            with wave.open(out) as r:
+                pcm = r.readframes(r.getnframes())
+            gap = b"\0" * (int(SR * 0.2) * 2)
+            expected = gap.join(engine.pcm(s, voice, speed) for s in sentences)
+            return st, pcm == expected
+
+        intro, outro = "大家好，欢迎来到我们的直播间。", "喜欢的话记得点赞关注！下单链接在左下角。"
+        st1, same1 = run(intro + "今天给大家带来一款新品保温杯。" + outro)
+        calls1 = engine.calls
+        st2, same2 = run(intro + "这款空气炸锅今天特价。" + outro)
+        calls2 = engine.calls - calls1
+        print(f"脚本1: {st1} 引擎调用 {calls1}; 脚本2（模板相同、正文不同）: {st2} 引擎调用 {calls2} "
+              f"-> 合成的句子 {engine.texts[calls1:]}")
+        ok = ok and same1 and same2 and calls1 == 4 and calls2 == 1 and st2["hits"] == 3
+
+        # 规范化：全角 / 多余空白视为同一句
+        before = engine.calls
+        st3, same3 = run("大家好，欢迎来到我们的直播间。  ")
+        ok = ok and same3 and engine.calls == before and st3["hits"] == 1
+        # 音色 / 语速 / 引擎版本不同 -> 不命中
+        before = engine.calls
+        run(intro, voice="v2")
+        run(intro, speed=1.2)
+        run(intro, version="fake-2")
+        ok = ok and engine.calls == before + 3
+        # 重新打开（SQLite 索引持久化）
+        cache.close()
+        cache = TTSSegmentCache(os.path.join(tmp, "cache"))
+        before = engine.calls
+        st4, same4 = run(intro + outro)
+        ok = ok and same4 and engine.calls == before and st4["misses"] == 0
+        print(f"规范化命中 / 参数区分 / 重开后命中: OK, 缓存 {cache.stats()}")
+
+        # 字节预算：只保留最近访问的句子，本次用到的句子不淘汰
+        small = TTSSegmentCache(os.path.join(tmp, "small"), byte_budget=150 * 1024)
+        for n in range(6):
+            run(f"第{n}条独立的句子，内容各不相同。", c=small)
+        s = small.stats()
+        st5, same5 = run("第5条独立的句子，内容各不相同。", c=small)
+        print(f"预算 150KB: {s['entries']} 条 {s['bytes'] // 1024}KB；最近一句仍命中={st5['hits'] == 1}")
+        ok = ok and s["bytes"] <= 150 * 1024 and st5["hits"] == 1 and same5
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    print("自测通过" if ok else "自测失败")
+    sys.exit(0 if ok else 1)
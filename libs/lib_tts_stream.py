@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+"""
+lib_tts_stream.py — 在线 TTS 流式合成（分句并发提交 / 自适应轮询 / 完成即下载 / 按序写入 WAV）
+
+原 generate_speech_online_concurrent：逐句串行提交任务，再用线程池每 2 秒轮询一次，全部完成后逐个串行下载，
+最后用 pydub 反复 `combined += segment` 拼接（每次拼接都复制一遍已有音频，段数多时是平方复杂度）。
+
+synthesize()：
+- 每个分句一个工作线程走完 提交 → 轮询 → 下载（并发上限 workers，共用调用方传入的连接池会话）
+- 轮询间隔自适应：首次 poll_initial 秒，之后按 poll_factor 递增到 poll_max（短句很快完成时不必白等 2 秒，
+  长句也不会每 2 秒打一次接口）
+- 某一句完成后立即下载，不等其它句子
+- WavAssembler 按句子顺序把 PCM 帧直接追加写入输出 WAV（前面的句子没到时先记下，到齐后依次写入），
+  不做重复拼接；段落格式不一致时用 pydub 转成第一段的格式
+- 任一句失败即停止（抛 TTSStreamError，带句子序号），清理临时文件
+- on_segment(序号, 分段文件)：每句下载完成后回调（句子缓存 lib_tts_cache 据此写入缓存）；
+  out_path=None 时不拼接，分段文件在回调后删除
+
+自测（本地 Flask 模拟 VoiceApiClient 的 tts / tts/result / 音频下载接口，延迟随机）：
+  python libs/lib_tts_stream.py
+"""
+
+import os
+import tempfile
+import threading
+import time
+import uuid
+import wave
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class TTSStreamError(RuntimeError):
+    """某个分句提交 / 合成 / 下载失败"""
+
+    def __init__(self, index: int, msg: str):
+        super().__init__(f"段落{index + 1}{msg}")
+        self.index = index
+        self.msg = msg
+
+
+def tts_status(result) -> Tuple[str, str]:
+    """解析 tts_result 的返回：("done", 音频URL) / ("failed", 错误信息) / ("pending", "")"""
+    if not isinstance(result, dict):
+        return "failed", "轮询结果异常"
+    data = result.get("data") or {}
+    task_status = data.get("status", "")
+    is_completed = (
+        task_status in ["completed", "success", "done"] or
+        (isinstance(task_status, int) and task_status >= 2)
+    )
+    is_failed = (
+        task_status in ["failed", "error"] or
+        (isinstance(task_status, int) and task_status < 0)
+    )
+    if result.get("code") == 0 and is_completed:
+        voice_url = (data.get("audio_url") or data.get("audioUrl") or data.get("voiceUrl") or
+                     data.get("voice_url") or data.get("url"))
+        if voice_url:
+            return "done", voice_url
+        return "failed", "未返回音频URL"
+    if is_failed:
+        return "failed", data.get("message") or data.get("msg") or data.get("error") or "未知错误"
+    return "pending", ""
+
+
+class WavAssembler:
+    """按序号把分段 WAV 的 PCM 帧依次追加写入一个输出 WAV（乱序到达的分段先暂存路径）"""
+
+    def __init__(self, path: str, delete_parts: bool = True):
+        self.path = path
+        self.delete_parts = delete_parts
+        self._writer: Optional[wave.Wave_write] = None
+        self._params = None
+        self._pending: Dict[int, str] = {}
+        self._next = 0
+        self._lock = threading.Lock()
+        self.frames = 0
+
+    @property
+    def written(self) -> int:
+        """已按顺序写入的分段数"""
+        return self._next
+
+    def add(self, index: int, part_path: str) -> int:
+        """登记第 index 段（从 0 开始），写入所有已连续的分段，返回已写入的分段数"""
+        with self._lock:
+            self._pending[index] = part_path
+            while self._next in self._pending:
+                src = self._pending.pop(self._next)
+                self._append(src)
+                if self.delete_parts:
+                    try:
+                        os.remove(src)
+                    except OSError:
+                        pass
+                self._next += 1
+            return self._next
+
+    def _append(self, src: str):
+        try:
+            with wave.open(src, "rb") as r:
+                params = (r.getnchannels(), r.getsampwidth(), r.getframerate())
+                if self._writer is None:
+                    self._open(params)
+                if params == self._params:
+                    while True:
+                        data = r.readframes(65536)
+                        if not data:
+                            break
+                        self._writer.writeframesraw(data)
+                        self.frames += len(data) // (params[0] * params[1])
+                    return
+        except wave.Error:
+            pass  # 非 PCM WAV（例如 mp3 / 浮点 wav）：交给 pydub 解码
+        from pydub import AudioSegment
+        seg = AudioSegment.from_file(src)
+        if self._writer is None:
+            self._open((seg.channels, seg.sample_width, seg.frame_rate))
+        ch, sw, sr = self._params
+        seg = seg.set_channels(ch).set_sample_width(sw).set_frame_rate(sr)
+        self._writer.writeframesraw(seg.raw_data)
+        self.frames += len(seg.raw_data) // (ch * sw)
+
+    def _open(self, params):
+        self._params = params
+        self._writer = wave.open(self.path, "wb")
+        self._writer.setnchannels(params[0])
+        self._writer.setsampwidth(params[1])
+        self._writer.setframerate(params[2])
+
+    def close(self, expected: Optional[int] = None):
+        """关闭输出（补写 WAV 头中的长度）；expected 给出时检查分段是否全部写入"""
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()  # wave 在 close 时回填 RIFF / data 长度
+                self._writer = None
+            if expected is not None and self._next != expected:
+                raise TTSStreamError(self._next, "缺失，音频未完整合成")
+
+    def abort(self):
+        """出错时关闭并删除输出与暂存的分段"""
+        with self._lock:
+            if self._writer is not None:
+                try:
+                    self._writer.close()
+                except Exception:
+                    pass
+                self._writer = None
+            for p in list(self._pending.values()) + [self.path]:
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+            self._pending.clear()
+
+
+def synthesize(chunks: List[str], submit: Callable[[str], str], poll: Callable[[str], dict],
+               download: Callable[[str, str], None], out_path: Optional[str], workers: int = 16,
+               task_timeout: float = 300, poll_initial: float = 0.5, poll_factor: float = 1.5,
+               poll_max: float = 4.0, on_progress: Optional[Callable[[int, int, int], None]] = None,
+               on_segment: Optional[Callable[[int, str], None]] = None) -> Optional[str]:
+    """流式合成全部分句并按顺序写入 out_path（WAV），返回 out_path
+
+    Args:
+        chunks: 分句文本（按顺序）
+        submit(text) -> task_id：提交一个 TTS 任务（失败抛异常）
+        poll(task_id) -> tts_result 的返回字典
+        download(url, path)：把合成好的音频下载到 path
+        workers: 同时进行的分句数（每句的线程大部分时间在等待轮询间隔）
+        task_timeout: 单句从提交到完成的最长等待
+        on_progress(完成数, 总数, 已写入数)：每完成一句调用一次
+        on_segment(序号, 分段文件)：每句下载完成后调用（out_path=None 时只回调、不拼接）
+    """
+    total = len(chunks)
+    if total == 0:
+        raise ValueError("没有要合成的文本")
+    stop = threading.Event()
+    if out_path is None:
+        assembler = None
+        base = os.path.join(tempfile.gettempdir(), f"tts_stream_{uuid.uuid4().hex[:8]}")
+    else:
+        assembler = WavAssembler(out_path)
+        base = os.path.splitext(out_path)[0]
+
+    def _one(i: int, text: str) -> Tuple[int, str]:
+        try:
+            task_id = submit(text)
+        except Exception as e:
+            raise TTSStreamError(i, f"提交失败：{e}")
+        if not task_id:
+            raise TTSStreamError(i, "未返回任务ID")
+        t0 = time.time()
+        delay = poll_initial
+        while True:
+            if stop.wait(delay):
+                raise TTSStreamError(i, "已取消")
+            try:
+                state, value = tts_status(poll(task_id))
+            except Exception as e:
+                raise TTSStreamError(i, f"处理失败：{e}")
+            if state == "done":
+                break
+            if state == "failed":
+                raise TTSStreamError(i, f"处理失败：{value}")
+            if time.time() - t0 > task_timeout:
+                raise TTSStreamError(i, "处理失败：任务超时")
+            delay = min(poll_max, delay * poll_factor)
+        part = f"{base}.part{i}.wav"
+        try:
+            download(value, part)
+        except Exception as e:
+            raise TTSStreamError(i, f"下载失败：{e}")
+        if stop.is_set():  # 其它句子已失败，输出已清理
+            try:
+                os.remove(part)
+            except OSError:
+                pass
+            raise TTSStreamError(i, "已取消")
+        return i, part
+
+    pool = ThreadPoolExecutor(max_workers=max(1, min(workers, total)), thread_name_prefix="tts-stream")
+    futures = {pool.submit(_one, i, c) for i, c in enumerate(chunks)}
+    completed = 0
+    try:
+        while futures:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for f in done:
+                i, part = f.result()
+                completed += 1
+                if on_segment is not None:
+                    on_segment(i, part)
+                if assembler is None:
+                    os.remove(part)
+                    written = completed
+                else:
+                    written = assembler.add(i, part)
+                if on_progress is not None:
+                    on_progress(completed, total, written)
+        if assembler is not None:
+            assembler.close(expected=total)
+        return out_path
+    except BaseException:
+        stop.set()
+        for f in futures:
+            f.cancel()
+        if assembler is not None:
+            assembler.abort()
+        raise
+    finally:
+        pool.shutdown(wait=False)
+
+
+# 自测：本地 Flask 模拟 VoiceApiClient 接口，对比原实现（串行提交 + 固定 2 秒轮询 + 串行下载 + 反复拼接）
+if __name__ == "__main__":
+    import io
+    import random
+    import shutil
+    import struct
+    import sys
+    import zlib
+    import logging
+
+    import requests
+    from flask import Flask, jsonify, request, send_file
+    from werkzeug.serving import make_server
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from voice_api import VoiceApiClient, make_session
+
+    SR = 16000
+    rng = random.Random(0)
+    app = Flask(__name__)
+    tasks: Dict[str, dict] = {}
+    lock = threading.Lock()
+
+    def _pcm(text: str) -> bytes:
+        n = int(SR * 0.12 * len(text))
+        seed = zlib.crc32(text.encode("utf-8")) % 1000
+        return struct.pack("<%dh" % n, *[(seed * 37 + k) % 2000 - 1000 for k in range(n)])
+
+    @app.post("/api/dsp/voice/tts")
+    def _tts():
+        body = request.get_json()
+        time.sleep(rng.uniform(0.05, 0.15))  # 提交接口本身的延迟
+        with lock:
+            tid = f"t_{len(tasks)}"
+            tasks[tid] = {"text": body["text"], "ready": time.time() + rng.uniform(0.3, 2.5)}
+        return jsonify({"code": 0, "data": {"task_id": tid}})
+
+    @app.get("/api/dsp/voice/tts/result")
+    def _result():
+        tid = request.args["taskId"]
+        t = tasks[tid]
+        if time.time() < t["ready"]:
+            return jsonify({"code": 0, "data": {"status": "processing"}})
+        return jsonify({"code": 0, "data": {"status": "completed", "audio_url": f"{base_url}/audio/{tid}.wav"}})
+
+    @app.get("/audio/<tid>.wav")
+    def _audio(tid):
+        time.sleep(rng.uniform(0.1, 0.4))  # 下载延迟
+        buf = io.BytesIO()
+        with wave.open(buf, "wb") as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(SR)
+            w.writeframes(_pcm(tasks[tid]["text"]))
+        buf.seek(0)
+        return send_file(buf, mimetype="audio/wav")
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    chunks = [("第%d句测试文本，" % i) * rng.randint(1, 4) for i in range(20)]
+    tmp = tempfile.mkdtemp()
+    ok = True
+    try:
+        # 原实现：串行提交 → 每 2 秒轮询 → 全部完成后串行下载 → 反复拼接
+        client = VoiceApiClient(base_url, "test")
+        t0 = time.perf_counter()
+        ids = [client.tts(1, c)["data"]["task_id"] for c in chunks]
+        urls = [None] * len(ids)
+
+        def _poll_old(i):
+            while True:
+                state, value = tts_status(client.tts_result(ids[i]))
+                if state == "done":
+                    urls[i] = value
+                    return
+                time.sleep(2)
+
+        with ThreadPoolExecutor(10) as ex:
+            list(ex.map(_poll_old, range(len(ids))))
+        combined = b""
+        for u in urls:
+            with wave.open(io.BytesIO(requests.get(u).content)) as r:
+                combined += r.readframes(r.getnframes())
+        t_old = time.perf_counter() - t0
+
+        # 新实现
+        session = make_session(16)
+        client = VoiceApiClient(base_url, "test", session=session)
+        out = os.path.join(tmp, "out.wav")
+
+        def _dl(url, path):
+            r = session.get(url, timeout=30)
+            r.raise_for_status()
+            with open(path, "wb") as f:
+                f.write(r.content)
+
+        t0 = time.perf_counter()
+        prog = []
+        synthesize(chunks, lambda c: client.tts(1, c)["data"]["task_id"], client.tts_result, _dl, out,
+                   on_progress=lambda c, t, w: prog.append(w))
+        t_new = time.perf_counter() - t0
+        with wave.open(out) as r:
+            pcm = r.readframes(r.getnframes())
+        expected = b"".join(_pcm(c) for c in chunks)
+        same = pcm == expected
+        leftovers = [f for f in os.listdir(tmp) if ".part" in f]
+        print(f"{len(chunks)} 句: 原实现 {t_old:.2f}s  流式 {t_new:.2f}s  ({t_old / t_new:.1f}x)  "
+              f"输出一致={same}  写入进度={prog[-5:]}  残留分段={len(leftovers)}")
+        ok = ok and same and t_new < t_old and not leftovers
+
+        # out_path=None：只逐句回调（供句子缓存使用），不拼接、不留分段文件
+        got = {}
+
+        def _keep(i, part):
+            with open(part, "rb") as f:
+                got[i] = f.read()
+
+        synthesize(chunks[:6], lambda c: client.tts(1, c)["data"]["task_id"], client.tts_result, _dl, None,
+                   on_segment=_keep)
+        seg_ok = sorted(got) == list(range(6)) and all(
+            wave.open(io.BytesIO(got[i])).readframes(10 ** 9) == _pcm(chunks[i]) for i in range(6))
+        print(f"逐句回调（不拼接）: {len(got)} 句，内容一致={seg_ok}")
+        ok = ok and seg_ok
+
+        # 失败：某一句提交失败时抛出带序号的错误，且不留下输出 / 分段文件
+        out2 = os.path.join(tmp, "fail.wav")
+
+        def _submit_fail(c):
+            if c == chunks[7]:
+                raise RuntimeError("模拟失败")
+            return client.tts(1, c)["data"]["task_id"]
+
+        try:
+            synthesize(chunks, _submit_fail, client.tts_result, _dl, out2)
+            failed = None
+        except TTSStreamError as e:
+            failed = e.index
+        time.sleep(1)
+        print(f"失败段落序号: {failed}, 输出已删除: {not os.path.exists(out2)}")
+        ok = ok and failed == 7 and not os.path.exists(out2)
+
+        # 拼接：反复 += 与按序追加写入
+        seg = b"\0" * (SR * 2)
+        n = 300
+        t0 = time.perf_counter()
+        combined = b""
+        for _ in range(n):
+            combined += seg
+        t_cat = time.perf_counter() - t0
+        parts = []
+        for i in range(n):
+            p = os.path.join(tmp, f"s{i}.wav")
+            with wave.open(p, "wb") as w:
+                w.setnchannels(1)
+                w.setsampwidth(2)
+                w.setframerate(SR)
+                w.writeframes(seg)
+            parts.append(p)
+        t0 = time.perf_counter()
+        asm = WavAssembler(os.path.join(tmp, "big.wav"))
+        for i in reversed(range(n)):
+            asm.add(i, parts[i])
+        asm.close(expected=n)
+        t_asm = time.perf_counter() - t0
+        print(f"拼接 {n} 段: 反复 += {t_cat:.3f}s  按序写入（含读分段文件）{t_asm:.3f}s  帧数 {asm.frames}")
+        ok = ok and asm.frames == n * SR
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmp, ignore_errors=True)
+    print("自测通过" if ok else "自测失败")
+    sys.exit(0 if ok else 1)
@@ -36,6 +36,30 @@ except ImportError:
 # ============================================================
 # 工具函数
 # ============================================================
+def make_session(pool_size: int = 16) -> requests.Session:
+    """
+    创建带连接池的会话（并发提交 / 轮询 / 下载时复用 keep-alive 连接）
+
+    只对 GET 做连接级自动重试；POST（例如提交 TTS 任务）不自动重试，避免重复创建任务。
+
+    Args:
+        pool_size: 每个主机的最大连接数（应不小于并发线程数）
+    """
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=2, backoff_factor=0.5, status_forcelist=[502, 503, 504],
+                          allowed_methods=["GET"]),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
 def safe_json(response: requests.Response) -> Dict[str, Any]:
     """
     安全解析JSON响应
@@ -103,17 +127,20 @@ class LicenseApi:
 class VoiceApiClient:
     """语音服务API客户端"""
     
-    def __init__(self, base_url: Optional[str] = None, license_key: str = ""):
+    def __init__(self, base_url: Optional[str] = None, license_key: str = "",
+                 session: Optional[requests.Session] = None):
         """
         初始化客户端
         
         Args:
             base_url: API基础URL
             license_key: 授权密钥
+            session: 复用连接的会话（并发请求时传入 make_session() 的结果），默认每次新建连接
         """
         self.base_url = (base_url or API_BASE_URL).rstrip("/")
         self.license_key = license_key
         self.machine_code = get_machine_code()
+        self.http = session or requests
 
     def _headers(self) -> Dict[str, str]:
         """获取请求头"""
@@ -138,7 +165,7 @@ class VoiceApiClient:
         with open(wav_path, "rb") as f:
             files = {"file": ("model.wav", f, "audio/wav")}
             data = {"name": name, "describe": describe}
-            response = requests.post(
+            response = self.http.post(
                 url, 
                 headers=self._headers(), 
                 files=files, 
@@ -150,7 +177,7 @@ class VoiceApiClient:
     def list_models(self) -> Dict[str, Any]:
         """获取模型列表"""
         url = f"{self.base_url}/api/dsp/voice/model/list"
-        response = requests.get(url, headers=self._headers(), timeout=DEFAULT_TIMEOUT)
+        response = self.http.get(url, headers=self._headers(), timeout=DEFAULT_TIMEOUT)
         return safe_json(response)
 
     def delete_model(self, model_id: int) -> Dict[str, Any]:
@@ -161,7 +188,7 @@ class VoiceApiClient:
             model_id: 模型ID
         """
         url = f"{self.base_url}/api/dsp/voice/model/delete"
-        response = requests.post(
+        response = self.http.post(
             url, 
             headers=self._headers(), 
             json={"model_id": model_id}, 
@@ -185,7 +212,7 @@ class VoiceApiClient:
         payload = {"model_id": model_id, "text": text}
         if speed != 1.0:
             payload["speed"] = speed
-        response = requests.post(
+        response = self.http.post(
             url, 
             headers=self._headers(), 
             json=payload, 
@@ -204,7 +231,7 @@ class VoiceApiClient:
             任务状态和结果
         """
         url = f"{self.base_url}/api/dsp/voice/tts/result"
-        response = requests.get(
+        response = self.http.get(
             url, 
             headers=self._headers(), 
             params={"taskId": task_id}, 
@@ -36,6 +36,7 @@ import shutil
 import requests as _req
 import gradio as gr
 import asyncio
+import atexit
 import ctypes
 import base64
 from datetime import datetime
@@ -260,6 +261,11 @@ _LIBS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "libs")
 if _LIBS_DIR not in sys.path:
     sys.path.insert(0, _LIBS_DIR)
 
+import lib_heygem_worker as _hw  # 常驻 HeyGem 进程（本地版口型合成）
+import lib_model_residency as _mr  # TTS 模型分级驻留（GPU / 内存 / 卸载）
+import lib_batch_pipeline as _bp  # 批量任务流水线
+import lib_tts_cache as _tc  # 句子级 TTS 缓存
+
 # ── 新功能模块（数字人 / 音色 / 字幕）──
 try:
     import lib_avatar as _av
@@ -322,6 +328,7 @@ except Exception:
 MUSIC_DATABASE_FILE = os.path.join(BASE_DIR, "data", "music_database.json")
 BGM_CACHE_DIR = os.path.join(BASE_DIR, "bgm_cache")  # 独立的BGM缓存目录
 os.makedirs(BGM_CACHE_DIR, exist_ok=True)
+TTS_CACHE_DIR = os.path.join(BASE_DIR, "tts_cache")  # 句子级 TTS 缓存（lib_tts_cache）
 
 HF_CACHE_DIR = os.path.abspath(os.path.join(FUNCOSYVOICE_DIR, "models", "hf_cache"))
 os.makedirs(HF_CACHE_DIR, exist_ok=True)
@@ -614,48 +621,72 @@ except Exception as _e:
     APP_VERSION, APP_BUILD = ("2.3.9", 239)
 
 
-_heygem_warmup_started = False
+_heygem_worker = None
+_heygem_worker_lock = threading.Lock()
+
+
+def _get_heygem_worker():
+    """HeyGem 常驻进程（首次调用时创建，进程本身按需启动）。
+
+    HEYGEM_WORKER=0 时每个任务结束即退出进程（等同旧的每任务启动方式）；
+    HEYGEM_WORKER_IDLE 为空闲多少秒后退出进程归还显存（默认 600）。
+    """
+    global _heygem_worker
+    with _heygem_worker_lock:
+        if _heygem_worker is None:
+            persistent = os.getenv("HEYGEM_WORKER", "1").strip() != "0"
+            try:
+                idle = float(os.getenv("HEYGEM_WORKER_IDLE", "600"))
+            except ValueError:
+                idle = 600.0
+            _heygem_worker = _hw.HeyGemWorker(
+                HEYGEM_PYTHON, HEYGEM_DIR, env=_build_heygem_env(),
+                idle_timeout=idle if persistent else 0,
+                creationflags=subprocess.CREATE_NO_WINDOW if sys.platform == "win32" else 0,
+                log=safe_print,
+            )
+            atexit.register(_heygem_worker.shutdown)
+        return _heygem_worker
+
+
+def cancel_heygem():
+    """取消正在进行的本地口型合成（run_heygem 抛出“已取消”），没有任务时返回 False"""
+    w = _heygem_worker
+    return w.cancel() if w is not None else False
+
+
+def _heygem_worker_running():
+    w = _heygem_worker
+    return w is not None and w.running
 
 
 def _warmup_heygem():
-    global _heygem_warmup_started
-    if _heygem_warmup_started:
+    """启动时预先拉起 HeyGem 常驻进程并加载模型（第一个任务直接复用）。
+
+    本地 TTS 已在 GPU 上时不常驻：加载完成后即结束进程（同原先的一次性预热，只预热文件缓存），
+    避免 HeyGem 模型 + CUDA 上下文与 TTS 同时占用显存。
+    """
+    if not os.path.exists(HEYGEM_PYTHON):
+        safe_print("[HEYGEM] python not found, skip warmup")
         return
-    _heygem_warmup_started = True
+    if os.getenv("HEYGEM_WORKER", "1").strip() == "0":
+        return
+    try:
+        w = _get_heygem_worker()
+        if tts is None or not _tts_on_gpu:
+            w.start()
+            return
 
-    def _run():
-        try:
-            if not os.path.exists(HEYGEM_PYTHON):
-                safe_print("[HEYGEM] python not found, skip warmup")
-                return
-            env = _build_heygem_env()
-            flags = subprocess.CREATE_NO_WINDOW if sys.platform == "win32" else 0
-            code = "import cy_app; cy_app.VideoProcessor(); print('HEYGEM_WARMUP_DONE', flush=True)"
-            p = subprocess.Popen([HEYGEM_PYTHON, "-c", code], cwd=HEYGEM_DIR, env=env,
-                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                                 text=True, encoding="utf-8", errors="replace",
-                                 creationflags=flags)
-            if p.stdout:
-                for _ in range(200):
-                    line = p.stdout.readline()
-                    if not line:
-                        if p.poll() is not None:
-                            break
-                        continue
-                    line = line.strip()
-                    if line:
-                        safe_print("[HEYGEM-WARMUP] " + line)
+        def _run():
             try:
-                p.wait(timeout=60)
-            except Exception:
-                try:
-                    p.kill()
-                except Exception:
-                    pass
-        except Exception as e:
-            safe_print("[HEYGEM] warmup fail: " + str(e))
+                w.start(wait=True)
+            except Exception as e:
+                safe_print("[HEYGEM] warmup fail: " + str(e))
+            w.stop_if_idle()
 
-    threading.Thread(target=_run, daemon=True).start()
+        threading.Thread(target=_run, daemon=True).start()
+    except Exception as e:
+        safe_print("[HEYGEM] warmup fail: " + str(e))
 
 
 # ══════════════════════════════════════════════════════════════
@@ -784,25 +815,74 @@ def auto_load_model():
 # ══════════════════════════════════════════════════════════════
 _tts_on_gpu = True  # 追踪 TTS 模型当前是否在 GPU 上
 
+
+def _load_tts_model():
+    """从磁盘构建 IndexTTS2（模型已被完全卸载时由驻留管理器调用）"""
+    model_dir = os.path.join(FUNCOSYVOICE_DIR, "checkpoints")
+    if not os.path.exists(model_dir):
+        safe_print("[GPU] 模型目录不存在，无法重新加载")
+        return None
+    original_cwd = os.getcwd()
+    os.chdir(FUNCOSYVOICE_DIR)
+    try:
+        from indextts.infer_v2 import IndexTTS2
+        return IndexTTS2(model_dir=model_dir,
+                         cfg_path=os.path.join(model_dir, "config.yaml"), use_fp16=True)
+    finally:
+        os.chdir(original_cwd)
+
+
+def _env_float(name, default):
+    try:
+        return float(os.getenv(name, str(default)))
+    except ValueError:
+        return float(default)
+
+
+# TTS 模型分级驻留：视频合成前降到（锁页）内存，合成后设备拷贝回 GPU；内存不足 / 长时间空闲才完全卸载
+_tts_res = _mr.ModelResidency(
+    "TTS 模型", _load_tts_model,
+    modules=('gpt', 'semantic_model', 'semantic_codec', 's2mel', 'campplus_model', 'bigvgan',
+             'qwen_emo.model'),
+    tensors=('semantic_mean', 'semantic_std', 'emo_matrix', 'spk_matrix'),
+    ram_reserve_gb=_env_float("TTS_RAM_RESERVE_GB", 4),
+    gpu_keep_free_gb=_env_float("TTS_KEEP_GPU_FREE_GB", 0),
+    idle_evict=_env_float("TTS_IDLE_EVICT_SEC", 1800),
+    pin=os.getenv("TTS_PIN_MEMORY", "1").strip() != "0",
+    gpu_reserve_gb=_env_float("TTS_GPU_RESERVE_GB", 1),
+    # 显存不足时先结束空闲的 HeyGem 常驻进程（正在合成时不结束，TTS 保持在内存）
+    make_room=lambda _need: _heygem_worker is not None and _heygem_worker.stop_if_idle(),
+    log=safe_print,
+)
+
+# 句子级 TTS 缓存：模板化文案里重复的句子直接复用已合成的音频（TTS_CACHE=0 关闭）
+_tts_cache = None
+if os.getenv("TTS_CACHE", "1").strip() != "0":
+    try:
+        _tts_cache = _tc.TTSSegmentCache(
+            TTS_CACHE_DIR, byte_budget=int(_env_float("TTS_CACHE_MAX_MB", 2048) * 1024 * 1024))
+    except Exception as e:
+        safe_print(f"[TTS缓存] 初始化失败，不使用缓存: {e}")
+
+
 def _release_tts_gpu():
-    """完全卸载 TTS 模型，同时释放 GPU 显存和系统内存"""
+    """视频合成前为 HeyGem 让出显存：降到内存（内存不足时完全卸载）"""
     global tts, _tts_on_gpu
     if tts is None:
         return
     try:
-        import torch, gc
-        del tts
-        tts = None
-        _tts_on_gpu = False
-        gc.collect()
-        torch.cuda.empty_cache()
-        safe_print("[GPU] TTS 模型已完全卸载（GPU + RAM 均已释放）")
+        _tts_res.adopt(tts)
+        tier = _tts_res.release()
+        _tts_on_gpu = tier == _mr.GPU
+        # 不在 GPU 上时由驻留管理器持有模型（之后可被后台按内存压力 / 空闲卸载）
+        if not _tts_on_gpu:
+            tts = None
     except Exception as e:
         safe_print(f"[GPU] 释放 TTS 失败: {e}")
 
 
 def _restore_tts_gpu():
-    """确保 TTS 模型已加载到 GPU（如已卸载则从磁盘重新加载）"""
+    """确保 TTS 模型已加载到 GPU（在内存中则设备拷贝回 GPU，已卸载则从磁盘重新加载）"""
     global tts, _tts_on_gpu
     
     # 如果是在线版，不需要恢复TTS模型
@@ -813,54 +893,17 @@ def _restore_tts_gpu():
     
     if tts is not None and _tts_on_gpu:
         return
-    # tts 已被卸载，需要从磁盘重新加载
-    if tts is None:
-        try:
-            safe_print("[GPU] TTS 模型已卸载，正在重新加载...")
-            model_dir = os.path.join(FUNCOSYVOICE_DIR, "checkpoints")
-            if not os.path.exists(model_dir):
-                safe_print("[GPU] 模型目录不存在，无法重新加载")
-                return
-            original_cwd = os.getcwd()
-            os.chdir(FUNCOSYVOICE_DIR)
-            try:
-                from indextts.infer_v2 import IndexTTS2
-                tts = IndexTTS2(model_dir=model_dir,
-                                cfg_path=os.path.join(model_dir, "config.yaml"), use_fp16=True)
-                _tts_on_gpu = True
-                safe_print("[GPU] TTS 模型重新加载完成")
-            finally:
-                os.chdir(original_cwd)
-        except Exception as e:
-            safe_print(f"[GPU] 重新加载 TTS 失败: {e}")
-        return
-    # tts 在内存中但在 CPU 上（兼容旧逻辑）
+    # 常驻 HeyGem 进程（模型 + CUDA 上下文）仍占着显存：先结束它（有任务时等任务结束）再把 TTS 搬回 GPU
+    w = _heygem_worker
+    if w is not None and w.running:
+        w.stop_if_idle(wait=True)
     try:
-        import torch
-        device = tts.device
-        if not device or device == "cpu":
+        if tts is not None:
+            _tts_res.adopt(tts)
+        model = _tts_res.acquire()
+        if model is not None:
+            tts = model
             _tts_on_gpu = True
-            return
-        for name in ('gpt', 'semantic_model', 'semantic_codec', 's2mel',
-                      'campplus_model', 'bigvgan'):
-            model = getattr(tts, name, None)
-            if model is not None and isinstance(model, torch.nn.Module):
-                model.to(device)
-        qwen = getattr(tts, 'qwen_emo', None)
-        if qwen is not None:
-            inner = getattr(qwen, 'model', None)
-            if inner is not None and isinstance(inner, torch.nn.Module):
-                inner.to(device)
-        for name in ('semantic_mean', 'semantic_std'):
-            t = getattr(tts, name, None)
-            if t is not None and isinstance(t, torch.Tensor) and not t.is_cuda:
-                setattr(tts, name, t.to(device))
-        for name in ('emo_matrix', 'spk_matrix'):
-            obj = getattr(tts, name, None)
-            if obj is not None and isinstance(obj, (list, tuple)):
-                setattr(tts, name, tuple(t.to(device) if isinstance(t, torch.Tensor) and not t.is_cuda else t for t in obj))
-        _tts_on_gpu = True
-        safe_print("[GPU] TTS 模型已恢复到 GPU")
     except Exception as e:
         safe_print(f"[GPU] 恢复 TTS 到 GPU 失败: {e}")
 
@@ -868,27 +911,34 @@ def _restore_tts_gpu():
 # ══════════════════════════════════════════════════════════════
 #  语音合成（支持本地版和在线版）
 # ══════════════════════════════════════════════════════════════
-def download_voice_from_proxy(play_url: str, output_path: str, max_retries: int = 5, extra_headers=None) -> str:
-    """通过代理URL下载音频文件到指定路径（自动重试 + 流式下载）"""
+def download_voice_from_proxy(play_url: str, output_path: str, max_retries: int = 5, extra_headers=None,
+                              session=None) -> str:
+    """通过代理URL下载音频文件到指定路径（自动重试 + 流式下载）
+
+    session: 复用调用方的连接池会话（并发下载时），默认新建会话并在结束时关闭
+    """
     import requests
     from requests.adapters import HTTPAdapter
     from urllib3.util.retry import Retry
     import time as _time
     import http.client as _http_client
 
-    session = requests.Session()
+    own_session = session is None
+    if own_session:
+        session = requests.Session()
     try:
-        # urllib3 层自动重试（仅针对连接级错误）
-        adapter = HTTPAdapter(
-            max_retries=Retry(
-                total=2,
-                backoff_factor=1,
-                status_forcelist=[502, 503, 504],
-                allowed_methods=["GET"],
+        if own_session:
+            # urllib3 层自动重试（仅针对连接级错误）
+            adapter = HTTPAdapter(
+                max_retries=Retry(
+                    total=2,
+                    backoff_factor=1,
+                    status_forcelist=[502, 503, 504],
+                    allowed_methods=["GET"],
+                )
             )
-        )
-        session.mount("https://", adapter)
-        session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
 
         headers = {
             "User-Agent": "ZhiMoAi-Client/1.0",
@@ -1016,13 +1066,15 @@ def download_voice_from_proxy(play_url: str, output_path: str, max_retries: int
             else:
                 raise last_err
     finally:
-        try:
-            session.close()
-        except Exception:
-            pass
+        if own_session:
+            try:
+                session.close()
+            except Exception:
+                pass
 
 
-def download_voice_from_lipvoice_direct(voice_url: str, output_path: str, sign: str, max_retries: int = 3) -> str:
+def download_voice_from_lipvoice_direct(voice_url: str, output_path: str, sign: str, max_retries: int = 3,
+                                        session=None) -> str:
     import requests
     import time as _time
     import http.client as _http_client
@@ -1040,7 +1092,7 @@ def download_voice_from_lipvoice_direct(voice_url: str, output_path: str, sign:
         r = None
         try:
             print(f"[直连下载] 第 {attempt}/{max_retries} 次尝试...")
-            r = requests.get(voice_url, headers=headers, timeout=(30, 600), stream=True)
+            r = (session or requests).get(voice_url, headers=headers, timeout=(30, 600), stream=True)
             r.raise_for_status()
             content_type = r.headers.get('Content-Type', '')
 
@@ -1173,10 +1225,64 @@ def split_text_by_sentences(text, max_chars=100):
     return chunks
 
 
+def _tts_sentences(text):
+    """句子缓存的分句：每句单独一段（缓存按句命中，不合并短句）"""
+    return split_text_by_sentences(text, max_chars=0)
+
+
+def _tts_engine_version():
+    """本地 TTS 引擎版本（模型配置变化后旧缓存自动失效）"""
+    try:
+        return "indextts2:" + _tc.file_digest(os.path.join(FUNCOSYVOICE_DIR, "checkpoints", "config.yaml"))
+    except OSError:
+        return "indextts2"
+
+
+def _tts_infer_cached(text, prompt_audio, out_path, infer_kw, progress=None):
+    """本地 TTS 合成到 out_path：逐句查句子缓存，只对未命中的句子调用 tts.infer
+
+    调用前需已 chdir 到 FUNCOSYVOICE_DIR；缓存关闭时整段合成。
+    """
+    sentences = _tts_sentences(text) if _tts_cache is not None else []
+    if not sentences:
+        tts.infer(spk_audio_prompt=prompt_audio, text=text, output_path=out_path, **infer_kw)
+        return
+    if infer_kw.get("use_emo_text") and not infer_kw.get("emo_text"):
+        # 未单独填写情感描述时按整段文案推断情感，逐句合成时保持一致
+        infer_kw = dict(infer_kw, emo_text=text)
+    params = dict(infer_kw)
+    if params.get("emo_audio_prompt"):
+        params["emo_audio_prompt"] = _tc.file_digest(params["emo_audio_prompt"])
+    voice = _tc.file_digest(prompt_audio)
+    engine = _tts_engine_version()
+    keys = [_tc.segment_key(s, voice, 1.0, engine, params) for s in sentences]
+    base = os.path.splitext(out_path)[0]
+
+    def _render(misses, on_segment):
+        for n, (i, sentence) in enumerate(misses):
+            if progress is not None:
+                progress(0.35 + 0.5 * n / len(misses),
+                         desc=f"🚀 生成第 {n + 1}/{len(misses)} 句（{len(sentences) - len(misses)} 句来自缓存）...")
+            part = f"{base}.part{i}.wav"
+            try:
+                tts.infer(spk_audio_prompt=prompt_audio, text=sentence, output_path=part, **infer_kw)
+                on_segment(i, part)
+            finally:
+                try:
+                    os.remove(part)
+                except OSError:
+                    pass
+
+    # 句间 200ms 静音，与 IndexTTS2 整段合成时的句间停顿一致
+    st = _tc.synthesize_cached(_tts_cache, sentences, keys, _render, out_path, gap_ms=200)
+    safe_print(f"[TTS缓存] {st['sentences']} 句，命中 {st['hits']}，合成 {st['misses']}")
+
+
 def generate_speech_online_concurrent(text, voice_name, speed=1.0, progress=gr.Progress()):
     """在线版 TTS：并发调用云端 API 合成语音（优化版）
 
-    将长文本分割成多个100字以内的段落，并发请求，全部完成后合成
+    将长文本分割成多个100字以内的段落，并发提交，每段完成即下载并按顺序写入输出 WAV（lib_tts_stream）
+    启用句子缓存时按句合成，已缓存的句子不再提交
     
     Args:
         text: 要合成的文本
@@ -1187,12 +1293,11 @@ def generate_speech_online_concurrent(text, voice_name, speed=1.0, progress=gr.P
         raise gr.Error("请输入要合成的文本内容")
 
     try:
-        from voice_api import VoiceApiClient, API_BASE_URL, get_machine_code
+        from voice_api import VoiceApiClient, API_BASE_URL, get_machine_code, make_session
         from lib_license import check_saved_license
         import lib_voice as _vc
+        import lib_tts_stream as _ts
         import time as _time
-        import concurrent.futures
-        from pydub import AudioSegment
 
         # 检查卡密
         status, info = check_saved_license()
@@ -1221,152 +1326,66 @@ def generate_speech_online_concurrent(text, voice_name, speed=1.0, progress=gr.P
 
         progress(0.05, desc=f"[在线] 准备并发请求 {chunk_count} 个任务...")
 
-        client = VoiceApiClient(API_BASE_URL, license_key)
-
-        # 提交所有任务（传递语速参数）
-        task_ids = []
-        for i, chunk in enumerate(text_chunks):
-            try:
-                result = client.tts(model_id, chunk, speed=speed)
-                if result.get("code") != 0:
-                    raise gr.Error(f"段落{i+1}提交失败：{result.get('msg', '未知错误')}")
-
-                data = result.get("data", {})
-                task_id = data.get("task_id") or data.get("taskId") or data.get("id")
-                if not task_id:
-                    raise gr.Error(f"段落{i+1}未返回任务ID")
-
-                task_ids.append((i, task_id, chunk))
-                print(f"[TTS在线版-并发] 段落{i+1}已提交，任务ID: {task_id}")
-            except Exception as e:
-                raise gr.Error(f"段落{i+1}提交失败：{e}")
-
-        progress(0.15, desc=f"[在线] 已提交 {chunk_count} 个任务，等待处理...")
-
-        # 并发轮询所有任务
-        def poll_task(task_info):
-            idx, task_id, chunk_text = task_info
-            start_time = _time.time()
-
-            while True:
-                try:
-                    result = client.tts_result(task_id)
-
-                    if not isinstance(result, dict):
-                        return (idx, None, f"轮询结果异常")
-
-                    data = result.get("data") or {}
-                    task_status = data.get("status", "")
-
-                    is_completed = (
-                        task_status in ["completed", "success", "done"] or
-                        task_status == 2 or
-                        (isinstance(task_status, int) and task_status >= 2)
-                    )
-
-                    is_failed = (
-                        task_status in ["failed", "error"] or
-                        task_status == -1 or
-                        (isinstance(task_status, int) and task_status < 0)
-                    )
-
-                    if result.get("code") == 0 and is_completed:
-                        voice_url = (
-                            data.get("audio_url") or
-                            data.get("audioUrl") or
-                            data.get("voiceUrl") or
-                            data.get("voice_url") or
-                            data.get("url")
-                        )
-
-                        if voice_url:
-                            print(f"[TTS在线版-并发] 段落{idx+1}已完成: {voice_url}")
-                            return (idx, voice_url, None)
-                        else:
-                            return (idx, None, "未返回音频URL")
-
-                    elif is_failed:
-                        error_msg = data.get("message") or data.get("msg") or data.get("error") or "未知错误"
-                        return (idx, None, error_msg)
-
-                    # 超时检查（每个任务最多等待5分钟）
-                    if _time.time() - start_time > 300:
-                        return (idx, None, "任务超时")
-
-                    _time.sleep(2)
-
-                except Exception as e:
-                    return (idx, None, str(e))
-
-        # 使用线程池并发轮询
-        audio_urls = [None] * chunk_count
-        with concurrent.futures.ThreadPoolExecutor(max_workers=min(chunk_count, 10)) as executor:
-            futures = [executor.submit(poll_task, task_info) for task_info in task_ids]
-
-            completed = 0
-            for future in concurrent.futures.as_completed(futures):
-                idx, url, error = future.result()
-                completed += 1
-
-                if error:
-                    raise gr.Error(f"段落{idx+1}处理失败：{error}")
-
-                audio_urls[idx] = url
-                progress(0.15 + 0.6 * completed / chunk_count,
-                        desc=f"[在线] 已完成 {completed}/{chunk_count} 个任务...")
-
-        progress(0.75, desc="[在线] 下载音频文件...")
-
-        # 下载所有音频文件
-        audio_files = []
+        # 共用连接池：提交 / 轮询 / 下载都复用 keep-alive 连接
+        session = make_session(pool_size=min(chunk_count, 16) + 2)
+        client = VoiceApiClient(API_BASE_URL, license_key, session=session)
         sign = os.getenv("LIPVOICE_SIGN", "").strip()
 
-        for i, voice_url in enumerate(audio_urls):
-            try:
-                ts = int(_time.time())
-                local_file = os.path.join(OUTPUT_DIR, f"tts_online_chunk_{ts}_{i}.wav")
-
-                if sign:
-                    download_voice_from_lipvoice_direct(voice_url, local_file, sign)
-                else:
-                    from urllib.parse import quote
-                    proxy_url = f"{API_BASE_URL}/api/dsp/voice/tts/download?voice_url={quote(voice_url)}"
-                    download_voice_from_proxy(
-                        proxy_url,
-                        local_file,
-                        extra_headers={
-                            "Authorization": f"Bearer {license_key}",
-                            "X-Machine-Code": get_machine_code(),
-                        },
-                    )
-
-                audio_files.append(local_file)
-                print(f"[TTS在线版-并发] 段落{i+1}已下载: {local_file}")
-
-            except Exception as e:
-                raise gr.Error(f"段落{i+1}下载失败：{e}")
+        def _submit(chunk):
+            # 传递语速参数
+            result = client.tts(model_id, chunk, speed=speed)
+            if result.get("code") != 0:
+                raise RuntimeError(result.get('msg', '未知错误'))
+            data = result.get("data", {})
+            return data.get("task_id") or data.get("taskId") or data.get("id")
 
-        progress(0.90, desc="[在线] 合成音频...")
+        def _download(voice_url, local_file):
+            if sign:
+                download_voice_from_lipvoice_direct(voice_url, local_file, sign, session=session)
+            else:
+                from urllib.parse import quote
+                proxy_url = f"{API_BASE_URL}/api/dsp/voice/tts/download?voice_url={quote(voice_url)}"
+                download_voice_from_proxy(
+                    proxy_url,
+                    local_file,
+                    extra_headers={
+                        "Authorization": f"Bearer {license_key}",
+                        "X-Machine-Code": get_machine_code(),
+                    },
+                    session=session,
+                )
 
-        # 合成所有音频
-        if len(audio_files) == 1:
-            final_file = audio_files[0]
-        else:
-            combined = AudioSegment.from_wav(audio_files[0])
-            for audio_file in audio_files[1:]:
-                segment = AudioSegment.from_wav(audio_file)
-                combined += segment
+        def _on_progress(completed, total, written):
+            progress(0.10 + 0.85 * completed / total,
+                     desc=f"[在线] 已完成 {completed}/{total} 段，已写入 {written} 段...")
 
-            ts = int(_time.time())
-            final_file = os.path.join(OUTPUT_DIR, f"tts_online_{ts}.wav")
-            combined.export(final_file, format="wav")
+        # 流式合成：并发提交，自适应轮询，每段完成即下载并按顺序写入输出 WAV
+        ts = int(_time.time())
+        final_file = os.path.join(OUTPUT_DIR, f"tts_online_{ts}.wav")
+        try:
+            sentences = _tts_sentences(text) if _tts_cache is not None else []
+            if sentences:
+                engine = f"online:{API_BASE_URL}"
+                keys = [_tc.segment_key(s, model_id, speed, engine) for s in sentences]
 
-            # 清理临时文件
-            for audio_file in audio_files:
-                try:
-                    os.remove(audio_file)
-                except Exception:
-                    pass
+                def _render(misses, on_segment):
+                    progress(0.10, desc=f"[在线] 合成 {len(misses)} 句（{len(sentences) - len(misses)} 句来自缓存）...")
+                    try:
+                        _ts.synthesize([s for _, s in misses], _submit, client.tts_result, _download, None,
+                                       on_progress=_on_progress,
+                                       on_segment=lambda j, part: on_segment(misses[j][0], part))
+                    except _ts.TTSStreamError as e:
+                        raise _ts.TTSStreamError(misses[e.index][0], e.msg)
+
+                st = _tc.synthesize_cached(_tts_cache, sentences, keys, _render, final_file)
+                print(f"[TTS在线版-并发] 句子缓存: {st['sentences']} 句，命中 {st['hits']}，合成 {st['misses']}")
+            else:
+                _ts.synthesize(text_chunks, _submit, client.tts_result, _download, final_file,
+                               on_progress=_on_progress)
+        except _ts.TTSStreamError as e:
+            raise gr.Error(str(e))
+        finally:
+            session.close()
 
         progress(1.0, desc="[OK] 合成完成")
         print(f"[TTS在线版-并发] 合成成功: {final_file}")
@@ -1570,11 +1589,12 @@ def generate_speech_local(text, prompt_audio, top_p, top_k, temperature, num_bea
         if emo_text and isinstance(emo_text, str) and emo_text.strip():
             final_emo_text = emo_text.strip()
 
-        tts.infer(
-            spk_audio_prompt=prompt_audio, text=text, output_path=out,
-            emo_audio_prompt=emo_ref_path, emo_alpha=float(emo_weight),
-            emo_vector=vec, use_emo_text=use_emo_text, emo_text=final_emo_text,
-            use_random=False, **kw
+        _tts_infer_cached(
+            text, prompt_audio, out,
+            dict(emo_audio_prompt=emo_ref_path, emo_alpha=float(emo_weight),
+                 emo_vector=vec, use_emo_text=use_emo_text, emo_text=final_emo_text,
+                 use_random=False, **kw),
+            progress=progress,
         )
         os.chdir(cwd)
         progress(0.90, desc="💾 保存音频文件...")
@@ -1943,7 +1963,8 @@ def run_heygem(video_path, audio_path, progress=gr.Progress(), detail_cb=None,
                output_path_override=None, steps=12, if_gfpgan=False):
     """使用 heygem-win-50 生成口型视频。
 
-    通过 HeyGem 内置 python 在子进程中调用 cy_app.VideoProcessor.process_video，避免依赖当前主进程环境。
+    通过 HeyGem 内置 python 的常驻子进程（lib_heygem_worker）调用 cy_app.VideoProcessor.process_video，
+    避免依赖当前主进程环境；模型只加载一次，多个任务复用同一进程。
     """
     if not video_path:
         raise gr.Error("请上传人物视频")
@@ -1969,162 +1990,48 @@ def run_heygem(video_path, audio_path, progress=gr.Progress(), detail_cb=None,
     progress(0.05, desc="初始化中...")
     _release_tts_gpu()
 
-    env = _build_heygem_env()
-    flags = subprocess.CREATE_NO_WINDOW if sys.platform == "win32" else 0
-
-    # 子进程脚本：调用 heygem 的 VideoProcessor，并把 yield 的内容打印出来（便于调试/追踪）
-    py_code = (
-        "import os,sys\n"
-        "os.chdir(r'''" + HEYGEM_DIR.replace("'", "''") + "''')\n"
-        "import cy_app\n"
-        "vp=cy_app.VideoProcessor()\n"
-        "gen=vp.process_video(1, r'''" + sa.replace("'", "''") + "''', r'''" + sv.replace("'", "''") + "''', " + str(int(steps or 12)) + ", " + ("True" if if_gfpgan else "False") + ", output_filename=r'''" + out.replace("'", "''") + "''')\n"
-        "last=None\n"
-        "try:\n"
-        "  for x in gen:\n"
-        "    last=x\n"
-        "    try: print(x, flush=True)\n"
-        "    except Exception: pass\n"
-        "except Exception as e:\n"
-        "  print('HEYGEM_ERROR:'+repr(e), flush=True)\n"
-        "  raise\n"
-        "print('HEYGEM_DONE', last, flush=True)\n"
-    )
-
-    try:
-        proc = subprocess.Popen(
-            [HEYGEM_PYTHON, "-c", py_code],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            cwd=HEYGEM_DIR,
-            env=env,
-            encoding="utf-8",
-            errors="replace",
-            creationflags=flags,
-            bufsize=1,
-        )
-    except Exception as e:
-        _restore_tts_gpu()
-        raise gr.Error("启动 HeyGem 失败: " + str(e))
-
     progress(0.08, desc="正在生成视频...")
-    last_line = ""
-    prog = 0.08
-    stage = "准备中"
-    stage_pct = 8
+    hp = _hw.HeyGemProgress()
     t0 = time.time()
-    # HeyGem 双进度追踪：总进度 + 步骤进度
-    step_total = 0
-    step_pct = 0       # 当前步骤百分比 0~100
-    step_label = ""    # 当前步骤描述
+    # HeyGem 双进度追踪：总进度 + 步骤进度（worker 把引擎日志解析成 phase + cur/total 事件）
+    state = {"prog": hp.prog}
 
-    if detail_cb:
-        try:
-            detail_cb(_dual_progress_html(stage, stage_pct, "", 0, 0))
-        except Exception:
-            pass
-    while True:
-        line = proc.stdout.readline() if proc.stdout else ""
-        if not line and proc.poll() is not None:
-            break
-        if not line:
-            continue
-        line = line.strip()
-        if not line:
-            continue
-        last_line = line
-        safe_print("[HEYGEM] " + line)
-        low = line.lower()
-
-        # ── 解析 HeyGem 各阶段（只在匹配时更新 stage，避免跳动）──
-
-        # 1) 预处理
-        if "文件下载耗时" in line or ("下载" in line and "耗时" in line):
-            stage = "准备素材"
-            stage_pct = max(stage_pct, 5)
-            prog = max(prog, 0.05)
-            step_label = "下载文件"
-            step_pct = 100
-        elif "format" in low and ("video" in low or "audio" in low or "帧率" in line or "fps" in low):
-            stage = "分析音视频"
-            stage_pct = max(stage_pct, 8)
-            prog = max(prog, 0.08)
-            step_label = "格式转换"
-            step_pct = 100
-        elif "batch_size" in low or "batch size" in low:
-            stage = "初始化推理"
-            stage_pct = max(stage_pct, 10)
-            prog = max(prog, 0.10)
-            step_label = "加载模型"
-            step_pct = 0
-
-        # 2) 数据准备进度：drivered_video_pn >>> progress: 12/108
-        elif "drivered_video_pn" in line:
-            stage = "准备数据"
-            dp = re.search(r'progress:\s*(\d+)/(\d+)', line)
-            if dp:
-                cur, total = int(dp.group(1)), int(dp.group(2))
-                step_total = max(step_total, total)
-                if total > 0:
-                    frac = cur / total
-                    stage_pct = max(stage_pct, int(10 + frac * 20))
-                    prog = max(prog, 0.10 + frac * 0.20)
-                    step_label = f"帧数据 {cur}/{total}"
-                    step_pct = int(frac * 100)
-
-        # 3) 推理进度：audio_transfer >>> frameId:24
-        elif "audio_transfer" in line and "frameid" in low:
-            stage = "生成口型"
-            ap = re.search(r'frameId[:\s]*(\d+)', line, re.IGNORECASE)
-            if ap:
-                step_cur = int(ap.group(1))
-                if step_total > 0:
-                    frac = min(1.0, step_cur / step_total)
-                    stage_pct = max(stage_pct, int(30 + frac * 55))
-                    prog = max(prog, 0.30 + frac * 0.55)
-                    step_label = f"推理帧 {step_cur}/{step_total}"
-                    step_pct = int(frac * 100)
-                else:
-                    stage_pct = max(stage_pct, min(80, stage_pct + 3))
-                    prog = max(prog, min(0.80, prog + 0.03))
-                    step_label = f"推理帧 {step_cur}"
-                    step_pct = min(step_pct + 5, 95)
-
-        # 4) 合成输出
-        elif "executing ffmpeg command" in low or ("ffmpeg" in low and "command" in low):
-            stage = "合成输出"
-            stage_pct = max(stage_pct, 88)
-            prog = max(prog, 0.88)
-            step_label = "ffmpeg 合并"
-            step_pct = 50
-        elif "video result saved" in low:
-            stage = "完成"
-            stage_pct = max(stage_pct, 95)
-            prog = max(prog, 0.95)
-            step_label = "保存文件"
-            step_pct = 100
+    def _on_event(ev):
+        if ev.get("type") == "log":
+            safe_print("[HEYGEM] " + ev.get("line", ""))
+            return
+        if ev.get("type") != "progress" or not hp.update(ev):
+            return
         if detail_cb:
             try:
                 el = int(time.time() - t0)
-                detail_cb(_dual_progress_html(stage, stage_pct, step_label, step_pct, el))
+                detail_cb(_dual_progress_html(hp.stage, hp.stage_pct, hp.step_label, hp.step_pct, el))
             except Exception:
                 pass
-
         # 推进 Gradio progress bar
         try:
-            from libs.app_version import get_app_version
-            APP_VERSION, APP_BUILD = get_app_version()
-            prog = min(0.96, prog + 0.002)
-            progress(prog, desc=f"{stage}... {int(stage_pct)}%")
+            state["prog"] = min(0.96, max(state["prog"], hp.prog) + 0.002)
+            progress(state["prog"], desc=f"{hp.stage}... {int(hp.stage_pct)}%")
         except Exception:
             pass
 
-    rc = proc.wait()
-    _restore_tts_gpu()
+    if detail_cb:
+        try:
+            detail_cb(_dual_progress_html(hp.stage, hp.stage_pct, "", 0, 0))
+        except Exception:
+            pass
+    try:
+        out = _get_heygem_worker().run(sa, sv, out, steps=steps, if_gfpgan=if_gfpgan, on_event=_on_event)
+    except _hw.HeyGemCancelled:
+        raise gr.Error("视频合成已取消")
+    except _hw.HeyGemWorkerError as e:
+        raise gr.Error("视频合成失败（HeyGem）: " + str(e))
+    finally:
+        # 常驻进程还在时 TTS 留在内存，下次合成语音前（_restore_tts_gpu）再结束进程并恢复；
+        # 每任务一个进程（HEYGEM_WORKER=0）时进程已退出，照旧立即恢复
+        if not _heygem_worker_running():
+            _restore_tts_gpu()
 
-    if rc != 0:
-        raise gr.Error("视频合成失败（HeyGem）: " + (last_line or "unknown error"))
     if not os.path.exists(out):
         raise gr.Error("输出视频文件未找到，请重试")
 
@@ -2154,6 +2061,99 @@ def _md5_of_local_file(path):
     return h.hexdigest()
 
 
+def _upload_error_retryable(e):
+    """上传异常是否值得断点续传重试：连接错误、超时、响应被截断以及 5xx / 429 重试；
+    其余 4xx（鉴权失败、参数错误、文件过大等）重试也不会成功，直接失败"""
+    if isinstance(e, _req.exceptions.HTTPError):
+        code = e.response.status_code if e.response is not None else 0
+        return code >= 500 or code == 429
+    if isinstance(e, (_req.exceptions.ConnectionError, _req.exceptions.Timeout,
+                      _req.exceptions.ChunkedEncodingError)):
+        return True
+    # 响应体不是合法 JSON（代理截断等）；requests 旧版本抛的是普通 ValueError
+    return (isinstance(e, getattr(_req.exceptions, "JSONDecodeError", ()))
+            or not isinstance(e, _req.exceptions.RequestException))
+
+
+def _upload_file_chunked(server_url, headers, fpath, fhash, fext, on_progress=None,
+                         chunk_size=8 * 1024 * 1024, max_retries=8, max_resyncs=5):
+    """分片断点续传上传文件到 HeyGem 服务器文件池。
+
+    断线后重新 create 取得服务器已收到的位置，从断点继续上传（已收到的分片服务器直接跳过）。
+    服务器连续 max_resyncs 次返回 409（进度不一致）时放弃，避免无限重试；
+    只有连接错误、超时和 5xx / 429 按指数退避重试（最多 max_retries 次），其余 4xx 立即失败。
+    on_progress(sent_bytes, total_bytes) 用于刷新界面进度。
+
+    Returns: 服务器返回的 data（含 hash / server_path）；服务器不支持分片接口（旧版本）时返回 None
+    """
+    size = os.path.getsize(fpath)
+    retries = 0
+    resyncs = 0
+    while True:
+        try:
+            resp = _req.post(
+                f"{server_url}/api/heygem/upload/create",
+                json={"hash": fhash, "ext": fext, "size": size, "chunk_size": chunk_size},
+                headers=headers, timeout=30,
+            )
+            if resp.status_code == 404:
+                return None
+            resp.raise_for_status()
+            cdata = resp.json()
+            if cdata.get("code") != 0:
+                raise RuntimeError(cdata.get("msg", "创建上传会话失败"))
+            info = cdata["data"]
+            if info.get("exists"):
+                return info
+
+            upload_id = info["upload_id"]
+            cs = int(info["chunk_size"])
+            index = int(info["next_index"])
+            total = int(info["total_chunks"])
+            if index > 0:
+                safe_print(f"[HEYGEM-ONLINE] 断点续传: {os.path.basename(fpath)} 从第 {index}/{total} 片继续")
+            resync = False
+            with open(fpath, "rb") as f:
+                f.seek(index * cs)
+                while index < total:
+                    chunk = f.read(cs)
+                    r = _req.put(
+                        f"{server_url}/api/heygem/upload/chunk",
+                        params={"upload_id": upload_id, "index": index},
+                        data=chunk, headers=headers, timeout=(30, 300),
+                    )
+                    if r.status_code == 409:
+                        resync = True  # 服务器进度与本地不一致，重新 create 取断点
+                        break
+                    r.raise_for_status()
+                    index += 1
+                    retries = 0
+                    resyncs = 0
+                    if on_progress:
+                        try: on_progress(min(size, index * cs), size)
+                        except Exception: pass
+            if resync:
+                resyncs += 1
+                if resyncs > max_resyncs:
+                    raise RuntimeError(f"上传进度与服务器不一致（已重新同步 {max_resyncs} 次）")
+                continue
+
+            resp = _req.post(f"{server_url}/api/heygem/upload/commit",
+                             json={"upload_id": upload_id}, headers=headers, timeout=60)
+            resp.raise_for_status()
+            cdata = resp.json()
+            if cdata.get("code") != 0:
+                raise RuntimeError(cdata.get("msg", "上传提交失败"))
+            return cdata["data"]
+        except (_req.exceptions.RequestException, ValueError) as e:
+            retries += 1
+            if retries > max_retries or not _upload_error_retryable(e):
+                raise
+            wait = min(30, 2 ** retries)
+            safe_print(f"[HEYGEM-ONLINE] 上传中断，{wait}s 后续传 ({retries}/{max_retries}): {e}")
+            time.sleep(wait)
+
+
 def _sim_wait_stage(elapsed):
     """根据等待时间返回模拟的进度阶段信息（不提及 GPU / 服务器）。
 
@@ -2184,6 +2184,61 @@ def _sim_wait_stage(elapsed):
     return stage, step, pct
 
 
+def _heygem_server_endpoint():
+    """读取在线合成服务器地址（自动补全 http:// 与默认端口 8383）和鉴权头，未配置时地址为空"""
+    server_url = os.getenv("HEYGEM_SERVER_URL", "").strip().rstrip("/")
+    api_secret = os.getenv("HEYGEM_API_SECRET", "").strip()
+    headers = {}
+    if api_secret:
+        headers["Authorization"] = f"Bearer {api_secret}"
+    if not server_url:
+        return "", headers
+    # 自动补全 http:// 前缀
+    if not server_url.startswith("http://") and not server_url.startswith("https://"):
+        server_url = "http://" + server_url
+    # 自动补全端口
+    from urllib.parse import urlparse
+    parsed = urlparse(server_url)
+    if not parsed.port:
+        server_url = server_url.rstrip("/") + ":8383"
+    return server_url, headers
+
+
+def _heygem_online_preupload(video_path, audio_path):
+    """提前把素材传到在线合成服务器文件池（批量流水线的上传阶段）。
+
+    run_heygem_online 提交前会按 hash 检查服务器已有文件，提前传好的文件不会再传；
+    这里失败不影响后续合成（run_heygem_online 会按原流程重新上传）。返回实际上传的文件数。
+    """
+    import requests as _req
+
+    server_url, headers = _heygem_server_endpoint()
+    if not server_url:
+        return 0
+    items = []
+    for fpath in (str(video_path), str(audio_path)):
+        items.append((fpath, _md5_of_local_file(fpath), os.path.splitext(fpath)[1] or ".bin"))
+    try:
+        resp = _req.post(f"{server_url}/api/heygem/check_files",
+                         json={"files": [{"hash": h, "ext": e} for _, h, e in items]},
+                         headers=headers, timeout=15)
+        resp.raise_for_status()
+        existing = resp.json().get("data", {})
+    except Exception as e:
+        safe_print(f"[HEYGEM-ONLINE] 预上传跳过（check_files 失败）: {e}")
+        return 0
+    uploaded = 0
+    for fpath, fhash, fext in items:
+        if existing.get(fhash):
+            continue
+        try:
+            if _upload_file_chunked(server_url, headers, fpath, fhash, fext) is not None:
+                uploaded += 1
+        except Exception as e:
+            safe_print(f"[HEYGEM-ONLINE] 预上传失败 {os.path.basename(fpath)}: {e}")
+    return uploaded
+
+
 def run_heygem_online(video_path, audio_path, progress=gr.Progress(), detail_cb=None,
                       output_path_override=None, **_kw):
     """使用 Linux HeyGem 服务器在线合成口型视频。
@@ -2192,30 +2247,17 @@ def run_heygem_online(video_path, audio_path, progress=gr.Progress(), detail_cb=
     """
     import requests as _req
 
-    server_url = os.getenv("HEYGEM_SERVER_URL", "").strip().rstrip("/")
     api_secret = os.getenv("HEYGEM_API_SECRET", "").strip()
-
+    server_url, headers = _heygem_server_endpoint()
     if not server_url:
         raise gr.Error("HEYGEM_SERVER_URL 未配置，请在设置中配置 Linux HeyGem 服务器地址\n"
                        "格式示例: http://192.168.1.100:8383")
-    # 自动补全 http:// 前缀
-    if not server_url.startswith("http://") and not server_url.startswith("https://"):
-        server_url = "http://" + server_url
-    # 自动补全端口
-    from urllib.parse import urlparse
-    parsed = urlparse(server_url)
-    if not parsed.port:
-        server_url = server_url.rstrip("/") + ":8383"
 
     if not video_path or not os.path.exists(str(video_path)):
         raise gr.Error("视频文件不存在，请重新上传")
     if not audio_path or not os.path.exists(str(audio_path)):
         raise gr.Error("音频文件不存在，请重新选择")
 
-    headers = {}
-    if api_secret:
-        headers["Authorization"] = f"Bearer {api_secret}"
-
     ts = int(time.time())
     out = output_path_override or os.path.join(OUTPUT_DIR, f"lipsync_online_{ts}.mp4")
     t0 = time.time()
@@ -2449,20 +2491,34 @@ def run_heygem_online(video_path, audio_path, progress=gr.Progress(), detail_cb=
                 detail_cb(_dual_progress_html("上传文件", pct, f"{ftype} ({sz//1024}KB)", int(i / max(len(upload_items), 1) * 100), int(time.time() - t0)))
             except Exception: pass
 
+        def _on_upload_progress(sent, total, _ftype=ftype, _pct=pct, _i=i):
+            if detail_cb:
+                try:
+                    detail_cb(_dual_progress_html(
+                        "上传文件", _pct, f"{_ftype} {sent // 1024}/{total // 1024}KB",
+                        int((_i + sent / max(total, 1)) / max(len(upload_items), 1) * 100),
+                        int(time.time() - t0)))
+                except Exception: pass
+
         try:
-            with open(fpath, "rb") as f:
-                resp = _req.post(
-                    f"{server_url}/api/heygem/upload_file",
-                    files={"file": (os.path.basename(fpath), f)},
-                    data={"hash": fhash, "ext": fext},
-                    headers=headers,
-                    timeout=(30, 600),
-                )
-            resp.raise_for_status()
-            udata = resp.json()
-            if udata.get("code") != 0:
-                raise RuntimeError(udata.get("msg", "上传失败"))
-            safe_print(f"[HEYGEM-ONLINE] 上传完成: {ftype} -> {udata.get('data', {}).get('hash')}")
+            udata = _upload_file_chunked(server_url, headers, fpath, fhash, fext,
+                                         on_progress=_on_upload_progress)
+            if udata is None:
+                # 旧版服务器不支持分片接口，回退整文件上传
+                with open(fpath, "rb") as f:
+                    resp = _req.post(
+                        f"{server_url}/api/heygem/upload_file",
+                        files={"file": (os.path.basename(fpath), f)},
+                        data={"hash": fhash, "ext": fext},
+                        headers=headers,
+                        timeout=(30, 600),
+                    )
+                resp.raise_for_status()
+                udata = resp.json()
+                if udata.get("code") != 0:
+                    raise RuntimeError(udata.get("msg", "上传失败"))
+                udata = udata.get("data", {})
+            safe_print(f"[HEYGEM-ONLINE] 上传完成: {ftype} -> {udata.get('hash')}")
         except _req.exceptions.RequestException as e:
             raise gr.Error(f"上传{ftype}到服务器失败: {e}")
 
@@ -2645,33 +2701,33 @@ def run_heygem_online(video_path, audio_path, progress=gr.Progress(), detail_cb=
         safe_print("[HEYGEM-ONLINE] WS 不可用，回退到 HTTP 轮询")
         _poll_progress_http()
 
-    # ── 6) 下载结果 ──
-    try:
-        resp = _req.get(
-            f"{server_url}/api/heygem/download",
-            params={"task_id": task_id},
-            headers=headers,
-            timeout=(15, 600),
-            stream=True,
-        )
-        resp.raise_for_status()
+    # ── 6) 下载结果（断点续传 + ETag 校验，见 libs/lib_download.py）──
+    _dl_last = [0.0]
 
-        # 检查返回类型：如果服务器返回了 JSON 错误而非视频流，提前报错
-        content_type = resp.headers.get("Content-Type", "")
-        if "application/json" in content_type:
-            try:
-                err_data = resp.json()
-                err_msg = err_data.get("msg") or err_data.get("message") or err_data.get("error") or str(err_data)
-            except Exception:
-                err_msg = "服务器返回了非视频数据"
-            raise gr.Error(f"下载失败，服务器返回错误: {err_msg}")
+    def _on_download(done, total):
+        now = time.time()
+        if not detail_cb or not total or now - _dl_last[0] < 0.5:
+            return
+        _dl_last[0] = now
+        try: detail_cb(_dual_progress_html("下载结果", 95, f"{done // 1048576}/{total // 1048576}MB",
+                                           int(done * 100 / total), int(now - t0)))
+        except Exception: pass
 
-        total_size = 0
-        with open(out, "wb") as f:
-            for chunk in resp.iter_content(chunk_size=256 * 1024):
-                if chunk:
-                    f.write(chunk)
-                    total_size += len(chunk)
+    try:
+        import lib_download as _dl
+        try:
+            total_size = _dl.download_resumable(
+                f"{server_url}/api/heygem/download",
+                out,
+                params={"task_id": task_id},
+                headers=headers,
+                timeout=(15, 600),
+                parallel=int(os.getenv("HEYGEM_DOWNLOAD_PARALLEL", "1") or 1),
+                progress_cb=_on_download,
+            )
+        except _dl.DownloadError as e:
+            # 服务器返回了 JSON 错误而非视频流
+            raise gr.Error(f"下载失败，服务器返回错误: {e}")
 
         if not os.path.exists(out) or total_size < 1024:
             detail = f"文件大小: {total_size} bytes" if total_size > 0 else "文件为空"
@@ -2761,14 +2817,48 @@ def generate_speech_batch(text, prompt_audio, out_path,
                   temperature=float(temperature), length_penalty=0.0,
                   num_beams=int(num_beams), repetition_penalty=float(repetition_penalty),
                   max_mel_tokens=int(max_mel_tokens))
-        tts.infer(spk_audio_prompt=prompt_audio, text=text, output_path=out_path,
-                  emo_audio_prompt=None, emo_alpha=0.5,
-                  emo_vector=None, use_emo_text=False, emo_text=None, use_random=False, **kw)
+        _tts_infer_cached(text, prompt_audio, out_path,
+                          dict(emo_audio_prompt=None, emo_alpha=0.5, emo_vector=None, use_emo_text=False,
+                               emo_text=None, use_random=False, **kw))
         return out_path
     finally:
         os.chdir(cwd)
 
 
+_BT_STATE_FILE = "batch_state.json"
+
+
+def _bt_signature(tasks, shared_video):
+    """批量任务指纹（任务内容 + 公共视频），用于找回上次未完成的同一批任务"""
+    keys = ("name", "audio_mode", "text", "ref_audio", "audio_path", "video_mode", "video_path", "avatar_name")
+    data = [{k: t.get(k) for k in keys} for t in tasks]
+    return hashlib.md5(json.dumps([data, str(shared_video or "")], ensure_ascii=False,
+                                  sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _bt_find_resumable(signature):
+    """在 OUTPUT_DIR 中查找同一批任务最近一次未全部完成的批量目录，没有则返回 None"""
+    found = []
+    try:
+        names = os.listdir(OUTPUT_DIR)
+    except OSError:
+        return None
+    for nm in names:
+        path = os.path.join(OUTPUT_DIR, nm, _BT_STATE_FILE)
+        if not os.path.isfile(path):
+            continue
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if data.get("signature") != signature:
+            continue
+        if any(t.get("error") or "lipsync" not in t.get("done_stages", []) for t in data.get("tasks", [])):
+            found.append((os.path.getmtime(path), os.path.dirname(path)))
+    return max(found)[1] if found else None
+
+
 def _render_task_list(tasks):
     if not tasks:
         return ('<div style="text-align:center;padding:28px 16px;color:#94a3b8;'
@@ -3948,9 +4038,18 @@ def build_ui():
                     inputs=[bt_tasks_state, bt_del_trigger],
                     outputs=[bt_tasks_state, bt_task_list_html])
 
-                # ── 事件：清空队列 ──
-                bt_clear_btn.click(
-                    lambda: ([], _render_task_list([]), "", gr.update(visible=False)),
+                # ── 事件：清空队列（批量运行中则停止：不再开始新阶段，并取消正在进行的本地口型合成）──
+                _bt_active = {"pipe": None}
+
+                def _bt_clear():
+                    pipe = _bt_active["pipe"]
+                    if pipe is not None:
+                        pipe.stop()
+                        cancel_heygem()
+                        return [], _render_task_list([]), "", gr.update()
+                    return [], _render_task_list([]), "", gr.update(visible=False)
+
+                bt_clear_btn.click(_bt_clear,
                     outputs=[bt_tasks_state, bt_task_list_html, bt_add_hint, bt_progress_html])
 
                 # ── 事件：开始批量生成 ──
@@ -3967,10 +4066,14 @@ def build_ui():
                                f"有 {sc} 个任务设置为「使用公共视频」，请先在右上角上传公共人物视频！")),
                                gr.update(), gr.update()); return
 
-                    ts_str = time.strftime("%Y%m%d_%H%M%S")
-                    safe_nm = re.sub(r'[\\/:*?"<>|]', '', batch_name.strip()) if batch_name.strip() else ""
-                    folder_name = f"{ts_str}_{safe_nm}" if safe_nm else ts_str
-                    batch_dir   = os.path.join(OUTPUT_DIR, folder_name)
+                    # 同一批任务上次未跑完时沿用原目录，已完成的阶段直接跳过
+                    signature = _bt_signature(tasks, shared_video)
+                    batch_dir = _bt_find_resumable(signature)
+                    if not batch_dir:
+                        ts_str = time.strftime("%Y%m%d_%H%M%S")
+                        safe_nm = re.sub(r'[\\/:*?"<>|]', '', batch_name.strip()) if batch_name.strip() else ""
+                        folder_name = f"{ts_str}_{safe_nm}" if safe_nm else ts_str
+                        batch_dir   = os.path.join(OUTPUT_DIR, folder_name)
                     os.makedirs(batch_dir, exist_ok=True)
                     import copy
                     rt    = copy.deepcopy(tasks)
@@ -3981,51 +4084,110 @@ def build_ui():
                                 gr.update(visible=True, value=_render_task_list(rt)),
                                 gr.update())
 
+                    online = os.getenv("HEYGEM_MODE", "local").strip().lower() == "online"
+                    # 告知 TTS 驻留管理器后面还有多少个 TTS 任务（有需求时视频合成期间模型只降到内存）
+                    tts_left = [sum(1 for t in rt if t.get("audio_mode") == "tts")]
+                    _tts_res.set_demand(tts_left[0])
+                    _noop_progress = lambda *a, **k: None  # 工作线程里不能驱动 gr.Progress
+
+                    def _st_audio(ctx):
+                        idx = ctx["idx"]
+                        if ctx.get("audio_mode") == "tts":
+                            ao = os.path.join(batch_dir, f"音频_{idx}.wav")
+                            try:
+                                generate_speech_batch(ctx["text"], ctx["ref_audio"], ao)
+                            finally:
+                                tts_left[0] -= 1
+                                _tts_res.set_demand(tts_left[0])
+                            ctx["audio"] = ao
+                        else:
+                            ap = ctx.get("audio_path")
+                            if not ap or not os.path.exists(ap):
+                                raise RuntimeError("音频文件不存在")
+                            ext = os.path.splitext(ap)[1]
+                            dst = os.path.join(batch_dir, f"音频_{idx}{ext}")
+                            shutil.copy2(ap, dst)
+                            ctx["audio"] = dst
+                        # 确定视频来源：优先使用数字人库，其次公共视频，最后专属视频
+                        avatar_name = ctx.get("avatar_name")
+                        if avatar_name and _LIBS_OK:
+                            # 从数字人库获取视频路径
+                            vp = _av.get_path(avatar_name)
+                            if not vp or not os.path.exists(vp):
+                                raise RuntimeError(f"数字人「{avatar_name}」视频不存在")
+                        elif ctx.get("video_mode") == "shared":
+                            if not shared_video or not os.path.exists(shared_video):
+                                raise RuntimeError("公共视频未上传")
+                            vp = shared_video
+                        else:
+                            vp = ctx.get("video_path")
+                            if not vp or not os.path.exists(vp):
+                                raise RuntimeError("专属视频不存在")
+                        ctx["video"] = str(vp)
+
+                    def _st_upload(ctx):
+                        _heygem_online_preupload(ctx["video"], ctx["audio"])
+
+                    def _st_lipsync(ctx):
+                        op = os.path.join(batch_dir, f"任务{ctx['idx']}.mp4")
+                        run_heygem_auto(ctx["video"], ctx["audio"], progress=_noop_progress,
+                                        output_path_override=op, steps=12, if_gfpgan=False)
+                        ctx["output"] = op
+
+                    # 本地版 TTS 与本地口型合成都占用本机 GPU，不能同时运行；在线合成时两者重叠
+                    stages = [_bp.Stage("audio", _st_audio, 1, ("gpu",),
+                                        check=lambda c: os.path.exists(c.get("audio", "")))]
+                    if online:
+                        stages.append(_bp.Stage("upload", _st_upload, 1))
+                        stages.append(_bp.Stage("lipsync", _st_lipsync,
+                                                max(1, int(os.getenv("HEYGEM_BATCH_CONCURRENCY", "2") or 2)),
+                                                check=lambda c: os.path.exists(c.get("output", ""))))
+                    else:
+                        stages.append(_bp.Stage("lipsync", _st_lipsync, 1, ("gpu",),
+                                                check=lambda c: os.path.exists(c.get("output", ""))))
+                    pipe = _bp.Pipeline(stages, state_path=os.path.join(batch_dir, _BT_STATE_FILE),
+                                        signature=signature)
+                    stage_desc = {"audio": "合成语音", "upload": "上传素材", "lipsync": "视频合成"}
+
                     yield _y(0,"运行中","准备开始，加载资源中...")
-                    for i,task in enumerate(rt):
-                        idx = i+1; tn = task.get("name",f"任务{idx}")
-                        rt[i]["status"] = "进行中"
-                        yield _y(i,"运行中",f"▶ 正在处理 {tn}（{idx}/{total}）")
-                        try:
-                            if task.get("audio_mode") == "tts":
-                                ao = os.path.join(batch_dir, f"音频_{idx}.wav")
-                                progress(0.1, desc=f"[{idx}/{total}] {tn} — 合成语音...")
-                                generate_speech_batch(task["text"], task["ref_audio"], ao)
-                                ap = ao
-                            else:
-                                ap = task.get("audio_path")
-                                if not ap or not os.path.exists(ap):
-                                    raise RuntimeError("音频文件不存在")
-                                ext = os.path.splitext(ap)[1]
-                                dst = os.path.join(batch_dir, f"音频_{idx}{ext}")
-                                shutil.copy2(ap, dst); ap = dst
-                            # 确定视频来源：优先使用数字人库，其次公共视频，最后专属视频
-                            avatar_name = task.get("avatar_name")
-                            if avatar_name and _LIBS_OK:
-                                # 从数字人库获取视频路径
-                                vp = _av.get_path(avatar_name)
-                                if not vp or not os.path.exists(vp):
-                                    raise RuntimeError(f"数字人「{avatar_name}」视频不存在")
-                            elif task.get("video_mode") == "shared":
-                                if not shared_video or not os.path.exists(shared_video):
-                                    raise RuntimeError("公共视频未上传")
-                                vp = shared_video
-                            else:
-                                vp = task.get("video_path")
-                                if not vp or not os.path.exists(vp):
-                                    raise RuntimeError("专属视频不存在")
-                            op = os.path.join(batch_dir, f"任务{idx}.mp4")
-                            progress(0.3, desc=f"[{idx}/{total}] {tn} — 视频合成...")
-                            run_heygem_auto(vp, ap, output_path_override=op, steps=12, if_gfpgan=False)
-                            rt[i]["status"] = "✅ 完成"
-                            yield _y(idx,"运行中",f"✅ {tn} 完成 → 任务{idx}.mp4")
-                        except Exception as e:
-                            rt[i]["status"] = "❌ 失败"
-                            yield _y(i,"运行中",f"❌ {tn} 失败：{str(e)[:80]}")
+                    done = 0
+                    finished = False
+                    _bt_active["pipe"] = pipe
+                    try:
+                        for ev in pipe.run([dict(t, id=str(i + 1), idx=i + 1) for i, t in enumerate(rt)]):
+                            if ev.get("status") == "finished":
+                                finished = True
+                                break
+                            i = ev["index"]; idx = i + 1; tn = rt[i].get("name", f"任务{idx}")
+                            st = ev["status"]
+                            if st == "start":
+                                rt[i]["status"] = "进行中"
+                                progress(done / total, desc=f"[{idx}/{total}] {tn} — {stage_desc[ev['stage']]}...")
+                                yield _y(done,"运行中",f"▶ {tn}（{idx}/{total}）{stage_desc[ev['stage']]}中")
+                            elif st == "failed":
+                                rt[i]["status"] = "❌ 失败"
+                                done += 1
+                                yield _y(done,"运行中",f"❌ {tn} 失败：{str(ev.get('error', ''))[:80]}")
+                            elif ev["stage"] == "lipsync":
+                                rt[i]["status"] = "✅ 完成"
+                                done += 1
+                                note = "（上次已完成）" if st == "skip" else ""
+                                yield _y(done,"运行中",f"✅ {tn} 完成 → 任务{idx}.mp4{note}")
+                    finally:
+                        stopped = pipe.stopped  # 清空队列时已停止
+                        pipe.stop()
+                        if not finished:
+                            cancel_heygem()  # 页面关闭 / 出错中断时不让本地合成在后台继续跑
+                        if _bt_active["pipe"] is pipe:
+                            _bt_active["pipe"] = None
+                        _tts_res.set_demand(0)
 
                     dc = sum(1 for t in rt if t["status"]=="✅ 完成")
                     fc = total-dc
-                    fm = f"全部完成！成功 {dc} 个" + (f"，失败 {fc} 个" if fc else "")
+                    if stopped:
+                        fm = f"已停止：成功 {dc} 个" + (f"，未完成 {fc} 个" if fc else "")
+                    else:
+                        fm = f"全部完成！成功 {dc} 个" + (f"，失败 {fc} 个" if fc else "")
                     yield (gr.update(visible=True, value=_render_batch_prog(total,total,"","已完成",fm,batch_dir)),
                            gr.update(visible=True, value=_render_task_list(rt)),
                            gr.update(value=[]))
@@ -5146,7 +5308,6 @@ def build_ui():
         # ── TTS 模式切换事件 ──
         def _on_tts_mode_switch(mode_choice):
             """切换TTS模式：更新环境变量、音色列表，并在需要时加载模型"""
-            global tts, _tts_on_gpu
             
             # 解析模式
             mode = "local" if "本地版" in mode_choice else "online"
@@ -5163,27 +5324,13 @@ def build_ui():
             
             # 如果切换到本地版且模型未加载，则加载模型
             if mode == "local" and tts is None:
-                try:
-                    safe_print("[TTS_MODE] 检测到切换到本地版，开始加载 TTS 模型...")
-                    model_dir = os.path.join(FUNCOSYVOICE_DIR, "checkpoints")
-                    if os.path.exists(model_dir):
-                        original_cwd = os.getcwd()
-                        os.chdir(FUNCOSYVOICE_DIR)
-                        try:
-                            from indextts.infer_v2 import IndexTTS2
-                            tts = IndexTTS2(model_dir=model_dir,
-                                          cfg_path=os.path.join(model_dir, "config.yaml"), 
-                                          use_fp16=True)
-                            _tts_on_gpu = True
-                            safe_print("[TTS_MODE] TTS 模型加载完成")
-                        finally:
-                            os.chdir(original_cwd)
-                    else:
-                        safe_print("[TTS_MODE] 模型目录不存在，无法加载")
-                except Exception as e:
-                    safe_print(f"[TTS_MODE] 模型加载失败: {e}")
-                    import traceback
-                    traceback.print_exc()
+                # 模型可能还在内存中（视频合成时降级），由驻留管理器决定设备拷贝还是从磁盘加载
+                safe_print("[TTS_MODE] 检测到切换到本地版，开始加载 TTS 模型...")
+                _restore_tts_gpu()
+                if tts is not None:
+                    safe_print("[TTS_MODE] TTS 模型加载完成")
+                else:
+                    safe_print("[TTS_MODE] 模型加载失败")
             
             # 更新音色列表（根据模式过滤）
             filter_mode = mode  # "local" 或 "online"
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+资产存储（引用计数 + 连接池 + 延迟删除）
+======================================
+upload_asset 按 MD5 把文件去重存到 STORE_DIR/{hash}{ext}，但 delete_asset 直接删除这个共享文件：
+两个用户（或同一用户的两条资产记录）指向同一内容时，删掉一条另一条就坏了。
+每个请求还要在全局 _db_lock 下新建一个 SQLite 连接，所有资产请求串行。
+
+本模块：
+  1. blobs 表按 (file_hash, file_ext) 记录引用计数；增删资产记录与引用计数在同一事务里更新
+  2. 删除 / 过期只把引用计数减到 0 并记下时间，物理删除由 gc() 统一执行（宽限期后、
+     且调用方确认没有任务还在用这个文件）
+  3. 连接池：WAL 模式，每个线程借用一个连接用完归还，写事务用 BEGIN IMMEDIATE + busy_timeout，
+     不再需要全局锁
+  4. list() 走 (license_key, asset_type, created_at) 索引分页
+
+已有 assets.db 首次打开时按现有资产记录重建引用计数。
+
+并发自检（50 个线程上传 / 删除重叠内容）：
+  python asset_store.py
+"""
+
+import logging
+import os
+import queue
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class AssetStore:
+    """资产记录 + 引用计数 blob"""
+
+    def __init__(self, db_path: str, store_path: Callable[[str, str], str],
+                 pool_size: int = 16, gc_grace: float = 600):
+        """
+        Args:
+            db_path: assets.db 路径
+            store_path: (file_hash, file_ext) -> 统一存储中的文件路径
+            pool_size: 连接池保留的最大空闲连接数
+            gc_grace: 引用计数归零后至少保留多久（秒）才允许物理删除
+        """
+        self.db_path = db_path
+        self.store_path = store_path
+        self.gc_grace = gc_grace
+        self._pool: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue(maxsize=pool_size)
+        with self._db() as conn:
+            conn.executescript("""
+            CREATE TABLE IF NOT EXISTS assets (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                license_key TEXT NOT NULL,
+                asset_type TEXT NOT NULL,          -- 'voice' | 'avatar'
+                name TEXT NOT NULL,
+                file_hash TEXT NOT NULL,
+                file_ext TEXT NOT NULL DEFAULT '',
+                file_path TEXT NOT NULL,
+                file_size INTEGER DEFAULT 0,
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_assets_key_type ON assets(license_key, asset_type);
+            CREATE INDEX IF NOT EXISTS idx_assets_expires ON assets(expires_at);
+            CREATE INDEX IF NOT EXISTS idx_assets_list ON assets(license_key, asset_type, created_at);
+            CREATE INDEX IF NOT EXISTS idx_assets_list_all ON assets(license_key, created_at);
+            """)
+            has_blobs = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name='blobs'").fetchone()
+            if not has_blobs:
+                conn.executescript("""
+                BEGIN IMMEDIATE;
+                CREATE TABLE blobs (
+                    file_hash TEXT NOT NULL,
+                    file_ext TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    size INTEGER DEFAULT 0,
+                    refcount INTEGER NOT NULL DEFAULT 0,
+                    zero_since REAL NOT NULL DEFAULT 0,
+                    PRIMARY KEY (file_hash, file_ext)
+                );
+                CREATE INDEX idx_blobs_gc ON blobs(refcount, zero_since);
+                CREATE INDEX idx_blobs_path ON blobs(path);
+                INSERT INTO blobs (file_hash, file_ext, path, size, refcount)
+                    SELECT file_hash, file_ext, MAX(file_path), MAX(file_size), COUNT(*)
+                    FROM assets GROUP BY file_hash, file_ext;
+                COMMIT;
+                """)
+                logger.info("[AssetStore] 已按现有资产记录建立引用计数")
+        logger.info(f"[AssetStore] 资产库就绪: {db_path}")
+
+    # ── 连接池 ──
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        return conn
+
+    @contextmanager
+    def _db(self):
+        """借出一个连接（同一时刻只被一个线程使用），用完归还连接池"""
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            try:
+                self._pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    @contextmanager
+    def _write(self):
+        """写事务：BEGIN IMMEDIATE 先拿写锁，避免并发事务读后写冲突"""
+        with self._db() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            yield conn
+            conn.execute("COMMIT")
+
+    # ── 资产记录 ──
+
+    def find(self, license_key: str, asset_type: str, file_hash: str, file_ext: str) -> Optional[sqlite3.Row]:
+        """同一 license + type + 内容的未过期资产（上传去重）"""
+        with self._db() as conn:
+            return conn.execute(
+                "SELECT id, name, file_size, file_hash, file_ext, file_path FROM assets "
+                "WHERE license_key=? AND asset_type=? AND file_hash=? AND file_ext=? AND expires_at>? "
+                "ORDER BY created_at DESC LIMIT 1",
+                (license_key, asset_type, file_hash, file_ext, time.time())).fetchone()
+
+    def add(self, license_key: str, asset_type: str, name: str, file_hash: str, file_ext: str,
+            file_size: int, ttl: float, source_path: str = "") -> Tuple[int, str]:
+        """登记一条资产记录并增加 blob 引用，返回 (asset_id, 存储路径)
+
+        source_path 为刚上传的文件：存储中已有同内容文件时删除它，否则移动到存储路径。
+        放在写事务内完成，gc() 不会在两者之间删掉存储文件。
+        """
+        dest = self.store_path(file_hash, file_ext)
+        now = time.time()
+        with self._write() as conn:
+            if source_path and os.path.exists(source_path):
+                if os.path.exists(dest) and os.path.getsize(dest) > 0:
+                    os.remove(source_path)
+                else:
+                    shutil.move(source_path, dest)
+            if not os.path.exists(dest):
+                raise FileNotFoundError(f"存储文件不存在: {dest}")
+            cur = conn.execute(
+                "INSERT INTO assets (license_key, asset_type, name, file_hash, file_ext, file_path, file_size, "
+                "created_at, expires_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (license_key, asset_type, name, file_hash, file_ext, dest, file_size, now, now + ttl))
+            conn.execute(
+                "INSERT INTO blobs (file_hash, file_ext, path, size, refcount, zero_since) VALUES (?, ?, ?, ?, 1, 0) "
+                "ON CONFLICT(file_hash, file_ext) DO UPDATE SET refcount=refcount+1, zero_since=0, path=excluded.path",
+                (file_hash, file_ext, dest, file_size))
+            return cur.lastrowid, dest
+
+    def _release(self, conn, rows: Iterable[sqlite3.Row], now: float):
+        counts = {}
+        for r in rows:
+            k = (r["file_hash"], r["file_ext"])
+            counts[k] = counts.get(k, 0) + 1
+        for (h, ext), n in counts.items():
+            conn.execute(
+                "UPDATE blobs SET refcount=MAX(refcount-?, 0), "
+                "zero_since=CASE WHEN refcount-?<=0 THEN ? ELSE 0 END WHERE file_hash=? AND file_ext=?",
+                (n, n, now, h, ext))
+
+    def remove(self, asset_id: int, license_key: str) -> bool:
+        """删除一条资产记录（只减引用计数，文件由 gc 删除），不存在返回 False"""
+        with self._write() as conn:
+            row = conn.execute("SELECT file_hash, file_ext FROM assets WHERE id=? AND license_key=?",
+                               (asset_id, license_key)).fetchone()
+            if row is None:
+                return False
+            conn.execute("DELETE FROM assets WHERE id=?", (asset_id,))
+            self._release(conn, [row], time.time())
+            return True
+
+    def expire(self, now: Optional[float] = None) -> int:
+        """删除过期资产记录并释放引用，返回删除条数"""
+        now = now or time.time()
+        with self._write() as conn:
+            rows = conn.execute("SELECT file_hash, file_ext FROM assets WHERE expires_at<?", (now,)).fetchall()
+            if rows:
+                conn.execute("DELETE FROM assets WHERE expires_at<?", (now,))
+                self._release(conn, rows, time.time())
+            return len(rows)
+
+    def list(self, license_key: str, asset_type: str = "", limit: int = 0,
+             offset: int = 0) -> Tuple[List[sqlite3.Row], int]:
+        """按创建时间倒序分页列出未过期资产，返回 (本页记录, 总数)；limit=0 表示不分页"""
+        now = time.time()
+        where = "license_key=? AND expires_at>?"
+        params = [license_key, now]
+        if asset_type:
+            where = "license_key=? AND asset_type=? AND expires_at>?"
+            params = [license_key, asset_type, now]
+        page = f" LIMIT {int(limit)} OFFSET {int(offset)}" if limit > 0 else ""
+        with self._db() as conn:
+            rows = conn.execute(
+                "SELECT id, asset_type, name, file_hash, file_ext, file_size, created_at, expires_at "
+                f"FROM assets WHERE {where} ORDER BY created_at DESC, id DESC{page}", params).fetchall()
+            if limit > 0:
+                total = conn.execute(f"SELECT COUNT(*) FROM assets WHERE {where}", params).fetchone()[0]
+            else:
+                total = len(rows)
+        return rows, total
+
+    # ── 引用与回收 ──
+
+    def referenced_paths(self, paths: List[str]) -> Set[str]:
+        """paths 中仍被资产引用（引用计数 > 0）的存储路径"""
+        if not paths:
+            return set()
+        with self._db() as conn:
+            rows = conn.execute(
+                f"SELECT path FROM blobs WHERE refcount>0 AND path IN ({', '.join('?' * len(paths))})",
+                list(paths)).fetchall()
+        return {r["path"] for r in rows}
+
+    def gc(self, in_use: Optional[Callable[[List[str]], Set[str]]] = None, limit: int = 500) -> int:
+        """物理删除引用计数归零超过宽限期的 blob，返回删除个数
+
+        in_use(paths) 返回仍被其它地方（排队中的任务等）使用的路径，这些 blob 留到下一轮。
+        """
+        cutoff = time.time() - self.gc_grace
+        with self._db() as conn:
+            rows = conn.execute(
+                "SELECT file_hash, file_ext, path FROM blobs WHERE refcount=0 AND zero_since<? LIMIT ?",
+                (cutoff, limit)).fetchall()
+        if not rows:
+            return 0
+        busy = in_use([r["path"] for r in rows]) if in_use else set()
+        removed = 0
+        with self._write() as conn:
+            for r in rows:
+                if r["path"] in busy:
+                    continue
+                # 事务内复查：借出连接与拿到写锁之间可能有新的引用
+                cur = conn.execute("DELETE FROM blobs WHERE file_hash=? AND file_ext=? AND refcount=0",
+                                   (r["file_hash"], r["file_ext"]))
+                if cur.rowcount:
+                    try:
+                        os.remove(r["path"])
+                    except FileNotFoundError:
+                        pass
+                    removed += 1
+        if removed:
+            logger.info(f"[AssetStore] 回收无引用文件 {removed} 个")
+        return removed
+
+    def check(self) -> List[str]:
+        """一致性检查：引用计数与资产记录数不符、或有引用但文件缺失的 blob"""
+        problems = []
+        with self._db() as conn:
+            for r in conn.execute(
+                    "SELECT b.file_hash, b.file_ext, b.path, b.refcount, "
+                    "(SELECT COUNT(*) FROM assets a WHERE a.file_hash=b.file_hash AND a.file_ext=b.file_ext) AS n "
+                    "FROM blobs b"):
+                if r["refcount"] != r["n"]:
+                    problems.append(f"{r['file_hash']}{r['file_ext']}: refcount={r['refcount']} 记录数={r['n']}")
+                if r["refcount"] > 0 and not os.path.exists(r["path"]):
+                    problems.append(f"{r['file_hash']}{r['file_ext']}: 文件缺失")
+        return problems
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+# 并发自检：50 个线程对 8 份重叠内容反复上传 / 删除，期间不断 gc；结束时引用计数与文件必须一致
+if __name__ == "__main__":
+    import hashlib
+    import random
+    import tempfile
+    import uuid
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    THREADS, OPS, CONTENTS = 50, 60, 8
+
+    with tempfile.TemporaryDirectory() as d:
+        store = os.path.join(d, "store")
+        os.makedirs(store)
+        assets = AssetStore(os.path.join(d, "assets.db"),
+                            lambda h, e: os.path.join(store, f"{h}{e}"), gc_grace=0)
+        payloads = [os.urandom(2048) + bytes([i]) for i in range(CONTENTS)]
+        hashes = [hashlib.md5(p).hexdigest() for p in payloads]
+        broken = []
+        errors = []
+
+        def worker(n):
+            rnd = random.Random(n)
+            mine = []
+            for _ in range(OPS):
+                try:
+                    if mine and rnd.random() < 0.45:
+                        assets.remove(mine.pop(rnd.randrange(len(mine))), f"user{n % 5}")
+                    else:
+                        i = rnd.randrange(CONTENTS)
+                        tmp = os.path.join(store, f"_tmp_{uuid.uuid4().hex}.wav")
+                        with open(tmp, "wb") as f:
+                            f.write(payloads[i])
+                        aid, path = assets.add(f"user{n % 5}", "voice", f"v{i}", hashes[i], ".wav",
+                                               len(payloads[i]), ttl=3600, source_path=tmp)
+                        mine.append(aid)
+                        # 其它用户删除同内容后，自己的资产文件必须仍然可读
+                        with open(path, "rb") as f:
+                            if f.read() != payloads[i]:
+                                broken.append(aid)
+                    if rnd.random() < 0.1:
+                        assets.gc()
+                except Exception as e:
+                    errors.append(repr(e))
+
+        t0 = time.perf_counter()
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(THREADS)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        dt = time.perf_counter() - t0
+        assets.gc()
+        problems = assets.check()
+        with assets._db() as conn:
+            live = conn.execute("SELECT COUNT(*) FROM assets").fetchone()[0]
+            live_blobs = conn.execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+        files = sum(1 for fn in os.listdir(store) if not fn.startswith("_tmp_"))
+        rows, total = assets.list("user0", "voice", limit=5, offset=5)
+        print(f"{THREADS} 线程 × {OPS} 次操作: {dt:.2f}s, 异常={len(errors)} {errors[:3]}, 读坏={len(broken)}")
+        print(f"剩余资产 {live} 条, blob {live_blobs} 个, 存储文件 {files} 个, 一致性问题={problems}")
+        print(f"分页: user0 第 2 页 {len(rows)} 条 / 共 {total} 条")
+        assets.expire(time.time() + 7200)  # 全部过期 → 引用归零 → gc 回收全部文件
+        assets.gc()
+        files = sum(1 for fn in os.listdir(store) if not fn.startswith("_tmp_"))
+        print(f"全部过期后 gc: 剩余存储文件 {files} 个, 一致性问题={assets.check()}")
+        assets.close()
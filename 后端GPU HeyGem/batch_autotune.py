@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+推理 batch_size 自动调优
+========================
+config.ini [digital] batch_size = 8 对所有显卡、分辨率、视频长度一刀切：小显存卡 OOM，大显存卡吃不满。
+
+BatchAutotuner：
+  1. 校准：在一段短校准片段上按候选值（1, 2, 4, 8, ...）从小到大测吞吐（帧/秒）；
+     OOM 时停止上探并记下 OOM 上限，吞吐连续两档提升不足 min_gain 时提前结束，取吞吐最高者；
+     各档吞吐相差都不到 min_gain（batch_size 对引擎没有可测的影响，差异只是计时噪声）时记为配置默认值
+  2. 结果按 (设备, 分辨率档位, 引擎版本) 写入 batch_tuning.db，重启后直接使用
+  3. choose()：_run_task 按任务所在设备与输入分辨率选 batch_size；未校准的档位用配置默认值，
+     但不超过已知的 OOM 上限
+  4. report_oom()：正式任务 OOM 时把该档位的值减半并记下上限（调用方以新值重试）
+
+本模块不依赖 GPU：校准只需要一个 run_batch(batch_size) -> 帧数 的回调。
+CPU 上用模拟模型（耗时、显存占用都是 batch_size 的函数）验证：
+  python batch_autotune.py
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import subprocess
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CANDIDATES = (1, 2, 4, 8, 16, 32)
+# 分辨率档位：按短边向上取整
+_BUCKETS = (360, 480, 720, 1080, 1440, 2160)
+
+
+def resolution_bucket(width: int, height: int) -> str:
+    short = min(width, height) if width > 0 and height > 0 else max(width, height)
+    for b in _BUCKETS:
+        if short <= b:
+            return f"{b}p"
+    return f"{_BUCKETS[-1]}p+"
+
+
+def bucket_height(bucket: str) -> int:
+    return int(bucket.rstrip("p+"))
+
+
+def is_oom(error) -> bool:
+    """异常或引擎错误信息是否为显存 / 内存不足"""
+    if isinstance(error, MemoryError):
+        return True
+    if type(error).__name__ == "OutOfMemoryError":  # torch.cuda.OutOfMemoryError
+        return True
+    text = str(error).lower()
+    return "out of memory" in text or "cuda_error_out_of_memory" in text or "failed to allocate memory" in text
+
+
+_device_names: Dict[str, str] = {}
+_device_lock = threading.Lock()
+
+
+def device_key(device: str) -> str:
+    """设备槽位 + 显卡型号 + 显存（换卡后自动重新校准）；无 nvidia-smi 时只用槽位"""
+    device = str(device)
+    with _device_lock:
+        if device not in _device_names:
+            name = ""
+            try:
+                p = subprocess.run(["nvidia-smi", "--query-gpu=name,memory.total", "--format=csv,noheader",
+                                    "-i", device.split(",")[0]], capture_output=True, text=True, timeout=10)
+                if p.returncode == 0:
+                    name = p.stdout.strip().splitlines()[0].replace(", ", ":")
+            except Exception:
+                pass
+            _device_names[device] = f"{device}:{name}" if name else device
+        return _device_names[device]
+
+
+class BatchAutotuner:
+    """batch_size 校准结果（SQLite）与按任务选择"""
+
+    def __init__(self, db_path: str, default: int = 8, candidates: Sequence[int] = DEFAULT_CANDIDATES,
+                 min_gain: float = 0.05, engine_version: str = "1"):
+        self.default = max(1, int(default))
+        self.candidates = sorted({max(1, int(c)) for c in candidates})
+        self.min_gain = min_gain
+        self.engine_version = str(engine_version)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tuning ("
+            " device TEXT NOT NULL, bucket TEXT NOT NULL, engine_version TEXT NOT NULL,"
+            " batch_size INTEGER NOT NULL, fps REAL NOT NULL DEFAULT 0, oom_at INTEGER NOT NULL DEFAULT 0,"
+            " samples TEXT NOT NULL DEFAULT '{}', tuned_at REAL NOT NULL,"
+            " PRIMARY KEY (device, bucket, engine_version))")
+
+    # ── 查询 ──
+
+    def get(self, device: str, bucket: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT batch_size, fps, oom_at, samples, tuned_at FROM tuning"
+                " WHERE device = ? AND bucket = ? AND engine_version = ?",
+                (device, bucket, self.engine_version)).fetchone()
+        if not row:
+            return None
+        return {"batch_size": row[0], "fps": row[1], "oom_at": row[2],
+                "samples": json.loads(row[3] or "{}"), "tuned_at": row[4]}
+
+    def is_tuned(self, device: str, bucket: str) -> bool:
+        rec = self.get(device, bucket)
+        return bool(rec and rec["fps"] > 0)
+
+    def choose(self, device: str, width: int, height: int) -> int:
+        """任务使用的 batch_size：已校准值 > 配置默认值（不超过已知 OOM 上限）"""
+        rec = self.get(device, resolution_bucket(width, height))
+        if rec is None:
+            return self.default
+        if rec["fps"] > 0:
+            return rec["batch_size"]
+        return min(self.default, rec["batch_size"])
+
+    def table(self) -> List[dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT device, bucket, batch_size, fps, oom_at, tuned_at FROM tuning WHERE engine_version = ?"
+                " ORDER BY device, bucket", (self.engine_version,)).fetchall()
+        return [{"device": r[0], "bucket": r[1], "batch_size": r[2], "fps": round(r[3], 2),
+                 "oom_at": r[4], "tuned_at": r[5]} for r in rows]
+
+    # ── 写入 ──
+
+    def _save(self, device, bucket, batch_size, fps, oom_at, samples):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO tuning (device, bucket, engine_version, batch_size, fps, oom_at,"
+                " samples, tuned_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (device, bucket, self.engine_version, batch_size, fps, oom_at,
+                 json.dumps({str(k): round(v, 3) for k, v in samples.items()}), time.time()))
+
+    def calibrate(self, device: str, bucket: str, run_batch: Callable[[int], float]) -> int:
+        """按候选值测吞吐并保存最优值；run_batch(batch_size) 跑一遍校准片段并返回处理的帧数，OOM 时抛异常"""
+        prev = self.get(device, bucket)
+        ceiling = (prev["oom_at"] - 1) if prev and prev["oom_at"] else None
+        samples: Dict[int, float] = {}
+        oom_at = prev["oom_at"] if prev else 0
+        best_bs, best_fps, flat = 0, 0.0, 0
+        for bs in self.candidates:
+            if ceiling is not None and bs > ceiling:
+                break
+            t0 = time.perf_counter()
+            try:
+                frames = run_batch(bs)
+            except Exception as e:
+                if not is_oom(e):
+                    raise
+                oom_at = bs
+                logger.info(f"[Autotune] {device} {bucket} batch={bs} OOM，停止上探")
+                break
+            fps = frames / max(time.perf_counter() - t0, 1e-6)
+            samples[bs] = fps
+            logger.info(f"[Autotune] {device} {bucket} batch={bs} {fps:.1f} fps")
+            if fps > best_fps * (1 + self.min_gain):
+                flat = 0
+            else:
+                flat += 1
+            if fps > best_fps:
+                best_bs, best_fps = bs, fps
+            if flat >= 2:
+                break
+        if not samples:
+            # 最小候选值也 OOM：记 1 并保留上限，任务仍可尝试
+            self._save(device, bucket, 1, 0.0, oom_at, samples)
+            return 1
+        if len(samples) >= 2 and max(samples.values()) < min(samples.values()) * (1 + self.min_gain):
+            # 吞吐与 batch_size 无关：引擎很可能没有读到设置的值，不能把噪声里的“最优”存下来
+            logger.warning(f"[Autotune] {device} {bucket} 各 batch_size 吞吐差异 < {self.min_gain:.0%}，"
+                           f"batch_size 设置可能未生效，记为默认值 {self.default}")
+            self._save(device, bucket, self.default, 0.0, oom_at, samples)
+            return self.default
+        self._save(device, bucket, best_bs, best_fps, oom_at, samples)
+        logger.info(f"[Autotune] {device} {bucket} 最优 batch_size={best_bs} ({best_fps:.1f} fps)")
+        return best_bs
+
+    def report_oom(self, device: str, bucket: str, batch_size: int) -> int:
+        """正式任务在 batch_size 下 OOM：该档位减半并记下上限，返回新值（1 时无法再降）"""
+        new = max(1, batch_size // 2)
+        rec = self.get(device, bucket)
+        oom_at = min(batch_size, rec["oom_at"]) if rec and rec["oom_at"] else batch_size
+        self._save(device, bucket, new, rec["fps"] if rec and rec["batch_size"] == new else 0.0,
+                   oom_at, rec["samples"] if rec else {})
+        logger.warning(f"[Autotune] {device} {bucket} batch={batch_size} OOM，降为 {new}")
+        return new
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# ── CPU 模拟模型 ──
+
+class SimulatedModel:
+    """耗时与显存都是 batch_size 的函数的模拟推理模型
+
+    显存 = 常驻 + batch × 每帧占用（按分辨率缩放），超出 memory_mb 抛 MemoryError（模拟 CUDA OOM）；
+    每批耗时 = 启动开销 + batch × 每帧耗时 × (1 + 超过 sweet_spot 后的争用)，
+    即小 batch 被启动开销拖累、大 batch 因争用变慢，吞吐在中间某个值最高。
+    """
+
+    def __init__(self, memory_mb: float, resident_mb: float = 1500, frame_mb_720p: float = 300,
+                 launch_ms: float = 12.0, frame_ms: float = 1.0, sweet_spot: int = 8, contention: float = 0.04):
+        self.memory_mb = memory_mb
+        self.resident_mb = resident_mb
+        self.frame_mb_720p = frame_mb_720p
+        self.launch_ms = launch_ms
+        self.frame_ms = frame_ms
+        self.sweet_spot = sweet_spot
+        self.contention = contention
+
+    def run(self, frames: int, batch_size: int, height: int = 720) -> int:
+        scale = (height / 720.0) ** 2
+        need = self.resident_mb + batch_size * self.frame_mb_720p * scale
+        if need > self.memory_mb:
+            raise MemoryError(f"CUDA out of memory. Tried to allocate {need - self.memory_mb:.0f} MiB")
+        slow = 1 + self.contention * max(0, batch_size - self.sweet_spot)
+        done = 0
+        while done < frames:
+            n = min(batch_size, frames - done)
+            time.sleep((self.launch_ms + n * self.frame_ms * scale * slow) / 1000.0)
+            done += n
+        return done
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    logging.basicConfig(level=logging.WARNING)
+    clip_frames = 96
+    cards = {"small-6GB": SimulatedModel(memory_mb=6144),
+             "large-24GB": SimulatedModel(memory_mb=24576, sweet_spot=16)}
+    with tempfile.TemporaryDirectory() as d:
+        db = os.path.join(d, "batch_tuning.db")
+        tuner = BatchAutotuner(db, default=8)
+        for card, model in cards.items():
+            for bucket in ("720p", "1080p"):
+                h = bucket_height(bucket)
+                best = tuner.calibrate(card, bucket, lambda bs: model.run(clip_frames, bs, h))
+                rec = tuner.get(card, bucket)
+                samples = ", ".join(f"{k}:{v:.0f}" for k, v in rec["samples"].items())
+                print(f"{card:<11}{bucket:>6}  best={best:<3} oom_at={rec['oom_at'] or '-':<3} fps[{samples}]")
+
+        # 固定 batch_size=8 与调优值在 1080p 上的对比（同一段 240 帧）
+        for card, model in cards.items():
+            bs = tuner.choose(card, 1920, 1080)
+            for label, b in (("固定 8", 8), (f"调优 {bs}", bs)):
+                t0 = time.perf_counter()
+                try:
+                    model.run(240, b, 1080)
+                    print(f"{card:<11} 1080p {label:<8} {240 / (time.perf_counter() - t0):7.1f} fps")
+                except MemoryError:
+                    print(f"{card:<11} 1080p {label:<8}     OOM")
+
+        # 持久化：重新打开后直接使用；OOM 回退；未校准档位用默认值但不超过 OOM 上限
+        tuner.close()
+        tuner = BatchAutotuner(db, default=8)
+        assert tuner.choose("small-6GB", 1280, 720) == tuner.get("small-6GB", "720p")["batch_size"]
+        assert tuner.choose("small-6GB", 640, 360) == 8
+        bs = tuner.choose("large-24GB", 1920, 1080)
+        assert tuner.report_oom("large-24GB", "1080p", bs) == max(1, bs // 2)
+        assert tuner.choose("large-24GB", 1920, 1080) == max(1, bs // 2)
+        assert resolution_bucket(1080, 1920) == "1080p" and resolution_bucket(3840, 2160) == "2160p"
+        print("持久化 / OOM 回退 / 档位划分: OK")
+
+        # batch_size 不影响吞吐（设置没传到引擎）：不把噪声里的最高值当最优存下
+        flat_best = tuner.calibrate("no-effect", "720p", lambda bs: time.sleep(0.05) or clip_frames)
+        assert flat_best == 8 and tuner.get("no-effect", "720p")["batch_size"] == 8
+        print(f"吞吐与 batch_size 无关时记为默认值: {flat_best}")
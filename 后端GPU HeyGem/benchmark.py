@@ -0,0 +1,756 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+离线基准测试（stub 引擎 + 合成素材，CPU 机器即可运行）
+=====================================================
+原先测 run_server.py 的吞吐必须有 GPU 和模型；loadtest.py 只压查询接口，走的是自带的 stub 服务，
+测不到上传、调度队列、帧编码这些真实路径。
+
+本脚本运行真正的 run_server.py，只把推理引擎换掉：
+  1. FakeTransDhTask：与 service.trans_dh_service.TransDhTask 接口相同（task_dic + work()），
+     按音频时长 × fps 以 --engine-fps 的速率产出合成帧，交给 run_server 替换后的 write_video
+     （帧 → ffmpeg 编码 → 合并音频 → 进度上报，与线上相同）
+  2. 沙箱目录：复制本目录的 .py 与 config/，改写 config.ini（关闭 ws / 预处理缓存 / 特征缓存 /
+     batch 自动调优），DB、上传、输出都落在沙箱里，不影响本机正在运行的服务
+  3. 合成素材由 ffmpeg lavfi 生成（testsrc2 视频、sine 音频，频率不同 → 内容 hash 不同）
+  4. 场景：
+       cold_submit        上传 + 提交 N 个不同音频的任务，等待完成并下载
+       cache_hit          重复提交同样的 音频 + 视频，走结果缓存
+       concurrent_uploads 多个客户端同时分片上传
+       progress_fanout    一个任务被多个 WebSocket（无 simple-websocket 时为 HTTP 轮询）订阅 + 轮询进度
+       edit_jobs          并发视频编辑任务（缩放 + 画中画 + BGM，单次编码）
+  5. 输出 JSON 报告；与基线报告逐项比较（*_ms / *_s 越小越好，*_per_min / *_per_s / *_mbps / *_ratio
+     越大越好），变差超过 --tolerance 时退出码为 1，可直接用于 CI
+
+  python benchmark.py                                   # 全部场景，报告写 benchmark_report.json
+  python benchmark.py --scenarios cold_submit,cache_hit --tasks 8
+  python benchmark.py --save-baseline                   # 把本次结果存为基线（benchmark_baseline.json）
+  python benchmark.py --baseline ci_baseline.json --tolerance 0.3
+
+基线与机器相关，仓库不附带；CI 须用 --baseline 显式指定，文件缺失或参数不一致时直接失败（退出码 2），
+不会在没有比较的情况下“通过”。未指定时使用本目录的 benchmark_baseline.json，缺失只告警。
+"""
+
+import argparse
+import configparser
+import enum
+import hashlib
+import json
+import os
+import platform
+import queue
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# stub 引擎产出帧的速率（帧/秒，0 = 不限速），由父进程经环境变量传给沙箱里的服务
+ENGINE_FPS_ENV = "HEYGEM_BENCH_ENGINE_FPS"
+SCENARIOS = ("cold_submit", "cache_hit", "concurrent_uploads", "progress_fanout", "edit_jobs")
+
+
+# ============================================================
+#  stub 引擎（在沙箱中由 service/trans_dh_service.py 导出为 TransDhTask）
+# ============================================================
+
+class EngineStatus(enum.Enum):
+    """与引擎 task_dic 条目首元素同形：run_server 按 name == "error" 判断失败"""
+    success = 1
+    error = 3
+
+
+def _synthetic_frames(width: int, height: int, n: int = 25):
+    """n 张平移的渐变图（内容变化但编码开销接近真实画面，不是噪声）"""
+    import numpy as np
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    base = np.stack([np.broadcast_to(x, (height, width)), np.broadcast_to(y, (height, width)),
+                     (x + y) / 2], axis=-1).astype(np.uint8)
+    return [np.roll(base, i * width // n, axis=1) for i in range(n)]
+
+
+class FakeTransDhTask:
+    """stub 引擎：task_dic / work() 与 TransDhTask 相同，帧交给（被 run_server 替换的）write_video"""
+
+    def __init__(self):
+        self.task_dic = {}
+        self.fps = float(os.environ.get(ENGINE_FPS_ENV, "100"))
+        cfg = configparser.ConfigParser()
+        cfg.read(os.path.join("config", "config.ini"), encoding="utf-8")
+        self.temp_dir = os.path.abspath(cfg.get("temp", "temp_dir", fallback="./temp"))
+        self.result_dir = os.path.abspath(cfg.get("result", "result_dir", fallback="./result"))
+        os.makedirs(self.temp_dir, exist_ok=True)
+        os.makedirs(self.result_dir, exist_ok=True)
+        from engine_lifecycle import MediaProbe
+        self._probe = MediaProbe(64)
+
+    def work(self, audio_path, video_path, work_id, *_args):
+        import service.trans_dh_service as tds  # write_video 在 run_server 导入时被替换
+        from y_utils.config import GlobalConfig
+
+        try:
+            vinfo = self._probe.probe(video_path)
+            duration = self._probe.probe(audio_path, video=False)["duration"]
+            width, height, fps = vinfo["width"], vinfo["height"], vinfo["fps"] or 25.0
+            total = max(1, int(duration * fps)) if duration > 0 else max(1, vinfo["frames"])
+            batch = max(1, int(getattr(GlobalConfig.instance(), "batch_size", 8) or 8))
+        except Exception as e:
+            self.task_dic[work_id] = (EngineStatus.error, 0, "", f"probe failed: {e}")
+            return
+
+        frames = _synthetic_frames(width, height)
+        imgs_queue, result_queue = queue.Queue(maxsize=8), queue.Queue()
+        writer = threading.Thread(
+            target=tds.write_video,
+            args=(imgs_queue, self.temp_dir, self.result_dir, work_id, audio_path,
+                  result_queue, width, height, fps),
+            daemon=True,
+        )
+        writer.start()
+        t0 = time.perf_counter()
+        for start in range(0, total, batch):
+            end = min(total, start + batch)
+            if self.fps > 0:
+                delay = t0 + end / self.fps - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            imgs_queue.put((None, "", [frames[i % len(frames)] for i in range(start, end)]))
+        imgs_queue.put((True, "", None))
+        writer.join()
+        ok, result = result_queue.get() if not result_queue.empty() else (False, "write_video 未返回结果")
+        self.task_dic[work_id] = (
+            (EngineStatus.success, 100, result, "success") if ok else (EngineStatus.error, 0, "", str(result))
+        )
+
+
+# ============================================================
+#  合成素材（ffmpeg lavfi）
+# ============================================================
+
+def make_video(path: str, seconds: float, size: str = "640x360", fps: int = 25, hue: int = 0) -> str:
+    """testsrc2 测试视频（H.264）；hue 不同 → 内容 hash 不同"""
+    subprocess.run(["ffmpeg", "-y", "-v", "error", "-f", "lavfi",
+                    "-i", f"testsrc2=size={size}:rate={fps}:d={seconds}",
+                    "-vf", f"hue=h={hue}", "-c:v", "libx264", "-preset", "ultrafast",
+                    "-pix_fmt", "yuv420p", path], check=True)
+    return path
+
+
+def make_audio(path: str, seconds: float, freq: int = 440) -> str:
+    """sine 测试音频（16k 单声道 wav）；freq 不同 → 内容 hash 不同"""
+    subprocess.run(["ffmpeg", "-y", "-v", "error", "-f", "lavfi",
+                    "-i", f"sine=f={freq}:d={seconds}", "-ar", "16000", "-ac", "1", path], check=True)
+    return path
+
+
+def _md5(path: str) -> str:
+    h = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# ============================================================
+#  沙箱：真实 run_server.py + stub 引擎
+# ============================================================
+
+_SERVICE_STUB = '''# benchmark.py 生成：推理引擎换成 stub
+from benchmark import FakeTransDhTask as TransDhTask  # noqa: F401
+
+write_video = None  # run_server.py 导入时替换为 _write_video_server
+'''
+
+# 引擎自带的 y_utils / h_utils 为编译模块（cp39）；当前解释器导入不了时用下面的最小实现代替
+_UTIL_SHIMS = {
+    "y_utils/__init__.py": "",
+    "y_utils/config.py": '''import configparser
+
+
+class GlobalConfig:
+    _instance = None
+
+    def __init__(self):
+        cfg = configparser.ConfigParser()
+        cfg.read("config/config.ini", encoding="utf-8")
+        self.batch_size = int(cfg.get("digital", "batch_size", fallback="8"))
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+''',
+    "y_utils/logger.py": '''import logging
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger("dh")
+''',
+    "h_utils/__init__.py": "",
+    "h_utils/custom.py": '''class CustomError(Exception):
+    pass
+''',
+}
+
+
+def _engine_utils_importable() -> bool:
+    probe = "import y_utils.config, y_utils.logger, h_utils.custom"
+    return subprocess.run([sys.executable, "-c", probe], cwd=_BASE_DIR,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+
+def build_sandbox(root: str, workers: int = 1) -> dict:
+    """复制服务代码与配置到 root，改写 config.ini、写入 stub 引擎；返回沙箱说明"""
+    for name in os.listdir(_BASE_DIR):
+        if name.endswith(".py"):
+            shutil.copy2(os.path.join(_BASE_DIR, name), os.path.join(root, name))
+    shutil.copytree(os.path.join(_BASE_DIR, "config"), os.path.join(root, "config"))
+
+    cfg_path = os.path.join(root, "config", "config.ini")
+    cfg = configparser.ConfigParser()
+    cfg.read(cfg_path, encoding="utf-8")
+    overrides = {
+        ("server", "ws_api_url"): "",
+        ("server", "api_secret"): "",
+        ("digital", "enable_gfpgan"): "1",  # 0 会尝试导入 face_lib 去替换 GFPGAN
+        ("register", "enable"): "0",
+        ("preprocess_cache", "enabled"): "0",
+        ("feature_cache", "enabled"): "0",
+        ("autotune", "enabled"): "0",
+        ("scheduler", "workers"): str(workers),
+        ("scheduler", "devices"): ",".join(str(i) for i in range(workers)),
+    }
+    for (section, key), value in overrides.items():
+        if not cfg.has_section(section):
+            cfg.add_section(section)
+        cfg.set(section, key, value)
+    with open(cfg_path, "w", encoding="utf-8") as f:
+        cfg.write(f)
+
+    os.makedirs(os.path.join(root, "service"))
+    with open(os.path.join(root, "service", "__init__.py"), "w") as f:
+        f.write("")
+    with open(os.path.join(root, "service", "trans_dh_service.py"), "w", encoding="utf-8") as f:
+        f.write(_SERVICE_STUB)
+
+    real_utils = _engine_utils_importable()
+    if real_utils:
+        for pkg in ("y_utils", "h_utils"):
+            os.symlink(os.path.join(_BASE_DIR, pkg), os.path.join(root, pkg))
+    else:
+        for rel, text in _UTIL_SHIMS.items():
+            os.makedirs(os.path.join(root, os.path.dirname(rel)), exist_ok=True)
+            with open(os.path.join(root, rel), "w", encoding="utf-8") as f:
+                f.write(text)
+    return {"dir": root, "engine_utils": "real" if real_utils else "shim", "workers": workers}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class SandboxServer:
+    """在沙箱目录里启动 python run_server.py（stub 引擎），等到 /health 报告 initialized"""
+
+    def __init__(self, root: str, engine_fps: float, workers: int = 1):
+        self.root = root
+        self.info = build_sandbox(root, workers)
+        self.port = _free_port()
+        self.base = f"http://127.0.0.1:{self.port}"
+        env = dict(os.environ, **{ENGINE_FPS_ENV: str(engine_fps)})
+        self._log = open(os.path.join(root, "server.log"), "wb")
+        self.proc = subprocess.Popen(
+            [sys.executable, "run_server.py", "--host", "127.0.0.1", "--port", str(self.port)],
+            cwd=root, env=env, stdout=self._log, stderr=subprocess.STDOUT,
+        )
+
+    def wait_ready(self, timeout: float = 60) -> float:
+        import requests
+        t0 = time.perf_counter()
+        while time.perf_counter() - t0 < timeout:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"服务启动失败，见 {self.root}/server.log:\n{self.log_tail()}")
+            try:
+                if requests.get(f"{self.base}/api/heygem/health", timeout=2).json().get("initialized"):
+                    return time.perf_counter() - t0
+            except (requests.RequestException, ValueError):
+                pass
+            time.sleep(0.2)
+        raise RuntimeError(f"服务未在 {timeout}s 内就绪:\n{self.log_tail()}")
+
+    def log_tail(self, n: int = 30) -> str:
+        try:
+            with open(os.path.join(self.root, "server.log"), "rb") as f:
+                return b"\n".join(f.read().splitlines()[-n:]).decode("utf-8", "replace")
+        except OSError:
+            return ""
+
+    def stop(self):
+        self.proc.terminate()
+        try:
+            self.proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+        self._log.close()
+
+
+# ============================================================
+#  客户端（与 PC 端相同的接口调用顺序）
+# ============================================================
+
+class BenchError(RuntimeError):
+    pass
+
+
+class Client:
+    def __init__(self, base: str):
+        import requests
+        self.base = base
+        self.http = requests.Session()
+
+    def _json(self, resp):
+        try:
+            body = resp.json()
+        except ValueError:
+            raise BenchError(f"{resp.request.method} {resp.url}: HTTP {resp.status_code}")
+        if body.get("code") != 0:
+            raise BenchError(f"{resp.request.method} {resp.url}: {body.get('msg')}")
+        return body.get("data", body)
+
+    def get(self, path, **params):
+        return self._json(self.http.get(self.base + path, params=params, timeout=60))
+
+    def post(self, path, **payload):
+        return self._json(self.http.post(self.base + path, json=payload, timeout=60))
+
+    def upload(self, path: str) -> tuple:
+        """check_files 去重 → upload_file；返回 (hash, ext)"""
+        h, ext = _md5(path), os.path.splitext(path)[1]
+        if not self.post("/api/heygem/check_files", files=[{"hash": h, "ext": ext}]).get(h):
+            with open(path, "rb") as f:
+                self._json(self.http.post(self.base + "/api/heygem/upload_file",
+                                          files={"file": (os.path.basename(path), f)},
+                                          data={"hash": h, "ext": ext}, timeout=600))
+        return h, ext
+
+    def upload_chunked(self, path: str, chunk_size: int = 1024 * 1024) -> str:
+        h, ext = _md5(path), os.path.splitext(path)[1]
+        size = os.path.getsize(path)
+        sess = self.post("/api/heygem/upload/create", hash=h, ext=ext, size=size, chunk_size=chunk_size)
+        if sess.get("exists"):
+            return h
+        with open(path, "rb") as f:
+            f.seek(sess["next_index"] * sess["chunk_size"])
+            index = sess["next_index"]
+            for chunk in iter(lambda: f.read(sess["chunk_size"]), b""):
+                self._json(self.http.put(f"{self.base}/api/heygem/upload/chunk", data=chunk, timeout=600,
+                                         params={"upload_id": sess["upload_id"], "index": index}))
+                index += 1
+        return self.post("/api/heygem/upload/commit", upload_id=sess["upload_id"])["hash"]
+
+    def wait_done(self, task_id: str, timeout: float = 600, interval: float = 0.1) -> dict:
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            data = self.get("/api/heygem/progress", task_id=task_id)
+            if data["status"] == "done":
+                return data
+            if data["status"] == "error":
+                raise BenchError(f"任务失败 {task_id}: {data.get('error') or data.get('message')}")
+            time.sleep(interval)
+        raise BenchError(f"任务超时 {task_id}")
+
+    def download(self, path: str, **params) -> int:
+        resp = self.http.get(self.base + path, params=params, stream=True, timeout=600)
+        if resp.status_code != 200:
+            raise BenchError(f"下载失败 {path}: HTTP {resp.status_code}")
+        return sum(len(c) for c in resp.iter_content(256 * 1024))
+
+
+# ============================================================
+#  场景
+# ============================================================
+
+def _pct(xs, q):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(q * len(xs)))] if xs else 0.0
+
+
+def _dist(prefix, xs, scale=1.0, digits=1):
+    return {f"{prefix}_p50{'_ms' if scale == 1000 else '_s'}": round(_pct(xs, 0.5) * scale, digits),
+            f"{prefix}_p95{'_ms' if scale == 1000 else '_s'}": round(_pct(xs, 0.95) * scale, digits)}
+
+
+class Bench:
+    def __init__(self, server: SandboxServer, media_dir: str, args):
+        self.server = server
+        self.client = Client(server.base)
+        self.media = media_dir
+        self.args = args
+        self.video = make_video(os.path.join(media_dir, "avatar.mp4"), args.seconds, args.resolution)
+        self.pairs = []  # cold_submit 合成过的 (audio_hash, video_hash)，cache_hit 复用
+
+    def _submit(self, audio, video):
+        t0 = time.perf_counter()
+        data = self.post_submit(audio, video)
+        return data, time.perf_counter() - t0
+
+    def post_submit(self, audio, video):
+        return self.client.post("/api/heygem/submit", audio_hash=audio[0], audio_ext=audio[1],
+                                video_hash=video[0], video_ext=video[1])
+
+    def cold_submit(self) -> dict:
+        n = self.args.tasks
+        audios = [make_audio(os.path.join(self.media, f"cold_{i}.wav"), self.args.seconds, 300 + 37 * i)
+                  for i in range(n)]
+        wall0 = time.perf_counter()
+        upload_s, submit_s, e2e_s, dl_s, tasks, frames, nbytes = [], [], [], [], [], 0, 0
+        for path in audios:
+            t0 = time.perf_counter()
+            audio, video = self.client.upload(path), self.client.upload(self.video)
+            upload_s.append(time.perf_counter() - t0)
+            data, seconds = self._submit(audio, video)
+            submit_s.append(seconds)
+            tasks.append((data["task_id"], time.perf_counter()))
+            self.pairs.append((audio, video))
+        for task_id, submitted in tasks:
+            frames += self.client.wait_done(task_id)["total_frames"]
+            e2e_s.append(time.perf_counter() - submitted)
+            t0 = time.perf_counter()
+            nbytes += self.client.download("/api/heygem/download", task_id=task_id)
+            dl_s.append(time.perf_counter() - t0)
+        wall = time.perf_counter() - wall0
+        out = {"tasks": n, "frames": frames}
+        out.update(_dist("upload", upload_s, 1000))
+        out.update(_dist("submit", submit_s, 1000))
+        out.update(_dist("e2e", e2e_s, 1, 2))
+        out["tasks_per_min"] = round(n / wall * 60, 2)
+        out["frames_per_s"] = round(frames / wall, 1)
+        out["download_mbps"] = round(nbytes / 1024 ** 2 / max(sum(dl_s), 1e-6), 1)
+        return out
+
+    def cache_hit(self) -> dict:
+        if not self.pairs:
+            audio = self.client.upload(make_audio(os.path.join(self.media, "warm.wav"), self.args.seconds, 250))
+            video = self.client.upload(self.video)
+            self.client.wait_done(self.post_submit(audio, video)["task_id"])
+            self.pairs.append((audio, video))
+        submit_s, dl_s, hits = [], [], 0
+        for _ in range(self.args.repeat):
+            for audio, video in self.pairs:
+                data, seconds = self._submit(audio, video)
+                submit_s.append(seconds)
+                hits += bool(data.get("cached"))
+                t0 = time.perf_counter()
+                self.client.download("/api/heygem/download", task_id=data["task_id"])
+                dl_s.append(time.perf_counter() - t0)
+        out = {"submits": len(submit_s), "hit_ratio": round(hits / max(1, len(submit_s)), 3)}
+        out.update(_dist("submit", submit_s, 1000))
+        out.update(_dist("download", dl_s, 1000))
+        return out
+
+    def concurrent_uploads(self) -> dict:
+        n, size = self.args.uploaders, int(self.args.upload_mb * 1024 * 1024)
+        paths = []
+        for i in range(n):
+            path = os.path.join(self.media, f"upload_{i}.mp4")
+            with open(path, "wb") as f:
+                f.write(os.urandom(size))
+            paths.append(path)
+
+        def _one(path):
+            client = Client(self.server.base)  # 每个上传方独立连接
+            t0 = time.perf_counter()
+            client.upload_chunked(path)
+            return time.perf_counter() - t0
+
+        wall0 = time.perf_counter()
+        with ThreadPoolExecutor(n) as pool:
+            upload_s = list(pool.map(_one, paths))
+        wall = time.perf_counter() - wall0
+        check_s = []
+        files = [{"hash": _md5(p), "ext": ".mp4"} for p in paths]
+        for _ in range(20):
+            t0 = time.perf_counter()
+            found = self.client.post("/api/heygem/check_files", files=files)
+            check_s.append(time.perf_counter() - t0)
+        if not all(found.values()):
+            raise BenchError("分片上传后 check_files 未找到文件")
+        out = {"uploaders": n, "upload_mb": self.args.upload_mb,
+               "aggregate_mbps": round(n * size / 1024 ** 2 / wall, 1)}
+        out.update(_dist("upload", upload_s, 1, 2))
+        out.update(_dist("check_files", check_s, 1000))
+        return out
+
+    def progress_fanout(self) -> dict:
+        audio = self.client.upload(make_audio(os.path.join(self.media, "fanout.wav"),
+                                              self.args.fanout_seconds, 211))
+        video = self.client.upload(self.video)
+        task_id = self.post_submit(audio, video)["task_id"]
+        try:
+            import simple_websocket  # flask-sock 的依赖
+        except ImportError:
+            simple_websocket = None
+        transport = "ws" if simple_websocket is not None else "http"
+
+        updates, done_at, poll_s, errors = [], [], [], []
+        stop = threading.Event()
+
+        def _subscriber():
+            n = 0
+            try:
+                if simple_websocket is not None:
+                    ws = simple_websocket.Client(f"ws://127.0.0.1:{self.server.port}/ws/progress/{task_id}")
+                    try:
+                        while True:
+                            msg = json.loads(ws.receive(timeout=120))
+                            n += 1
+                            if msg.get("code") != 0 or msg["data"]["status"] in ("done", "error"):
+                                break
+                    finally:
+                        try:
+                            ws.close()
+                        except simple_websocket.ConnectionClosed:
+                            pass  # 服务端推送终态后已关闭连接
+                else:
+                    client = Client(self.server.base)
+                    while True:
+                        data = client.get("/api/heygem/progress", task_id=task_id)
+                        n += 1
+                        if data["status"] in ("done", "error"):
+                            break
+                        time.sleep(0.2)
+                done_at.append(time.time())
+                updates.append(n)
+            except Exception as e:
+                errors.append(str(e))
+
+        def _poller():
+            client = Client(self.server.base)
+            while not stop.is_set():
+                t0 = time.perf_counter()
+                client.get("/api/heygem/progress", task_id=task_id)
+                poll_s.append(time.perf_counter() - t0)
+                stop.wait(0.05)
+
+        subs = [threading.Thread(target=_subscriber, daemon=True) for _ in range(self.args.subscribers)]
+        polls = [threading.Thread(target=_poller, daemon=True) for _ in range(self.args.pollers)]
+        for t in subs + polls:
+            t.start()
+        for t in subs:
+            t.join(timeout=self.args.fanout_seconds * 20 + 120)
+        stop.set()
+        for t in polls:
+            t.join(timeout=10)
+        if errors:
+            raise BenchError(f"{len(errors)} 个订阅者失败: {errors[0]}")
+        finished_at = self.client.wait_done(task_id)["finished_at"]
+        out = {"transport": transport, "subscribers": len(updates), "pollers": self.args.pollers,
+               "updates_p50": _pct(updates, 0.5)}
+        out.update(_dist("done_lag", [max(0.0, t - finished_at) for t in done_at], 1000))
+        out.update(_dist("poll", poll_s, 1000))
+        return out
+
+    def edit_jobs(self) -> dict:
+        video = self.client.upload(self.video)
+        pip = self.client.upload(make_video(os.path.join(self.media, "pip.mp4"), 2, "320x180", hue=90))
+        bgm = self.client.upload(make_audio(os.path.join(self.media, "bgm.wav"), self.args.seconds, 523))
+        ops = json.dumps([
+            {"type": "scale", "width": 480},
+            {"type": "overlay", "hash": pip[0], "ext": pip[1], "position": "bottom-right", "scale": 0.3},
+            {"type": "bgm", "hash": bgm[0], "ext": bgm[1], "volume": 0.2},
+        ])
+
+        def _one(_):
+            client = Client(self.server.base)
+            t0 = time.perf_counter()
+            data = client._json(client.http.post(f"{client.base}/api/video/edit", timeout=60, data={
+                "operations": ops, "video_hash": video[0], "video_ext": video[1]}))
+            submitted = time.perf_counter() - t0
+            client.wait_done(data["task_id"])
+            client.download("/api/video/edit/download", task_id=data["task_id"])
+            return submitted, time.perf_counter() - t0
+
+        wall0 = time.perf_counter()
+        with ThreadPoolExecutor(self.args.edits) as pool:
+            results = list(pool.map(_one, range(self.args.edits)))
+        wall = time.perf_counter() - wall0
+        out = {"jobs": len(results), "jobs_per_min": round(len(results) / wall * 60, 2)}
+        out.update(_dist("submit", [r[0] for r in results], 1000))
+        out.update(_dist("job", [r[1] for r in results], 1, 2))
+        return out
+
+
+# ============================================================
+#  报告与基线比较
+# ============================================================
+
+def metric_direction(name: str) -> int:
+    """-1 越小越好，+1 越大越好，0 不参与比较"""
+    if name.endswith(("_ms", "_s")):
+        return -1
+    if name.endswith(("_per_min", "_per_s", "_mbps", "_ratio")):
+        return 1
+    return 0
+
+
+# 参数不同的两次结果不可比
+_COMPARABLE_PARAMS = ("resolution", "seconds", "engine_fps", "tasks", "workers", "uploaders",
+                      "upload_mb", "subscribers", "pollers", "fanout_seconds", "edits")
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """逐项比较，返回 [(场景, 指标, 基线值, 本次值, 变化比例, 是否退化)]"""
+    rows = []
+    for scenario, metrics in report.get("scenarios", {}).items():
+        base = baseline.get("scenarios", {}).get(scenario)
+        if not isinstance(base, dict) or "error" in metrics:
+            continue
+        for name, value in metrics.items():
+            direction = metric_direction(name)
+            old = base.get(name)
+            if not direction or not isinstance(old, (int, float)) or not isinstance(value, (int, float)):
+                continue
+            change = (value - old) / old if old else 0.0
+            # 绝对值很小的耗时（< 5ms / < 0.5s）抖动大，不判退化
+            noise = direction < 0 and max(value, old) < (5 if name.endswith("_ms") else 0.5)
+            rows.append((scenario, name, old, value, change, change * direction < -tolerance and not noise))
+    return rows
+
+
+def _host_info() -> dict:
+    try:
+        ffmpeg = subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True).stdout.split("\n")[0]
+    except OSError:
+        ffmpeg = ""
+    return {"platform": platform.platform(), "python": platform.python_version(),
+            "cpus": os.cpu_count(), "ffmpeg": ffmpeg}
+
+
+def run(args) -> dict:
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"未知场景: {', '.join(sorted(unknown))}（可选: {', '.join(SCENARIOS)}）")
+    if not shutil.which("ffmpeg") or not shutil.which("ffprobe"):
+        raise SystemExit("需要 ffmpeg / ffprobe（PATH 中）")
+
+    report = {"created_at": time.strftime("%Y-%m-%d %H:%M:%S"), "host": _host_info(),
+              "params": {k: getattr(args, k) for k in _COMPARABLE_PARAMS}, "scenarios": {}}
+    root = tempfile.mkdtemp(prefix="heygem_bench_")
+    server = None
+    try:
+        sandbox, media = os.path.join(root, "server"), os.path.join(root, "media")
+        os.makedirs(sandbox)
+        os.makedirs(media)
+        server = SandboxServer(sandbox, args.engine_fps, args.workers)
+        report["startup_s"] = round(server.wait_ready(), 2)
+        report["sandbox"] = {k: v for k, v in server.info.items() if k != "dir"}
+        bench = Bench(server, media, args)
+        for name in scenarios:
+            print(f"[bench] {name} ...", flush=True)
+            t0 = time.perf_counter()
+            try:
+                result = getattr(bench, name)()
+            except Exception as e:
+                result = {"error": str(e)}
+                print(f"[bench] {name} 失败: {e}\n{server.log_tail()}", flush=True)
+            result["wall_s"] = round(time.perf_counter() - t0, 2)
+            report["scenarios"][name] = result
+        report["server_stages"] = bench.client.get("/api/heygem/queue").get("stages", {})
+    finally:
+        if server is not None:
+            server.stop()
+        if args.keep:
+            print(f"[bench] 沙箱保留在 {root}")
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+    return report
+
+
+def print_report(report: dict, rows: list):
+    for scenario, metrics in report["scenarios"].items():
+        print(f"\n== {scenario} ==")
+        for name, value in metrics.items():
+            print(f"  {name:<22}{value}")
+    if report.get("server_stages"):
+        print("\n== 服务端阶段耗时 ==")
+        for stage, s in sorted(report["server_stages"].items()):
+            print(f"  {stage:<16}n={s.get('count', 0):<5} p50={s.get('p50_ms', 0)}ms p95={s.get('p95_ms', 0)}ms")
+    if rows:
+        print(f"\n{'场景':<20}{'指标':<22}{'基线':>10}{'本次':>10}{'变化':>9}")
+        for scenario, name, old, value, change, bad in rows:
+            print(f"{scenario:<20}{name:<22}{old:>10}{value:>10}{change:>+8.0%}{'  ← 退化' if bad else ''}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HeyGem 服务离线基准测试（stub 引擎）",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--scenarios", type=str, default=",".join(SCENARIOS), help="逗号分隔的场景")
+    parser.add_argument("--resolution", type=str, default="640x360", help="合成视频分辨率")
+    parser.add_argument("--seconds", type=float, default=4, help="素材时长（秒）")
+    parser.add_argument("--engine-fps", type=float, default=100, help="stub 引擎产帧速率（0 = 不限速）")
+    parser.add_argument("--workers", type=int, default=1, help="引擎 worker 数（[scheduler] workers）")
+    parser.add_argument("--tasks", type=int, default=4, help="cold_submit 任务数")
+    parser.add_argument("--repeat", type=int, default=5, help="cache_hit 每个组合重复提交次数")
+    parser.add_argument("--uploaders", type=int, default=8, help="concurrent_uploads 并发上传数")
+    parser.add_argument("--upload-mb", type=float, default=16, help="每个上传文件大小（MB）")
+    parser.add_argument("--subscribers", type=int, default=50, help="progress_fanout 订阅者数")
+    parser.add_argument("--pollers", type=int, default=10, help="progress_fanout HTTP 轮询者数")
+    parser.add_argument("--fanout-seconds", type=float, default=8, help="progress_fanout 任务音频时长（秒）")
+    parser.add_argument("--edits", type=int, default=4, help="edit_jobs 并发编辑任务数")
+    parser.add_argument("--report", type=str, default="benchmark_report.json", help="报告输出路径")
+    parser.add_argument("--baseline", type=str, default="",
+                        help="基线报告；显式指定时文件缺失 / 参数不一致即失败，"
+                             "未指定时用 benchmark_baseline.json（缺失只告警）")
+    parser.add_argument("--save-baseline", action="store_true", help="把本次报告写为基线")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许的变差比例")
+    parser.add_argument("--keep", action="store_true", help="保留沙箱目录（含 server.log）")
+    args = parser.parse_args()
+    required = bool(args.baseline)
+    args.baseline = args.baseline or os.path.join(_BASE_DIR, "benchmark_baseline.json")
+    compare_baseline = not args.save_baseline
+    if compare_baseline and not os.path.exists(args.baseline):
+        if required:
+            parser.error(f"基线文件不存在: {args.baseline}（先用 --save-baseline 生成）")
+        print(f"[bench] 警告: 未找到基线 {args.baseline}，本次不做退化比较，退出码不反映性能变化；"
+              f"用 --save-baseline 生成基线，CI 中请用 --baseline 显式指定")
+        compare_baseline = False
+
+    report = run(args)
+    rows, mismatch = [], False
+    if compare_baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("params") != report["params"]:
+            print(f"[bench] {'错误' if required else '警告'}: 基线参数与本次不同，无法比较: {args.baseline}")
+            mismatch = required
+        else:
+            rows = compare(report, baseline, args.tolerance)
+            report["comparison"] = {"baseline": args.baseline, "tolerance": args.tolerance,
+                                    "regressions": [f"{s}.{n}" for s, n, *_, bad in rows if bad]}
+    print_report(report, rows)
+
+    with open(args.report, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n[bench] 报告: {os.path.abspath(args.report)}")
+    if args.save_baseline:
+        shutil.copyfile(args.report, args.baseline)
+        print(f"[bench] 已保存为基线: {args.baseline}")
+
+    failed = [name for name, m in report["scenarios"].items() if "error" in m]
+    regressions = report.get("comparison", {}).get("regressions", [])
+    if regressions:
+        print(f"[bench] 性能退化（>{args.tolerance:.0%}）: {', '.join(regressions)}")
+    sys.exit(2 if mismatch else 1 if failed or regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
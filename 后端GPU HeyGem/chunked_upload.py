@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+分片断点续传上传
+================
+原 /api/heygem/upload_file 一次性接收整个文件再重新读一遍算 MD5，上传几百 MB 的数字人视频时
+连接一断就要从 0 字节重传。本模块实现按顺序追加的分片上传会话：
+  1. create：按 (hash, ext, size) 得到确定的 upload_id，同一文件重连后拿到同一个会话
+  2. put_chunk：只接受 offset 处的下一片；已收到的分片直接跳过，乱序分片拒绝
+  3. 服务端边收边更新 hashlib.md5 状态，commit 时直接得到最终 MD5，无需再读一遍文件
+  4. commit：校验大小与 hash，把分片文件移动到统一存储（STORE_DIR/{hash}{ext}）
+
+会话元数据写在 STORE_DIR/_up_{upload_id}.json，服务重启后按已落盘的分片数恢复 offset，
+MD5 状态在首次续传时从分片文件重建一次。
+
+断线续传自检（本地 HTTP 服务上中途断开一个分片请求，再重启续传）：
+  python chunked_upload.py
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+class UploadError(RuntimeError):
+    """上传请求不合法（调用方返回 4xx）"""
+
+    def __init__(self, msg, code=400):
+        super().__init__(msg)
+        self.code = code
+
+
+class UploadSession:
+    """一个上传会话：分片文件 + 增量 MD5 状态"""
+
+    def __init__(self, upload_id, file_hash, ext, size, chunk_size, part_path, meta_path):
+        self.upload_id = upload_id
+        self.file_hash = file_hash
+        self.ext = ext
+        self.size = size
+        self.chunk_size = chunk_size
+        self.part_path = part_path
+        self.meta_path = meta_path
+        self.offset = 0
+        self.md5 = None  # hashlib 对象，覆盖 [0, offset)；None 表示需从分片文件重建
+        self.lock = threading.Lock()
+
+    @property
+    def total_chunks(self) -> int:
+        return max(1, (self.size + self.chunk_size - 1) // self.chunk_size)
+
+    @property
+    def next_index(self) -> int:
+        return self.offset // self.chunk_size
+
+    def info(self) -> dict:
+        return {
+            "upload_id": self.upload_id,
+            "hash": self.file_hash,
+            "ext": self.ext,
+            "size": self.size,
+            "chunk_size": self.chunk_size,
+            "offset": self.offset,
+            "next_index": self.next_index,
+            "total_chunks": self.total_chunks,
+            "complete": self.offset >= self.size,
+        }
+
+
+class ChunkedUploadManager:
+    """分片上传会话管理"""
+
+    def __init__(self, store_dir: str, default_chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.store_dir = store_dir
+        self.default_chunk_size = default_chunk_size
+        self._sessions: Dict[str, UploadSession] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_upload_id(file_hash: str, ext: str, size: int) -> str:
+        return hashlib.md5(f"{file_hash}{ext}:{size}".encode()).hexdigest()[:16]
+
+    def _paths(self, upload_id):
+        return (os.path.join(self.store_dir, f"_up_{upload_id}.part"),
+                os.path.join(self.store_dir, f"_up_{upload_id}.json"))
+
+    def create(self, file_hash: str, ext: str, size: int, chunk_size: int = 0) -> UploadSession:
+        """创建或恢复上传会话（同一文件重复 create 返回同一会话）"""
+        if not file_hash or size <= 0:
+            raise UploadError("hash 和 size 不能为空")
+        upload_id = self.make_upload_id(file_hash, ext, size)
+        chunk_size = int(chunk_size or self.default_chunk_size)
+        chunk_size = min(MAX_CHUNK_SIZE, max(MIN_CHUNK_SIZE, chunk_size))
+        # 查找 / 新建分片文件 / 登记在同一把锁内完成：并发 create 不会截断正在写入的分片文件
+        with self._lock:
+            sess = self._get_locked(upload_id)
+            if sess is not None:
+                return sess
+            part_path, meta_path = self._paths(upload_id)
+            sess = UploadSession(upload_id, file_hash, ext, size, chunk_size, part_path, meta_path)
+            sess.md5 = hashlib.md5()
+            open(part_path, "wb").close()
+            with open(meta_path, "w", encoding="utf-8") as f:
+                json.dump({"hash": file_hash, "ext": ext, "size": size, "chunk_size": chunk_size,
+                           "created_at": time.time()}, f)
+            self._sessions[upload_id] = sess
+        logger.info(f"[ChunkUpload] 新会话: {upload_id} hash={file_hash}{ext} size={size} chunk={chunk_size}")
+        return sess
+
+    def get(self, upload_id: str) -> Optional[UploadSession]:
+        """取会话；内存中没有时从磁盘元数据恢复（服务重启后续传）"""
+        with self._lock:
+            return self._get_locked(upload_id)
+
+    def _get_locked(self, upload_id: str) -> Optional[UploadSession]:
+        sess = self._sessions.get(upload_id)
+        if sess is not None:
+            return sess
+        part_path, meta_path = self._paths(upload_id)
+        if not (os.path.exists(meta_path) and os.path.exists(part_path)):
+            return None
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except Exception:
+            return None
+        sess = UploadSession(upload_id, meta["hash"], meta["ext"], int(meta["size"]),
+                             int(meta["chunk_size"]), part_path, meta_path)
+        # 只承认完整分片（最后一片除外），截掉断电时写了一半的尾巴
+        on_disk = os.path.getsize(part_path)
+        sess.offset = on_disk if on_disk >= sess.size else (on_disk // sess.chunk_size) * sess.chunk_size
+        if sess.offset != on_disk:
+            with open(part_path, "r+b") as f:
+                f.truncate(sess.offset)
+        self._sessions[upload_id] = sess
+        logger.info(f"[ChunkUpload] 从磁盘恢复会话: {upload_id} offset={sess.offset}/{sess.size}")
+        return sess
+
+    @staticmethod
+    def _ensure_md5(sess: UploadSession):
+        if sess.md5 is not None:
+            return
+        h = hashlib.md5()
+        with open(sess.part_path, "rb") as f:
+            remaining = sess.offset
+            while remaining > 0:
+                buf = f.read(min(1024 * 1024, remaining))
+                if not buf:
+                    break
+                h.update(buf)
+                remaining -= len(buf)
+        sess.md5 = h
+
+    def put_chunk(self, upload_id: str, index: int, data: bytes) -> dict:
+        """追加一个分片，返回会话状态（含 skipped 标记）"""
+        sess = self.get(upload_id)
+        if sess is None:
+            raise UploadError(f"上传会话不存在: {upload_id}", 404)
+        with sess.lock:
+            start = index * sess.chunk_size
+            expected = min(sess.chunk_size, sess.size - start)
+            if index < 0 or start >= sess.size:
+                raise UploadError(f"分片序号越界: {index}")
+            if start < sess.offset:
+                info = sess.info()
+                info["skipped"] = True  # 重连后重发的分片，已收到
+                return info
+            if start > sess.offset:
+                raise UploadError(f"分片乱序: 期望 {sess.next_index}，收到 {index}", 409)
+            if len(data) != expected:
+                raise UploadError(f"分片大小不符: 期望 {expected}，收到 {len(data)}")
+            self._ensure_md5(sess)
+            with open(sess.part_path, "ab") as f:
+                f.write(data)
+            sess.md5.update(data)
+            sess.offset += len(data)
+            info = sess.info()
+            info["skipped"] = False
+            return info
+
+    def commit(self, upload_id: str, dest_fn: Callable[[str, str], str]) -> dict:
+        """完成上传：用增量 MD5 确定最终 hash，移动到 dest_fn(hash, ext) 指定的存储路径"""
+        sess = self.get(upload_id)
+        if sess is None:
+            raise UploadError(f"上传会话不存在: {upload_id}", 404)
+        with sess.lock:
+            if sess.offset < sess.size:
+                raise UploadError(f"上传未完成: {sess.offset}/{sess.size}", 409)
+            self._ensure_md5(sess)
+            actual = sess.md5.hexdigest()
+            if actual != sess.file_hash:
+                logger.warning(f"[ChunkUpload] hash 不匹配: 期望={sess.file_hash}, 实际={actual}")
+            dest = dest_fn(actual, sess.ext)
+            if os.path.exists(dest) and os.path.getsize(dest) > 0:
+                os.remove(sess.part_path)
+                os.utime(dest, None)
+            else:
+                shutil.move(sess.part_path, dest)
+            try:
+                os.remove(sess.meta_path)
+            except OSError:
+                pass
+        with self._lock:
+            self._sessions.pop(upload_id, None)
+        logger.info(f"[ChunkUpload] 上传完成: {actual}{sess.ext} ({sess.size} bytes)")
+        return {"hash": actual, "server_path": os.path.realpath(dest), "size": sess.size}
+
+
+# 自检：本地 HTTP 服务上真实断开一个分片 PUT → 服务重启 → 重新 create 续传 → 文件与源文件一致
+if __name__ == "__main__":
+    import http.client
+    import socket
+    import sys
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    from flask import Flask, jsonify, request
+    from werkzeug.serving import make_server
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    C = MIN_CHUNK_SIZE
+    ok = True
+    with tempfile.TemporaryDirectory() as d:
+        payload = os.urandom(3 * C + 12345)
+        src_hash = hashlib.md5(payload).hexdigest()
+        state = {"mgr": ChunkedUploadManager(d, default_chunk_size=C)}
+        app = Flask(__name__)
+
+        # 与 run_server 的 /api/heygem/upload/create、/chunk 相同的处理方式
+        @app.route("/create", methods=["POST"])
+        def _create():
+            body = request.get_json(force=True)
+            return jsonify(state["mgr"].create(body["hash"], body["ext"], int(body["size"])).info())
+
+        @app.route("/chunk", methods=["PUT"])
+        def _chunk():
+            try:
+                info = state["mgr"].put_chunk(request.args["upload_id"], int(request.args["index"]),
+                                              request.get_data(cache=False))
+            except UploadError as e:
+                return jsonify({"msg": str(e)}), e.code
+            return jsonify(info)
+
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        port = server.server_port
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        def _call(method, path, body=b""):
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            try:
+                conn.request(method, path, body=body)
+                resp = conn.getresponse()
+                return resp.status, json.loads(resp.read() or b"{}")
+            finally:
+                conn.close()
+
+        def _create_http():
+            return _call("POST", "/create", json.dumps({"hash": src_hash, "ext": ".mp4", "size": len(payload)}))[1]
+
+        def _put(uid, i):
+            return _call("PUT", f"/chunk?upload_id={uid}&index={i}", payload[i * C:(i + 1) * C])
+
+        # 并发 create 同一文件：拿到同一会话，分片文件不被截断
+        with ThreadPoolExecutor(8) as ex:
+            ids = set(ex.map(lambda _: _create_http()["upload_id"], range(8)))
+        uid = ids.pop()
+        for i in range(2):
+            _put(uid, i)
+        with ThreadPoolExecutor(8) as ex:
+            offsets = set(ex.map(lambda _: _create_http()["offset"], range(8)))
+        part_size = os.path.getsize(state["mgr"].get(uid).part_path)
+        print(f"并发 create: 会话数={len(ids) + 1} offset={offsets} 分片文件={part_size}")
+        ok = ok and not ids and offsets == {2 * C} and part_size == 2 * C
+
+        # 第 2 片发到一半时断开连接（Content-Length 为整片，只写入一半字节就关闭 socket）
+        sock = socket.create_connection(("127.0.0.1", port))
+        head = (f"PUT /chunk?upload_id={uid}&index=2 HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+                f"Content-Length: {C}\r\n\r\n").encode()
+        sock.sendall(head + payload[2 * C:2 * C + C // 2])
+        sock.close()
+        time.sleep(0.5)
+        offset = state["mgr"].get(uid).offset
+        print(f"断线后: offset={offset}（半片未写入）")
+        ok = ok and offset == 2 * C
+
+        # 服务重启：丢弃内存会话，从磁盘恢复；客户端重新 create 后从 next_index 续传
+        state["mgr"] = ChunkedUploadManager(d, default_chunk_size=C)
+        sess = _create_http()
+        print(f"续传起点: next_index={sess['next_index']}")
+        skipped = _put(uid, 0)[1]["skipped"]
+        for i in range(sess["next_index"], sess["total_chunks"]):
+            status, _ = _put(uid, i)
+            ok = ok and status == 200
+        res = state["mgr"].commit(uid, lambda h, e: os.path.join(d, f"{h}{e}"))
+        server.shutdown()
+        with open(res["server_path"], "rb") as f:
+            same = f.read() == payload
+        print(f"重发分片被跳过={skipped} hash 一致={res['hash'] == src_hash} 内容一致={same}")
+        ok = ok and sess["next_index"] == 2 and skipped and res["hash"] == src_hash and same
+    print("自检通过" if ok else "自检失败")
+    sys.exit(0 if ok else 1)
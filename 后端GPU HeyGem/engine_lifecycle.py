@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+推理引擎生命周期：就绪检测 + 能力探测缓存 + 输入媒体信息缓存
+============================================================
+原先 _init_service 创建引擎后固定 time.sleep(10)（引擎子进程加载模型的时间靠猜）；
+每个任务进入引擎前还要再跑一遍 ffmpeg -version、cv2.VideoCapture 打开输入视频、
+ffprobe 取音频时长，而入队时 _estimate_frames 已经对同样的文件做过一次。
+
+EngineLifecycle：
+  1. 就绪检测只做一次并记录每项耗时：ffmpeg / ffprobe / 编码器探测 → 引擎创建 → 等待引擎就绪。
+     引擎就绪需要正向信号：引擎自身的 is_ready() / ready、引擎写出的 ready_file，或 probe 探测成功
+     （子进程 CPU 时间在 settle 窗口内不再增长时尝试）；ready_timeout 秒内没有信号即启动失败
+  2. 能力探测（ffmpeg 版本、可用编码器）进程内缓存，任务热路径不再起子进程
+  3. status() 给 /api/heygem/health 报告实际状态（starting / ready / failed）与各检查耗时
+
+MediaProbe：每个文件一次 ffprobe JSON（format + streams）取时长、分辨率、fps、帧数，
+按内容 hash 缓存（统一存储文件名即 MD5；其它文件按 路径 + 大小 + mtime）。
+
+对比（stub 引擎 + 本地生成的输入文件，原方案 vs 本模块的启动耗时与每任务引擎前开销）：
+  python engine_lifecycle.py
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import re
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+STARTING = "starting"
+READY = "ready"
+FAILED = "failed"
+
+_HASH_NAME = re.compile(r"^[0-9a-f]{32}$")
+
+
+# ── 输入媒体信息 ──
+
+def media_key(path: str) -> tuple:
+    """缓存键：统一存储里的文件名就是内容 MD5（加上大小防止截断文件命中），其它文件用 路径 + 大小 + mtime"""
+    st = os.stat(path)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if _HASH_NAME.match(stem):
+        return ("md5", stem, st.st_size)
+    return ("path", os.path.abspath(path), st.st_size, st.st_mtime_ns)
+
+
+def _parse_rate(value: str) -> float:
+    try:
+        num, _, den = (value or "").partition("/")
+        return float(num) / float(den or 1) if float(den or 1) else 0.0
+    except ValueError:
+        return 0.0
+
+
+def ffprobe_json(path: str, timeout: float = 30) -> dict:
+    """一次 ffprobe 调用取 format + streams（JSON）"""
+    p = subprocess.run(
+        ["ffprobe", "-v", "quiet", "-print_format", "json", "-show_format", "-show_streams", path],
+        capture_output=True, text=True, timeout=timeout)
+    return json.loads(p.stdout or "{}")
+
+
+def parse_media_info(data: dict) -> dict:
+    """ffprobe JSON → {duration, width, height, fps, frames, has_audio, has_video}"""
+    streams = data.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video"), None)
+    info = {
+        "duration": float(data.get("format", {}).get("duration") or 0),
+        "width": 0, "height": 0, "fps": 0.0, "frames": 0,
+        "has_audio": any(s.get("codec_type") == "audio" for s in streams),
+        "has_video": video is not None,
+    }
+    if video:
+        info["width"] = int(video.get("width") or 0)
+        info["height"] = int(video.get("height") or 0)
+        info["fps"] = _parse_rate(video.get("avg_frame_rate", "")) or _parse_rate(video.get("r_frame_rate", ""))
+        frames = int(video.get("nb_frames") or 0)
+        if frames <= 0:
+            duration = float(video.get("duration") or info["duration"] or 0)
+            frames = int(round(duration * info["fps"]))
+        info["frames"] = frames
+    return info
+
+
+def _cv2_video_info(path: str) -> dict:
+    """ffprobe 不可用 / 未解析出视频流时的兜底（与原实现相同的 cv2 读取）"""
+    import cv2
+    cap = cv2.VideoCapture(path)
+    try:
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        return {"duration": frames / fps if fps > 0 else 0.0,
+                "width": int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                "height": int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                "fps": fps, "frames": frames, "has_audio": False, "has_video": frames > 0}
+    finally:
+        cap.release()
+
+
+class MediaProbe:
+    """输入文件媒体信息缓存（LRU，按内容 hash）；同一文件的并发探测只执行一次"""
+
+    def __init__(self, max_entries: int = 512):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[tuple, dict]" = OrderedDict()
+        self._key_locks: Dict[tuple, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def probe(self, path: str, video: bool = True) -> dict:
+        """返回媒体信息（调用方不要修改返回的 dict）；video=True 时解析不出视频流会用 cv2 兜底"""
+        key = media_key(path)
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                if key in self._data:
+                    self.hits += 1
+                    return self._data[key]
+                self.misses += 1
+            try:
+                info = parse_media_info(ffprobe_json(path))
+            except Exception as e:
+                logger.warning(f"[Lifecycle] ffprobe 失败: {path} ({e})")
+                info = parse_media_info({})
+            if video and info["frames"] <= 0:
+                try:
+                    info = dict(_cv2_video_info(path), has_audio=info["has_audio"])
+                except Exception as e:
+                    logger.warning(f"[Lifecycle] cv2 读取视频信息失败: {path} ({e})")
+            with self._lock:
+                self._data[key] = info
+                self._key_locks.pop(key, None)
+                while len(self._data) > self.max_entries:
+                    self._data.popitem(last=False)
+            return info
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+# ── 引擎就绪 ──
+
+def child_pids() -> set:
+    """当前进程的直接子进程（Linux 读 /proc/<pid>/task/*/children，其它平台用 multiprocessing）"""
+    pids = set()
+    try:
+        task_dir = f"/proc/{os.getpid()}/task"
+        for tid in os.listdir(task_dir):
+            with open(os.path.join(task_dir, tid, "children")) as f:
+                pids.update(int(x) for x in f.read().split())
+        return pids
+    except OSError:
+        return {p.pid for p in multiprocessing.active_children()}
+
+
+def _alive(pid: int) -> bool:
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rpartition(")")[2].split()[0] not in ("Z", "X")
+    except OSError:
+        return pid in {p.pid for p in multiprocessing.active_children()}
+    except IndexError:
+        return False
+
+
+def _modified_since(path: str, since: float) -> bool:
+    try:
+        return os.stat(path).st_mtime >= since
+    except OSError:
+        return False
+
+
+def _cpu_ticks(pid: int) -> Optional[int]:
+    """进程 utime + stime（Linux /proc，时钟滴答）；读不到返回 None"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rpartition(")")[2].split()
+        return int(fields[11]) + int(fields[12])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class EngineLifecycle:
+    """引擎就绪检测与能力探测（进程内单例，由 run_server._init_service 驱动）"""
+
+    def __init__(self, ready_timeout: float = 300.0, settle_seconds: float = 1.0, poll_interval: float = 0.2,
+                 ready_file: str = ""):
+        self.ready_timeout = ready_timeout
+        self.settle_seconds = settle_seconds
+        self.ready_file = ready_file
+        self.poll_interval = poll_interval
+        self.state = STARTING
+        self.error = ""
+        self.checks: List[dict] = []
+        self._caps: Optional[dict] = None
+        self._caps_lock = threading.Lock()
+        self._ready = threading.Event()
+        self._t0 = time.time()
+        self._ready_at = 0.0
+
+    # 能力探测（缓存）
+
+    def capabilities(self) -> dict:
+        """ffmpeg / ffprobe 版本与可用编码器（进程内只探测一次）"""
+        with self._caps_lock:
+            if self._caps is None:
+                from frame_sink import available_encoders
+                caps = {"ffmpeg": _tool_version("ffmpeg"), "ffprobe": _tool_version("ffprobe")}
+                caps["encoders"] = sorted(e for e in available_encoders() if "264" in e or "265" in e or e == "aac")
+                self._caps = caps
+            return self._caps
+
+    def require_ffmpeg(self):
+        if not self.capabilities()["ffmpeg"]:
+            raise RuntimeError("ffmpeg 未安装！请执行: sudo apt install -y ffmpeg")
+
+    # 就绪检查
+
+    def check(self, name: str, fn: Callable):
+        """执行一项就绪检查并记录耗时；失败时置为 failed 并重新抛出"""
+        t0 = time.perf_counter()
+        try:
+            result = fn()
+        except Exception as e:
+            self._record(name, t0, False, str(e))
+            self.mark_failed(f"{name}: {e}")
+            raise
+        self._record(name, t0, True)
+        return result
+
+    def _record(self, name, t0, ok, detail=""):
+        ms = round((time.perf_counter() - t0) * 1000, 1)
+        self.checks.append({"name": name, "ok": ok, "ms": ms, "detail": detail})
+        logger.info(f"[Lifecycle] {name}: {'OK' if ok else 'FAILED'} {ms}ms {detail}".rstrip())
+
+    def wait_engine_ready(self, engine, children_before=(), probe: Optional[Callable] = None,
+                          since: float = 0.0) -> str:
+        """等待引擎就绪，返回判定依据（hook / ready-file / probe / settled / no-children）；超时抛出 TimeoutError
+
+        就绪以正向信号为准：引擎自身的 is_ready() / ready、引擎写出的 ready_file（修改时间不早于 since）、
+        或 probe(engine) 成功（例如跑一个极短的推理）。子进程 CPU 时间稳定只用来决定何时尝试 probe：
+        CPU 不增长也可能是在等磁盘读取 / CUDA 初始化。三种信号都没有时才退回 CPU 稳定推断（settled，记警告）。
+
+        children_before：创建引擎前已存在的子进程 pid（child_pids()），不计入引擎
+        """
+        deadline = time.monotonic() + self.ready_timeout
+        since = since or self._t0
+        hook = getattr(engine, "is_ready", None)
+        has_flag = hook is not None or hasattr(engine, "ready")
+        positive = has_flag or bool(self.ready_file) or probe is not None
+        children = sorted(child_pids() - set(children_before))
+        if not positive and not children:
+            return "no-children"  # 引擎在本进程内同步加载，创建返回即就绪
+        last, stable_since = None, time.monotonic()
+        while time.monotonic() < deadline:
+            if has_flag and (hook() if callable(hook) else getattr(engine, "ready")):
+                return "hook"
+            if self.ready_file and _modified_since(self.ready_file, since):
+                return "ready-file"
+            dead = [pid for pid in children if not _alive(pid)]
+            if dead:
+                raise RuntimeError(f"引擎子进程启动后退出: pid={dead[0]}")
+            ticks = [_cpu_ticks(pid) for pid in children]  # 无 /proc 时全为 None：每个 settle 窗口尝试一次 probe
+            now = time.monotonic()
+            if ticks != last:
+                last, stable_since = ticks, now
+            elif now - stable_since >= self.settle_seconds:
+                if probe is not None:
+                    try:
+                        if probe(engine):
+                            return "probe"
+                    except Exception as e:
+                        logger.info(f"[Lifecycle] 就绪探测未通过，继续等待: {e}")
+                    stable_since = time.monotonic()  # 下一个稳定窗口再试
+                elif not positive and children and None not in ticks:
+                    logger.warning("[Lifecycle] 引擎未提供就绪信号（hook / ready_file / probe），按子进程 CPU 稳定推断就绪")
+                    return "settled"
+            time.sleep(self.poll_interval)
+        raise TimeoutError(f"{self.ready_timeout:g}s 内未收到引擎就绪信号")
+
+    def mark_ready(self):
+        self.state = READY
+        self._ready_at = time.time()
+        self._ready.set()
+        logger.info(f"[Lifecycle] 引擎就绪，启动耗时 {self._ready_at - self._t0:.1f}s")
+
+    def mark_failed(self, error: str):
+        self.state = FAILED
+        self.error = error
+        self._ready.set()
+
+    @property
+    def ready(self) -> bool:
+        return self.state == READY
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._ready.wait(timeout) and self.ready
+
+    def status(self) -> dict:
+        return {
+            "state": self.state,
+            "error": self.error,
+            "startup_seconds": round((self._ready_at or time.time()) - self._t0, 2),
+            "checks": list(self.checks),
+            "capabilities": self._caps or {},
+        }
+
+
+def _tool_version(tool: str) -> str:
+    try:
+        p = subprocess.run([tool, "-version"], capture_output=True, text=True, timeout=5)
+    except FileNotFoundError:
+        return ""
+    except Exception as e:
+        logger.warning(f"[Lifecycle] 探测 {tool} 版本失败: {e}")
+        return "unknown"
+    first = (p.stdout or "").splitlines()[:1]
+    m = re.search(r"version (\S+)", first[0]) if first else None
+    return m.group(1) if m else "unknown"
+
+
+# ── 对比测试：stub 引擎 ──
+
+def _stub_model_load(seconds, io_wait, loaded):
+    """模拟引擎子进程加载模型：先等待磁盘 / CUDA 初始化（不占 CPU），再占满 CPU 加载，之后空闲等待任务"""
+    time.sleep(io_wait)
+    end = time.time() + seconds
+    x = 0
+    while time.time() < end:
+        x += 1
+    loaded.set()
+    while True:
+        time.sleep(1)
+
+
+class _StubEngine:
+    def __init__(self, load_seconds=2.0, io_wait=0.0):
+        self.task_dic = {}
+        self.loaded = multiprocessing.Event()
+        self._proc = multiprocessing.Process(target=_stub_model_load, args=(load_seconds, io_wait, self.loaded),
+                                             daemon=True)
+        self._proc.start()
+
+    def probe(self):
+        """就绪探测（真实服务里是跑一个极短的推理）"""
+        return self.loaded.is_set()
+
+    def close(self):
+        self._proc.terminate()
+        self._proc.join()
+
+
+def _old_pre_engine(audio_path, video_path):
+    """原 _estimate_frames（入队时）+ _run_task 进入引擎前的检查"""
+    import cv2
+
+    def _estimate():
+        cap = cv2.VideoCapture(video_path)
+        video_frames, fps = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), cap.get(cv2.CAP_PROP_FPS)
+        cap.release()
+        p = subprocess.run(["ffprobe", "-v", "quiet", "-show_entries", "format=duration",
+                            "-of", "default=noprint_wrappers=1:nokey=1", audio_path],
+                           capture_output=True, text=True, timeout=10)
+        return max(video_frames, int(float(p.stdout.strip() or 0) * fps))
+
+    _estimate()
+    subprocess.run(["ffmpeg", "-version"], capture_output=True, timeout=5)
+    return _estimate()
+
+
+def _new_pre_engine(lifecycle, probe, audio_path, video_path):
+    def _estimate():
+        v = probe.probe(video_path)
+        return max(v["frames"], int(probe.probe(audio_path, video=False)["duration"] * v["fps"]))
+
+    _estimate()
+    lifecycle.require_ffmpeg()
+    return _estimate()
+
+
+if __name__ == "__main__":
+    import hashlib
+    import shutil
+    import tempfile
+
+    logging.basicConfig(level=logging.WARNING)
+    n_tasks, n_inputs = 20, 4
+    with tempfile.TemporaryDirectory() as d:
+        inputs = []
+        for i in range(n_inputs):
+            v, a = os.path.join(d, f"v{i}.mp4"), os.path.join(d, f"a{i}.wav")
+            subprocess.run(["ffmpeg", "-loglevel", "error", "-y", "-f", "lavfi",
+                            "-i", "testsrc=size=640x360:rate=25", "-t", str(4 + i), "-pix_fmt", "yuv420p", v],
+                           check=True)
+            subprocess.run(["ffmpeg", "-loglevel", "error", "-y", "-f", "lavfi",
+                            "-i", "sine=frequency=440", "-t", str(6 + i), a], check=True)
+            for src in (v, a):  # 统一存储：文件名 = 内容 MD5
+                with open(src, "rb") as f:
+                    dst = os.path.join(d, hashlib.md5(f.read()).hexdigest() + os.path.splitext(src)[1])
+                shutil.move(src, dst)
+                inputs.append(dst)
+        pairs = [(inputs[2 * i + 1], inputs[2 * i]) for i in range(n_inputs)]
+
+        # 启动：原方案固定 sleep(10)；新方案等子进程加载完即就绪
+        t0 = time.time()
+        engine = _StubEngine(load_seconds=2.0)
+        time.sleep(10)
+        old_start = time.time() - t0
+        engine.close()
+
+        lifecycle = EngineLifecycle(ready_timeout=10.0, settle_seconds=1.0)
+        t0 = time.time()
+        lifecycle.check("capabilities", lifecycle.capabilities)
+        before = child_pids()
+        engine = lifecycle.check("engine_create", lambda: _StubEngine(load_seconds=2.0))
+        how = lifecycle.check("engine_ready",
+                              lambda: lifecycle.wait_engine_ready(engine, before, probe=_StubEngine.probe))
+        lifecycle.mark_ready()
+        new_start = time.time() - t0
+        engine.close()
+        print(f"启动: 原方案 {old_start:.2f}s（sleep 10）  新方案 {new_start:.2f}s（{how}，stub 模型加载 2s）")
+
+        # 加载前先空等 2s（磁盘 / CUDA 初始化）：只看 CPU 稳定会提前判定就绪，probe 要等真正加载完
+        for use_probe in (False, True):
+            before = child_pids()
+            engine = _StubEngine(load_seconds=1.0, io_wait=2.0)
+            t = time.time()
+            how = lifecycle.wait_engine_ready(engine, before, probe=_StubEngine.probe if use_probe else None)
+            print(f"  先空等 2s 再加载 1s: {how} 用时 {time.time() - t:.2f}s，此时模型已加载={engine.loaded.is_set()}")
+            engine.close()
+
+        # 超时不再按就绪处理
+        before = child_pids()
+        engine = _StubEngine(load_seconds=0.1, io_wait=30)
+        try:
+            EngineLifecycle(ready_timeout=1.5).wait_engine_ready(engine, before, probe=_StubEngine.probe)
+            print("  超时: 未报错（错误）")
+        except TimeoutError as e:
+            print(f"  超时: {e}")
+        engine.close()
+
+        # 每任务引擎前开销（入队预估 + 进入引擎前检查），{n_inputs} 组输入循环复用
+        old_ms, new_ms = [], []
+        probe = MediaProbe()
+        for i in range(n_tasks):
+            audio, video = pairs[i % n_inputs]
+            t = time.perf_counter()
+            f_old = _old_pre_engine(audio, video)
+            old_ms.append((time.perf_counter() - t) * 1000)
+            t = time.perf_counter()
+            f_new = _new_pre_engine(lifecycle, probe, audio, video)
+            new_ms.append((time.perf_counter() - t) * 1000)
+            assert abs(f_old - f_new) <= 1, (f_old, f_new)
+        first, warm = new_ms[:n_inputs], new_ms[n_inputs:]
+        print(f"每任务引擎前开销（{n_tasks} 任务 / {n_inputs} 组输入）:")
+        print(f"  原方案: 平均 {sum(old_ms) / len(old_ms):.1f}ms")
+        print(f"  新方案: 首次 {sum(first) / len(first):.1f}ms，缓存命中 {sum(warm) / len(warm):.2f}ms  {probe.stats()}")
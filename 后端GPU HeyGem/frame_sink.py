@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+单次编码帧输出（ffmpeg stdin 管道）
+==================================
+原 _write_video_server 先用 cv2.VideoWriter(mp4v) 写临时文件，再调用 ffmpeg 重新编码为
+libx264 并合并音频：每帧编码两次，还要在磁盘上走一个来回。
+
+FfmpegFrameSink 启动一个常驻 ffmpeg 进程，通过 stdin 直接喂 BGR 原始帧
+（-f rawvideo -pix_fmt bgr24），同一遍完成 H.264 编码与音频合并。
+编码器可选 libx264（preset 可配）或 NVENC（h264_nvenc，检测到时才启用）。
+
+基准测试（CPU 合成帧，对比两次编码方案的耗时与写盘字节数）：
+  python frame_sink.py
+"""
+
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+_encoders_cache: Optional[set] = None
+_encoders_lock = threading.Lock()
+
+
+def available_encoders() -> set:
+    """ffmpeg 支持的编码器名称集合（进程内只探测一次）"""
+    global _encoders_cache
+    with _encoders_lock:
+        if _encoders_cache is None:
+            names = set()
+            try:
+                p = subprocess.run(["ffmpeg", "-hide_banner", "-encoders"],
+                                   capture_output=True, text=True, timeout=10)
+                for line in p.stdout.splitlines():
+                    parts = line.split()
+                    # 形如 " V....D libx264   libx264 H.264 / AVC ..."
+                    if len(parts) >= 2 and len(parts[0]) == 6 and parts[0][0] in "VAS":
+                        names.add(parts[1])
+            except Exception as e:
+                logger.warning(f"[FrameSink] 探测 ffmpeg 编码器失败: {e}")
+            _encoders_cache = names
+        return _encoders_cache
+
+
+def resolve_encoder(preference: str = "libx264") -> str:
+    """把配置值（libx264 / nvenc / auto）解析为实际可用的编码器名"""
+    preference = (preference or "libx264").strip().lower()
+    if preference in ("nvenc", "h264_nvenc", "auto"):
+        if "h264_nvenc" in available_encoders():
+            return "h264_nvenc"
+        if preference != "auto":
+            logger.warning("[FrameSink] 未检测到 h264_nvenc，回退 libx264")
+    return "libx264"
+
+
+def build_command(output_path: str, width: int, height: int, fps: float,
+                  audio_path: Optional[str] = None, encoder: str = "libx264",
+                  preset: str = "veryfast", crf: int = 15,
+                  keyframes: Optional[List[int]] = None) -> List[str]:
+    """构造 ffmpeg 命令：stdin 原始 BGR 帧 + 可选音频 → H.264/AAC mp4
+
+    keyframes: 在这些帧号强制 IDR 关键帧（分段缓存按帧数 stream copy 切分用）
+    """
+    cmd = [
+        "ffmpeg", "-loglevel", "warning", "-y",
+        "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}",
+        "-r", f"{fps:.6g}", "-i", "pipe:0",
+    ]
+    if audio_path:
+        cmd += ["-i", audio_path, "-map", "0:v", "-map", "1:a"]
+    if encoder == "h264_nvenc":
+        cmd += ["-c:v", "h264_nvenc", "-preset", "p4", "-rc", "vbr", "-cq", str(crf + 4), "-b:v", "0",
+                "-profile:v", "baseline"]
+    else:
+        cmd += ["-c:v", "libx264", "-preset", preset, "-profile:v", "baseline", "-level", "3.1",
+                "-crf", str(crf)]
+    cmd += ["-pix_fmt", "yuv420p"]
+    if keyframes:
+        cmd += ["-force_key_frames", "expr:" + "+".join(f"eq(n,{int(n)})" for n in keyframes)]
+        if encoder == "h264_nvenc":
+            cmd += ["-forced-idr", "1"]
+    if audio_path:
+        cmd += ["-c:a", "aac", "-shortest"]
+    cmd += ["-movflags", "+faststart", output_path]
+    return cmd
+
+
+class FfmpegFrameSink:
+    """把帧直接写入 ffmpeg stdin 的视频输出"""
+
+    def __init__(self, output_path: str, width: int, height: int, fps: float,
+                 audio_path: Optional[str] = None, encoder: str = "libx264",
+                 preset: str = "veryfast", crf: int = 15, keyframes: Optional[List[int]] = None):
+        self.output_path = output_path
+        self.width = int(width)
+        self.height = int(height)
+        self.fps = float(fps) if fps and fps > 0 else 25.0
+        self.audio_path = audio_path
+        self.encoder = encoder
+        self.frame_count = 0
+        self.cmd = build_command(output_path, self.width, self.height, self.fps,
+                                 audio_path, encoder, preset, crf, keyframes)
+        self._frame_bytes = self.width * self.height * 3
+        self._stderr = tempfile.TemporaryFile()  # 避免 stderr 管道写满阻塞 ffmpeg
+        self._proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stderr=self._stderr)
+        logger.info(f"[FrameSink] ffmpeg 已启动: {' '.join(self.cmd)}")
+
+    def write(self, img):
+        """写入一帧（BGR uint8，尺寸不符时缩放到输出尺寸）"""
+        if img.shape[0] != self.height or img.shape[1] != self.width:
+            import cv2
+            img = cv2.resize(img, (self.width, self.height))
+        buf = img.tobytes() if img.flags["C_CONTIGUOUS"] else img.copy().tobytes()
+        if len(buf) != self._frame_bytes:
+            raise ValueError(f"帧格式不符: {img.shape} {img.dtype}")
+        try:
+            self._proc.stdin.write(buf)
+        except (BrokenPipeError, OSError):
+            raise RuntimeError(f"ffmpeg 编码进程已退出: {self._read_stderr()}")
+        self.frame_count += 1
+
+    def _read_stderr(self) -> str:
+        try:
+            self._stderr.seek(0)
+            return self._stderr.read().decode("utf-8", "replace")[-800:]
+        except Exception:
+            return ""
+
+    def close(self, timeout: Optional[float] = None) -> int:
+        """结束输入并等待 ffmpeg 完成，失败时抛 RuntimeError"""
+        try:
+            self._proc.stdin.close()
+        except Exception:
+            pass
+        rc = self._proc.wait(timeout=timeout)
+        err = self._read_stderr()
+        self._stderr.close()
+        if rc != 0:
+            raise RuntimeError(f"ffmpeg 编码失败: rc={rc}, stderr={err}")
+        if err.strip():
+            logger.warning(f"[FrameSink] ffmpeg: {err.strip()}")
+        return rc
+
+    def abort(self):
+        """异常时终止 ffmpeg 并删除不完整的输出"""
+        try:
+            self._proc.kill()
+            self._proc.wait(timeout=5)
+        except Exception:
+            pass
+        try:
+            self._stderr.close()
+        except Exception:
+            pass
+        try:
+            if os.path.exists(self.output_path):
+                os.remove(self.output_path)
+        except OSError:
+            pass
+
+
+def mux_audio(video_path: str, audio_path: str, output_path: str) -> int:
+    """给已编码的视频合并音频（视频流直接复制，不重新编码）"""
+    cmd = ["ffmpeg", "-loglevel", "warning", "-y", "-i", video_path, "-i", audio_path,
+           "-map", "0:v", "-map", "1:a", "-c:v", "copy", "-c:a", "aac", "-shortest",
+           "-movflags", "+faststart", output_path]
+    return subprocess.call(cmd)
+
+
+# 基准测试：合成帧 → 两次编码（mp4v 临时文件 + libx264 重编码） vs 管道单次编码
+if __name__ == "__main__":
+    import time
+
+    import cv2
+    import numpy as np
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    W, H, FPS, N = 720, 1280, 25, 250
+
+    def frames():
+        base = np.random.RandomState(0).randint(0, 255, (H, W, 3), dtype=np.uint8)
+        for i in range(N):
+            yield np.roll(base, i * 4, axis=1)
+
+    with tempfile.TemporaryDirectory() as d:
+        audio = os.path.join(d, "a.wav")
+        subprocess.call(["ffmpeg", "-loglevel", "error", "-y", "-f", "lavfi", "-i",
+                         f"sine=frequency=440:duration={N / FPS}", audio])
+
+        t0 = time.perf_counter()
+        tmp = os.path.join(d, "t.mp4")
+        vw = cv2.VideoWriter(tmp, cv2.VideoWriter_fourcc(*"mp4v"), FPS, (W, H))
+        for img in frames():
+            vw.write(img)
+        vw.release()
+        legacy_out = os.path.join(d, "legacy.mp4")
+        subprocess.call(["ffmpeg", "-loglevel", "error", "-y", "-i", audio, "-i", tmp,
+                         "-map", "0:a", "-map", "1:v", "-c:a", "aac", "-c:v", "libx264",
+                         "-profile:v", "baseline", "-level", "3.1", "-pix_fmt", "yuv420p",
+                         "-crf", "15", "-shortest", "-movflags", "+faststart", legacy_out])
+        t_legacy = time.perf_counter() - t0
+        b_legacy = os.path.getsize(tmp) + os.path.getsize(legacy_out)
+
+        for enc in ("libx264", resolve_encoder("auto")):
+            t0 = time.perf_counter()
+            out = os.path.join(d, f"pipe_{enc}.mp4")
+            sink = FfmpegFrameSink(out, W, H, FPS, audio_path=audio, encoder=enc)
+            for img in frames():
+                sink.write(img)
+            sink.close()
+            t_pipe = time.perf_counter() - t0
+            print(f"管道单次编码[{enc}]: {t_pipe:.2f}s, 写盘 {os.path.getsize(out) / 1e6:.1f}MB")
+        print(f"两次编码(mp4v+libx264): {t_legacy:.2f}s, 写盘 {b_legacy / 1e6:.1f}MB")
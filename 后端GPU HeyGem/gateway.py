@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+生产模式 HTTP 网关（gunicorn + gevent worker）
+============================================
+run_server.py 末尾是 Flask 开发服务器 app.run(threaded=True)：每个连接一个线程，
+几百个轮询进度的客户端加上大文件下载时线程数不受限制，send_file 逐块拷贝占住线程。
+
+生产模式拆成两类进程：
+  1. 引擎进程：python run_server.py --host 127.0.0.1 --port 8384，唯一持有 GPU、任务状态、
+     调度器与各 SQLite 库，只监听本机
+  2. HTTP 进程：gunicorn -c gunicorn.conf.py gateway:app，gevent worker 承接外部连接；
+     本模块不导入引擎，worker 数可以按连接数扩展
+
+网关对请求的处理：
+  - 普通 API：经每个 worker 有上限（[serving] engine_pool）的长连接池转发给引擎，
+    上传请求体按流转发；引擎同时处理的请求数因此有界，超出的连接在网关里以协程等待
+  - 进度 / 队列轮询：按 [serving] poll_cache_ms 做短时缓存，同一 URL 的并发未命中合并为一次转发
+    （几百个客户端轮询同一队列时引擎只处理一次）
+  - 结果下载：引擎只返回文件路径（X-HeyGem-File），由网关直接发送（range_file.py：sendfile + Range / 内容 ETag），
+    不占引擎线程
+  - /ws/progress/<task_id>：网关每秒向引擎查询一次进度，有变化时推送
+
+gunicorn.conf.py 在 master 启动时拉起引擎进程、退出时结束它。
+负载测试（stub 引擎，对比开发服务器与网关的 progress / queue 延迟）：
+  python loadtest.py
+"""
+
+import configparser
+import json
+import os
+import threading
+import time
+from http.client import HTTPConnection
+from typing import List, Optional
+from urllib.parse import quote, unquote
+
+from flask import Flask, Response, jsonify, request
+
+from range_file import send_range_file
+
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+_cfg = configparser.ConfigParser()
+_cfg.read(os.path.join(_BASE_DIR, "config", "config.ini"), encoding="utf-8")
+
+# HEYGEM_ENGINE_ADDR=host:port 覆盖配置（loadtest.py 用）
+_engine_addr = os.environ.get("HEYGEM_ENGINE_ADDR", "")
+if _engine_addr:
+    ENGINE_HOST, _, _port = _engine_addr.rpartition(":")
+    ENGINE_PORT = int(_port)
+else:
+    ENGINE_HOST = _cfg.get("serving", "engine_host", fallback="127.0.0.1")
+    ENGINE_PORT = int(_cfg.get("serving", "engine_port", fallback="8384"))
+ENGINE_POOL = int(_cfg.get("serving", "engine_pool", fallback="16"))
+ENGINE_TIMEOUT = float(_cfg.get("serving", "engine_timeout_seconds", fallback="600"))
+WS_POLL_INTERVAL = float(_cfg.get("serving", "ws_poll_interval", fallback="1.0"))
+POLL_CACHE_TTL = float(_cfg.get("serving", "poll_cache_ms", fallback="500")) / 1000.0
+
+# 只读轮询接口：允许短时缓存
+_CACHED_PATHS = {"/api/heygem/progress", "/api/heygem/queue", "/api/heygem/health"}
+
+GATEWAY_HEADER = "X-HeyGem-Gateway"
+FILE_HEADER = "X-HeyGem-File"
+FILENAME_HEADER = "X-HeyGem-Filename"
+ETAG_HEADER = "X-HeyGem-ETag"
+
+# 逐跳头不转发（RFC 7230 6.1）
+_HOP_HEADERS = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+                "te", "trailer", "transfer-encoding", "upgrade", "host", "content-length"}
+
+
+class EnginePool:
+    """到引擎进程的 HTTP 长连接池；同时借出的连接数不超过 size（gevent 下等待为协程切换）"""
+
+    def __init__(self, host: str, port: int, size: int = 16, timeout: float = 600):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._sem = threading.BoundedSemaphore(max(1, size))
+        self._idle: List[HTTPConnection] = []
+        self._lock = threading.Lock()
+
+    def acquire(self) -> HTTPConnection:
+        self._sem.acquire()
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return HTTPConnection(self.host, self.port, timeout=self.timeout, blocksize=65536)
+
+    def release(self, conn: HTTPConnection, reuse: bool):
+        if reuse:
+            with self._lock:
+                self._idle.append(conn)
+        else:
+            conn.close()
+        self._sem.release()
+
+
+class PollCache:
+    """(URL, 鉴权头) -> 引擎响应的短时缓存；同一键的并发未命中只转发一次"""
+
+    def __init__(self, ttl: float, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, fetch):
+        hit = self._data.get(key)
+        if hit and hit[0] > time.monotonic():
+            return hit[1]
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            hit = self._data.get(key)
+            if hit and hit[0] > time.monotonic():
+                return hit[1]
+            value = fetch()
+            if value[0] == 200:
+                with self._lock:
+                    if len(self._data) >= self.max_entries:
+                        now = time.monotonic()
+                        for k in [k for k, v in self._data.items() if v[0] <= now]:
+                            self._data.pop(k, None)
+                            self._key_locks.pop(k, None)
+                    self._data[key] = (time.monotonic() + self.ttl, value)
+            return value
+
+
+app = Flask(__name__)
+_pool = EnginePool(ENGINE_HOST, ENGINE_PORT, ENGINE_POOL, ENGINE_TIMEOUT)
+_poll_cache = PollCache(POLL_CACHE_TTL)
+
+
+def _forward_headers() -> dict:
+    headers = {k: v for k, v in request.headers.items()
+               if k.lower() not in _HOP_HEADERS and not k.lower().startswith("x-heygem-")}
+    headers[GATEWAY_HEADER] = "1"
+    # 追加直连地址（客户端自带的 X-Forwarded-For 不可信，引擎取最后一项）
+    forwarded = request.headers.get("X-Forwarded-For", "").strip()
+    peer = request.remote_addr or ""
+    headers["X-Forwarded-For"] = f"{forwarded}, {peer}" if forwarded else peer
+    return headers
+
+
+def _engine_unavailable(e: Exception):
+    return jsonify({"code": 503, "msg": f"引擎服务不可用: {e}"}), 503
+
+
+def _fetch(method: str, target: str, headers: dict):
+    """转发一个无请求体的请求并读完响应，返回 (status, headers, body)"""
+    conn = _pool.acquire()
+    ok = False
+    try:
+        conn.request(method, target, headers=headers)
+        resp = conn.getresponse()
+        body = resp.read()
+        ok = not resp.will_close
+        return resp.status, resp.getheaders(), body
+    finally:
+        _pool.release(conn, ok)
+
+
+def _fetch_cached(target: str, headers: dict):
+    if POLL_CACHE_TTL <= 0:
+        return _fetch("GET", target, headers)
+    return _poll_cache.get((target, headers.get("Authorization", "")), lambda: _fetch("GET", target, headers))
+
+
+def _response_headers(headers) -> list:
+    return [(k, v) for k, v in headers if k.lower() not in _HOP_HEADERS and not k.lower().startswith("x-heygem-")]
+
+
+@app.route("/", defaults={"path": ""}, methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "HEAD", "PATCH"])
+@app.route("/<path:path>", methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "HEAD", "PATCH"])
+def proxy(path):
+    """转发到引擎进程；引擎返回 X-HeyGem-File 时由网关直接发送该文件"""
+    target = request.full_path if request.query_string else request.path
+    headers = _forward_headers()
+    if request.method == "GET" and request.path in _CACHED_PATHS:
+        try:
+            status, resp_headers, body = _fetch_cached(target, headers)
+        except Exception as e:
+            return _engine_unavailable(e)
+        return Response(body, status=status, headers=_response_headers(resp_headers))
+
+    body = None
+    encode_chunked = False
+    if request.content_length:
+        headers["Content-Length"] = str(request.content_length)
+        body = request.stream
+    elif request.headers.get("Transfer-Encoding", "").lower() == "chunked":
+        body = iter(lambda: request.stream.read(65536), b"")
+        encode_chunked = True
+
+    conn = _pool.acquire()
+    try:
+        conn.request(request.method, target, body=body, headers=headers, encode_chunked=encode_chunked)
+        resp = conn.getresponse()
+    except Exception as e:
+        _pool.release(conn, False)
+        return _engine_unavailable(e)
+
+    out_headers = _response_headers(resp.getheaders())
+    file_path = resp.getheader(FILE_HEADER)
+    if file_path:
+        resp.read()
+        _pool.release(conn, not resp.will_close)
+        file_path = unquote(file_path)
+        if not os.path.isfile(file_path):
+            return jsonify({"code": 404, "msg": "结果文件不存在"}), 404
+        r = send_range_file(file_path, mimetype=resp.getheader("Content-Type", "video/mp4"),
+                            download_name=unquote(resp.getheader(FILENAME_HEADER, os.path.basename(file_path))),
+                            etag=resp.getheader(ETAG_HEADER))
+        for k, v in out_headers:
+            if k.lower().startswith("access-control-"):
+                r.headers[k] = v
+        return r
+
+    def _stream():
+        done = False
+        try:
+            while True:
+                chunk = resp.read(65536)
+                if not chunk:
+                    done = True
+                    break
+                yield chunk
+        finally:
+            _pool.release(conn, done and not resp.will_close)
+
+    if request.method == "HEAD":
+        resp.read()
+        _pool.release(conn, not resp.will_close)
+        out_headers += [("Content-Length", resp.getheader("Content-Length", "0"))]
+        return Response(b"", status=resp.status, headers=out_headers)
+    length = resp.getheader("Content-Length")
+    if length is not None:
+        out_headers.append(("Content-Length", length))
+    return Response(_stream(), status=resp.status, headers=out_headers, direct_passthrough=True)
+
+
+try:
+    from flask_sock import Sock
+    _sock: Optional[Sock] = Sock(app)
+except ImportError:
+    _sock = None
+
+if _sock is not None:
+    @_sock.route("/ws/progress/<task_id>")
+    def ws_progress(ws, task_id):
+        """与引擎的 /ws/progress 相同的推送协议；进度改为网关定时查询引擎"""
+        token = request.args.get("token", "").strip()
+        last_sent = None
+        try:
+            while True:
+                headers = {GATEWAY_HEADER: "1"}
+                if token:
+                    headers["Authorization"] = f"Bearer {token}"
+                try:
+                    status, _, body = _fetch_cached(f"/api/heygem/progress?task_id={quote(task_id)}", headers)
+                    msg = json.loads(body or b"{}")
+                except Exception as e:
+                    ws.send(json.dumps({"code": 503, "msg": f"引擎服务不可用: {e}"}))
+                    break
+                if msg.get("code") != 0:
+                    ws.send(json.dumps(msg))
+                    break
+                data = msg["data"]
+                is_terminal = data["status"] in ("done", "error")
+                data_key = (data["status"], data["progress"], data["current_frame"])
+                if is_terminal or data_key != last_sent:
+                    ws.send(json.dumps(msg))
+                    last_sent = data_key
+                if is_terminal:
+                    break
+                time.sleep(WS_POLL_INTERVAL)
+        except Exception:
+            pass
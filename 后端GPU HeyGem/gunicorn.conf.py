@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+生产模式启动配置（参数来自 config.ini [serving]）
+
+  pip install -r requirements_serving.txt
+  gunicorn -c gunicorn.conf.py gateway:app
+
+master 启动时拉起引擎进程（run_server.py，只监听 engine_host:engine_port，唯一持有 GPU），
+HTTP 由 gevent worker 承接（见 gateway.py）；engine_external = 1 时引擎由外部单独启动。
+"""
+
+import configparser
+import os
+import subprocess
+import sys
+
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+_cfg = configparser.ConfigParser()
+_cfg.read(os.path.join(_BASE_DIR, "config", "config.ini"), encoding="utf-8")
+
+bind = [_cfg.get("serving", "bind", fallback="0.0.0.0:8383")]
+workers = int(_cfg.get("serving", "workers", fallback="2"))
+worker_class = "gevent"
+worker_connections = int(_cfg.get("serving", "worker_connections", fallback="1000"))
+# 上传 / 下载大文件时请求可能持续很久；gevent worker 的心跳不受单个请求阻塞
+timeout = int(_cfg.get("serving", "worker_timeout_seconds", fallback="120"))
+keepalive = 5
+chdir = _BASE_DIR
+
+_ENGINE_HOST = _cfg.get("serving", "engine_host", fallback="127.0.0.1")
+_ENGINE_PORT = _cfg.get("serving", "engine_port", fallback="8384")
+_ENGINE_EXTERNAL = _cfg.get("serving", "engine_external", fallback="0").strip() == "1"
+_engine = None
+
+
+def on_starting(server):
+    """master 进程启动：拉起引擎进程（在 fork HTTP worker 之前，worker 不继承引擎）"""
+    global _engine
+    if _ENGINE_EXTERNAL:
+        server.log.info(f"[Serving] 使用外部引擎进程: {_ENGINE_HOST}:{_ENGINE_PORT}")
+        return
+    cmd = [sys.executable, os.path.join(_BASE_DIR, "run_server.py"),
+           "--host", _ENGINE_HOST, "--port", str(_ENGINE_PORT)]
+    _engine = subprocess.Popen(cmd, cwd=_BASE_DIR)
+    server.log.info(f"[Serving] 引擎进程已启动: pid={_engine.pid} {_ENGINE_HOST}:{_ENGINE_PORT}")
+
+
+def on_exit(server):
+    if _engine is None or _engine.poll() is not None:
+        return
+    server.log.info(f"[Serving] 停止引擎进程: pid={_engine.pid}")
+    _engine.terminate()
+    try:
+        _engine.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        _engine.kill()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+产物索引与后台清理（janitor）
+============================
+原 _cleanup_old_files 每小时对 UPLOAD_DIR / OUTPUT_DIR / STORE_DIR 做 os.listdir + stat 全量扫描：
+产物达到几十万个时是一次数秒的 I/O 风暴，与 _write_video_server 抢磁盘；而且它只看 mtime，
+分不清文件是否还被排队中的任务或资产记录引用。
+
+本模块把服务器创建的每个产物（上传文件、任务输出目录、编辑目录、临时文件……）登记到
+artifacts.db，记录 owner（所属任务）、kind、expires_at：
+  1. 清理只按 expires_at 索引取到期条目，每批 batch_size 个，按 max_deletes_per_sec 限速
+  2. 删除前调用 in_use(rows) 询问调用方哪些路径仍被引用；被引用的条目顺延 defer_seconds 后再检查
+  3. 文件复用（上传去重命中等）时 touch() 顺延到期时间
+  4. 升级前已存在的文件由 adopt() 在首次启动时导入一次（按 mtime + TTL 计算到期），之后不再扫目录
+
+基准测试（20 万个文件：登记、到期清理耗时，对比 listdir + stat 全量扫描）：
+  python janitor.py
+"""
+
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from typing import Callable, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class Janitor:
+    """产物索引 + 按到期时间分批限速清理"""
+
+    def __init__(self, db_path: str, batch_size: int = 200, max_deletes_per_sec: float = 500,
+                 defer_seconds: float = 3600,
+                 in_use: Optional[Callable[[List[sqlite3.Row]], Set[str]]] = None):
+        """
+        Args:
+            db_path: SQLite 文件路径
+            batch_size: 每批取出的到期条目数
+            max_deletes_per_sec: 删除速率上限（0 = 不限速）
+            defer_seconds: 仍被引用的条目顺延多久再检查
+            in_use: 回调，传入一批到期条目（path / kind / owner），返回其中仍被引用的路径集合
+        """
+        self.batch_size = batch_size
+        self.max_deletes_per_sec = max_deletes_per_sec
+        self.defer_seconds = defer_seconds
+        self.in_use = in_use
+        self.deleted = 0
+        self.deferred = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+        CREATE TABLE IF NOT EXISTS artifacts (
+            path TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            owner TEXT NOT NULL DEFAULT '',
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_artifacts_expires ON artifacts(expires_at);
+        CREATE INDEX IF NOT EXISTS idx_artifacts_owner ON artifacts(owner);
+        CREATE TABLE IF NOT EXISTS janitor_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        """)
+        logger.info(f"[Janitor] 产物索引就绪: {db_path}")
+
+    # ── 登记 ──
+
+    def track(self, path: str, kind: str, ttl: float, owner: str = ""):
+        """登记（或刷新）一个产物，ttl 秒后到期"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO artifacts (path, kind, owner, created_at, expires_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET kind=excluded.kind, owner=excluded.owner, "
+                "expires_at=MAX(artifacts.expires_at, excluded.expires_at)",
+                (os.path.abspath(path), kind, owner, now, now + ttl))
+
+    def touch(self, path: str, ttl: float):
+        """产物被复用：到期时间顺延到 now + ttl（未登记的路径忽略）"""
+        with self._lock:
+            self._conn.execute("UPDATE artifacts SET expires_at=MAX(expires_at, ?) WHERE path=?",
+                               (time.time() + ttl, os.path.abspath(path)))
+
+    def untrack(self, path: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM artifacts WHERE path=?", (os.path.abspath(path),))
+
+    def live(self, paths: List[str]) -> Set[str]:
+        """paths 中已登记且尚未到期的路径"""
+        if not paths:
+            return set()
+        abs_paths = {os.path.abspath(p): p for p in paths}
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT path FROM artifacts WHERE expires_at>? AND path IN ({', '.join('?' * len(abs_paths))})",
+                [time.time()] + list(abs_paths)).fetchall()
+        return {abs_paths[r["path"]] for r in rows}
+
+    def adopt(self, directory: str, kind: str, ttl: float, skip: Callable[[str], bool] = None) -> int:
+        """导入目录下已有的一级条目（每个目录只做一次），返回导入条数"""
+        directory = os.path.abspath(directory)
+        key = f"adopted:{directory}"
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM janitor_meta WHERE key=?", (key,)).fetchone():
+                return 0
+        rows = []
+        if os.path.isdir(directory):
+            with os.scandir(directory) as it:
+                for e in it:
+                    if skip and skip(e.name):
+                        continue
+                    try:
+                        mtime = e.stat(follow_symlinks=False).st_mtime
+                    except OSError:
+                        continue
+                    rows.append((e.path, kind, "", mtime, mtime + ttl))
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("INSERT OR IGNORE INTO artifacts (path, kind, owner, created_at, expires_at) "
+                                   "VALUES (?, ?, ?, ?, ?)", rows)
+            self._conn.execute("INSERT OR REPLACE INTO janitor_meta (key, value) VALUES (?, ?)",
+                               (key, str(time.time())))
+            self._conn.execute("COMMIT")
+        if rows:
+            logger.info(f"[Janitor] 导入已有文件 {len(rows)} 个: {directory}")
+        return len(rows)
+
+    # ── 清理 ──
+
+    @staticmethod
+    def _remove(path: str):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def sweep(self, now: Optional[float] = None, max_batches: int = 0) -> int:
+        """删除到期且未被引用的产物，返回删除条数（max_batches=0 表示清到没有到期条目为止）"""
+        now = now or time.time()
+        total = 0
+        batches = 0
+        while not self._stop.is_set():
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT path, kind, owner FROM artifacts WHERE expires_at<=? ORDER BY expires_at LIMIT ?",
+                    (now, self.batch_size)).fetchall()
+            if not rows:
+                break
+            busy = set()
+            if self.in_use is not None:
+                try:
+                    busy = self.in_use(rows)
+                except Exception as e:
+                    logger.warning(f"[Janitor] 引用检查失败，本批全部顺延: {e}")
+                    busy = {r["path"] for r in rows}
+            t0 = time.time()
+            removed = []
+            for r in rows:
+                if r["path"] in busy:
+                    continue
+                try:
+                    self._remove(r["path"])
+                    removed.append((r["path"],))
+                except Exception as e:
+                    logger.warning(f"[Janitor] 删除失败 {r['path']}: {e}")
+                    busy.add(r["path"])
+            with self._lock:
+                self._conn.execute("BEGIN")
+                self._conn.executemany("DELETE FROM artifacts WHERE path=?", removed)
+                if busy:
+                    self._conn.executemany("UPDATE artifacts SET expires_at=? WHERE path=?",
+                                           [(now + self.defer_seconds, p) for p in busy])
+                self._conn.execute("COMMIT")
+            total += len(removed)
+            self.deleted += len(removed)
+            self.deferred += len(busy)
+            batches += 1
+            if max_batches and batches >= max_batches:
+                break
+            if self.max_deletes_per_sec > 0 and removed:
+                # 限速：让出磁盘给合成 / 编码
+                wait = len(removed) / self.max_deletes_per_sec - (time.time() - t0)
+                if wait > 0 and self._stop.wait(wait):
+                    break
+        return total
+
+    def start(self, interval: float = 60, on_sweep: Optional[Callable[[float, int], None]] = None):
+        """后台线程：每 interval 秒清理一次到期产物；on_sweep(耗时秒, 删除数) 供指标统计"""
+        def _run():
+            while not self._stop.wait(interval):
+                try:
+                    t0 = time.perf_counter()
+                    n = self.sweep()
+                    if on_sweep is not None:
+                        on_sweep(time.perf_counter() - t0, n)
+                    if n:
+                        logger.info(f"[Janitor] 清理到期产物 {n} 个")
+                except Exception as e:
+                    logger.error(f"[Janitor] 清理异常: {e}", exc_info=True)
+
+        self._thread = threading.Thread(target=_run, name="janitor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def stats(self) -> dict:
+        with self._lock:
+            n, due = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(expires_at<=?), 0) FROM artifacts", (time.time(),)).fetchone()
+        return {"tracked": n, "due": due, "deleted": self.deleted, "deferred": self.deferred}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# 基准测试：20 万个文件，一半到期；另有一批仍被引用的到期文件必须保留
+if __name__ == "__main__":
+    import tempfile
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    N, DIRS, TTL = 200000, 4, 86400
+
+    with tempfile.TemporaryDirectory() as d:
+        dirs = [os.path.join(d, f"dir{i}") for i in range(DIRS)]
+        for x in dirs:
+            os.makedirs(x)
+        now = time.time()
+        paths = []
+        for i in range(N):
+            p = os.path.join(dirs[i % DIRS], f"f{i:06d}.bin")
+            open(p, "wb").close()
+            if i % 2 == 0:
+                os.utime(p, (now - 2 * TTL, now - 2 * TTL))
+            paths.append(p)
+        referenced = {p for i, p in enumerate(paths) if i % 2 == 0 and i % 1000 == 0}
+
+        t0 = time.perf_counter()
+        n_scan = sum(1 for x in dirs for name in os.listdir(x)
+                     if now - os.path.getmtime(os.path.join(x, name)) > TTL)
+        t_scan = time.perf_counter() - t0
+
+        jan = Janitor(os.path.join(d, "artifacts.db"), batch_size=500, max_deletes_per_sec=0,
+                      in_use=lambda rows: {r["path"] for r in rows} & referenced)
+        t0 = time.perf_counter()
+        adopted = sum(jan.adopt(x, "file", TTL) for x in dirs)
+        t_adopt = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        jan.track(os.path.join(d, "new.bin"), "file", TTL, owner="task1")
+        t_track = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        deleted = jan.sweep(now)
+        t_sweep = time.perf_counter() - t0
+        kept = all(os.path.exists(p) for p in referenced)
+
+        t0 = time.perf_counter()
+        jan.sweep(now)  # 没有到期条目时的一次空清理（后台线程的常态）
+        t_idle = time.perf_counter() - t0
+        st = jan.stats()
+        jan.close()
+
+    print(f"{N} 个文件: listdir+stat 全量扫描(仅判断不删除) {t_scan * 1000:.0f}ms, 到期 {n_scan} 个")
+    print(f"首次导入 {adopted} 个: {t_adopt * 1000:.0f}ms, 单次登记 {t_track * 1e6:.0f}µs")
+    print(f"按索引清理: 删除 {deleted} 个 {t_sweep * 1000:.0f}ms, 被引用保留={kept} "
+          f"(顺延 {len(referenced)} 个), 空清理 {t_idle * 1e6:.0f}µs, 统计={st}")
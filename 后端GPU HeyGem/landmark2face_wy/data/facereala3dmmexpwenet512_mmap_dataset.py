@@ -0,0 +1,112 @@
+import os.path
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from data.base_dataset import BaseDataset
+from data.Facereala3dmmexpwenet512_dataset import Facereala3dmmexpwenet512Dataset, get_idts
+from data.feature_store import FeatureStore, FeatureStoreWriter, source_signature, store_is_current
+
+
+def get_store_path(opt, mode):
+    return os.path.join(opt.feature_path, '.feature_store',
+                        '{}_{}_{}_{}'.format(opt.name.split('_')[0], opt.img_size, mode, opt.audio_feature))
+
+
+def get_source_paths(opt, mode, idt_name):
+    root = os.path.join(opt.feature_path, idt_name)
+    if opt.audio_feature == "3dmm":
+        training_data_path = os.path.join(root, '{}_{}.t7'.format(opt.img_size, mode))
+    else:
+        training_data_path = os.path.join(root, '{}_{}_{}.t7'.format(opt.img_size, mode, opt.audio_feature))
+    paths = {'feature': os.path.join(root, '%s.npy' % opt.audio_feature), 't7': training_data_path}
+    if mode == 'train':
+        paths['wenet'] = os.path.join(root, 'audio_wenet_feature.npy')
+        paths['audio_data'] = os.path.join(root, 'audio_data.npy')
+    return root, paths
+
+
+def pack_feature_store(opt, mode, idts, store_path, signature=''):
+    """按 Facereala3dmmexpwenet512Dataset 的读取方式逐个 idt 读入并追加写入打包目录（只在首次 / 源文件变化时执行）"""
+    with FeatureStoreWriter(store_path, keys=('3dmm', 'wenet'), signature=signature) as writer:
+        for idt_name in idts:
+            root, paths = get_source_paths(opt, mode, idt_name)
+            feature = np.load(paths['feature'])
+            feature1 = np.load(paths['wenet']) if mode == 'train' else np.zeros((0, 0), dtype=feature.dtype)
+            training_data = torch.load(paths['t7'])
+            img_paths = training_data['img_paths']
+            features_3dmm = training_data['features_3dmm']
+            if mode == 'train':
+                audio_features = np.load(paths['audio_data'], allow_pickle=True).tolist()
+            else:
+                audio_features = [(0, 0)] * len(img_paths)
+            frames = []
+            for img in range(len(img_paths)):
+                frames.append((img_paths[img][0].split('/')[-1], int(features_3dmm[img]),
+                               int(audio_features[img][0]), int(audio_features[img][1])))
+            writer.add_clip(idt_name, '{}/{}_dlib_crop'.format(root, opt.img_size),
+                            {'3dmm': feature, 'wenet': feature1}, frames)
+
+
+class FeatureStoreLabels:
+    """self.labels 的只读视图：按需从 frames memmap 生成 [img_path, feature_3dmm_idx, audio_feature]"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, idx):
+        row = self.store.frame(int(idx))
+        return [self.store.img_path(int(idx)), int(row['feat_idx']), (int(row['audio_lo']), int(row['audio_hi']))]
+
+
+class FeatureStoreDict:
+    """self.new_dict 的只读视图：idt 名称 -> [3dmm, wenet, wenet]（features.bin 上的 memmap 视图）"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, idt_name):
+        clip = self.store.clip_ids[idt_name]
+        feature1 = self.store.array(clip, 'wenet')
+        return [self.store.array(clip, '3dmm'), feature1, feature1]
+
+    def __contains__(self, idt_name):
+        return idt_name in self.store.clip_ids
+
+
+class Facereala3dmmexpwenet512MmapDataset(Facereala3dmmexpwenet512Dataset):
+    """同 Facereala3dmmexpwenet512Dataset（--dataset_mode facereala3dmmexpwenet512_mmap），特征改为打包 memmap：
+
+    首次运行把各 idt 的 .npy / .t7 打包到 feature_path/.feature_store/ 下，之后启动只打开 memmap，
+    逐帧标签与特征按需读取，DataLoader worker 共享同一批只读页。__getitem__ 沿用父类实现。
+    """
+
+    def __init__(self, opt, mode=None):
+        BaseDataset.__init__(self, opt)
+        mode = mode or 'train'
+        idts = get_idts(opt.name.split('_')[0])
+        print("---------load data list--------: ", idts)
+        store_path = get_store_path(opt, mode)
+        sources = []
+        for idt_name in idts:
+            sources += sorted(get_source_paths(opt, mode, idt_name)[1].values())
+        signature = source_signature(sources)
+        if not store_is_current(store_path, signature):
+            print("---------pack feature store--------: ", store_path)
+            pack_feature_store(opt, mode, idts, store_path, signature)
+        self.store = FeatureStore(store_path)
+        self.labels = FeatureStoreLabels(self.store)
+        self.new_dict = FeatureStoreDict(self.store)
+        self.label_starts, self.label_ends = self.store.clip_bounds()
+        self.transforms_image = transforms.Compose([transforms.ToTensor(),
+                                                    transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
+
+        self.transforms_label = transforms.Compose([transforms.ToTensor(),
+                                                    transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
+        self.shuffle()
+
+    def shuffle(self):
+        # 打乱顺序用 int64 数组（列表每个元素是一个 Python int 对象）
+        self.labels_index = np.random.permutation(len(self.labels))
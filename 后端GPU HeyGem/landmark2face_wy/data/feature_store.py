@@ -0,0 +1,392 @@
+"""Packed, memory-mapped feature store for the landmark2face datasets
+
+原 *_dataset.py 在 __init__ 里对每个 idt 逐个 np.load 3dmm / wenet 特征并 torch.load .t7，
+再逐帧 append [img_path, idx, audio_range] 到 Python 列表：启动时间与常驻内存随语料线性增长，
+DataLoader fork 出的每个 worker 还会因引用计数写入把这些列表所在页逐渐复制一份。
+
+本模块把语料打包成一个目录：
+  features.bin   所有特征矩阵首尾相接（64 字节对齐，保留原 dtype），按需 memmap
+  arrays.npy     (clips, keys) 结构化数组：每个矩阵的偏移 / dtype / shape
+  frames.npy     逐帧结构化数组（clip, feat_idx, audio_lo, audio_hi, name_off, name_len），mmap 打开
+  names.bin      逐帧图片文件名（utf-8 首尾相接）
+  meta.json      keys / clip 名称 / 图片目录 / 源文件签名（签名变化时重新打包）
+
+FeatureStore 打开时只读 meta.json，其余全部 mmap；memmap 句柄按进程惰性打开，pickle 时不带数据，
+DataLoader worker（fork 或 spawn）各自映射同一批只读页。
+
+基准测试（合成 10k clips 语料，对比逐个 np.load + Python 列表与打包 memmap 的启动时间 / 峰值内存）：
+  python feature_store.py
+  python feature_store.py --clips 10000 --frames 40
+"""
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+STORE_VERSION = 1
+_ALIGN = 64
+
+FRAME_DTYPE = np.dtype([
+    ('clip', '<i4'),
+    ('feat_idx', '<i4'),
+    ('audio_lo', '<i4'),
+    ('audio_hi', '<i4'),
+    ('name_off', '<i8'),
+    ('name_len', '<i4'),
+])
+ARRAY_DTYPE = np.dtype([
+    ('offset', '<i8'),
+    ('dtype', 'S8'),
+    ('ndim', '<i4'),
+    ('shape', '<i8', (4,)),
+])
+
+
+def source_signature(paths):
+    """源文件签名（路径 + 大小 + mtime），打包结果与源文件不一致时重新打包"""
+    items = []
+    for p in paths:
+        st = os.stat(p)
+        items.append('%s:%d:%d' % (p, st.st_size, int(st.st_mtime)))
+    return hashlib.md5('\n'.join(items).encode('utf-8')).hexdigest()
+
+
+def store_is_current(root, signature=None):
+    """root 下已有完整的打包结果（且签名一致）"""
+    try:
+        with open(os.path.join(root, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return meta.get('version') == STORE_VERSION and (signature is None or meta.get('signature') == signature)
+
+
+class FeatureStoreWriter:
+    """逐 clip 追加写入（内存峰值 = 单个 clip 的特征），close() 时原子地换入 root"""
+
+    def __init__(self, root, keys, signature=''):
+        self.root = root
+        self.keys = list(keys)
+        self.signature = signature
+        self._tmp = '%s.tmp-%d' % (root.rstrip('/'), os.getpid())
+        shutil.rmtree(self._tmp, ignore_errors=True)
+        os.makedirs(self._tmp)
+        self._features = open(os.path.join(self._tmp, 'features.bin'), 'wb')
+        self._names = open(os.path.join(self._tmp, 'names.bin'), 'wb')
+        self._names_off = 0
+        self._frames = []
+        self._arrays = []
+        self._clips = []
+        self._image_dirs = []
+        self._count = 0
+
+    def add_clip(self, name, image_dir, arrays, frames):
+        """arrays: {key: ndarray}；frames: [(图片文件名, feat_idx, audio_lo, audio_hi)]"""
+        clip = len(self._clips)
+        row = np.zeros(len(self.keys), dtype=ARRAY_DTYPE)
+        for k, key in enumerate(self.keys):
+            arr = np.ascontiguousarray(arrays[key])
+            if arr.ndim > 4:
+                raise ValueError('%s/%s: ndim > 4' % (name, key))
+            pad = -self._features.tell() % _ALIGN
+            self._features.write(b'\0' * pad)
+            row[k]['offset'] = self._features.tell()
+            row[k]['dtype'] = arr.dtype.str.encode()
+            row[k]['ndim'] = arr.ndim
+            row[k]['shape'][:arr.ndim] = arr.shape
+            self._features.write(arr.tobytes())
+        self._arrays.append(row)
+
+        rows = np.zeros(len(frames), dtype=FRAME_DTYPE)
+        for i, (img_name, feat_idx, audio_lo, audio_hi) in enumerate(frames):
+            b = img_name.encode('utf-8')
+            rows[i] = (clip, feat_idx, audio_lo, audio_hi, self._names_off, len(b))
+            self._names.write(b)
+            self._names_off += len(b)
+        self._frames.append(rows)
+        self._clips.append(name)
+        self._image_dirs.append(image_dir)
+        self._count += len(frames)
+
+    def close(self):
+        self._features.close()
+        self._names.close()
+        arrays = np.stack(self._arrays) if self._arrays else np.zeros((0, len(self.keys)), dtype=ARRAY_DTYPE)
+        np.save(os.path.join(self._tmp, 'arrays.npy'), arrays)
+        frames = np.concatenate(self._frames) if self._frames else np.zeros(0, dtype=FRAME_DTYPE)
+        np.save(os.path.join(self._tmp, 'frames.npy'), frames)
+        with open(os.path.join(self._tmp, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({'version': STORE_VERSION, 'keys': self.keys, 'clips': self._clips,
+                       'image_dirs': self._image_dirs, 'frames': self._count,
+                       'signature': self.signature}, f)
+        # 多个进程（DDP rank）同时打包时先完成的生效，其余丢弃自己的结果
+        if os.path.isdir(self.root):
+            old = '%s.old-%d' % (self.root.rstrip('/'), os.getpid())
+            os.rename(self.root, old)
+            shutil.rmtree(old, ignore_errors=True)
+        try:
+            os.rename(self._tmp, self.root)
+        except OSError:
+            shutil.rmtree(self._tmp, ignore_errors=True)
+
+    def abort(self):
+        for f in (self._features, self._names):
+            f.close()
+        shutil.rmtree(self._tmp, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class FeatureStore:
+    """只读打开打包结果：逐帧索引与特征均为 memmap，按进程惰性映射，可安全传给 DataLoader worker"""
+
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('version') != STORE_VERSION:
+            raise ValueError('feature store version mismatch: %s' % root)
+        self.keys = meta['keys']
+        self.clips = meta['clips']
+        self.image_dirs = meta['image_dirs']
+        self.clip_ids = {name: i for i, name in enumerate(self.clips)}
+        self._key_ids = {k: i for i, k in enumerate(self.keys)}
+        self._pid = None
+
+    def _open(self):
+        if self._pid == os.getpid():
+            return
+        self._frames = np.load(os.path.join(self.root, 'frames.npy'), mmap_mode='r')
+        arrays = np.load(os.path.join(self.root, 'arrays.npy'))
+        # (clips, keys) 个矩阵的偏移 / shape 拆成普通数组；dtype 只有少数几种，换成编号
+        self._offsets = arrays['offset']
+        self._ndims = arrays['ndim']
+        self._shapes = arrays['shape']
+        names, self._dtype_ids = np.unique(arrays['dtype'], return_inverse=True)
+        self._dtype_ids = self._dtype_ids.reshape(arrays.shape)
+        self._dtypes = [np.dtype(d.decode()) for d in names]
+        size = os.path.getsize(os.path.join(self.root, 'features.bin'))
+        self._features = np.memmap(os.path.join(self.root, 'features.bin'), dtype=np.uint8, mode='r',
+                                   shape=(max(size, 1),)) if size else np.zeros(1, dtype=np.uint8)
+        self._names = np.memmap(os.path.join(self.root, 'names.bin'), dtype=np.uint8, mode='r') \
+            if os.path.getsize(os.path.join(self.root, 'names.bin')) else np.zeros(0, dtype=np.uint8)
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ('_frames', '_features', '_names', '_offsets', '_ndims', '_shapes', '_dtype_ids', '_dtypes'):
+            state.pop(k, None)
+        state['_pid'] = None
+        return state
+
+    def __len__(self):
+        self._open()
+        return len(self._frames)
+
+    @property
+    def frames(self):
+        """逐帧结构化数组（memmap，只读）"""
+        self._open()
+        return self._frames
+
+    def frame(self, i):
+        self._open()
+        return self._frames[i]
+
+    def img_path(self, i):
+        self._open()
+        row = self._frames[i]
+        off, n = int(row['name_off']), int(row['name_len'])
+        name = self._names[off:off + n].tobytes().decode('utf-8')
+        return os.path.join(self.image_dirs[int(row['clip'])], name)
+
+    def array(self, clip, key):
+        """clip 的特征矩阵（features.bin 上的只读视图，切片时才读盘）"""
+        self._open()
+        k = self._key_ids[key]
+        shape = tuple(self._shapes[clip, k, :self._ndims[clip, k]].tolist())
+        return np.ndarray(shape, dtype=self._dtypes[self._dtype_ids[clip, k]], buffer=self._features,
+                          offset=int(self._offsets[clip, k]))
+
+    def clip_bounds(self):
+        """每个 clip 的逐帧区间 [starts, ends)（frames 按 clip 顺序写入）"""
+        self._open()
+        counts = np.bincount(self._frames['clip'], minlength=len(self.clips))
+        ends = np.cumsum(counts)
+        return ends - counts, ends
+
+
+# 基准测试：合成 N 个 clip 的语料（布局同 Facereala3dmmexpwenet512Dataset 的输入），
+# 子进程内分别做 逐个 np.load + Python 标签列表 / 打开打包 memmap，比较启动时间、峰值 RSS 与随机读取
+if __name__ == '__main__':
+    import argparse
+    import multiprocessing
+    import pickle
+    import resource
+    import subprocess
+    import sys
+    import tempfile
+    import time
+
+    def seq_index(index, num_frames):
+        return [min(max(i, 0), num_frames - 1) for i in range(index - 10, index + 10)]
+
+    def sample(features, features1, feat_idx, audio_lo, audio_hi):
+        """同 Facereala3dmmexpwenet512_dataset.get_3dmm_feature"""
+        idx_list = seq_index(feat_idx, features.shape[0])
+        feature1 = features1[:, audio_lo:audio_hi]
+        feature = np.concatenate([features[idx_list, 80:144], features[idx_list, -3:],
+                                  np.transpose(feature1, (1, 0))], 1)
+        return np.transpose(feature, (1, 0))
+
+    def legacy_load(corpus):
+        new_dict, labels = {}, []
+        for idt_name in sorted(os.listdir(corpus)):
+            root = os.path.join(corpus, idt_name)
+            feature = np.load(os.path.join(root, '3dmm.npy'))
+            feature1 = np.load(os.path.join(root, 'audio_wenet_feature.npy'))
+            new_dict[idt_name] = [feature, feature1, feature1]
+            with open(os.path.join(root, '512_train.t7'), 'rb') as f:
+                training_data = pickle.load(f)
+            audio_features = np.load(os.path.join(root, 'audio_data.npy'), allow_pickle=True).tolist()
+            image_dir = '{}/512_dlib_crop'.format(root)
+            for img, p in enumerate(training_data['img_paths']):
+                labels.append([os.path.join(image_dir, p[0].split('/')[-1]),
+                               training_data['features_3dmm'][img], audio_features[img]])
+        order = list(range(len(labels)))
+        return new_dict, labels, order
+
+    def pack(corpus, out):
+        with FeatureStoreWriter(out, keys=('3dmm', 'wenet')) as w:
+            for idt_name in sorted(os.listdir(corpus)):
+                root = os.path.join(corpus, idt_name)
+                with open(os.path.join(root, '512_train.t7'), 'rb') as f:
+                    training_data = pickle.load(f)
+                audio_features = np.load(os.path.join(root, 'audio_data.npy'), allow_pickle=True).tolist()
+                frames = [(p[0].split('/')[-1], training_data['features_3dmm'][k]) + tuple(audio_features[k])
+                          for k, p in enumerate(training_data['img_paths'])]
+                w.add_clip(idt_name, '{}/512_dlib_crop'.format(root),
+                           {'3dmm': np.load(os.path.join(root, '3dmm.npy')),
+                            'wenet': np.load(os.path.join(root, 'audio_wenet_feature.npy'))}, frames)
+
+    def store_sample(store, i):
+        row = store.frame(i)
+        clip = int(row['clip'])
+        return sample(store.array(clip, '3dmm'), store.array(clip, 'wenet'),
+                      int(row['feat_idx']), int(row['audio_lo']), int(row['audio_hi']))
+
+    def worker_checksum(args):
+        store, idx = args
+        return float(sum(store_sample(store, int(i)).sum() for i in idx)), len(store.img_path(int(idx[0])))
+
+    def proc_mb(field):
+        """/proc/self/status 中的内存项（MB）：VmRSS 含已映射的文件页，RssAnon 只算进程私有内存"""
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+        return 0.0
+
+    def child(mode, corpus, store_dir, n_access):
+        t0 = time.perf_counter()
+        if mode == 'baseline':
+            startup = 0.0
+            startup_rss = proc_mb('VmRSS')
+            n = 0
+        elif mode == 'legacy':
+            new_dict, labels, order = legacy_load(corpus)
+            startup = time.perf_counter() - t0
+            startup_rss = proc_mb('VmRSS')
+            n = len(labels)
+            rng = np.random.RandomState(0)
+            t1 = time.perf_counter()
+            total = 0.0
+            for i in rng.randint(0, n, n_access):
+                img_path, feat_idx, (lo, hi) = labels[order[i]]
+                features, features1, _ = new_dict[img_path.split('/')[-3]]
+                total += float(sample(features, features1, feat_idx, lo, hi).sum())
+        else:
+            store = FeatureStore(store_dir)
+            order = np.random.permutation(len(store))
+            starts, ends = store.clip_bounds()
+            startup = time.perf_counter() - t0
+            startup_rss = proc_mb('VmRSS')
+            n = len(store)
+            rng = np.random.RandomState(0)
+            t1 = time.perf_counter()
+            total = 0.0
+            for i in rng.randint(0, n, n_access):
+                total += float(store_sample(store, int(i)).sum())
+        access = (time.perf_counter() - t1) if mode != 'baseline' else 0.0
+        print(json.dumps({'startup_s': startup, 'frames': n, 'checksum': total if mode != 'baseline' else 0,
+                          'access_us': access / n_access * 1e6 if mode != 'baseline' else 0,
+                          'startup_rss_mb': startup_rss, 'anon_mb': proc_mb('RssAnon'),
+                          'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}))
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--clips', type=int, default=10000)
+    ap.add_argument('--frames', type=int, default=40, help='每个 clip 的帧数')
+    ap.add_argument('--access', type=int, default=20000, help='随机读取次数')
+    ap.add_argument('--child', nargs=3, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+    if args.child:
+        child(args.child[0], args.child[1], args.child[2], args.access)
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory() as d:
+        corpus, store_dir = os.path.join(d, 'feature'), os.path.join(d, 'store')
+        t0 = time.perf_counter()
+        rng = np.random.RandomState(0)
+        for c in range(args.clips):
+            root = os.path.join(corpus, 'idt%05d' % c)
+            os.makedirs(root)
+            n = args.frames
+            np.save(os.path.join(root, '3dmm.npy'), rng.rand(n, 147).astype(np.float32))
+            np.save(os.path.join(root, 'audio_wenet_feature.npy'), rng.rand(64, n + 20).astype(np.float32))
+            np.save(os.path.join(root, 'audio_data.npy'), np.array([(k, k + 20) for k in range(n)], dtype=object),
+                    allow_pickle=True)
+            with open(os.path.join(root, '512_train.t7'), 'wb') as f:
+                pickle.dump({'img_paths': [['/src/idt%05d/512_dlib_crop/%06d.jpg' % (c, k)] for k in range(n)],
+                             'features_3dmm': list(range(n))}, f)
+        print('合成语料: %d clips × %d 帧 (%.1fs)' % (args.clips, args.frames, time.perf_counter() - t0))
+        t0 = time.perf_counter()
+        pack(corpus, store_dir)
+        print('打包（一次性）: %.1fs, %.0fMB' % (time.perf_counter() - t0, sum(
+            os.path.getsize(os.path.join(store_dir, f)) for f in os.listdir(store_dir)) / 1e6))
+
+        def run_child(mode):
+            subprocess.run(['sync'])
+            out = subprocess.run([sys.executable, __file__, '--access', str(args.access),
+                                  '--child', mode, corpus, store_dir], capture_output=True, text=True)
+            if out.returncode != 0:
+                raise SystemExit(out.stderr)
+            return json.loads(out.stdout.strip().splitlines()[-1])
+
+        base = run_child('baseline')
+        results = {m: run_child(m) for m in ('legacy', 'mmap')}
+        print('%-6s %8s %12s %12s %12s %10s' % ('', '启动', '启动后RSS', '峰值RSS', '私有内存', '随机读取'))
+        for m, r in results.items():
+            # 均扣除解释器 + numpy 的基线；mmap 的峰值 RSS 含随机读取时映射进来的文件页（可回收、worker 间共享）
+            print('%-6s %7.2fs %10.1fMB %10.1fMB %10.1fMB %8.1fus' % (
+                m, r['startup_s'], r['startup_rss_mb'] - base['startup_rss_mb'],
+                r['peak_rss_mb'] - base['peak_rss_mb'], r['anon_mb'] - base['anon_mb'], r['access_us']))
+        same = abs(results['legacy']['checksum'] - results['mmap']['checksum']) < 1e-3 * max(
+            1.0, abs(results['legacy']['checksum']))
+
+        # worker 安全：fork 进程池（同 DataLoader 默认，子进程按 pid 重新映射；store pickle 不带数据）与单进程读取结果一致
+        store = FeatureStore(store_dir)
+        payload = len(pickle.dumps(store))
+        idx = np.random.RandomState(1).randint(0, len(store), (8, 500))
+        expect = [worker_checksum((store, i)) for i in idx]
+        with multiprocessing.get_context('fork').Pool(4) as pool:
+            got = pool.map(worker_checksum, [(store, i) for i in idx])
+        print('读取结果一致: %s, fork worker 一致: %s (pickle %d 字节)' % (same, got == expect, payload))
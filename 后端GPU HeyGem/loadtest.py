@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+HTTP 负载测试（locust 风格：N 个模拟用户，每个用户循环 请求 → 随机等待）
+=====================================================================
+用户行为按权重混合：查询进度 /api/heygem/progress、查询队列 /api/heygem/queue、
+偶尔下载一次结果视频；统计每个接口的 p50 / p99 / 最大延迟与吞吐。
+
+默认使用 stub 引擎（不需要 GPU / 模型）：用 benchmark.py 的沙箱启动真实的 run_server.py（推理引擎换成
+FakeTransDhTask，素材由 ffmpeg 生成），先跑完一条任务供下载，再提交若干条任务让它们在测试期间处于
+排队 / 合成中（真实的 progress / queue 处理函数、_tasks_lock、调度器统计、_get_queue_info 缓存都在路径上），分别测
+  1. 开发模式：run_server.py 直接对外（app.run(threaded=True)）
+  2. 生产模式：run_server.py 作为引擎进程，gunicorn + gevent 网关（gateway.py）在前面
+
+  python loadtest.py                               # 两种模式各跑一遍
+  python loadtest.py --users 500 --duration 30
+  python loadtest.py --target http://127.0.0.1:8383 --token xxx --task-id <已有任务>   # 压测已在运行的服务
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.client import HTTPConnection
+from urllib.parse import urlparse
+
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# ── 引擎进程：真实 run_server.py + stub 引擎（benchmark.py 沙箱）──
+
+def start_engine(root: str, args):
+    """启动沙箱服务并准备任务，返回 (server, 全部任务 id, 已完成可下载的任务 id)"""
+    from benchmark import Client, SandboxServer, make_audio, make_video
+
+    sandbox, media = os.path.join(root, "server"), os.path.join(root, "media")
+    os.makedirs(sandbox)
+    os.makedirs(media)
+    server = SandboxServer(sandbox, args.engine_fps)
+    try:
+        server.wait_ready()
+        client = Client(server.base)
+        video = client.upload(make_video(os.path.join(media, "avatar.mp4"), args.task_seconds))
+
+        def _submit(i):
+            audio = client.upload(make_audio(os.path.join(media, f"a{i}.wav"), args.task_seconds, 300 + 37 * i))
+            return client.post("/api/heygem/submit", audio_hash=audio[0], audio_ext=audio[1],
+                               video_hash=video[0], video_ext=video[1])["task_id"]
+
+        done = _submit(0)
+        client.wait_done(done)
+        return server, [done] + [_submit(i) for i in range(1, args.tasks)], [done]
+    except Exception:
+        print(server.log_tail())
+        server.stop()
+        raise
+
+
+# ── 模拟用户 ──
+
+class Stats:
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.peak_threads = 0
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, ok):
+        with self._lock:
+            if ok:
+                self.samples.setdefault(name, []).append(seconds)
+            else:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def report(self, title, duration):
+        print(f"\n== {title} ==")
+        print(f"{'接口':<24}{'请求数':>8}{'失败':>6}{'p50(ms)':>10}{'p99(ms)':>10}{'max(ms)':>10}{'rps':>8}")
+        for name in sorted(set(self.samples) | set(self.errors)):
+            xs = sorted(self.samples.get(name, []))
+            pct = (lambda q: xs[min(len(xs) - 1, int(q * len(xs)))] * 1000) if xs else (lambda q: 0.0)
+            print(f"{name:<24}{len(xs):>8}{self.errors.get(name, 0):>6}{pct(0.5):>10.1f}{pct(0.99):>10.1f}"
+                  f"{(xs[-1] * 1000 if xs else 0):>10.1f}{len(xs) / duration:>8.0f}")
+        if self.peak_threads:
+            print(f"引擎进程线程数峰值: {self.peak_threads}")
+
+
+def _read_body(resp, kbps):
+    """按 kbps 限速读取响应体（模拟移动端慢速下载）；kbps<=0 表示不限速"""
+    if kbps <= 0:
+        return resp.read()
+    chunks = []
+    while True:
+        chunk = resp.read(64 * 1024)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+        time.sleep(len(chunk) / 1024.0 / kbps)
+
+
+def _user(base, token, task_ids, done_ids, stop, stats, wait, download_kbps):
+    u = urlparse(base)
+    conn = None
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    actions = [("progress", 6), ("queue", 2), ("download", 1)]
+    names = [a for a, w in actions for _ in range(w)]
+    while not stop.is_set():
+        action = random.choice(names)
+        task_id = random.choice(done_ids if action == "download" else task_ids)
+        path = {"progress": f"/api/heygem/progress?task_id={task_id}",
+                "queue": "/api/heygem/queue",
+                "download": f"/api/heygem/download?task_id={task_id}"}[action]
+        t0 = time.perf_counter()
+        ok = False
+        try:
+            if conn is None:
+                conn = HTTPConnection(u.hostname, u.port or 80, timeout=60)
+            conn.request("GET", path, headers=headers)
+            resp = conn.getresponse()
+            body = _read_body(resp, download_kbps if action == "download" else 0)
+            ok = resp.status == 200 and (action == "download" or json.loads(body).get("code") == 0)
+            if resp.will_close:
+                conn.close()
+                conn = None
+        except Exception:
+            if conn is not None:
+                conn.close()
+            conn = None
+        stats.add(f"GET {action}", time.perf_counter() - t0, ok)
+        stop.wait(random.uniform(*wait))
+    if conn is not None:
+        conn.close()
+
+
+def _sample_threads(pid, stop, stats):
+    """采样引擎（stub）进程的线程数峰值（Linux /proc）"""
+    while not stop.is_set():
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                n = int(next(l for l in f if l.startswith("Threads:")).split()[1])
+            stats.peak_threads = max(stats.peak_threads, n)
+        except (OSError, StopIteration, ValueError):
+            return
+        stop.wait(0.2)
+
+
+def run_load(base, token, task_ids, users, duration, wait=(0.05, 0.3), engine_pid=0, download_kbps=0,
+             done_ids=None):
+    stats = Stats()
+    stop = threading.Event()
+    if engine_pid:
+        threading.Thread(target=_sample_threads, args=(engine_pid, stop, stats), daemon=True).start()
+    threads = [threading.Thread(target=_user, args=(base, token, task_ids, done_ids or task_ids, stop, stats,
+                                                     wait, download_kbps), daemon=True)
+               for _ in range(users)]
+    for t in threads:
+        t.start()
+        time.sleep(0.002)  # 逐步爬升，避免瞬间建立全部连接
+    time.sleep(duration)
+    stop.set()
+    for t in threads:
+        t.join(timeout=60)
+    return stats
+
+
+# ── 启动 / 等待服务 ──
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"服务未在 {timeout}s 内启动: {port}")
+
+
+def _spawn(cmd, env=None):
+    return subprocess.Popen(cmd, cwd=_BASE_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HeyGem HTTP 负载测试",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--users", type=int, default=300, help="模拟用户数")
+    parser.add_argument("--duration", type=float, default=20, help="每种模式的压测时长（秒）")
+    parser.add_argument("--target", type=str, default="", help="压测已在运行的服务（不启动沙箱）")
+    parser.add_argument("--token", type=str, default="", help="API 鉴权密钥")
+    parser.add_argument("--task-id", type=str, action="append", default=[], help="--target 模式下查询的任务")
+    parser.add_argument("--download-kbps", type=float, default=8192,
+                        help="下载限速（KB/s，模拟慢速客户端；0 = 不限速）")
+    parser.add_argument("--gateway-workers", type=int, default=2, help="生产模式 gunicorn worker 数")
+    parser.add_argument("--tasks", type=int, default=8, help="沙箱中提交的任务数（第一条跑完供下载）")
+    parser.add_argument("--task-seconds", type=float, default=10, help="任务素材时长（秒）")
+    parser.add_argument("--engine-fps", type=float, default=5,
+                        help="stub 引擎产帧速率：压测期间其余任务保持排队 / 合成中")
+    args = parser.parse_args()
+
+    if args.target:
+        if not args.task_id:
+            parser.error("--target 模式需要至少一个 --task-id")
+        stats = run_load(args.target, args.token, args.task_id, args.users, args.duration,
+                         download_kbps=args.download_kbps)
+        stats.report(f"{args.target} ({args.users} 用户)", args.duration)
+        return
+
+    if not shutil.which("ffmpeg") or not shutil.which("ffprobe"):
+        parser.error("沙箱模式需要 ffmpeg / ffprobe（PATH 中）")
+
+    # 1. 开发模式：run_server.py 直接对外
+    with tempfile.TemporaryDirectory() as d:
+        server, task_ids, done_ids = start_engine(d, args)
+        try:
+            stats = run_load(server.base, "", task_ids, args.users, args.duration, engine_pid=server.proc.pid,
+                             download_kbps=args.download_kbps, done_ids=done_ids)
+            stats.report(f"开发模式 app.run(threaded=True)，{args.users} 用户", args.duration)
+        finally:
+            server.stop()
+
+    # 2. 生产模式：run_server.py 作为引擎进程，gunicorn + gevent 网关对外
+    with tempfile.TemporaryDirectory() as d:
+        server, task_ids, done_ids = start_engine(d, args)
+        gw_port = _free_port()
+        env = dict(os.environ, HEYGEM_ENGINE_ADDR=f"127.0.0.1:{server.port}")
+        gw = _spawn([sys.executable, "-m", "gunicorn", "-k", "gevent", "-w", str(args.gateway_workers),
+                     "--worker-connections", "2000", "-b", f"127.0.0.1:{gw_port}", "gateway:app"], env=env)
+        try:
+            _wait_port(gw_port)
+            stats = run_load(f"http://127.0.0.1:{gw_port}", "", task_ids, args.users, args.duration,
+                             engine_pid=server.proc.pid, download_kbps=args.download_kbps, done_ids=done_ids)
+            stats.report(f"生产模式 gunicorn gevent ×{args.gateway_workers} + 引擎进程，{args.users} 用户",
+                         args.duration)
+        finally:
+            gw.terminate()
+            gw.wait()
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
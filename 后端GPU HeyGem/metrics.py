@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+服务指标（Prometheus 文本格式）与阶段耗时
+========================================
+run_server.py 原先只有 print 日志和 queue / health 的 JSON，排队等待、上传字节数、缓存命中率、
+引擎帧率、编码耗时、清理耗时都无从统计。
+
+  1. Registry：Counter / Gauge / Histogram（带标签），render() 输出 Prometheus 文本格式（/metrics）；
+     Gauge 可挂回调，在抓取时现算（队列长度、任务状态分布等）
+  2. StageTimer：span("engine_work") 上下文统计各阶段耗时，同时写入
+     heygem_stage_seconds 直方图与每阶段最近 N 次的滚动窗口（queue_status 返回 p50 / p95 / p99）
+  3. ServerMetrics：run_server.py 使用的全部指标定义
+
+不依赖 prometheus_client。自测（benchmark.py 的沙箱：真实 run_server.py + stub 引擎跑几条任务后，
+抓取 /metrics 与 /api/heygem/queue 校验各阶段计数；需要 ffmpeg）：
+  python metrics.py
+"""
+
+import bisect
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _label_str(names: Sequence[str], values: Sequence, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[tuple, object] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: 标签应为 {self.labelnames}，实际 {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self.header() + [f"{self.name}{_label_str(self.labelnames, k)} {_fmt(v)}" for k, v in items]
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self._fn: Optional[Callable] = None
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_function(self, fn: Callable):
+        """抓取时调用 fn()：无标签返回数值，有标签返回 {标签值元组: 数值}"""
+        self._fn = fn
+
+    def render(self) -> List[str]:
+        if self._fn is not None:
+            try:
+                got = self._fn()
+            except Exception:
+                got = {} if self.labelnames else None
+            if got is None:
+                items = []
+            elif self.labelnames:
+                items = sorted((tuple(str(x) for x in (k if isinstance(k, tuple) else (k,))), v)
+                               for k, v in got.items())
+            else:
+                items = [((), got)]
+        else:
+            with self._lock:
+                items = sorted(self._values.items())
+        return self.header() + [f"{self.name}{_label_str(self.labelnames, k)} {_fmt(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            st = self._values.get(key)
+            if st is None:
+                st = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            st[0][bisect.bisect_left(self.buckets, value)] += 1
+            st[1] += value
+            st[2] += 1
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, ([*v[0]], v[1], v[2])) for k, v in self._values.items())
+        lines = self.header()
+        for key, (counts, total, count) in items:
+            cum = 0
+            for le, n in zip(list(self.buckets) + [math.inf], counts):
+                cum += n
+                lines.append(f"{self.name}_bucket{_label_str(self.labelnames, key, ('le', _fmt(le)))} {cum}")
+            lines.append(f"{self.name}_sum{_label_str(self.labelnames, key)} {_fmt(total)}")
+            lines.append(f"{self.name}_count{_label_str(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()) -> Counter:
+        return self._add(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=()) -> Gauge:
+        return self._add(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for m in self._metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+class StageTimer:
+    """阶段耗时：直方图 + 每阶段最近 window 次的滚动窗口"""
+
+    def __init__(self, histogram: Histogram, window: int = 512):
+        self.histogram = histogram
+        self.window = window
+        self._recent: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float):
+        self.histogram.observe(seconds, stage=stage)
+        with self._lock:
+            self._recent.setdefault(stage, deque(maxlen=self.window)).append(seconds)
+
+    @contextmanager
+    def span(self, stage: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - t0)
+
+    def summary(self) -> dict:
+        """{stage: {count, p50_ms, p95_ms, p99_ms, max_ms}}（最近 window 次）"""
+        with self._lock:
+            recent = {k: sorted(v) for k, v in self._recent.items()}
+        out = {}
+        for stage, xs in sorted(recent.items()):
+            pct = lambda q: round(xs[min(len(xs) - 1, int(q * len(xs)))] * 1000, 1)
+            out[stage] = {"count": len(xs), "p50_ms": pct(0.5), "p95_ms": pct(0.95),
+                          "p99_ms": pct(0.99), "max_ms": round(xs[-1] * 1000, 1)}
+        return out
+
+
+class ServerMetrics(Registry):
+    """run_server.py 的指标定义"""
+
+    STAGES = ("upload", "check_files", "cache_lookup", "queue_wait", "engine_work", "write_video",
+              "download", "cleanup", "cleanup_records")
+
+    def __init__(self, window: int = 512):
+        super().__init__()
+        self.http_requests = self.counter(
+            "heygem_http_requests_total", "HTTP 请求数", ("endpoint", "method", "status"))
+        self.http_seconds = self.histogram(
+            "heygem_http_request_seconds", "HTTP 请求处理耗时（不含响应体传输）", ("endpoint",))
+        self.stage_seconds = self.histogram(
+            "heygem_stage_seconds", "各阶段耗时", ("stage",))
+        self.stages = StageTimer(self.stage_seconds, window)
+        self.upload_bytes = self.counter("heygem_upload_bytes_total", "上传写入的字节数", ("kind",))
+        self.download_bytes = self.counter("heygem_download_bytes_total", "结果下载响应字节数（按 Content-Length）")
+        self.cache_lookups = self.counter("heygem_result_cache_lookups_total", "合成结果缓存查询", ("result",))
+        self.file_checks = self.counter("heygem_check_files_total", "文件池秒传检查", ("result",))
+        self.tasks_finished = self.counter("heygem_tasks_finished_total", "结束的合成任务", ("status",))
+        self.engine_frames = self.counter("heygem_engine_frames_total", "引擎输出帧数")
+        self.engine_fps = self.histogram(
+            "heygem_engine_fps", "单任务引擎吞吐（帧/秒）", (),
+            buckets=(1, 2, 5, 10, 15, 20, 25, 30, 40, 50, 75, 100, 150, 200))
+        self.cleanup_deleted = self.counter("heygem_cleanup_deleted_total", "清理删除的文件数")
+        self.tasks = self.gauge("heygem_tasks", "内存中的任务数（按状态）", ("status",))
+        self.queued_frames = self.gauge("heygem_queued_frames", "排队任务预估帧数总和")
+        self.workers_busy = self.gauge("heygem_workers_busy", "正在执行任务的引擎 worker 数")
+        self.workers = self.gauge("heygem_workers", "引擎 worker 数")
+
+    def span(self, stage: str):
+        return self.stages.span(stage)
+
+    def observe_stage(self, stage: str, seconds: float):
+        self.stages.observe(stage, seconds)
+
+
+def parse_text(text: str) -> Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float]:
+    """解析 Prometheus 文本格式（自测与调试用）：{(名称, ((标签, 值), ...)): 数值}"""
+    import re
+    out = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        m = re.match(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{(.*)\})? (\S+)$', line)
+        if not m:
+            raise ValueError(f"无法解析: {line}")
+        labels = tuple(re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', m.group(3) or ""))
+        out[(m.group(1), labels)] = float(m.group(4).replace("+Inf", "inf"))
+    return out
+
+
+# 自测：benchmark.py 的沙箱（真实 run_server.py + stub 引擎 + ffmpeg 合成素材）跑几条任务，
+# 再抓取真实的 /metrics 与 /api/heygem/queue，校验请求钩子、各阶段 span 与抓取时回调的 Gauge
+if __name__ == "__main__":
+    import os
+    import shutil
+    import sys
+    import tempfile
+
+    from benchmark import Client, SandboxServer, make_audio, make_video
+
+    if not shutil.which("ffmpeg") or not shutil.which("ffprobe"):
+        sys.exit("需要 ffmpeg / ffprobe（PATH 中）")
+    N = 3
+    root = tempfile.mkdtemp(prefix="heygem_metrics_")
+    server = None
+    try:
+        sandbox, media = os.path.join(root, "server"), os.path.join(root, "media")
+        os.makedirs(sandbox)
+        os.makedirs(media)
+        server = SandboxServer(sandbox, engine_fps=0)
+        server.wait_ready()
+        client = Client(server.base)
+        video_path = make_video(os.path.join(media, "avatar.mp4"), 2)
+        frames = 0
+        for i in range(N):
+            audio = client.upload(make_audio(os.path.join(media, f"a{i}.wav"), 2, 300 + 50 * i))
+            video = client.upload(video_path)  # 第二条起秒传命中
+            task_id = client.post("/api/heygem/submit", audio_hash=audio[0], audio_ext=audio[1],
+                                  video_hash=video[0], video_ext=video[1])["task_id"]
+            frames += client.wait_done(task_id)["total_frames"]
+            client.download("/api/heygem/download", task_id=task_id)
+
+        text = client.http.get(server.base + "/metrics", timeout=10).text
+        m = parse_text(text)
+        summary = client.get("/api/heygem/queue")["stages"]
+
+        def count(stage):
+            return m.get(("heygem_stage_seconds_count", (("stage", stage),)), 0)
+
+        # 每条任务：音频 + 视频各一次秒传检查；视频只在第一次上传
+        expected = {"check_files": 2 * N, "upload": N + 1, "cache_lookup": N, "queue_wait": N,
+                    "engine_work": N, "write_video": N, "download": N}
+        got = {stage: count(stage) for stage in expected}
+        checks = {
+            "stage counts": got == expected,
+            "queue summary": all(summary.get(st, {}).get("count") == n for st, n in expected.items()),
+            "check_files hit/miss": (m.get(("heygem_check_files_total", (("result", "hit"),))) == N - 1
+                                     and m.get(("heygem_check_files_total", (("result", "miss"),))) == N + 1),
+            "cache miss": m.get(("heygem_result_cache_lookups_total", (("result", "miss"),))) == N,
+            "tasks finished": m.get(("heygem_tasks_finished_total", (("status", "done"),))) == N,
+            "engine frames": m.get(("heygem_engine_frames_total", ())) == frames,
+            "submit requests": m.get(("heygem_http_requests_total", (("endpoint", "/api/heygem/submit"),
+                                                                     ("method", "POST"), ("status", "200")))) == N,
+            "gauge tasks done": m.get(("heygem_tasks", (("status", "done"),))) == N,
+            "gauge workers": m.get(("heygem_workers", ())) == 1 and m.get(("heygem_workers_busy", ())) == 0,
+        }
+        # 直方图桶单调不减且 +Inf 桶等于 count
+        le = sorted((float(dict(k[1])["le"]), v) for k, v in m.items()
+                    if k[0] == "heygem_stage_seconds_bucket" and dict(k[1])["stage"] == "engine_work")
+        checks["histogram"] = all(a[1] <= b[1] for a, b in zip(le, le[1:])) and le[-1][1] == N
+        print(f"/metrics: {len(text.splitlines())} 行，{len(m)} 个样本；阶段计数 {got}")
+        for name, passed in checks.items():
+            print(f"  {'OK  ' if passed else 'FAIL'} {name}")
+        ok = all(checks.values())
+        if not ok:
+            print(server.log_tail())
+    finally:
+        if server is not None:
+            server.stop()
+        shutil.rmtree(root, ignore_errors=True)
+    print("自测通过" if ok else "自测失败")
+    sys.exit(0 if ok else 1)
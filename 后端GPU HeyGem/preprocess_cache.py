@@ -0,0 +1,563 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+数字人视频预处理缓存（人脸框 / 关键点 / 对齐裁剪）
+==============================================
+线上流量反复使用同几十个数字人视频，但每次 work() 都会在编译好的 face_lib / landmark2face_wy
+里重新做人脸检测、关键点和裁剪。本模块把这些逐帧结果按 (视频 MD5, 引擎版本 + 缓存版本, 被包装的函数) 缓存到 STORE_DIR 旁：
+
+  preprocess_cache/{video_md5}_{engine_version}.{cache_version}_{函数}/
+      meta.json            输出结构（数组 / 元组）与帧数
+      fingerprints.npy     每帧指纹（uint8[N,16]，含非图像参数），命中前校验，防止帧序错位时返回错误结果
+      out{k}.npy           第 k 个输出逐帧拼接后的数据（np.load mmap_mode='r'）
+      out{k}.idx.npy       第 k 个输出的逐帧偏移（int64[N+1]）
+  preprocess_cache/index.db  条目大小 / 最近访问时间索引（淘汰时不再遍历缓存目录）
+
+默认包装人脸框（get_bboxes）以及关键点 + 对齐裁剪（get_single_face / get_multi_face）；
+各函数的记录互相独立，外层命中时内层检测整个跳过。engine_version 即 [engine] version（批量调优、分段缓存
+同样按它失效），更换引擎后整体失效；cache_version 是本缓存自己的版本号（只更换检测 / 对齐模型时修改）。
+
+工作方式：
+  1. 主进程 _run_task 在 work() 前 begin_session(video_md5)，把会话写入 .active（子进程可见）
+  2. install() 以打补丁的方式包装检测函数（与 GFPGAN / write_video 的替换方式相同，
+     模块级执行，spawn 出的引擎子进程同样生效）；包装函数先查缓存，未命中才真正检测，
+     首次处理某视频时逐帧记录到 _partial_* 目录
+  3. work() 结束后主进程 end_session() 把记录整理为上述 .npy 文件，登记到 index.db，
+     并按字节预算做 LRU 淘汰（首次打开时扫描一次已有目录建立索引）
+
+同时有多个会话时只查不录（无法确定帧属于哪个视频）；帧指纹不符时回退真实检测。
+
+自检（stub 检测器统计真实调用次数）：
+  python preprocess_cache.py
+"""
+
+import functools
+import hashlib
+import importlib
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_ACTIVE_FILE = ".active"
+
+
+def frame_fingerprint(img) -> bytes:
+    """帧指纹：形状 + 8 像素步长采样的 MD5（1080p 约 0.1ms）"""
+    arr = np.asarray(img)
+    h = hashlib.md5(str(arr.shape).encode())
+    sample = arr[::8, ::8] if arr.ndim >= 2 else arr
+    h.update(np.ascontiguousarray(sample).tobytes())
+    return h.digest()
+
+
+_SIG_TYPES = (int, float, str, bool, type(None))
+
+
+def call_signature(args, kwargs) -> bytes:
+    """检测函数的非图像参数（阈值 / 裁剪尺寸等标量）；对象参数（self 等）不计入"""
+    def _plain(v):
+        if isinstance(v, _SIG_TYPES):
+            return True
+        return isinstance(v, (tuple, list)) and all(isinstance(x, _SIG_TYPES) for x in v)
+    parts = [repr(a) for a in args if _plain(a)]
+    parts += [f"{k}={v!r}" for k, v in sorted(kwargs.items()) if _plain(v)]
+    return "|".join(parts).encode()
+
+
+def target_slug(target: str) -> str:
+    """"模块:类.方法" -> 缓存目录名里的函数部分（类.方法）"""
+    return re.sub(r"[^0-9A-Za-z._]+", "-", target.split(":", 1)[-1])
+
+
+def _split_outputs(result):
+    """把检测函数返回值拆成数组列表；不支持的类型返回 None（不缓存）"""
+    if isinstance(result, np.ndarray):
+        return "array", [result]
+    if isinstance(result, (tuple, list)) and result:
+        outs = []
+        for r in result:
+            if isinstance(r, np.ndarray):
+                outs.append(r)
+            elif isinstance(r, (int, float)) or r is None:
+                outs.append(np.asarray(np.nan if r is None else r, dtype=np.float64))
+            else:
+                return None, None
+        return ("tuple" if isinstance(result, tuple) else "list"), outs
+    return None, None
+
+
+class CacheEntry:
+    """一个视频的预处理结果（只读，内存映射）"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.fingerprints = np.load(os.path.join(path, "fingerprints.npy"), mmap_mode="r")
+        self._outs = []
+        for k in range(self.meta["n_out"]):
+            data = np.load(os.path.join(path, f"out{k}.npy"), mmap_mode="r")
+            idx = np.load(os.path.join(path, f"out{k}.idx.npy"))
+            self._outs.append((data, idx, self.meta["shapes"][k]))
+        self._fp_index: Optional[Dict[bytes, int]] = None
+
+    @property
+    def frames(self) -> int:
+        return int(self.meta["frames"])
+
+    def index_of(self, fp: bytes) -> int:
+        """按指纹查帧号（帧序错位时重新对齐），找不到返回 -1"""
+        if self._fp_index is None:
+            self._fp_index = {bytes(self.fingerprints[i]): i for i in range(self.frames)}
+        return self._fp_index.get(fp, -1)
+
+    def get(self, i: int, fp: bytes):
+        """取第 i 帧的结果；指纹不符返回 None"""
+        if i < 0 or i >= self.frames or bytes(self.fingerprints[i]) != fp:
+            return None
+        outs = []
+        for data, idx, shape in self._outs:
+            a, b = int(idx[i]), int(idx[i + 1])
+            if shape is None:  # 标量
+                v = float(data[a])
+                outs.append(None if np.isnan(v) else v)
+            elif shape[0] == -1:  # 首维逐帧可变（如人脸个数）
+                outs.append(np.array(data[a:b]).reshape([b - a] + shape[1:]))
+            else:
+                outs.append(np.array(data[a:b]).reshape(shape))
+        kind = self.meta["kind"]
+        if kind == "array":
+            return outs[0]
+        return tuple(outs) if kind == "tuple" else outs
+
+
+class _PartialWriter:
+    """子进程侧：首次处理某视频时逐帧追加记录"""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.kind = None
+        self._files = None
+
+    def add(self, fp: bytes, kind: str, outs: List[np.ndarray]):
+        if self._files is None:
+            self.kind = kind
+            with open(os.path.join(self.path, "kind"), "w") as f:
+                f.write(f"{kind}\n{len(outs)}\n")
+            self._files = [open(os.path.join(self.path, f"out{k}.seq"), "ab") for k in range(len(outs))]
+            self._fp = open(os.path.join(self.path, "fp.bin"), "ab")
+        if kind != self.kind or len(outs) != len(self._files):
+            raise ValueError("检测输出结构不一致")
+        for f, a in zip(self._files, outs):
+            np.save(f, np.asarray(a), allow_pickle=False)  # ascontiguousarray 会把 0 维标量变成 1 维
+            f.flush()
+        self._fp.write(fp)
+        self._fp.flush()
+
+    def close(self):
+        if self._files:
+            for f in self._files:
+                f.close()
+            self._fp.close()
+        self._files = None
+
+
+class PreprocessCache:
+    """预处理缓存目录管理"""
+
+    def __init__(self, root: str, byte_budget: int, cache_version: str = "2", engine_version: str = "1"):
+        self.root = root
+        self.byte_budget = byte_budget
+        self.cache_version = str(cache_version)
+        self.engine_version = str(engine_version)
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._entries: Dict[str, CacheEntry] = {}
+        self._active_mtime = -1.0
+        self._active: Dict[str, str] = {}
+        self._states: Dict[tuple, dict] = {}  # 本进程内每个 (会话视频, 函数) 的帧计数 / 记录器
+        self._targets: List[str] = []  # 已包装函数的 slug
+        self._conn: Optional[sqlite3.Connection] = None  # 索引只在主进程（会话 / 淘汰）打开
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, video_hash, slug):
+        return f"{video_hash}_{self.engine_version}.{self.cache_version}_{slug}"
+
+    def entry_dir(self, video_hash: str, slug: str) -> str:
+        return os.path.join(self.root, self._key(video_hash, slug))
+
+    def get(self, video_hash: str, slug: str) -> Optional[CacheEntry]:
+        key = self._key(video_hash, slug)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and os.path.isdir(entry.path):
+            return entry
+        path = self.entry_dir(video_hash, slug)
+        if not os.path.exists(os.path.join(path, "meta.json")):
+            return None
+        try:
+            entry = CacheEntry(path)
+        except Exception as e:
+            logger.warning(f"[PreprocessCache] 缓存损坏，删除: {path} ({e})")
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+        with self._lock:
+            self._entries[key] = entry
+        return entry
+
+    # ── 大小索引（主进程） ──
+
+    def _db(self) -> sqlite3.Connection:
+        """条目索引；首次创建时扫描一次已有目录（旧版本 / 旧缓存版本的条目也登记，按 LRU 自然淘汰）"""
+        if self._conn is None:
+            conn = sqlite3.connect(os.path.join(self.root, "index.db"), check_same_thread=False,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            fresh = conn.execute("SELECT name FROM sqlite_master WHERE name='entries'").fetchone() is None
+            conn.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                name TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_entries_lru ON entries(last_access);
+            """)
+            if fresh:
+                for name in os.listdir(self.root):
+                    path = os.path.join(self.root, name)
+                    meta = os.path.join(path, "meta.json")
+                    if name.startswith((".", "_")) or not os.path.exists(meta):
+                        continue
+                    size = sum(os.path.getsize(os.path.join(path, fn)) for fn in os.listdir(path))
+                    conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                                 (name, size, os.path.getmtime(meta)))
+            self._conn = conn
+        return self._conn
+
+    def _touch(self, name: str):
+        with self._lock:
+            self._db().execute("UPDATE entries SET last_access=? WHERE name=?", (time.time(), name))
+
+    # ── 会话（主进程） ──
+
+    def _write_active(self, active: Dict[str, str]):
+        tmp = os.path.join(self.root, f"{_ACTIVE_FILE}.{os.getpid()}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(active, f)
+        os.replace(tmp, os.path.join(self.root, _ACTIVE_FILE))
+
+    def begin_session(self, video_hash: str) -> str:
+        """work() 前调用：登记当前处理的视频，返回会话 ID"""
+        session_id = uuid.uuid4().hex[:12]
+        with self._lock:
+            active = self._read_active_locked(force=True)
+            active[video_hash] = session_id
+            self._write_active(active)
+        for slug in self._targets:
+            if self.get(video_hash, slug) is not None:
+                self._touch(self._key(video_hash, slug))
+        return session_id
+
+    def end_session(self, video_hash: str, session_id: str):
+        """work() 后调用：注销会话，把子进程的逐帧记录整理为缓存条目，然后按预算淘汰"""
+        with self._lock:
+            active = self._read_active_locked(force=True)
+            if active.get(video_hash) == session_id:
+                del active[video_hash]
+                self._write_active(active)
+        for slug in self._targets:
+            key = self._key(video_hash, slug)
+            partial = os.path.join(self.root, f"_partial_{key}_{session_id}")
+            if not os.path.isdir(partial):
+                continue
+            try:
+                if self.get(video_hash, slug) is None:
+                    size = self._finalize(partial, self.entry_dir(video_hash, slug))
+                    if size:
+                        with self._lock:
+                            self._db().execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                                               (key, size, time.time()))
+            except Exception as e:
+                logger.warning(f"[PreprocessCache] 整理缓存失败: {key} ({e})")
+            finally:
+                shutil.rmtree(partial, ignore_errors=True)
+        self.evict()
+
+    def _read_active_locked(self, force=False) -> Dict[str, str]:
+        p = os.path.join(self.root, _ACTIVE_FILE)
+        try:
+            mtime = os.path.getmtime(p)
+        except OSError:
+            self._active, self._active_mtime = {}, -1.0
+            return {}
+        if force or mtime != self._active_mtime:
+            try:
+                with open(p, "r", encoding="utf-8") as f:
+                    self._active = json.load(f)
+                self._active_mtime = mtime
+            except Exception:
+                self._active = {}
+        return dict(self._active)
+
+    def _finalize(self, partial: str, dest: str) -> int:
+        """把逐帧记录整理为缓存条目，返回条目字节数（没有记录返回 0）"""
+        with open(os.path.join(partial, "kind"), "r") as f:
+            kind, n_out = f.read().split()
+        n_out = int(n_out)
+        with open(os.path.join(partial, "fp.bin"), "rb") as f:
+            fps = np.frombuffer(f.read(), dtype=np.uint8).reshape(-1, 16)
+        n = len(fps)
+        if n == 0:
+            return 0
+        tmp = dest + f".tmp{os.getpid()}"
+        os.makedirs(tmp, exist_ok=True)
+        shapes = []
+        for k in range(n_out):
+            arrs = []
+            with open(os.path.join(partial, f"out{k}.seq"), "rb") as f:
+                for _ in range(n):
+                    arrs.append(np.load(f, allow_pickle=False))
+            if all(a.ndim == 0 for a in arrs):
+                data = np.array([float(a) for a in arrs], dtype=np.float64)
+                offsets = np.arange(n + 1, dtype=np.int64)
+                shapes.append(None)
+            else:
+                arrs = [a.reshape((1,) + a.shape) if a.ndim == 0 else a for a in arrs]
+                tails = {a.shape[1:] for a in arrs}
+                if len(tails) != 1:
+                    raise ValueError(f"第 {k} 个输出逐帧形状不一致: {tails}")
+                tail = tails.pop()
+                fixed = len({a.shape for a in arrs}) == 1
+                data = np.concatenate(arrs, axis=0)
+                offsets = np.zeros(n + 1, dtype=np.int64)
+                offsets[1:] = np.cumsum([a.shape[0] for a in arrs])
+                shapes.append(list(arrs[0].shape) if fixed else [-1] + list(tail))
+            np.save(os.path.join(tmp, f"out{k}.npy"), data)
+            np.save(os.path.join(tmp, f"out{k}.idx.npy"), offsets)
+        np.save(os.path.join(tmp, "fingerprints.npy"), fps)
+        with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"kind": kind, "n_out": n_out, "frames": n, "shapes": shapes,
+                       "cache_version": self.cache_version, "engine_version": self.engine_version,
+                       "created_at": time.time()}, f)
+        size = sum(os.path.getsize(os.path.join(tmp, fn)) for fn in os.listdir(tmp))
+        os.replace(tmp, dest)
+        logger.info(f"[PreprocessCache] 写入缓存: {os.path.basename(dest)} ({n} 帧, {size} bytes)")
+        return size
+
+    def evict(self) -> int:
+        """按 index.db 的最近访问时间做 LRU，淘汰到字节预算以内，返回删除条目数"""
+        if self.byte_budget <= 0:
+            return 0
+        with self._lock:
+            db = self._db()
+            total = db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total <= self.byte_budget:
+                return 0
+            rows = db.execute("SELECT name, size FROM entries ORDER BY last_access").fetchall()
+        removed = 0
+        for name, size in rows:
+            if total <= self.byte_budget:
+                break
+            with self._lock:
+                self._entries.pop(name, None)
+                self._db().execute("DELETE FROM entries WHERE name=?", (name,))
+            shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+            total -= size
+            removed += 1
+            logger.info(f"[PreprocessCache] LRU 淘汰: {name} ({size} bytes)")
+        return removed
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+    # ── 检测包装（任何进程） ──
+
+    def _lookup(self, fp: bytes, slug: str):
+        """在当前活跃会话里查找该帧的缓存结果，返回 (结果 or None, 可记录的会话 state or None)"""
+        with self._lock:
+            active = self._read_active_locked()
+        record_state = None
+        for video_hash, session_id in active.items():
+            st = self._states.get((video_hash, slug))
+            if st is None or st["session_id"] != session_id:
+                if st is not None and st.get("writer"):
+                    st["writer"].close()
+                st = self._states[(video_hash, slug)] = {"session_id": session_id, "idx": 0, "writer": None}
+            entry = self.get(video_hash, slug)
+            if entry is not None:
+                i = st["idx"]
+                res = entry.get(i, fp)
+                if res is None:
+                    i = entry.index_of(fp)
+                    res = entry.get(i, fp) if i >= 0 else None
+                if res is not None:
+                    st["idx"] = i + 1
+                    return res, None
+            elif len(active) == 1:
+                record_state = (video_hash, st)
+        return None, record_state
+
+    def wrap(self, fn, slug: str):
+        """包装检测函数 fn(self_or_img, img, ...)：按帧指纹（含非图像参数）查缓存，未命中时调用原函数并记录"""
+        if slug not in self._targets:
+            self._targets.append(slug)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            img = next((a for a in args if isinstance(a, np.ndarray) and a.ndim == 3), None)
+            if img is None:
+                return fn(*args, **kwargs)
+            fp = hashlib.md5(frame_fingerprint(img) + call_signature(args, kwargs)).digest()
+            try:
+                res, record = self._lookup(fp, slug)
+            except Exception as e:
+                logger.debug(f"[PreprocessCache] 查询失败: {e}")
+                res, record = None, None
+            if res is not None:
+                self.hits += 1
+                return res
+            self.misses += 1
+            result = fn(*args, **kwargs)
+            if record is not None:
+                video_hash, st = record
+                kind, outs = _split_outputs(result)
+                if kind is not None:
+                    try:
+                        if st["writer"] is None:
+                            st["writer"] = _PartialWriter(os.path.join(
+                                self.root, f"_partial_{self._key(video_hash, slug)}_{st['session_id']}"))
+                        st["writer"].add(fp, kind, outs)
+                        st["idx"] += 1
+                    except Exception as e:
+                        logger.warning(f"[PreprocessCache] 记录失败，本视频不缓存: {e}")
+                        st["writer"] = None
+                        st["session_id"] = ""
+            return result
+
+        wrapper._preprocess_cached = True
+        return wrapper
+
+    def install(self, target: str) -> bool:
+        """给 "模块路径:类名.方法名" 或 "模块路径:函数名" 打补丁，失败返回 False"""
+        try:
+            mod_name, attr_path = target.split(":", 1)
+            obj = importlib.import_module(mod_name)
+            parts = attr_path.split(".")
+            for p in parts[:-1]:
+                obj = getattr(obj, p)
+            fn = getattr(obj, parts[-1])
+            if getattr(fn, "_preprocess_cached", False):
+                if target_slug(target) not in self._targets:
+                    self._targets.append(target_slug(target))
+                return True
+            setattr(obj, parts[-1], self.wrap(fn, target_slug(target)))
+            return True
+        except Exception as e:
+            logger.warning(f"[PreprocessCache] 无法包装 {target}: {e}")
+            return False
+
+
+# 自检：stub 检测器统计真实调用次数，第二次处理同一视频应全部命中（人脸框与关键点 / 裁剪两级）
+if __name__ == "__main__":
+    import sys
+    import tempfile
+    import types
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+    class StubDetector:
+        calls = {"bboxes": 0, "align": 0}
+
+        def get_bboxes(self, image, thresh=0.5):
+            StubDetector.calls["bboxes"] += 1
+            n = int(image[0, 0, 0]) % 3  # 每帧 0~2 张脸
+            boxes = np.full((n, 5), float(image[0, 0, 0]) * thresh, dtype=np.float32)
+            kps = np.full((n, 5, 2), float(image[0, 0, 1]), dtype=np.float32)
+            return boxes, kps
+
+        def get_single_face(self, image, crop_size=96):
+            """关键点 + 对齐裁剪（内部先做人脸框检测）"""
+            StubDetector.calls["align"] += 1
+            _boxes, kps = self.get_bboxes(image)
+            crop = np.ascontiguousarray(image[:crop_size, :crop_size])
+            lm = np.full((68, 2), float(image[1, 1, 0]), dtype=np.float32)
+            return crop, lm, float(kps.sum()) if len(kps) else None
+
+    mod = types.ModuleType("stub_face_detect")
+    mod.StubDetector = StubDetector
+    sys.modules["stub_face_detect"] = mod
+
+    rng = np.random.RandomState(0)
+    video = [rng.randint(0, 255, (256, 256, 3), dtype=np.uint8) for _ in range(120)]
+    other = [rng.randint(0, 255, (256, 256, 3), dtype=np.uint8) for _ in range(120)]
+    ALIGN = "StubDetector.get_single_face"
+    ok = True
+
+    def _same(a, b):
+        return all(np.array_equal(x, y) if isinstance(x, np.ndarray) else x == y for x, y in zip(a, b))
+
+    with tempfile.TemporaryDirectory() as d:
+        cache = PreprocessCache(d, byte_budget=0)
+        assert cache.install("stub_face_detect:StubDetector.get_bboxes")
+        assert cache.install(f"stub_face_detect:{ALIGN}")
+        det = StubDetector()
+
+        def run(frames, video_hash, crop_size=96):
+            sid = cache.begin_session(video_hash)
+            out = [(det.get_bboxes(f), det.get_single_face(f, crop_size=crop_size)) for f in frames]
+            cache.end_session(video_hash, sid)
+            return out
+
+        first = run(video, "aaaa")
+        c1 = dict(StubDetector.calls)
+        second = run(video, "aaaa")
+        c2 = {k: StubDetector.calls[k] - c1[k] for k in c1}
+        same = all(_same(a[0], b[0]) and _same(a[1], b[1]) for a, b in zip(first, second))
+        print(f"首次处理真实调用 {c1}，再次处理 {c2}，结果一致={same}")
+        ok = ok and c2 == {"bboxes": 0, "align": 0} and same
+
+        # 引擎版本变化后旧记录不再命中
+        cache.engine_version = "2"
+        before = dict(StubDetector.calls)
+        run(video[:10], "aaaa")
+        ok = ok and StubDetector.calls["align"] - before["align"] == 10
+        cache.engine_version = "1"
+
+        # 非图像参数不同（裁剪尺寸）不能命中
+        before = dict(StubDetector.calls)
+        run(video[:10], "aaaa", crop_size=64)
+        ok = ok and StubDetector.calls["align"] - before["align"] == 10
+
+        entry_bytes = sum(os.path.getsize(os.path.join(cache.entry_dir("aaaa", ALIGN), fn))
+                          for fn in os.listdir(cache.entry_dir("aaaa", ALIGN)))
+        cache.byte_budget = int(entry_bytes * 2.5)  # 裁剪结果最多容纳两个视频
+        run(other, "bbbb")
+        run(other, "cccc")  # 超出字节预算后最久未用的 aaaa 被淘汰
+        c3 = dict(StubDetector.calls)
+        run(video, "aaaa")
+        evicted = StubDetector.calls["align"] - c3["align"]
+        print(f"LRU 淘汰后重新处理 aaaa 真实对齐 {evicted} 次, 统计={cache.stats()}")
+        ok = ok and evicted == len(video)
+
+        # 重新打开：索引已持久化，淘汰只查 index.db
+        cache2 = PreprocessCache(d, byte_budget=cache.byte_budget)
+        n_index = cache2._db().execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        n_dirs = sum(1 for n in os.listdir(d) if os.path.exists(os.path.join(d, n, "meta.json")))
+        print(f"索引条目 {n_index}，缓存目录 {n_dirs}")
+        ok = ok and n_index == n_dirs
+    print("自检通过" if ok else "自检失败")
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+结果视频下载：Range / ETag + sendfile
+====================================
+原 download_result 直接 send_file：ETag 由 werkzeug 按 mtime + 大小生成，与内容无关；
+带 Range 的请求被包成逐块读取的迭代器，gunicorn 无法走 sendfile。
+
+send_range_file()：
+  1. ETag = 文件内容 MD5（客户端下载完用它校验；按 路径 + 大小 + mtime 缓存，只算一次）
+  2. If-None-Match → 304；单段 Range（bytes=a-b / a- / -n）→ 206 + Content-Range；
+     If-Range 与 ETag 不符时忽略 Range 返回完整文件；越界 → 416
+  3. 响应体交给服务器的 wsgi.file_wrapper（文件已 seek 到起点、Content-Length 为区间长度）：
+     gunicorn 据此对区间调用 sendfile()；开发服务器没有 file_wrapper 时按区间长度分块读
+
+run_server.py（开发模式）与 gateway.py（生产模式网关）共用。
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from flask import Response, request
+
+_etag_cache: "OrderedDict[tuple, str]" = OrderedDict()
+_etag_lock = threading.Lock()
+_ETAG_CACHE_SIZE = 1024
+
+
+def content_etag(path: str) -> str:
+    """文件内容 MD5（按 路径 + 大小 + mtime 缓存）"""
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    with _etag_lock:
+        if key in _etag_cache:
+            _etag_cache.move_to_end(key)
+            return _etag_cache[key]
+    h = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    etag = h.hexdigest()
+    with _etag_lock:
+        _etag_cache[key] = etag
+        while len(_etag_cache) > _ETAG_CACHE_SIZE:
+            _etag_cache.popitem(last=False)
+    return etag
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """解析单段 Range 头，返回 [start, end]（含）；无 / 多段 / 无法解析返回 None，越界返回 (size, size)"""
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[6:].strip().partition("-")
+    try:
+        if first == "":
+            n = int(last)
+            if n <= 0:
+                return size, size
+            return max(0, size - n), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return size, size
+    return start, min(end, size - 1)
+
+
+def _iter_range(f, length: int, block: int = 256 * 1024):
+    try:
+        while length > 0:
+            chunk = f.read(min(block, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def send_range_file(path: str, mimetype: str = "video/mp4", download_name: str = "",
+                    etag: Optional[str] = None) -> Response:
+    """发送文件（支持 Range / If-Range / If-None-Match），ETag 默认为内容 MD5"""
+    size = os.path.getsize(path)
+    etag = etag or content_etag(path)
+    quoted = f'"{etag}"'
+
+    if_none_match = request.headers.get("If-None-Match", "")
+    if if_none_match and (if_none_match.strip() == "*" or quoted in [t.strip() for t in if_none_match.split(",")]):
+        response = Response(status=304)
+        response.headers["ETag"] = quoted
+        return response
+
+    rng = parse_range(request.headers.get("Range", ""), size)
+    if_range = request.headers.get("If-Range", "").strip()
+    if rng is not None and if_range and if_range != quoted:
+        rng = None  # 文件已变化：返回完整内容
+
+    if rng == (size, size):
+        response = Response(status=416)
+        response.headers["Content-Range"] = f"bytes */{size}"
+        response.headers["ETag"] = quoted
+        return response
+
+    start, end = rng if rng is not None else (0, size - 1)
+    length = max(0, end - start + 1)
+    f = open(path, "rb")
+    f.seek(start)
+    wrapper = request.environ.get("wsgi.file_wrapper")
+    if wrapper is not None and (end == size - 1 or request.environ.get("SERVER_SOFTWARE", "").startswith("gunicorn")):
+        # gunicorn 按 Content-Length 截断并对 [start, start+length) 调用 sendfile
+        body = wrapper(f, 256 * 1024)
+    else:
+        body = _iter_range(f, length)
+
+    response = Response(body, status=206 if rng is not None else 200, mimetype=mimetype, direct_passthrough=True)
+    response.headers["Content-Length"] = str(length)
+    response.headers["Accept-Ranges"] = "bytes"
+    response.headers["ETag"] = quoted
+    if rng is not None:
+        response.headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    if download_name:
+        response.headers["Content-Disposition"] = f'inline; filename="{download_name}"'
+    return response
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    from flask import Flask
+
+    app = Flask(__name__)
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "result.mp4")
+        data = os.urandom(1024 * 1024 + 7)
+        with open(path, "wb") as f:
+            f.write(data)
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        app.add_url_rule("/f", "f", lambda: send_range_file(path, download_name="result.mp4"))
+        client = app.test_client()
+        size = len(data)
+        cases = [
+            ({}, 200, data),
+            ({"Range": "bytes=100-199"}, 206, data[100:200]),
+            ({"Range": "bytes=1000-"}, 206, data[1000:]),
+            ({"Range": "bytes=-500"}, 206, data[-500:]),
+            ({"Range": f"bytes=100-{size + 100}"}, 206, data[100:]),
+            ({"Range": f"bytes={size}-"}, 416, b""),
+            ({"Range": "bytes=0-1,5-6"}, 200, data),
+            ({"Range": "bytes=10-19", "If-Range": etag}, 206, data[10:20]),
+            ({"Range": "bytes=10-19", "If-Range": '"stale"'}, 200, data),
+            ({"If-None-Match": etag}, 304, b""),
+        ]
+        for headers, status, body in cases:
+            r = client.get("/f", headers=headers)
+            assert r.status_code == status, (headers, r.status_code)
+            assert r.data == body, headers
+            assert r.headers["ETag"] == etag
+            if status == 206:
+                assert int(r.headers["Content-Length"]) == len(body)
+            r.close()
+        print(f"Range / If-Range / If-None-Match: {len(cases)} 项 OK")
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+合成结果缓存（SQLite 索引 + 硬链接 + 字节预算淘汰）
+================================================
+原实现在任务完成后 shutil.copy2 把结果复制到 OUTPUT_DIR/cache_{key}/cache_{key}.mp4：
+每个输出视频在磁盘上存两份，缓存条目只能靠 _cleanup_old_files 按 mtime TTL 删除。
+
+本模块：
+  1. results.db 索引表记录每个条目的大小、命中次数、最近访问时间
+  2. 写入时 os.link 硬链接任务输出（同一文件系统零拷贝），失败时尝试 reflink（FICLONE），最后才复制
+  3. 总大小超过字节预算时按 LRU（最近访问）或 LFU（命中次数）淘汰；刚命中的条目有保护期，
+     避免客户端还没下载就被删
+  4. 命中 / 未命中计数通过 stats() 暴露给 queue_status
+
+条目路径沿用 cache_{key}/cache_{key}.mp4 布局，旧版本留下的缓存文件在首次查询时自动登记进索引。
+
+自检（淘汰顺序 + 并发查询）：
+  python result_cache.py
+"""
+
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+_FICLONE = 0x40049409  # linux/fs.h: _IOW(0x94, 9, int)
+
+
+def link_or_copy(src: str, dst: str) -> str:
+    """把 src 放到 dst：硬链接 → reflink → 复制，返回实际使用的方式"""
+    try:
+        os.link(src, dst)
+        return "link"
+    except OSError:
+        pass
+    try:
+        import fcntl
+        with open(src, "rb") as fs, open(dst, "wb") as fd:
+            fcntl.ioctl(fd.fileno(), _FICLONE, fs.fileno())
+        shutil.copystat(src, dst)
+        return "reflink"
+    except (OSError, ImportError):
+        try:
+            os.remove(dst)
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+    return "copy"
+
+
+class ResultCache:
+    """合成结果缓存：单连接 + 自有锁（与 TaskStore 相同的用法）"""
+
+    def __init__(self, root: str, db_path: str, byte_budget: int = 0,
+                 policy: str = "lru", protect_seconds: float = 600):
+        """
+        Args:
+            root: 缓存条目所在目录（OUTPUT_DIR）
+            db_path: 索引 SQLite 文件路径
+            byte_budget: 缓存总字节上限（0 = 不限制）
+            policy: lru（最近访问时间）| lfu（命中次数，同次数按最近访问）
+            protect_seconds: 最近这段时间内访问过的条目不淘汰
+        """
+        self.root = root
+        self.byte_budget = byte_budget
+        self.policy = "lfu" if str(policy).strip().lower() == "lfu" else "lru"
+        self.protect_seconds = protect_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+        CREATE TABLE IF NOT EXISTS result_cache (
+            cache_key TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL DEFAULT 0,
+            hits INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            last_access REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_result_cache_lru ON result_cache(last_access);
+        CREATE INDEX IF NOT EXISTS idx_result_cache_lfu ON result_cache(hits, last_access);
+        """)
+        logger.info(f"[ResultCache] 结果缓存就绪: {db_path} (policy={self.policy}, budget={byte_budget})")
+
+    def entry_path(self, cache_key: str) -> str:
+        return os.path.join(self.root, f"cache_{cache_key}", f"cache_{cache_key}.mp4")
+
+    def lookup(self, cache_key: str) -> Optional[str]:
+        """查询缓存，命中返回结果文件路径并记一次命中；文件已不存在的条目顺带删除"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT path FROM result_cache WHERE cache_key=?", (cache_key,)).fetchone()
+            path = row["path"] if row else self.entry_path(cache_key)
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = 0
+            if size <= 0:
+                if row:
+                    self._conn.execute("DELETE FROM result_cache WHERE cache_key=?", (cache_key,))
+                self.misses += 1
+                return None
+            if row:
+                self._conn.execute(
+                    "UPDATE result_cache SET hits=hits+1, last_access=? WHERE cache_key=?", (now, cache_key))
+            else:
+                # 旧版本 shutil.copy2 写入的缓存文件：登记进索引
+                self._conn.execute(
+                    "INSERT INTO result_cache (cache_key, path, size, hits, created_at, last_access) "
+                    "VALUES (?, ?, ?, 1, ?, ?)", (cache_key, path, size, os.path.getmtime(path), now))
+            self.hits += 1
+            return path
+
+    def put(self, cache_key: str, src_path: str) -> Optional[str]:
+        """把任务输出登记为缓存条目（硬链接），返回条目路径；随后按预算淘汰"""
+        dst = self.entry_path(cache_key)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = f"{dst}.tmp{threading.get_ident()}"
+        method = link_or_copy(src_path, tmp)
+        os.replace(tmp, dst)
+        size = os.path.getsize(dst)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO result_cache (cache_key, path, size, hits, created_at, last_access) "
+                "VALUES (?, ?, ?, 0, ?, ?) ON CONFLICT(cache_key) DO UPDATE SET "
+                "path=excluded.path, size=excluded.size, last_access=excluded.last_access",
+                (cache_key, dst, size, now, now))
+        logger.info(f"[ResultCache] 缓存写入({method}): {dst} ({size} bytes)")
+        self.evict(keep=cache_key)
+        return dst
+
+    def evict(self, keep: str = "") -> int:
+        """淘汰到字节预算以内（keep 为刚写入、本轮不淘汰的条目），返回删除条目数"""
+        if self.byte_budget <= 0:
+            return 0
+        order = "hits, last_access" if self.policy == "lfu" else "last_access"
+        removed = []
+        with self._lock:
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM result_cache").fetchone()[0]
+            if total <= self.byte_budget:
+                return 0
+            cutoff = time.time() - self.protect_seconds
+            for row in self._conn.execute(
+                    f"SELECT cache_key, path, size FROM result_cache WHERE last_access<? AND cache_key!=? "
+                    f"ORDER BY {order}", (cutoff, keep)).fetchall():
+                if total <= self.byte_budget:
+                    break
+                self._conn.execute("DELETE FROM result_cache WHERE cache_key=?", (row["cache_key"],))
+                removed.append(row["path"])
+                total -= row["size"]
+        for path in removed:
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+        if removed:
+            logger.info(f"[ResultCache] 淘汰 {len(removed)} 个条目（{self.policy}）")
+        return len(removed)
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM result_cache").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "entries": entries,
+            "bytes": total,
+            "byte_budget": self.byte_budget,
+            "policy": self.policy,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# 自检：淘汰顺序（LRU / LFU）+ 多线程并发查询（模拟 submit_task 并发命中）
+if __name__ == "__main__":
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    with tempfile.TemporaryDirectory() as d:
+        def make_output(name, size=1000):
+            p = os.path.join(d, f"{name}.mp4")
+            with open(p, "wb") as f:
+                f.write(os.urandom(size))
+            return p
+
+        for policy in ("lru", "lfu"):
+            cache = ResultCache(os.path.join(d, policy), os.path.join(d, f"{policy}.db"),
+                                byte_budget=3000, policy=policy, protect_seconds=0)
+            for k in ("a", "b", "c"):
+                src = make_output(f"{policy}_{k}")
+                cache.put(k, src)
+                time.sleep(0.01)
+            linked = os.stat(cache.entry_path("a")).st_ino == os.stat(os.path.join(d, f"{policy}_a.mp4")).st_ino
+            # 访问顺序 a×3 → c → b：LRU 应淘汰最久未访问的 a，LFU 应淘汰命中少且较早访问的 c
+            for k in ("a", "a", "a", "c", "b"):
+                cache.lookup(k)
+                time.sleep(0.01)
+            cache.put("d", make_output(f"{policy}_d"))
+            left = sorted(k for k in "abcd" if os.path.exists(cache.entry_path(k)))
+            print(f"[{policy}] 硬链接={linked} 写入 d 后保留: {left} 统计={cache.stats()}")
+            cache.close()
+
+        cache = ResultCache(os.path.join(d, "mt"), os.path.join(d, "mt.db"))
+        cache.put("hot", make_output("hot"))
+        with ThreadPoolExecutor(50) as ex:
+            t0 = time.perf_counter()
+            results = list(ex.map(lambda i: cache.lookup("hot" if i % 4 else f"miss{i}"), range(20000)))
+            dt = time.perf_counter() - t0
+        st = cache.stats()
+        ok = st["hits"] == sum(1 for r in results if r) == 15000 and st["misses"] == 5000
+        hits_db = cache._conn.execute("SELECT hits FROM result_cache WHERE cache_key='hot'").fetchone()[0]
+        print(f"50 线程并发查询 20000 次: {dt * 1000:.0f}ms, 计数一致={ok and hits_db == 15000}")
+        cache.close()
@@ -4,14 +4,21 @@
 HeyGem Linux 在线合成服务
 =========================
 功能：
-  1. 多并发队列（最大并发数可配置，默认3，超出排队）
-  2. 客户端上传视频+音频 -> 服务端合成（支持 hash 去重，相同文件不重复上传）
-  3. 超过1天的上传/输出文件自动清理
-  4. 合成进度实时回传客户端
+  1. 多 worker 调度队列（worker 数 / 绑定 GPU 可配置，优先级 + 客户端公平轮转 + 准入控制）
+  2. 任务状态写入 tasks.db（SQLite WAL），重启后恢复任务记录并重新排队未完成任务
+  3. 客户端上传视频+音频 -> 服务端合成（支持 hash 去重，相同文件不重复上传）
+  4. 上传/输出文件登记到产物索引（artifacts.db），janitor 按到期时间分批清理，仍被引用的文件不删
+  5. 合成进度实时回传客户端（引擎子进程经共享内存上报帧数，进度总线按变化推送）
+  6. 音色 / 数字人资产按内容去重并引用计数（assets.db），删除资产不影响共享同一文件的其它资产
+  7. 视频编辑（字幕 / 画中画 / 缩放 / BGM）编译为单个 ffmpeg 滤镜图一次编码，在编辑任务池中异步执行
+  8. 结果下载支持 Range 断点续传，ETag 为内容 MD5，客户端下载完成后校验（range_file.py）
+  9. /metrics 暴露 Prometheus 指标（请求数 / 各阶段耗时直方图 / 缓存命中 / 队列深度 / 引擎 fps，metrics.py）
+ 10. 分段增量渲染：音频按静音切段缓存已渲染视频段，只改末尾一句时只重渲染变化的段（segment_cache.py）
 
 启动方式：
   python run_server.py
   python run_server.py --host 0.0.0.0 --port 8383
+  gunicorn -c gunicorn.conf.py gateway:app   # 生产模式：gevent 网关 + 本进程作为引擎进程（见 gateway.py）
 """
 
 import argparse
@@ -21,7 +28,6 @@ import hashlib
 import json
 import os
 import shutil
-import sqlite3
 import subprocess
 import sys
 import threading
@@ -29,9 +35,9 @@ import time
 import traceback
 import uuid
 from collections import OrderedDict
-from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 from typing import Optional
+from urllib.parse import quote
 
 # Keep process CWD stable for both main process and spawn children.
 # Some binary modules read config/config.ini by relative path at import time.
@@ -77,8 +83,46 @@ if _ENABLE_GFPGAN == "0":
     except Exception as _e:
         print(f"[Server] 禁用 GFPGAN 失败: {_e}")
 
-import cv2
-from flask import Flask, request, jsonify, send_file
+# ── 数字人视频预处理缓存：包装人脸检测（必须在 import engine 之前，引擎子进程导入本模块时同样生效） ──
+_preprocess_cache = None
+if _cfg_check.get("preprocess_cache", "enabled", fallback="1").strip() == "1":
+    try:
+        from preprocess_cache import PreprocessCache
+        _pc_upload = _cfg_check.get("server", "upload_dir", fallback="./uploads")
+        _pc_upload = _pc_upload if os.path.isabs(_pc_upload) else os.path.join(_BASE_DIR, _pc_upload)
+        _preprocess_cache = PreprocessCache(
+            os.path.join(os.path.abspath(_pc_upload), "preprocess_cache"),
+            byte_budget=int(float(_cfg_check.get("preprocess_cache", "max_gb", fallback="20")) * 1024 ** 3),
+            cache_version=_cfg_check.get("preprocess_cache", "cache_version", fallback="2").strip(),
+            engine_version=_cfg_check.get("engine", "version", fallback="1").strip(),
+        )
+        _pc_targets = _cfg_check.get(
+            "preprocess_cache", "targets",
+            fallback=",".join(f"face_lib.face_detect_and_align.face_align_5_landmarks:FaceDetect5Landmarks.{m}"
+                              for m in ("get_bboxes", "get_single_face", "get_multi_face")))
+        _pc_installed = [t for t in (x.strip() for x in _pc_targets.split(",")) if t and _preprocess_cache.install(t)]
+        if not _pc_installed:
+            _preprocess_cache = None
+        print(f"[Server] 预处理缓存: {', '.join(_pc_installed) or '未启用（无可包装的检测函数）'}")
+    except Exception as _e:
+        _preprocess_cache = None
+        print(f"[Server] 启用预处理缓存失败: {_e}")
+
+# ── 音频特征缓存：同一条音频换不同数字人重复提交时跳过 STFT / mel 计算 ──
+if _cfg_check.get("feature_cache", "enabled", fallback="1").strip() == "1":
+    try:
+        from wenet.tools import _feature_cache
+        _fc_upload = _cfg_check.get("server", "upload_dir", fallback="./uploads")
+        _fc_upload = _fc_upload if os.path.isabs(_fc_upload) else os.path.join(_BASE_DIR, _fc_upload)
+        _feature_cache.install(
+            os.path.join(os.path.abspath(_fc_upload), "feature_cache"),
+            byte_budget=int(float(_cfg_check.get("feature_cache", "max_gb", fallback="5")) * 1024 ** 3),
+        )
+        print("[Server] 音频特征缓存已启用")
+    except Exception as _e:
+        print(f"[Server] 启用音频特征缓存失败: {_e}")
+
+from flask import Flask, Response, g, request, jsonify
 
 try:
     from flask_sock import Sock
@@ -91,6 +135,24 @@ import service.trans_dh_service
 from h_utils.custom import CustomError
 from y_utils.config import GlobalConfig
 from y_utils.logger import logger
+from task_scheduler import (
+    PRIORITIES, PRIORITY_INTERACTIVE, AdmissionError, TaskScheduler, parse_devices,
+)
+from task_store import TaskStore
+from result_cache import ResultCache, link_or_copy
+from segment_cache import SegmentCache, SegmentError, plan_segments
+from janitor import Janitor
+from asset_store import AssetStore
+from range_file import content_etag, send_range_file
+from engine_lifecycle import EngineLifecycle, MediaProbe, child_pids
+from batch_autotune import BatchAutotuner, bucket_height, device_key, is_oom, resolution_bucket
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, ServerMetrics
+from video_edit import EditQueue, normalize_ops, run_edit
+from chunked_upload import ChunkedUploadManager, UploadError
+from frame_sink import FfmpegFrameSink, mux_audio, resolve_encoder
+from progress_bus import (
+    SHM_ENV, STATE_ERROR, ProgressBus, ProgressPump, ProgressReporter, ProgressRing,
+)
 
 # WebSocket 客户端（连接到 API 端）
 try:
@@ -106,9 +168,15 @@ except ImportError:
 _cfg = configparser.ConfigParser()
 _cfg.read(_CFG_PATH, encoding="utf-8")
 
-# ── 强制单任务串行：避免多任务同时占用 GPU 导致 OOM ──
-# 忽略 config.ini 中的 max_concurrent，强制为 1
-MAX_CONCURRENT = 1
+# ── 调度器：[scheduler] workers 个引擎 worker，按 devices 绑定 GPU ──
+# 默认 1 个 worker（单任务串行，避免多任务同时占用同一张卡导致 OOM）；
+# 多卡机器配置 devices = 0,1,2,3 + workers = 4，大显存卡可让多个 worker 共用一张卡
+SCHEDULER_WORKERS = int(_cfg.get("scheduler", "workers", fallback="1"))
+SCHEDULER_DEVICES = _cfg.get("scheduler", "devices", fallback="0").strip()
+# 准入控制：排队任务预估帧数总和上限 / 单客户端排队任务数上限（0 = 不限制）
+MAX_QUEUED_FRAMES = int(_cfg.get("scheduler", "max_queued_frames", fallback="0"))
+MAX_QUEUED_PER_CLIENT = int(_cfg.get("scheduler", "max_queued_per_client", fallback="0"))
+MAX_CONCURRENT = SCHEDULER_WORKERS
 UPLOAD_DIR = _cfg.get("server", "upload_dir", fallback="./uploads")
 OUTPUT_DIR = _cfg.get("server", "output_dir", fallback="./outputs")
 FILE_TTL = int(_cfg.get("server", "file_ttl_seconds", fallback="86400"))
@@ -139,48 +207,20 @@ os.makedirs(STORE_DIR, exist_ok=True)
 # 资产 TTL（30天保留，仅 DB 记录用）
 ASSET_TTL = int(_cfg.get("server", "asset_ttl_seconds", fallback=str(30 * 86400)))  # 30天
 
-# SQLite 数据库：资产元数据
-_DB_PATH = os.path.join(os.path.dirname(__file__), "assets.db")
-_db_lock = threading.Lock()
-
-
-def _get_db():
-    conn = sqlite3.connect(_DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA journal_mode=WAL")
-    return conn
-
-
-def _init_db():
-    conn = _get_db()
-    conn.executescript("""
-    CREATE TABLE IF NOT EXISTS assets (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        license_key TEXT NOT NULL,
-        asset_type TEXT NOT NULL,          -- 'voice' | 'avatar'
-        name TEXT NOT NULL,
-        file_hash TEXT NOT NULL,
-        file_ext TEXT NOT NULL DEFAULT '',
-        file_path TEXT NOT NULL,
-        file_size INTEGER DEFAULT 0,
-        created_at REAL NOT NULL,
-        expires_at REAL NOT NULL
-    );
-    CREATE INDEX IF NOT EXISTS idx_assets_key_type ON assets(license_key, asset_type);
-    CREATE INDEX IF NOT EXISTS idx_assets_expires ON assets(expires_at);
-    """)
-    conn.close()
-    logger.info(f"[DB] 资产数据库初始化完成: {_DB_PATH}")
-
-
-_init_db()
-
 
 def _store_path(file_hash, ext):
     """根据 hash 和扩展名，返回统一存储目录中的路径"""
     return os.path.join(STORE_DIR, f"{file_hash}{ext}")
 
 
+# SQLite 数据库：资产元数据（连接池 + 引用计数，同内容文件在最后一条引用删除后由 gc 回收）
+_DB_PATH = os.path.join(os.path.dirname(__file__), "assets.db")
+_assets = AssetStore(
+    _DB_PATH, _store_path,
+    gc_grace=float(_cfg.get("assets", "gc_grace_seconds", fallback="600")),
+)
+
+
 def _file_exists(file_hash, ext):
     """检查文件是否已存在于统一存储"""
     p = _store_path(file_hash, ext)
@@ -198,6 +238,10 @@ def _resolve_file(file_hash: str, ext: str) -> str:
     return ""
 
 
+# 分片断点续传上传会话（分片文件 _up_*.part 与元数据暂存在 STORE_DIR）
+_chunk_uploads = ChunkedUploadManager(STORE_DIR)
+
+
 def _md5_of_file(path):
     """计算文件的 MD5"""
     h = hashlib.md5()
@@ -208,96 +252,122 @@ def _md5_of_file(path):
 
 
 # ============================================================
-#  自定义 write_video（与 app.py / run_api.py 一致）
+#  自定义 write_video：帧直接写入 ffmpeg stdin，单次编码并合并音频
 # ============================================================
+# 编码器：libx264 | nvenc | auto（auto = 有 NVENC 用 NVENC，否则 libx264）
+VIDEO_ENCODER = _cfg.get("digital", "video_encoder", fallback="libx264").strip()
+VIDEO_PRESET = _cfg.get("digital", "video_preset", fallback="medium").strip()
+VIDEO_CRF = int(_cfg.get("digital", "video_crf", fallback="15"))
+
+
+def _resolve_merge_audio(audio_path, temp_dir, work_id):
+    """音频路径不存在时尝试 temp_dir 下引擎格式化后的音频"""
+    if os.path.exists(audio_path):
+        return audio_path
+    logger.warning(f"[Server] 音频文件不存在: {audio_path}, 尝试在 temp_dir 查找")
+    # 引擎可能传的是相对路径，尝试在 temp_dir 中寻找格式化后的音频
+    _alt = os.path.join(temp_dir, f"{work_id}_format.wav")
+    if os.path.exists(_alt):
+        logger.info(f"[Server] 使用备选音频: {_alt}")
+        return _alt
+    logger.error(f"[Server] 备选音频也不存在: {_alt}")
+    return audio_path
+
+
 def _write_video_server(
     output_imgs_queue, temp_dir, result_dir, work_id, audio_path,
     result_queue, width, height, fps,
     watermark_switch=0, digital_auth=0, temp_queue=None,
 ):
-    output_mp4 = os.path.join(temp_dir, f"{work_id}-t.mp4")
+    _t_write = time.perf_counter()
     result_path = os.path.join(result_dir, f"{work_id}-r.mp4")
-    fourcc = cv2.VideoWriter_fourcc(*"mp4v")
-    video_write = cv2.VideoWriter(output_mp4, fourcc, fps, (width, height))
-    logger.info(f"[Server] VideoWriter init: {work_id}")
+    audio_path = _resolve_merge_audio(audio_path, temp_dir, work_id)
+    has_audio = os.path.exists(audio_path)
+    # 音频此时不存在则先只编码视频，帧结束后再复制视频流合并音频
+    video_out = result_path if has_audio else os.path.join(temp_dir, f"{work_id}-t.mp4")
 
     frame_count = 0
-    # 进度文件：子进程写入帧数，主进程读取（跨进程 IPC）
-    _progress_file = os.path.join(temp_dir, f".progress_{work_id}")
-    _last_progress_write = 0  # 上次写进度文件的时间戳（节流，避免频繁 IO 拖慢合成）
+    # 进度上报：子进程每批帧写入共享内存槽位，主进程 ProgressPump 读取（不可用时回退 .progress 文件）
+    reporter = ProgressReporter(work_id, temp_dir)
+    sink = None
 
     try:
+        # 分段缓存：主进程 _run_task 写入的段边界帧号，在这些帧强制关键帧以便按段切分
+        keyframes = None
+        _kf = os.path.join(temp_dir, f".keyframes_{work_id}")
+        if os.path.exists(_kf):
+            with open(_kf, "r") as _kff:
+                keyframes = json.load(_kff)
+        sink = FfmpegFrameSink(
+            video_out, width, height, fps,
+            audio_path=audio_path if has_audio else None,
+            encoder=resolve_encoder(VIDEO_ENCODER), preset=VIDEO_PRESET, crf=VIDEO_CRF,
+            keyframes=keyframes,
+        )
+        logger.info(f"[Server] FrameSink init: {work_id} encoder={sink.encoder} "
+                    f"audio={audio_path if has_audio else '(稍后合并)'}")
         while True:
             state, reason, value_ = output_imgs_queue.get()
             if isinstance(state, bool) and state is True:
                 logger.info(f"[Server] VideoWriter [{work_id}] 帧队列结束")
-                video_write.release()
                 break
             elif isinstance(state, bool) and state is False:
                 logger.error(f"[Server] VideoWriter [{work_id}] 异常: {reason}")
                 raise CustomError(reason)
             else:
                 for img in value_:
-                    video_write.write(img)
+                    sink.write(img)
                     frame_count += 1
-                # 写进度文件供主进程读取，节流：每 5 秒最多写一次
-                _now = time.time()
-                if _now - _last_progress_write >= 5:
-                    _last_progress_write = _now
-                    try:
-                        with open(_progress_file, "w") as _pf:
-                            _pf.write(f"{frame_count}\n")
-                    except Exception:
-                        pass
-
-        if video_write is not None:
-            video_write.release()
-
-        # 诊断：检查音频文件是否存在
-        if not os.path.exists(audio_path):
-            logger.warning(f"[Server] 音频文件不存在: {audio_path}, 尝试在 temp_dir 查找")
-            # 引擎可能传的是相对路径，尝试在 temp_dir 中寻找格式化后的音频
-            _alt = os.path.join(temp_dir, f"{work_id}_format.wav")
-            if os.path.exists(_alt):
-                audio_path = _alt
-                logger.info(f"[Server] 使用备选音频: {audio_path}")
-            else:
-                logger.error(f"[Server] 备选音频也不存在: {_alt}")
-
-        logger.info(f"[Server] ffmpeg merge: audio={audio_path} (exists={os.path.exists(audio_path)}, "
-                     f"size={os.path.getsize(audio_path) if os.path.exists(audio_path) else 0}), "
-                     f"video={output_mp4}")
+                reporter.frames(frame_count)
 
         # 帧数校验：如果生成的帧数远少于预期，记录警告
         logger.info(f"[Server] VideoWriter [{work_id}] 实际帧数: {frame_count}")
+        _sink, sink = sink, None
+        _sink.close()
+
+        if not has_audio:
+            audio_path = _resolve_merge_audio(audio_path, temp_dir, work_id)
+            if os.path.exists(audio_path):
+                rc = mux_audio(video_out, audio_path, result_path)
+                if rc != 0:
+                    logger.warning(f"[Server] ffmpeg 合并音频退出码非零: {rc}")
+            else:
+                logger.error(f"[Server] 无可用音频，输出无声视频: {work_id}")
+                shutil.move(video_out, result_path)
+            try:
+                if os.path.exists(video_out):
+                    os.remove(video_out)
+            except OSError:
+                pass
 
-        command = (
-            f'ffmpeg -loglevel warning -y -i {audio_path} -i {output_mp4} '
-            f'-map 0:a -map 1:v '
-            f'-c:a aac -c:v libx264 -profile:v baseline -level 3.1 '
-            f'-pix_fmt yuv420p -crf 15 '
-            f'-shortest '
-            f'-movflags +faststart -strict -2 {result_path}'
-        )
-        logger.info(f"[Server] ffmpeg: {command}")
-        rc = subprocess.call(command, shell=True)
-        if rc != 0:
-            logger.warning(f"[Server] ffmpeg 退出码非零: {rc}")
         # 校验结果文件
         if not os.path.exists(result_path) or os.path.getsize(result_path) < 1024:
             raise RuntimeError(f"ffmpeg 合并失败: 结果文件不存在或过小")
         logger.info(f"[Server] 视频生成完成: {result_path} ({os.path.getsize(result_path)} bytes)")
+        # 阶段耗时（本函数在引擎子进程中运行）写文件，主进程 _run_task 读取后计入指标
+        try:
+            with open(os.path.join(temp_dir, f".stages_{work_id}"), "w") as _sf:
+                json.dump({"write_video": time.perf_counter() - _t_write, "frames": frame_count}, _sf)
+        except OSError:
+            pass
+        reporter.finish(frame_count)
         result_queue.put([True, result_path])
     except Exception as e:
         logger.error(f"[Server] VideoWriter [{work_id}] 异常: {e}")
-        # 写错误文件供主进程读取（与进度文件同目录）
-        try:
-            _err_file = os.path.join(temp_dir, f".error_{work_id}")
-            with open(_err_file, "w") as _ef:
-                _ef.write(str(e))
-        except Exception:
-            pass
+        if sink is not None:
+            sink.abort()
+        reporter.finish(frame_count, error=str(e))
+        if not reporter.shared:
+            # 写错误文件供主进程读取（与进度文件同目录）
+            try:
+                _err_file = os.path.join(temp_dir, f".error_{work_id}")
+                with open(_err_file, "w") as _ef:
+                    _ef.write(str(e))
+            except Exception:
+                pass
         result_queue.put([False, f"[{work_id}] 异常: {e}"])
+    finally:
+        reporter.close()
     logger.info(f"[Server] VideoWriter [{work_id}] 线程结束")
 
 
@@ -318,6 +388,26 @@ else:
     except Exception:
         print(logger_msg)
 
+# ── 指标：/metrics（Prometheus 文本格式）+ 各阶段耗时（queue_status 返回滚动汇总） ──
+_metrics = ServerMetrics(window=int(_cfg.get("metrics", "stage_window", fallback="512")))
+
+
+@app.before_request
+def _metrics_start():
+    g._metrics_t0 = time.perf_counter()
+
+
+@app.after_request
+def _metrics_record(response):
+    try:
+        endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        _metrics.http_requests.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+        _metrics.http_seconds.observe(time.perf_counter() - g._metrics_t0, endpoint=endpoint)
+    except Exception:
+        pass
+    return response
+
+
 # ── CORS 支持（手机端 H5 跨域访问视频/接口） ──
 @app.after_request
 def _add_cors_headers(response):
@@ -333,17 +423,86 @@ def _add_cors_headers(response):
         pass
     return response
 
-_task_instance = None
-# 推理串行锁已移除：MAX_CONCURRENT=1 时 semaphore 已保证同一时刻只有一个任务
-
-_semaphore = threading.Semaphore(MAX_CONCURRENT)  # MAX_CONCURRENT=1，天然串行队列
-_executor = ThreadPoolExecutor(max_workers=5)  # 1个任务槽位 + 4个辅助线程
+_task_instance = None  # worker 0 的引擎实例
+# 引擎生命周期：启动时一次性就绪检查（代替固定 sleep），ffmpeg 能力探测缓存；health_check 报告其状态
+_lifecycle = EngineLifecycle(
+    ready_timeout=float(_cfg.get("engine", "ready_timeout_seconds", fallback="300")),
+    settle_seconds=float(_cfg.get("engine", "ready_settle_seconds", fallback="1.0")),
+    ready_file=_cfg.get("engine", "ready_file", fallback="").strip(),
+)
+# 输入文件媒体信息：每个文件一次 ffprobe JSON，按内容 hash 缓存（入队预估与任务执行共用）
+_media_probe = MediaProbe(int(_cfg.get("engine", "probe_cache_size", fallback="512")))
+# 推理 batch_size 自动调优：按 (设备, 分辨率档位) 校准并写入 batch_tuning.db，_run_task 按任务选择
+# 默认关闭（见 config.ini [autotune]）：batch_size 经进程级 GlobalConfig 传给引擎，只有引擎在每次 work() 时
+# 于本进程读取该值才有效；仅单 worker 生效，多 worker 时 _init_service 会关闭调优
+AUTOTUNE_ENABLED = _cfg.get("autotune", "enabled", fallback="0").strip() == "1"
+_batch_tuner = BatchAutotuner(
+    os.path.join(os.path.dirname(__file__), "batch_tuning.db"),
+    default=int(_cfg.get("digital", "batch_size", fallback="8")),
+    candidates=[int(x) for x in _cfg.get("autotune", "candidates", fallback="1,2,4,8,16,32").split(",") if x.strip()],
+    min_gain=float(_cfg.get("autotune", "min_gain", fallback="0.05")),
+    engine_version=_cfg.get("engine", "version", fallback="1").strip(),
+)
+_scheduler: Optional[TaskScheduler] = None  # 由 _init_service 创建
+_engine_env_lock = threading.Lock()
 
 _tasks = OrderedDict()
 _tasks_lock = threading.Lock()
 
+# 任务持久化日志：_tasks 的每次状态变化同步写入 tasks.db（与 assets.db 同目录）
+_TASK_DB_PATH = os.path.join(os.path.dirname(__file__), "tasks.db")
+_task_store = TaskStore(_TASK_DB_PATH)
+
+# 合成结果缓存：相同 audio+video 直接返回；条目与任务输出硬链接，按 [result_cache] 字节预算淘汰
+_result_cache = ResultCache(
+    OUTPUT_DIR, os.path.join(os.path.dirname(__file__), "results.db"),
+    byte_budget=int(float(_cfg.get("result_cache", "max_gb", fallback="50")) * 1024 ** 3),
+    policy=_cfg.get("result_cache", "policy", fallback="lru"),
+)
+
+# 分段增量渲染：音频按静音切段，已渲染的视频段按内容 hash 缓存，只改了末尾一句时只重渲染变化的段
+SEGMENT_CACHE_ENABLED = _cfg.get("segment_cache", "enabled", fallback="0").strip() == "1"
+SEGMENT_FRAME_MAP = _cfg.get("segment_cache", "frame_map", fallback="").strip()
+_segment_version: Optional[str] = None
+
+
+def _get_segment_version() -> str:
+    """段缓存版本：引擎版本 + 实际使用的编码器（auto / nvenc 解析后的结果）+ 编码参数；首次分段时解析"""
+    global _segment_version
+    if _segment_version is None:
+        _segment_version = "|".join([_cfg.get("engine", "version", fallback="1").strip(),
+                                     resolve_encoder(VIDEO_ENCODER), VIDEO_PRESET, str(VIDEO_CRF)])
+    return _segment_version
+
+
+_segment_cache: Optional[SegmentCache] = None
+if SEGMENT_CACHE_ENABLED:
+    _segment_cache = SegmentCache(
+        os.path.join(UPLOAD_DIR, "segment_cache"),
+        byte_budget=int(float(_cfg.get("segment_cache", "max_gb", fallback="20")) * 1024 ** 3),
+    )
+
+# 视频编辑任务池：固定数量 ffmpeg 并发，状态与合成任务共用 _tasks / 进度接口
+_edit_queue = EditQueue(
+    workers=int(_cfg.get("video_edit", "workers", fallback="2")),
+    max_pending=int(_cfg.get("video_edit", "max_pending", fallback="16")),
+)
+
+# 产物索引：上传文件 / 任务输出 / 编辑目录 / 临时文件登记到 artifacts.db，由 janitor 按到期时间分批清理
+_janitor = Janitor(
+    os.path.join(os.path.dirname(__file__), "artifacts.db"),
+    batch_size=int(_cfg.get("janitor", "batch_size", fallback="200")),
+    max_deletes_per_sec=float(_cfg.get("janitor", "max_deletes_per_sec", fallback="200")),
+)
+
+# 进度总线：_update_task 每次变化都发布，ws_progress 等订阅方按变化推送
+_progress_bus = ProgressBus()
+_progress_ring: Optional[ProgressRing] = None  # 引擎子进程帧进度共享内存（_init_service 创建）
+_progress_pump: Optional[ProgressPump] = None
+_work_to_task = {}  # work_id -> task_id（受 _tasks_lock 保护）
+
 # WebSocket 客户端实例
-_ws_client: Optional[GpuWebSocketClient] = None
+_ws_client: Optional["GpuWebSocketClient"] = None
 
 
 class TaskStatus:
@@ -377,8 +536,14 @@ def _new_task(task_id, audio_name, video_name):
 
 def _update_task(task_id, **kwargs):
     with _tasks_lock:
-        if task_id in _tasks:
-            _tasks[task_id].update(kwargs)
+        if task_id not in _tasks:
+            return
+        _tasks[task_id].update(kwargs)
+    _progress_bus.publish(task_id)
+    try:
+        _task_store.update(task_id, **kwargs)
+    except Exception as e:
+        logger.warning(f"[TaskStore] 写入失败: {task_id} ({e})")
 
 
 _last_ws_notify_time = 0  # 上次通知 gpu_power_manager 的时间戳
@@ -394,10 +559,8 @@ def _notify_gpu_task_active(task_id: str = "", task_type: str = "heygem_task"):
         _ws_client.notify_task_active(task_id=task_id, task_type=task_type)
 
 
-_last_progress_push_time = {}  # task_id -> last push timestamp（节流 WS 推送）
-
 def _push_progress(task_id: str):
-    """通过 WS 推送任务进度给客户端（节流：每 2 秒最多推一次帧进度）"""
+    """通过 WS 推送任务进度给客户端（同一任务的帧进度由 ws_client 出站队列按 progress_window 合并）"""
     if not _ws_client:
         return
     with _tasks_lock:
@@ -415,14 +578,6 @@ def _push_progress(task_id: str):
     if not key:
         return  # 没有 license_key（旧版客户端/PC直连），不推送
 
-    # 帧进度节流：synthesizing 状态每 2 秒最多推一次
-    now = time.time()
-    if status in (TaskStatus.SYNTHESIZING, TaskStatus.PROCESSING):
-        last = _last_progress_push_time.get(task_id, 0)
-        if now - last < 2:
-            return
-    _last_progress_push_time[task_id] = now
-
     _ws_client.send_progress(
         task_id=task_id,
         key=key,
@@ -436,22 +591,25 @@ def _push_progress(task_id: str):
 
 
 def _update_task_progress(work_id, stage, frame_count):
-    task_id = ""
     with _tasks_lock:
-        for t in _tasks.values():
-            if t.get("_work_id") == work_id:
-                total = t.get("total_frames", 0) or 1
-                # 动态修正：实际帧数超过预估时，上调 total_frames
-                if frame_count > total:
-                    total = int(frame_count * 1.05)  # 留 5% 余量
-                    t["total_frames"] = total
-                pct = min(95, int(frame_count / total * 90) + 5)
-                t["status"] = stage
-                t["current_frame"] = frame_count
-                t["progress"] = pct
-                t["message"] = f"合成中 {frame_count}/{total} 帧 ({pct}%)"
-                task_id = t.get("task_id", "")
-                break
+        task_id = _work_to_task.get(work_id, "")
+        t = _tasks.get(task_id)
+        if not t or t["status"] in (TaskStatus.DONE, TaskStatus.ERROR):
+            return
+        total = t.get("total_frames", 0) or 1
+        # 动态修正：实际帧数超过预估时，上调 total_frames
+        if frame_count > total:
+            total = int(frame_count * 1.05)  # 留 5% 余量
+        pct = min(95, int(frame_count / total * 90) + 5)
+        fields = {
+            "total_frames": total,
+            "current_frame": frame_count,
+            "progress": pct,
+            "message": f"合成中 {frame_count}/{total} 帧 ({pct}%)",
+        }
+        if t["status"] != stage:
+            fields["status"] = stage
+    _update_task(task_id, **fields)
     # 每 30 秒通知 gpu_power_manager 有活跃任务，防止误判空闲关机
     _notify_gpu_task_active(task_id=task_id, task_type="heygem_synthesizing")
     # WS 推送进度给客户端
@@ -459,18 +617,59 @@ def _update_task_progress(work_id, stage, frame_count):
         _push_progress(task_id)
 
 
+def _on_engine_progress(work_id, frame_count, state, msg):
+    """ProgressPump 回调：引擎子进程经共享内存上报的帧进度 / 错误"""
+    if state == STATE_ERROR:
+        with _tasks_lock:
+            task_id = _work_to_task.get(work_id, "")
+        if task_id:
+            _update_task(task_id, status=TaskStatus.ERROR, progress=0,
+                         message=f"合成失败: {msg}", error=msg, finished_at=time.time())
+            _push_progress(task_id)
+        return
+    if frame_count > 0:
+        _update_task_progress(work_id, TaskStatus.SYNTHESIZING, frame_count)
+
+
+# 队列 / 缓存统计：进度轮询每次都会带上，统计要扫任务表并查结果缓存 / 分段缓存的 SQLite 聚合，
+# 在 queue_info_ttl_seconds 内复用同一份结果
+QUEUE_INFO_TTL = float(_cfg.get("server", "queue_info_ttl_seconds", fallback="3"))
+_queue_info_cache = (0.0, None)
+_queue_info_lock = threading.Lock()
+
+
 def _get_queue_info():
+    global _queue_info_cache
+    with _queue_info_lock:
+        expires, info = _queue_info_cache
+        if info is None or time.monotonic() >= expires:
+            info = _build_queue_info()
+            _queue_info_cache = (time.monotonic() + QUEUE_INFO_TTL, info)
+    return dict(info)
+
+
+def _build_queue_info():
     with _tasks_lock:
         total = len(_tasks)
         processing = sum(1 for t in _tasks.values()
                          if t["status"] in (TaskStatus.PROCESSING, TaskStatus.SYNTHESIZING, TaskStatus.ENCODING))
         queued = sum(1 for t in _tasks.values() if t["status"] == TaskStatus.QUEUED)
-    return {
+    info = {
         "total_tasks": total,
         "processing": processing,
         "queued": queued,
         "max_concurrent": MAX_CONCURRENT,
     }
+    if _scheduler is not None:
+        st = _scheduler.stats()
+        info["queued_frames"] = st["queued_frames"]
+        info["queued_by_priority"] = st["queued_by_priority"]
+        info["workers"] = st["workers"]
+    info["result_cache"] = _result_cache.stats()
+    if _segment_cache is not None:
+        info["segment_cache"] = _segment_cache.stats()
+    info["video_edit"] = _edit_queue.stats()
+    return info
 
 
 # ============================================================
@@ -498,26 +697,123 @@ def auth_required(f):
 # ============================================================
 #  核心：任务执行
 # ============================================================
-def _run_task(task_id, audio_path, video_path):
-    _update_task(task_id, status=TaskStatus.QUEUED, message="等待可用 GPU 槽位...")
-    _semaphore.acquire()
+def _apply_batch_size(batch_size: int):
+    """把 batch_size 写入引擎读取的全局配置。
+
+    GlobalConfig 为进程级，无法按引擎 / 任务区分，因此自动调优只在单 worker 下启用（见 _init_service）；
+    引擎创建时已派生且自行读取过配置的子进程不受此设置影响，所以自动调优默认关闭，
+    校准时若各档吞吐无差异也不会保存结果（BatchAutotuner.calibrate）。
+    """
+    try:
+        GlobalConfig.instance().batch_size = int(batch_size)
+    except Exception as e:
+        logger.warning(f"[Server] 设置 batch_size 失败: {e}")
+
+
+def _engine_temp_dir() -> str:
+    _d = _cfg.get("temp", "temp_dir", fallback="./temp")
+    return _d if os.path.isabs(_d) else os.path.join(_BASE_DIR, _d)
+
+
+def _write_keyframes(work_id: str, keyframes):
+    """把段边界帧号交给引擎子进程的 _write_video_server（同 .progress_ 文件的约定）"""
+    with open(os.path.join(_engine_temp_dir(), f".keyframes_{work_id}"), "w") as f:
+        json.dump([int(k) for k in keyframes], f)
+
+
+def _plan_segments(audio_path, video_path, video_frames, fps):
+    """分段计划（不分段 / 失败时返回 None，任务照常完整渲染）"""
+    if _segment_cache is None:
+        return None
+    try:
+        return plan_segments(
+            audio_path, os.path.splitext(os.path.basename(video_path))[0], fps, video_frames,
+            version=_get_segment_version(), frame_map=SEGMENT_FRAME_MAP,
+            silence_db=float(_cfg.get("segment_cache", "silence_db", fallback="-40")),
+            min_silence=float(_cfg.get("segment_cache", "min_silence", fallback="0.3")),
+            min_segment=float(_cfg.get("segment_cache", "min_segment", fallback="2.0")),
+        )
+    except Exception as e:
+        logger.warning(f"[Server] 分段计划失败，完整渲染: {e}")
+        return None
+
+
+def _render_segments(task_id, engine, plan, audio_path, video_path):
+    """增量渲染：复用已缓存的段，只把变化的区间交给引擎
+
+    返回 (拼接结果路径, 实际渲染帧数)；无可复用段 / 失败时返回 (None, 0)，调用方完整渲染。
+    """
+
+    def _render_span(span_audio, span_video, keyframes):
+        work_id = str(uuid.uuid1())
+        with _tasks_lock:
+            _work_to_task[work_id] = task_id
+        if _progress_ring is not None:
+            _progress_ring.register(work_id)
+        _write_keyframes(work_id, keyframes)
+        engine.task_dic[work_id] = ""
+        try:
+            engine.work(span_audio, span_video, work_id, 0, 0, 0, 0)
+            entry = engine.task_dic.get(work_id, "")
+        finally:
+            engine.task_dic.pop(work_id, None)
+            with _tasks_lock:
+                _work_to_task.pop(work_id, None)
+            if _progress_ring is not None:
+                _progress_ring.release(work_id)
+            for _fn in [f".keyframes_{work_id}", f".progress_{work_id}", f".error_{work_id}",
+                        f".stages_{work_id}"]:
+                _fp = os.path.join(_engine_temp_dir(), _fn)
+                if os.path.exists(_fp):
+                    os.remove(_fp)
+        path = entry[2] if isinstance(entry, (list, tuple)) and len(entry) > 2 else ""
+        if not (isinstance(path, str) and os.path.isfile(path)):
+            # 引擎返回路径可能不含目录前缀（同 _run_task 的修正逻辑）
+            _result = _cfg.get("result", "result_dir", fallback="./result")
+            _result = _result if os.path.isabs(_result) else os.path.join(_BASE_DIR, _result)
+            path = next((p for p in (os.path.join(d, f"{work_id}-r.mp4") for d in (_result, _engine_temp_dir()))
+                         if os.path.isfile(p)), "")
+        if not path:
+            raise SegmentError(f"引擎未产出分段结果: {repr(entry)[:200]}")
+        return path
+
+    def _on_plan(frames, reused):
+        _update_task(task_id, total_frames=frames,
+                     message=f"增量渲染: 复用 {reused}/{len(plan.segments)} 段，需渲染 {frames} 帧")
+
+    out_path = os.path.join(_engine_temp_dir(), f"{task_id}_segments.mp4")
+    try:
+        res = _segment_cache.render_incremental(plan, audio_path, video_path, out_path, _render_span, _on_plan)
+    except Exception as e:
+        logger.warning(f"[Server] 增量渲染失败，回退完整渲染: {task_id}: {e}")
+        _update_task(task_id, total_frames=plan.total_frames)
+        return None, 0
+    if res is None:
+        return None, 0
+    logger.info(f"[Server] 增量渲染完成: {task_id} {res}")
+    return out_path, res["rendered_frames"]
+
+
+def _run_task(task_id, audio_path, video_path, engine=None, device="0"):
+    """执行单个合成任务（由调度器 worker 线程调用，engine 为该 worker 绑定的引擎实例）"""
+    engine = engine or _task_instance
     try:
         # 通知 gpu_power_manager 有任务开始处理（立即通知，不受节流限制）
         global _last_ws_notify_time
         _last_ws_notify_time = 0  # 强制立即发送
         _notify_gpu_task_active(task_id=task_id, task_type="heygem_processing")
 
+        _now = time.time()
+        with _tasks_lock:
+            _created_at = _tasks.get(task_id, {}).get("created_at", _now)
+        _metrics.observe_stage("queue_wait", max(0.0, _now - _created_at))
         _update_task(task_id, status=TaskStatus.PROCESSING, message="开始处理...",
-                     started_at=time.time())
+                     started_at=_now)
         _push_progress(task_id)  # 推送 processing 状态
+        _t_pre = time.perf_counter()
 
-        # 检查 ffmpeg 是否可用
-        try:
-            subprocess.run(["ffmpeg", "-version"], capture_output=True, timeout=5)
-        except FileNotFoundError:
-            raise RuntimeError("ffmpeg 未安装！请执行: sudo apt install -y ffmpeg")
-        except Exception:
-            pass
+        # 检查 ffmpeg 是否可用（启动时探测一次，此处读缓存）
+        _lifecycle.require_ffmpeg()
 
         # 检查输入文件
         if not os.path.exists(audio_path):
@@ -525,35 +821,30 @@ def _run_task(task_id, audio_path, video_path):
         if not os.path.exists(video_path):
             raise RuntimeError(f"视频文件不存在: {video_path}")
 
-        cap = cv2.VideoCapture(video_path)
-        video_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        cap.release()
+        # 媒体信息：入队时 _estimate_frames 已探测过同一文件，这里命中缓存
+        vinfo = _media_probe.probe(video_path)
+        video_frames, width, height, fps = vinfo["frames"], vinfo["width"], vinfo["height"], vinfo["fps"]
 
         if video_frames <= 0 or width <= 0 or height <= 0:
             raise RuntimeError(f"视频文件无效: frames={video_frames}, size={width}x{height}")
 
         # 预期输出帧数 = 音频时长 × fps（引擎按音频时长生成，不是按输入视频帧数）
         total_frames = video_frames  # 默认值
-        try:
-            probe = subprocess.run(
-                ["ffprobe", "-v", "quiet", "-show_entries", "format=duration",
-                 "-of", "default=noprint_wrappers=1:nokey=1", audio_path],
-                capture_output=True, text=True, timeout=10,
-            )
-            audio_duration = float(probe.stdout.strip())
-            if audio_duration > 0 and fps > 0:
-                total_frames = max(video_frames, int(audio_duration * fps))
-                logger.info(f"[Server] 音频时长={audio_duration:.1f}s, 预期输出帧数={total_frames} (视频帧数={video_frames})")
-        except Exception as _e:
-            logger.warning(f"[Server] 获取音频时长失败，使用视频帧数: {_e}")
+        audio_duration = _media_probe.probe(audio_path, video=False)["duration"]
+        if audio_duration > 0 and fps > 0:
+            total_frames = max(video_frames, int(audio_duration * fps))
+            logger.info(f"[Server] 音频时长={audio_duration:.1f}s, 预期输出帧数={total_frames} (视频帧数={video_frames})")
+        else:
+            logger.warning("[Server] 获取音频时长失败，使用视频帧数")
 
         _update_task(task_id, total_frames=total_frames,
                      message=f"视频信息: {width}x{height} {fps:.1f}fps 预计{total_frames}帧")
 
         work_id = str(uuid.uuid1())
+        with _tasks_lock:
+            _work_to_task[work_id] = task_id
+        if _progress_ring is not None:
+            _progress_ring.register(work_id)
         _update_task(task_id, _work_id=work_id)
 
         def _transcode_video_for_engine(src_video: str, out_video: str) -> None:
@@ -600,17 +891,49 @@ def _run_task(task_id, audio_path, video_path):
             except Exception:
                 return ""
 
-        # ── 推理执行（MAX_CONCURRENT=1，无需额外锁，semaphore 已保证串行） ──
-        logger.info(f"[Server] 开始推理: {task_id}")
-        _task_instance.task_dic[work_id] = ""
-        try:
-            _task_instance.work(audio_path, video_path, work_id, 0, 0, 0, 0)
-        except Exception as work_err:
-            logger.warning(f"[Server] 推理引擎 work() 抛异常: {work_err}")
-
-        # 读取引擎输出（即使没有异常也要检查 Status）
-        result_entry = _task_instance.task_dic.get(work_id, "")
-        err_msg = _engine_entry_message(result_entry)
+        # batch_size：该设备 + 分辨率档位的调优值（未校准时为 [digital] batch_size）
+        _dev_key, _bucket = device_key(device), resolution_bucket(width, height)
+        batch_size = _batch_tuner.choose(_dev_key, width, height) if AUTOTUNE_ENABLED else _batch_tuner.default
+        _apply_batch_size(batch_size)
+
+        # ── 推理执行（每个 worker 独占自己的引擎实例，无需额外锁） ──
+        _pre_ms = round((time.perf_counter() - _t_pre) * 1000, 1)
+        _update_task(task_id, _pre_engine_ms=_pre_ms, _batch_size=batch_size)
+        logger.info(f"[Server] 开始推理: {task_id} (batch_size={batch_size} {_bucket}, 引擎前开销 {_pre_ms}ms)")
+        # 预处理缓存会话：按视频内容 hash（统一存储文件名）查找/记录人脸检测结果
+        _pc_hash = os.path.splitext(os.path.basename(video_path))[0]
+        _t_engine = time.perf_counter()
+        # 分段增量渲染：有已缓存的段时只渲染变化的区间并拼接；否则完整渲染（段边界强制关键帧，完成后切段入缓存）
+        _seg_plan = _plan_segments(audio_path, video_path, video_frames, fps)
+        _seg_result, _seg_frames = (_render_segments(task_id, engine, _seg_plan, audio_path, video_path)
+                                    if _seg_plan else (None, 0))
+        result_entry = (None, 100, _seg_result, "segments") if _seg_result else ""
+        if _seg_plan and not _seg_result:
+            _write_keyframes(work_id, _seg_plan.keyframes)
+        while not _seg_result:
+            engine.task_dic[work_id] = ""
+            work_err = None
+            _pc_session = _preprocess_cache.begin_session(_pc_hash) if _preprocess_cache else None
+            try:
+                engine.work(audio_path, video_path, work_id, 0, 0, 0, 0)
+            except Exception as e:
+                work_err = e
+                logger.warning(f"[Server] 推理引擎 work() 抛异常: {e}")
+            finally:
+                if _pc_session:
+                    _preprocess_cache.end_session(_pc_hash, _pc_session)
+
+            # 读取引擎输出（即使没有异常也要检查 Status）
+            result_entry = engine.task_dic.get(work_id, "")
+            err_msg = _engine_entry_message(result_entry)
+
+            # 显存不足：该档位 batch_size 减半（记入调优结果）后重试，直到 1
+            _oom = is_oom(work_err) if work_err else (_engine_entry_is_error(result_entry) and is_oom(err_msg))
+            if not (_oom and AUTOTUNE_ENABLED and batch_size > 1):
+                break
+            batch_size = _batch_tuner.report_oom(_dev_key, _bucket, batch_size)
+            _apply_batch_size(batch_size)
+            _update_task(task_id, _batch_size=batch_size, message=f"显存不足，batch_size 降为 {batch_size} 重试...")
 
         # 仅在格式错误时兜底重试一次，避免无意义重跑
         if _engine_entry_is_error(result_entry) and ("format video error" in (err_msg or "").lower()):
@@ -620,14 +943,17 @@ def _run_task(task_id, audio_path, video_path):
                 _temp_dir = os.path.join(_BASE_DIR, _temp_dir)
             os.makedirs(_temp_dir, exist_ok=True)
             fallback_video = os.path.join(_temp_dir, f"{task_id}_fallback.mp4")
+            _janitor.track(fallback_video, "temp", 3600, owner=task_id)
             _transcode_video_for_engine(video_path, fallback_video)
-            _task_instance.task_dic[work_id] = ""
+            engine.task_dic[work_id] = ""
             try:
-                _task_instance.work(audio_path, fallback_video, work_id, 0, 0, 0, 0)
+                engine.work(audio_path, fallback_video, work_id, 0, 0, 0, 0)
             except Exception as retry_err:
                 raise RuntimeError(f"推理引擎错误(重试后仍失败): {retry_err}")
-            result_entry = _task_instance.task_dic.get(work_id, "")
-        logger.info(f"[Server] 推理完成: {task_id}")
+            result_entry = engine.task_dic.get(work_id, "")
+        _engine_seconds = time.perf_counter() - _t_engine
+        _metrics.observe_stage("engine_work", _engine_seconds)
+        logger.info(f"[Server] 推理完成: {task_id} ({_engine_seconds:.1f}s)")
 
         if isinstance(result_entry, (list, tuple)) and len(result_entry) > 2:
             raw_result = result_entry[2]
@@ -636,6 +962,7 @@ def _run_task(task_id, audio_path, video_path):
 
         task_output_dir = os.path.join(OUTPUT_DIR, task_id)
         os.makedirs(task_output_dir, exist_ok=True)
+        _janitor.track(task_output_dir, "output", FILE_TTL, owner=task_id)
 
         # 引擎返回的路径可能不含目录前缀，先尝试在 temp/result 下查找
         _base = os.path.dirname(os.path.abspath(__file__))
@@ -691,21 +1018,26 @@ def _run_task(task_id, audio_path, video_path):
         _update_task(task_id, status=TaskStatus.DONE, progress=100,
                      message="合成完成", result_path=result_path,
                      finished_at=time.time())
+        _metrics.tasks_finished.inc(status="done")
+        _rendered = _seg_frames if _seg_result else total_frames
+        _metrics.engine_frames.inc(_rendered)
+        if _engine_seconds > 0 and _rendered > 0:
+            _metrics.engine_fps.observe(_rendered / _engine_seconds)
         _push_progress(task_id)  # 推送 done 状态
-        _last_progress_push_time.pop(task_id, None)  # 清理节流记录
 
-        # ── 写缓存：复制结果到缓存目录，下次相同 audio+video 可直接返回 ──
+        # ── 写缓存：结果硬链接到缓存条目，下次相同 audio+video 可直接返回 ──
         with _tasks_lock:
             _ck = _tasks.get(task_id, {}).get("_cache_key", "")
         if _ck and result_path and os.path.exists(result_path):
             try:
-                _cache_dir = os.path.join(OUTPUT_DIR, f"cache_{_ck}")
-                os.makedirs(_cache_dir, exist_ok=True)
-                _cache_file = os.path.join(_cache_dir, f"cache_{_ck}.mp4")
-                shutil.copy2(result_path, _cache_file)
-                logger.info(f"[Server] 缓存写入: {_cache_file}")
+                _result_cache.put(_ck, result_path)
             except Exception as ce:
                 logger.warning(f"[Server] 缓存写入失败: {ce}")
+        if _seg_plan and not _seg_result and result_path and os.path.exists(result_path):
+            try:
+                _segment_cache.store_render(_seg_plan, result_path)
+            except Exception as se:
+                logger.warning(f"[Server] 分段缓存写入失败: {se}")
 
         # 清理进度文件和错误文件
         try:
@@ -716,7 +1048,13 @@ def _run_task(task_id, audio_path, video_path):
                 _base = os.path.dirname(os.path.abspath(__file__))
                 _temp = _cfg.get("temp", "temp_dir", fallback="./temp")
                 _temp = os.path.join(_base, _temp) if not os.path.isabs(_temp) else _temp
-                for _fn in [f".progress_{_wid}", f".error_{_wid}"]:
+                _sf = os.path.join(_temp, f".stages_{_wid}")
+                if os.path.exists(_sf):
+                    with open(_sf, "r") as f:
+                        _stages = json.load(f)
+                    if "write_video" in _stages:
+                        _metrics.observe_stage("write_video", float(_stages["write_video"]))
+                for _fn in [f".progress_{_wid}", f".error_{_wid}", f".stages_{_wid}", f".keyframes_{_wid}"]:
                     _fp = os.path.join(_temp, _fn)
                     if os.path.exists(_fp):
                         os.remove(_fp)
@@ -730,13 +1068,122 @@ def _run_task(task_id, audio_path, video_path):
         _update_task(task_id, status=TaskStatus.ERROR, progress=0,
                      message=f"合成失败: {e}", error=str(e),
                      finished_at=time.time())
+        _metrics.tasks_finished.inc(status="error")
         _push_progress(task_id)  # 推送 error 状态
-        _last_progress_push_time.pop(task_id, None)
     finally:
-        _semaphore.release()
+        _wid = ""
+        with _tasks_lock:
+            _wid = _tasks.get(task_id, {}).get("_work_id", "")
+            _work_to_task.pop(_wid, None)
+        if _wid and _progress_ring is not None:
+            _progress_ring.release(_wid)
         gc.collect()
 
 
+def _estimate_frames(audio_path, video_path) -> int:
+    """预估输出帧数（音频时长 × 视频 fps），用于调度器准入控制，失败返回 0"""
+    try:
+        vinfo = _media_probe.probe(video_path)
+        video_frames, fps = vinfo["frames"], vinfo["fps"]
+        audio_duration = _media_probe.probe(audio_path, video=False)["duration"]
+        return max(video_frames, int(audio_duration * fps)) if fps > 0 else video_frames
+    except Exception as e:
+        logger.warning(f"[Server] 预估帧数失败: {e}")
+        return 0
+
+
+def _enqueue_task(task_id, audio_path, video_path, client="", priority=PRIORITY_INTERACTIVE):
+    """把已登记到 _tasks 的任务交给调度器；准入失败时移除任务记录并抛 AdmissionError"""
+    if _scheduler is None:
+        raise RuntimeError("推理服务尚未初始化")
+    est_frames = _estimate_frames(audio_path, video_path)
+    for _p in (audio_path, video_path):
+        _janitor.touch(_p, FILE_TTL)  # 输入文件被复用：顺延到期时间
+    with _tasks_lock:
+        task_snapshot = dict(_tasks.get(task_id, {}))
+    _task_store.put(task_snapshot, audio_path=audio_path, video_path=video_path,
+                    client=client, priority=priority)
+    try:
+        pos = _scheduler.submit(task_id, audio_path, video_path, client=client,
+                                priority=priority, est_frames=est_frames)
+    except AdmissionError:
+        with _tasks_lock:
+            _tasks.pop(task_id, None)
+        _task_store.delete(task_id)
+        raise
+    _update_task(task_id, message=f"等待可用 GPU 槽位... (第{pos}位)")
+    return pos
+
+
+def _claim_cached_result(task_id: str, cache_file: str) -> Optional[str]:
+    """把结果缓存条目硬链接（跨文件系统时复制）到任务自己的输出目录，交给 janitor 按 FILE_TTL 管理
+
+    之后结果缓存淘汰该条目不会让本任务的下载 404；条目在查询后恰好被淘汰时返回 None，按未命中处理。
+    """
+    task_output_dir = os.path.join(OUTPUT_DIR, task_id)
+    dest = os.path.join(task_output_dir, os.path.basename(cache_file))
+    tmp = f"{dest}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        os.makedirs(task_output_dir, exist_ok=True)
+        link_or_copy(os.path.realpath(cache_file), tmp)
+        os.replace(tmp, dest)
+    except OSError as e:
+        logger.warning(f"[ResultCache] 缓存条目已不可用，按未命中处理: {cache_file} ({e})")
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return None
+    _janitor.track(task_output_dir, "output", FILE_TTL, owner=task_id)
+    return dest
+
+
+def _dispatch_job(job, worker):
+    """调度器回调：在 worker 线程中执行任务"""
+    _run_task(job.task_id, *job.args, engine=worker.engine, device=worker.device)
+
+
+def _create_engine(device: str):
+    """为调度器 worker 创建绑定到指定 GPU 的推理引擎实例
+
+    引擎的推理子进程在创建时继承 CUDA_VISIBLE_DEVICES，因此创建期间临时设置该变量。
+    """
+    with _engine_env_lock:
+        _old = os.environ.get("CUDA_VISIBLE_DEVICES")
+        os.environ["CUDA_VISIBLE_DEVICES"] = device
+        try:
+            return service.trans_dh_service.TransDhTask()
+        finally:
+            if _old is None:
+                os.environ.pop("CUDA_VISIBLE_DEVICES", None)
+            else:
+                os.environ["CUDA_VISIBLE_DEVICES"] = _old
+
+
+def _parse_priority(value) -> str:
+    value = (value or "").strip()
+    return value if value in PRIORITIES else PRIORITY_INTERACTIVE
+
+
+def _from_gateway() -> bool:
+    """请求是否由本机网关（gateway.py）转发"""
+    return request.headers.get("X-HeyGem-Gateway") == "1" and request.remote_addr in ("127.0.0.1", "::1")
+
+
+def _client_id(license_key: str = "") -> str:
+    """调度器的客户端标识（轮转公平 / 准入按客户端计数）：优先卡密，其次客户端 IP
+
+    经网关转发时 remote_addr 都是 127.0.0.1，取网关追加在 X-Forwarded-For 末尾的真实地址。
+    """
+    if license_key:
+        return license_key
+    if _from_gateway():
+        forwarded = request.headers.get("X-Forwarded-For", "").split(",")[-1].strip()
+        if forwarded:
+            return forwarded
+    return request.remote_addr or ""
+
+
 # ============================================================
 #  Flask 路由
 # ============================================================
@@ -760,19 +1207,17 @@ def check_files():
 
     files = data.get("files", [])
     result = {}
-    for item in files:
-        h = item.get("hash", "").strip()
-        ext = item.get("ext", "").strip()
-        if h:
-            exists = _file_exists(h, ext)
-            if exists:
-                # 刷新 mtime 避免被清理
-                p = _store_path(h, ext)
-                try:
-                    os.utime(p, None)
-                except Exception:
-                    pass
-            result[h] = exists
+    with _metrics.span("check_files"):
+        for item in files:
+            h = item.get("hash", "").strip()
+            ext = item.get("ext", "").strip()
+            if h:
+                exists = _file_exists(h, ext)
+                if exists:
+                    # 顺延到期时间避免被清理
+                    _janitor.track(_store_path(h, ext), "store", FILE_TTL)
+                result[h] = exists
+                _metrics.file_checks.inc(result="hit" if exists else "miss")
     return jsonify({"code": 0, "data": result})
 
 
@@ -803,12 +1248,13 @@ def upload_single_file():
 
     dest = _store_path(file_hash, ext)
 
-    # 如果已存在，跳过写入，只刷新 mtime
+    # 如果已存在，跳过写入，只顺延到期时间
     if os.path.exists(dest) and os.path.getsize(dest) > 0:
-        os.utime(dest, None)
         logger.info(f"[Upload] 文件已存在，跳过: {file_hash}{ext}")
     else:
-        uploaded.save(dest)
+        with _metrics.span("upload"):
+            uploaded.save(dest)
+        _metrics.upload_bytes.inc(os.path.getsize(dest), kind="file")
         # 校验 hash
         actual_hash = _md5_of_file(dest)
         if actual_hash != file_hash:
@@ -820,6 +1266,7 @@ def upload_single_file():
             dest = real_dest
             file_hash = actual_hash
         logger.info(f"[Upload] 文件保存: {file_hash}{ext} ({os.path.getsize(dest)} bytes)")
+    _janitor.track(dest, "store", FILE_TTL)
 
     return jsonify({
         "code": 0,
@@ -827,6 +1274,105 @@ def upload_single_file():
     })
 
 
+@app.route("/api/heygem/upload/create", methods=["POST"])
+@auth_required
+def chunked_upload_create():
+    """
+    创建（或恢复）分片上传会话
+
+    请求体 JSON:
+      {"hash": "md5hex", "ext": ".mp4", "size": 123456, "chunk_size": 8388608}
+
+    返回:
+      文件已存在: {"code": 0, "data": {"exists": true, "hash": "...", "server_path": "..."}}
+      否则:       {"code": 0, "data": {"exists": false, "upload_id": "...", "chunk_size": ..., "next_index": ...}}
+    """
+    try:
+        data = request.get_json(force=True)
+    except Exception:
+        return jsonify({"code": 400, "msg": "请求体必须是合法的JSON"}), 400
+
+    file_hash = str(data.get("hash", "")).strip()
+    ext = str(data.get("ext", "")).strip() or ".bin"
+    try:
+        size = int(data.get("size", 0))
+        chunk_size = int(data.get("chunk_size", 0))
+    except (TypeError, ValueError):
+        return jsonify({"code": 400, "msg": "size / chunk_size 必须是整数"}), 400
+
+    if file_hash and _file_exists(file_hash, ext):
+        p = _store_path(file_hash, ext)
+        _janitor.track(p, "store", FILE_TTL)
+        return jsonify({"code": 0, "data": {"exists": True, "hash": file_hash,
+                                            "server_path": os.path.realpath(p)}})
+    try:
+        sess = _chunk_uploads.create(file_hash, ext, size, chunk_size)
+    except UploadError as e:
+        return jsonify({"code": e.code, "msg": str(e)}), e.code
+    _janitor.track(sess.part_path, "upload_part", FILE_TTL)
+    _janitor.track(sess.meta_path, "upload_part", FILE_TTL)
+    info = sess.info()
+    info["exists"] = False
+    return jsonify({"code": 0, "data": info})
+
+
+@app.route("/api/heygem/upload/chunk", methods=["PUT", "POST"])
+@auth_required
+def chunked_upload_put():
+    """
+    上传一个分片（请求体为分片原始字节）
+
+    GET 参数: upload_id, index
+    已收到的分片直接返回 skipped=true；乱序分片返回 409，客户端应先查 status 再续传。
+    """
+    upload_id = request.args.get("upload_id", "").strip()
+    try:
+        index = int(request.args.get("index", "-1"))
+    except ValueError:
+        return jsonify({"code": 400, "msg": "index 必须是整数"}), 400
+    try:
+        with _metrics.span("upload"):
+            chunk = request.get_data(cache=False)
+            info = _chunk_uploads.put_chunk(upload_id, index, chunk)
+    except UploadError as e:
+        return jsonify({"code": e.code, "msg": str(e)}), e.code
+    if not info.get("skipped"):
+        _metrics.upload_bytes.inc(len(chunk), kind="chunk")
+    return jsonify({"code": 0, "data": info})
+
+
+@app.route("/api/heygem/upload/status", methods=["GET"])
+@auth_required
+def chunked_upload_status():
+    """查询分片上传会话进度（断线重连后据 next_index 续传）"""
+    upload_id = request.args.get("upload_id", "").strip()
+    sess = _chunk_uploads.get(upload_id)
+    if sess is None:
+        return jsonify({"code": 404, "msg": f"上传会话不存在: {upload_id}"}), 404
+    return jsonify({"code": 0, "data": sess.info()})
+
+
+@app.route("/api/heygem/upload/commit", methods=["POST"])
+@auth_required
+def chunked_upload_commit():
+    """
+    完成分片上传：MD5 由上传过程中的增量 hash 状态直接得出，文件移入统一存储
+
+    请求体 JSON: {"upload_id": "..."}
+    返回: {"code": 0, "data": {"hash": "...", "server_path": "...", "size": ...}}
+    """
+    try:
+        data = request.get_json(force=True)
+    except Exception:
+        return jsonify({"code": 400, "msg": "请求体必须是合法的JSON"}), 400
+    try:
+        result = _chunk_uploads.commit(str(data.get("upload_id", "")).strip(), _store_path)
+    except UploadError as e:
+        return jsonify({"code": e.code, "msg": str(e)}), e.code
+    _janitor.track(_store_path(result["hash"], os.path.splitext(result["server_path"])[1]), "store", FILE_TTL)
+    return jsonify({"code": 0, "data": result})
+
+
 @app.route("/api/heygem/submit", methods=["POST"])
 @auth_required
 def submit_task():
@@ -838,7 +1384,8 @@ def submit_task():
         "audio_hash": "md5hex",
         "audio_ext": ".wav",
         "video_hash": "md5hex",
-        "video_ext": ".mp4"
+        "video_ext": ".mp4",
+        "priority": "interactive" | "batch"   (可选，默认 interactive)
       }
 
     返回:
@@ -855,6 +1402,7 @@ def submit_task():
     video_ext = data.get("video_ext", ".mp4").strip()
     license_key = data.get("license_key", "").strip()  # 客户端卡密，用于 WS 进度推送
     sender_fd = int(data.get("sender_fd", 0))           # WS fd（从 Dsp.php 转发时携带）
+    priority = _parse_priority(data.get("priority", ""))
 
     if not audio_hash or not video_hash:
         return jsonify({"code": 400, "msg": "audio_hash 和 video_hash 不能为空"}), 400
@@ -867,17 +1415,14 @@ def submit_task():
     if not video_path:
         return jsonify({"code": 404, "msg": f"视频文件不存在: {video_hash}{video_ext}，请先上传"}), 404
 
-    # ── 缓存命中：相同 audio+video 组合已合成过且结果文件仍在，直接返回 ──
+    # ── 缓存命中：相同 audio+video 组合已合成过且结果文件仍在，直接返回（结果链接进任务输出目录，之后缓存淘汰不影响下载） ──
     cache_key = hashlib.md5(f"{audio_hash}_{video_hash}".encode()).hexdigest()[:16]
-    cache_result_dir = os.path.join(OUTPUT_DIR, f"cache_{cache_key}")
-    cache_result_file = os.path.join(cache_result_dir, f"cache_{cache_key}.mp4")
-    if os.path.exists(cache_result_file) and os.path.getsize(cache_result_file) > 0:
-        # 刷新 mtime 避免被清理
-        try:
-            os.utime(cache_result_file, None)
-            os.utime(cache_result_dir, None)
-        except Exception:
-            pass
+    with _metrics.span("cache_lookup"):
+        cache_result_file = _result_cache.lookup(cache_key)
+        if cache_result_file:
+            cache_result_file = _claim_cached_result(cache_key, cache_result_file)
+    _metrics.cache_lookups.inc(result="hit" if cache_result_file else "miss")
+    if cache_result_file:
         # 创建一个已完成的任务记录
         task_id = cache_key
         task_info = _new_task(task_id, f"{audio_hash}{audio_ext}", f"{video_hash}{video_ext}")
@@ -885,12 +1430,13 @@ def submit_task():
             "status": TaskStatus.DONE,
             "progress": 100,
             "message": "合成完成（缓存命中）",
-            "result_path": os.path.realpath(cache_result_file),
+            "result_path": cache_result_file,
             "finished_at": time.time(),
             "started_at": time.time(),
         })
         with _tasks_lock:
             _tasks[task_id] = task_info
+        _task_store.put(task_info)
         logger.info(f"[Server] 缓存命中: cache_key={cache_key}, audio={audio_hash}, video={video_hash}")
         return jsonify({
             "code": 0,
@@ -906,7 +1452,12 @@ def submit_task():
     with _tasks_lock:
         _tasks[task_id] = task_info
 
-    _executor.submit(_run_task, task_id, audio_path, video_path)
+    try:
+        _enqueue_task(task_id, audio_path, video_path,
+                      client=_client_id(license_key), priority=priority)
+    except AdmissionError as e:
+        logger.warning(f"[Server] 拒绝任务(排队已满): {e}")
+        return jsonify({"code": 429, "msg": f"服务器繁忙，请稍后再试: {e}"}), 429
 
     # 通知 WS 服务器有活跃任务（gpu_power_manager 据此延长空闲计时，防止误关机）
     if _ws_client:
@@ -939,21 +1490,31 @@ def upload_and_submit():
     task_id = str(uuid.uuid4()).replace("-", "")[:16]
     task_dir = os.path.join(UPLOAD_DIR, task_id)
     os.makedirs(task_dir, exist_ok=True)
+    _janitor.track(task_dir, "upload", FILE_TTL, owner=task_id)
 
     audio_ext = os.path.splitext(audio_file.filename or "audio.wav")[1] or ".wav"
     video_ext = os.path.splitext(video_file.filename or "video.mp4")[1] or ".mp4"
     audio_path = os.path.join(task_dir, f"audio{audio_ext}")
     video_path = os.path.join(task_dir, f"video{video_ext}")
 
-    audio_file.save(audio_path)
-    video_file.save(video_path)
+    with _metrics.span("upload"):
+        audio_file.save(audio_path)
+        video_file.save(video_path)
+    _metrics.upload_bytes.inc(os.path.getsize(audio_path) + os.path.getsize(video_path), kind="legacy")
     logger.info(f"[Server] 上传完成: task={task_id}, audio={os.path.getsize(audio_path)}B, video={os.path.getsize(video_path)}B")
 
     task_info = _new_task(task_id, audio_file.filename, video_file.filename)
     with _tasks_lock:
         _tasks[task_id] = task_info
 
-    _executor.submit(_run_task, task_id, audio_path, video_path)
+    try:
+        _enqueue_task(task_id, audio_path, video_path,
+                      client=_client_id(request.form.get("license_key", "").strip()),
+                      priority=_parse_priority(request.form.get("priority", "")))
+    except AdmissionError as e:
+        logger.warning(f"[Server] 拒绝任务(排队已满): {e}")
+        shutil.rmtree(task_dir, ignore_errors=True)
+        return jsonify({"code": 429, "msg": f"服务器繁忙，请稍后再试: {e}"}), 429
 
     return jsonify({
         "code": 0,
@@ -976,12 +1537,11 @@ def _build_progress_data(task_id: str) -> dict:
 
     queue_pos = 0
     if task["status"] == TaskStatus.QUEUED:
-        with _tasks_lock:
-            for t in _tasks.values():
-                if t["status"] == TaskStatus.QUEUED:
-                    queue_pos += 1
-                if t["task_id"] == task_id:
-                    break
+        # 调度器中的任务用精确位置（含优先级 / 轮转公平）；调度器里没有时（重启后回放等）按存储估算
+        if _scheduler is not None:
+            queue_pos = _scheduler.position(task_id)
+        if not queue_pos:
+            queue_pos = _task_store.queue_position(task_id)
 
     # ── 跨进程进度同步：从子进程写的进度文件读取真实帧数 ──
     progress = task["progress"]
@@ -990,11 +1550,13 @@ def _build_progress_data(task_id: str) -> dict:
     status = task["status"]
     total_frames = task["total_frames"]
 
-    if status in (TaskStatus.PROCESSING, TaskStatus.QUEUED) and progress < 95:
+    # 编辑任务的进度由 ffmpeg -progress 直接上报，不做帧数估算
+    if status in (TaskStatus.PROCESSING, TaskStatus.QUEUED) and progress < 95 and not task.get("_kind"):
         work_id = task.get("_work_id", "")
         _real_frame = 0
         _sub_error = ""
-        if work_id:
+        if work_id and _progress_ring is None:
+            # 共享内存不可用时回退：读取子进程写的进度/错误文件
             _base = os.path.dirname(os.path.abspath(__file__))
             _temp = _cfg.get("temp", "temp_dir", fallback="./temp")
             _temp = os.path.join(_base, _temp) if not os.path.isabs(_temp) else _temp
@@ -1028,6 +1590,8 @@ def _build_progress_data(task_id: str) -> dict:
             progress = pct
             status = TaskStatus.SYNTHESIZING
             message = f"合成中 {_real_frame}/{total_frames} 帧 ({pct}%)"
+            if _real_frame != task["current_frame"]:
+                _update_task(task_id, current_frame=_real_frame, progress=pct)
         elif total_frames > 0 and task.get("started_at", 0) > 0:
             elapsed = time.time() - task["started_at"]
             est_frame = max(0, int((elapsed - 10) * 1.0))
@@ -1052,7 +1616,7 @@ def _build_progress_data(task_id: str) -> dict:
                 progress = pct
                 message = f"排队等待中... (第{queue_pos}位)"
 
-    return {
+    data = {
         "task_id": task["task_id"],
         "status": status,
         "progress": progress,
@@ -1066,6 +1630,9 @@ def _build_progress_data(task_id: str) -> dict:
         "finished_at": task["finished_at"],
         "error": task["error"],
     }
+    if task.get("_kind") == "edit":
+        data["result_hash"] = task.get("_result_hash", "")
+    return data
 
 
 @app.route("/api/heygem/progress", methods=["GET"])
@@ -1104,6 +1671,7 @@ if _FLASK_SOCK_OK and sock is not None:
 
         logger.info(f"[WS-Direct] 客户端已连接进度推送: task={task_id}")
         last_sent = None
+        version = _progress_bus.version(task_id)
         try:
             while True:
                 data = _build_progress_data(task_id)
@@ -1121,13 +1689,32 @@ if _FLASK_SOCK_OK and sock is not None:
                 if is_terminal:
                     break
 
-                time.sleep(1)
+                # 等进度总线通知变化；超时后也重建一次（排队/预处理阶段的进度按时间估算）
+                version = _progress_bus.wait(task_id, version, timeout=5)
         except Exception as e:
             logger.info(f"[WS-Direct] 连接断开: task={task_id} ({e})")
 
     logger.info("[Server] WebSocket 进度推送已启用: /ws/progress/<task_id>")
 
 
+def _send_result(path: str, download_name: str, etag: str = ""):
+    """发送结果视频（Range / ETag = 内容 MD5，见 range_file.py）；
+    生产模式网关（gateway.py）转发的请求只回传路径与 ETag，由网关进程直接发送文件"""
+    with _metrics.span("download"):
+        etag = etag or content_etag(path)
+        if _from_gateway():
+            response = app.response_class(b"", mimetype="video/mp4")
+            response.headers["X-HeyGem-File"] = quote(os.path.abspath(path))
+            response.headers["X-HeyGem-Filename"] = quote(download_name)
+            response.headers["X-HeyGem-ETag"] = etag
+            _metrics.download_bytes.inc(os.path.getsize(path))
+            return response
+        response = send_range_file(path, mimetype="video/mp4", download_name=download_name, etag=etag)
+    if response.status_code in (200, 206):
+        _metrics.download_bytes.inc(int(response.headers.get("Content-Length", 0)))
+    return response
+
+
 @app.route("/api/heygem/download", methods=["GET"])
 @auth_required
 def download_result():
@@ -1149,8 +1736,7 @@ def download_result():
     if not result_path or not os.path.exists(result_path):
         return jsonify({"code": 404, "msg": "结果文件不存在"}), 404
 
-    return send_file(result_path, mimetype="video/mp4", as_attachment=False,
-                     download_name=f"{task_id}.mp4")
+    return _send_result(result_path, f"{task_id}.mp4")
 
 
 @app.route("/api/heygem/queue", methods=["GET"])
@@ -1168,16 +1754,27 @@ def queue_status():
                 "created_at": t["created_at"],
             })
     info["tasks"] = task_list
+    info["stages"] = _metrics.stages.summary()
     return jsonify({"code": 0, "data": info})
 
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Prometheus 指标（文本格式）"""
+    return Response(_metrics.render(), mimetype=METRICS_CONTENT_TYPE)
+
+
 @app.route("/api/heygem/health", methods=["GET"])
 def health_check():
     """健康检查"""
     return jsonify({
         "code": 0,
         "msg": "ok",
-        "initialized": _task_instance is not None,
+        "initialized": _lifecycle.ready,
+        "engine": _lifecycle.status(),
+        "media_probe": _media_probe.stats(),
+        "batch_tuning": _batch_tuner.table(),
+        "ws_client": _ws_client.stats() if _ws_client else None,
         "queue": _get_queue_info(),
     })
 
@@ -1217,70 +1814,43 @@ def upload_asset():
     # 先保存到临时文件，计算 hash 做去重
     tmp_id = str(uuid.uuid4()).replace("-", "")[:12]
     tmp_path = os.path.join(STORE_DIR, f"_tmp_{tmp_id}{ext}")
+    _janitor.track(tmp_path, "store_tmp", 3600)
     uploaded.save(tmp_path)
 
     file_hash = _md5_of_file(tmp_path)
     file_size = os.path.getsize(tmp_path)
-    now = time.time()
 
     # DB 去重：同一 license + type + hash + ext 若未过期，直接复用
-    with _db_lock:
-        conn = _get_db()
-        existed = conn.execute(
-            "SELECT id, name, file_size, file_hash, file_ext FROM assets "
-            "WHERE license_key=? AND asset_type=? AND file_hash=? AND file_ext=? AND expires_at>? "
-            "ORDER BY created_at DESC LIMIT 1",
-            (license_key, asset_type, file_hash, ext, now),
-        ).fetchone()
-
-        if existed:
-            conn.close()
-            try:
-                if os.path.exists(tmp_path):
-                    os.remove(tmp_path)
-            except Exception:
-                pass
+    existed = _assets.find(license_key, asset_type, file_hash, ext)
+    if existed:
+        try:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        except Exception:
+            pass
 
-            # 刷新 store 文件 mtime，避免被清理
-            store_dest = _store_path(file_hash, ext)
-            if os.path.exists(store_dest):
-                try:
-                    os.utime(store_dest, None)
-                except Exception:
-                    pass
-
-            logger.info(f"[Asset] 去重命中: id={existed['id']} type={asset_type} key={license_key} hash={file_hash}")
-            return jsonify({
-                "code": 0,
-                "data": {
-                    "id": existed["id"],
-                    "name": name or existed["name"],
-                    "asset_type": asset_type,
-                    "file_hash": existed["file_hash"],
-                    "file_ext": existed["file_ext"],
-                    "file_size": existed["file_size"],
-                }
-            })
+        # 顺延 store 文件到期时间，避免被清理
+        store_dest = _store_path(file_hash, ext)
+        if os.path.exists(store_dest):
+            _janitor.track(store_dest, "store", FILE_TTL)
 
-        # 文件落盘到统一存储：用 hash 命名，避免重复
-        dest_path = _store_path(file_hash, ext)
-        if not os.path.exists(dest_path) or os.path.getsize(dest_path) == 0:
-            shutil.move(tmp_path, dest_path)
-        else:
-            try:
-                os.remove(tmp_path)
-            except Exception:
-                pass
+        logger.info(f"[Asset] 去重命中: id={existed['id']} type={asset_type} key={license_key} hash={file_hash}")
+        return jsonify({
+            "code": 0,
+            "data": {
+                "id": existed["id"],
+                "name": name or existed["name"],
+                "asset_type": asset_type,
+                "file_hash": existed["file_hash"],
+                "file_ext": existed["file_ext"],
+                "file_size": existed["file_size"],
+            }
+        })
 
-        # 写入 DB
-        conn.execute(
-            "INSERT INTO assets (license_key, asset_type, name, file_hash, file_ext, file_path, file_size, created_at, expires_at) "
-            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            (license_key, asset_type, name, file_hash, ext, dest_path, file_size, now, now + ASSET_TTL)
-        )
-        conn.commit()
-        asset_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
-        conn.close()
+    # 文件落盘到统一存储（hash 命名，已有同内容文件则丢弃临时文件）并登记资产、增加引用计数
+    asset_id, dest_path = _assets.add(license_key, asset_type, name, file_hash, ext, file_size,
+                                      ASSET_TTL, source_path=tmp_path)
+    _janitor.track(dest_path, "store", FILE_TTL)
 
     logger.info(f"[Asset] 上传: id={asset_id} type={asset_type} name={name} key={license_key} hash={file_hash} size={file_size}")
 
@@ -1304,6 +1874,10 @@ def list_assets():
     查询资产列表
 
     GET /api/asset/list?license_key=xxx&asset_type=voice
+    GET /api/asset/list?license_key=xxx&asset_type=voice&page=1&page_size=50
+
+    不带 page / page_size 时 data 为完整列表（旧客户端）；
+    带分页参数时 data 为 {"items": [...], "total": N, "page": p, "page_size": n}
     """
     license_key = request.args.get("license_key", "").strip()
     asset_type = request.args.get("asset_type", "").strip()
@@ -1311,23 +1885,19 @@ def list_assets():
     if not license_key:
         return jsonify({"code": 400, "msg": "缺少 license_key"}), 400
 
-    now = time.time()
-    with _db_lock:
-        conn = _get_db()
-        if asset_type:
-            rows = conn.execute(
-                "SELECT id, asset_type, name, file_hash, file_ext, file_size, created_at, expires_at "
-                "FROM assets WHERE license_key=? AND asset_type=? AND expires_at>? ORDER BY created_at DESC",
-                (license_key, asset_type, now)
-            ).fetchall()
-        else:
-            rows = conn.execute(
-                "SELECT id, asset_type, name, file_hash, file_ext, file_size, created_at, expires_at "
-                "FROM assets WHERE license_key=? AND expires_at>? ORDER BY created_at DESC",
-                (license_key, now)
-            ).fetchall()
-        conn.close()
+    paged = "page" in request.args or "page_size" in request.args
+    try:
+        page = max(1, int(request.args.get("page", 1)))
+        page_size = min(200, max(1, int(request.args.get("page_size", 50))))
+    except ValueError:
+        return jsonify({"code": 400, "msg": "page / page_size 必须为整数"}), 400
+
+    if paged:
+        rows, total = _assets.list(license_key, asset_type, limit=page_size, offset=(page - 1) * page_size)
+    else:
+        rows, total = _assets.list(license_key, asset_type)
 
+    now = time.time()
     items = []
     for r in rows:
         items.append({
@@ -1341,6 +1911,8 @@ def list_assets():
             "days_left": max(0, int((r["expires_at"] - now) / 86400)),
         })
 
+    if paged:
+        return jsonify({"code": 0, "data": {"items": items, "total": total, "page": page, "page_size": page_size}})
     return jsonify({"code": 0, "data": items})
 
 
@@ -1359,22 +1931,8 @@ def delete_asset():
     if not asset_id or not license_key:
         return jsonify({"code": 400, "msg": "缺少 id 或 license_key"}), 400
 
-    with _db_lock:
-        conn = _get_db()
-        row = conn.execute(
-            "SELECT file_path FROM assets WHERE id=? AND license_key=?",
-            (asset_id, license_key)
-        ).fetchone()
-        if row:
-            # 删除文件
-            try:
-                if os.path.exists(row["file_path"]):
-                    os.remove(row["file_path"])
-            except Exception:
-                pass
-            conn.execute("DELETE FROM assets WHERE id=? AND license_key=?", (asset_id, license_key))
-            conn.commit()
-        conn.close()
+    # 只删除记录、减少引用计数：同内容文件可能还被其它资产引用，无引用后由清理线程回收
+    _assets.remove(asset_id, license_key)
 
     return jsonify({"code": 0, "msg": "已删除"})
 
@@ -1411,26 +1969,11 @@ def _handle_ws_task(task_msg: dict):
             if not asset_id or not license_key:
                 raise ValueError("缺少 id 或 license_key")
 
-            with _db_lock:
-                conn = _get_db()
-                row = conn.execute(
-                    "SELECT file_path FROM assets WHERE id=? AND license_key=?",
-                    (asset_id, license_key)
-                ).fetchone()
-                if row:
-                    # 删除文件
-                    try:
-                        if os.path.exists(row["file_path"]):
-                            os.remove(row["file_path"])
-                            logger.info(f"[WS Task] 删除文件: {row['file_path']}")
-                    except Exception as e:
-                        logger.warning(f"[WS Task] 删除文件失败: {e}")
-                    conn.execute("DELETE FROM assets WHERE id=? AND license_key=?", (asset_id, license_key))
-                    conn.commit()
-                    logger.info(f"[WS Task] 删除资产成功: id={asset_id}")
-                else:
-                    logger.warning(f"[WS Task] 资产不存在: id={asset_id}")
-                conn.close()
+            # 文件由清理线程在无引用后回收
+            if _assets.remove(asset_id, license_key):
+                logger.info(f"[WS Task] 删除资产成功: id={asset_id}")
+            else:
+                logger.warning(f"[WS Task] 资产不存在: id={asset_id}")
 
             # 发送成功结果
             if _ws_client:
@@ -1463,33 +2006,10 @@ def _handle_ws_task(task_msg: dict):
             file_ext = os.path.splitext(original_filename)[1] or os.path.splitext(file_path)[1]
             file_size = os.path.getsize(file_path)
 
-            # 保存到统一存储
-            asset_file_path = _store_path(file_hash, file_ext)
-            if not os.path.exists(asset_file_path) or os.path.getsize(asset_file_path) == 0:
-                shutil.copy2(file_path, asset_file_path)
-
-            # 保存到数据库
-            now = time.time()
-            expires_at = now + ASSET_TTL
-
-            with _db_lock:
-                conn = _get_db()
-                conn.execute(
-                    """INSERT INTO assets (license_key, asset_type, name, file_hash, file_ext,
-                       file_path, file_size, created_at, expires_at)
-                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                    (license_key, asset_type, name, file_hash, file_ext,
-                     asset_file_path, file_size, now, expires_at)
-                )
-                asset_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
-                conn.commit()
-                conn.close()
-
-            # 删除临时文件
-            try:
-                os.remove(file_path)
-            except Exception:
-                pass
+            # 移动到统一存储（已有同内容文件则删除临时文件）并写入数据库、增加引用计数
+            asset_id, asset_file_path = _assets.add(license_key, asset_type, name, file_hash, file_ext,
+                                                    file_size, ASSET_TTL, source_path=file_path)
+            _janitor.track(asset_file_path, "store", FILE_TTL)
 
             logger.info(f"[WS Task] 上传资产成功: id={asset_id} name={name}")
 
@@ -1527,30 +2047,31 @@ def _handle_ws_task(task_msg: dict):
             cache_key = hashlib.md5(f"{audio_hash}_{video_hash}".encode()).hexdigest()[:16]
 
             # 缓存命中检查
-            cache_result_dir = os.path.join(OUTPUT_DIR, f"cache_{cache_key}")
-            cache_result_file = os.path.join(cache_result_dir, f"cache_{cache_key}.mp4")
-            if os.path.exists(cache_result_file) and os.path.getsize(cache_result_file) > 0:
-                try:
-                    os.utime(cache_result_file, None)
-                except Exception:
-                    pass
+            with _metrics.span("cache_lookup"):
+                cache_result_file = _result_cache.lookup(cache_key)
+                if cache_result_file:
+                    cache_result_file = _claim_cached_result(cache_key, cache_result_file)
+            _metrics.cache_lookups.inc(result="hit" if cache_result_file else "miss")
+            if cache_result_file:
                 task_id = cache_key
                 task_info = _new_task(task_id, f"{audio_hash}{audio_ext}", f"{video_hash}{video_ext}")
                 task_info.update({
                     "status": TaskStatus.DONE, "progress": 100,
                     "message": "合成完成（缓存命中）",
-                    "result_path": os.path.realpath(cache_result_file),
+                    "result_path": cache_result_file,
                     "finished_at": time.time(), "started_at": time.time(),
                 })
                 with _tasks_lock:
                     _tasks[task_id] = task_info
+                _task_store.put(task_info)
                 logger.info(f"[WS Task] 缓存命中: cache_key={cache_key}")
             else:
                 task_info = _new_task(task_id, f"{audio_hash}{audio_ext}", f"{video_hash}{video_ext}")
                 task_info["_cache_key"] = cache_key
                 with _tasks_lock:
                     _tasks[task_id] = task_info
-                _executor.submit(_run_task, task_id, audio_path, video_path)
+                _enqueue_task(task_id, audio_path, video_path, client=key,
+                              priority=_parse_priority(payload.get("priority", "")))
                 logger.info(f"[WS Task] 合成任务已提交: task={task_id} audio={audio_hash} video={video_hash}")
 
             if _ws_client:
@@ -1592,297 +2113,197 @@ def _handle_ws_task(task_msg: dict):
 #  视频编辑 API（字幕 / 画中画 / BGM）
 # ============================================================
 
+def _path_within(path: str, *roots: str) -> bool:
+    """path（解析符号链接后）是否位于 roots 之一的目录内"""
+    real = os.path.realpath(path)
+    for root in roots:
+        root = os.path.realpath(root)
+        try:
+            if real != root and os.path.commonpath([real, root]) == root:
+                return True
+        except ValueError:  # Windows 不同盘符
+            pass
+    return False
+
+
+def _edit_input_path(op: dict, work_dir: str, field: str, default_ext: str) -> str:
+    """解析操作引用的素材：op["file"] 为上传字段名，或 op["hash"] + op["ext"] 引用文件池
+
+    结果必须位于 work_dir 或 STORE_DIR 内（hash / ext 中的 ../ 等不能指向其它文件）。
+    """
+    if op.get("file"):
+        uploaded = request.files.get(op["file"])
+        if not uploaded:
+            raise ValueError(f"缺少上传文件: {op['file']}")
+        ext = os.path.splitext(os.path.basename(uploaded.filename or ""))[1] or default_ext
+        path = os.path.join(work_dir, f"{field}_{uuid.uuid4().hex[:8]}{ext}")
+        if not _path_within(path, work_dir):
+            raise ValueError(f"上传文件名无效: {op['file']}")
+        uploaded.save(path)
+        return path
+    if op.get("hash"):
+        path = _resolve_file(str(op["hash"]), str(op.get("ext", default_ext)))
+        if not path or not _path_within(path, STORE_DIR):
+            raise ValueError(f"文件不存在，请先上传: {op['hash']}")
+        return path
+    raise ValueError(f"{op.get('type')} 缺少 file 或 hash")
+
+
+def _legacy_edit_ops(edit_type: str) -> list:
+    """旧版 edit_type 表单字段转换为操作列表（multi 仍按 字幕 → 画中画 → BGM 的顺序）"""
+    form = request.form
+    try:
+        style = json.loads(form.get("subtitle_style", "{}").strip() or "{}")
+    except Exception:
+        style = {}
+    subtitle = {"type": "subtitle", "text": form.get("subtitle_text", ""),
+                "title_text": form.get("title_text", ""), "style": style}
+    pip = {"type": "overlay", "position": form.get("pip_position", "bottom-right").strip(),
+           "scale": form.get("pip_scale", "0.3")}
+    if request.files.get("pip_video"):
+        pip["file"] = "pip_video"
+    elif _resolve_file(form.get("pip_video_hash", "").strip(), form.get("pip_video_ext", ".mp4").strip()):
+        pip.update(hash=form.get("pip_video_hash").strip(), ext=form.get("pip_video_ext", ".mp4").strip())
+    bgm = {"type": "bgm", "volume": form.get("bgm_volume", "0.15")}
+    if request.files.get("bgm_audio"):
+        bgm["file"] = "bgm_audio"
+
+    ops = {"subtitle": [subtitle], "pip": [pip], "bgm": [bgm], "multi": [subtitle, pip, bgm]}.get(edit_type)
+    if ops is None:
+        raise ValueError(f"不支持的 edit_type: {edit_type}")
+    # 旧接口缺少素材时原样输出，不报错
+    return [op for op in ops if op["type"] == "subtitle" or op.get("file") or op.get("hash")]
+
+
+def _run_edit_job(task_id, video_path, ops, output_path, work_dir):
+    """编辑任务（EditQueue worker 线程）：单次编码执行全部操作，结果存入统一存储"""
+    _update_task(task_id, status=TaskStatus.ENCODING, progress=5, message="编辑中...", started_at=time.time())
+    _push_progress(task_id)
+
+    def _on_progress(pct):
+        progress = min(95, 5 + int(pct * 90))
+        _update_task(task_id, progress=progress, message=f"编辑中 {progress}%")
+        _push_progress(task_id)
+
+    try:
+        if ops:
+            run_edit(video_path, ops, output_path, work_dir, on_progress=_on_progress)
+        else:
+            shutil.copy2(video_path, output_path)
+
+        # 将结果存入统一存储
+        result_hash = _md5_of_file(output_path)
+        store_result = _store_path(result_hash, ".mp4")
+        if not os.path.exists(store_result):
+            link_or_copy(output_path, store_result)
+        _janitor.track(store_result, "store", FILE_TTL)
+
+        _update_task(task_id, status=TaskStatus.DONE, progress=100, message="编辑完成",
+                     result_path=output_path, _result_hash=result_hash, finished_at=time.time())
+        logger.info(f"[VideoEdit] 完成: task={task_id} ops={[op['type'] for op in ops]} result_hash={result_hash}")
+        return result_hash
+    except Exception as e:
+        logger.error(f"[VideoEdit] 失败: {task_id}\n{traceback.format_exc()}")
+        _update_task(task_id, status=TaskStatus.ERROR, progress=0, message=f"编辑失败: {e}",
+                     error=str(e), finished_at=time.time())
+        raise
+    finally:
+        _push_progress(task_id)
+
+
 @app.route("/api/video/edit", methods=["POST"])
 @auth_required
 def video_edit():
     """
-    视频后期编辑（通过 ffmpeg）
+    视频后期编辑（通过 ffmpeg，单次编码；提交后异步执行）
 
     multipart/form-data:
       - video: 主视频文件（或 video_hash + video_ext 引用文件池）
-      - edit_type: 'subtitle' | 'pip' | 'bgm' | 'multi'
-      - subtitle_text: 字幕文本（edit_type=subtitle 时）
-      - subtitle_style: 字幕样式 JSON（可选）
-      - pip_video: 画中画视频文件（edit_type=pip 时）
-      - pip_position: 画中画位置 'top-left'|'top-right'|'bottom-left'|'bottom-right'（默认 bottom-right）
-      - pip_scale: 画中画缩放比例（默认 0.3）
-      - bgm_audio: BGM音频文件（edit_type=bgm 时）
-      - bgm_volume: BGM音量 0.0~1.0（默认 0.15）
+      - operations: 有序操作列表 JSON，例如
+          [{"type": "subtitle", "text": "...", "title_text": "...", "style": {...}},
+           {"type": "overlay", "file": "pip_video", "position": "bottom-right", "scale": 0.3},
+           {"type": "scale", "width": 1280, "height": -2},
+           {"type": "bgm", "hash": "...", "ext": ".mp3", "volume": 0.15}]
+        overlay / bgm 的素材用 file（本请求中的上传字段名）或 hash + ext（文件池）指定
+      - edit_type: 未提供 operations 时使用旧参数：'subtitle' | 'pip' | 'bgm' | 'multi'
+        （subtitle_text / title_text / subtitle_style / pip_video / pip_video_hash / pip_position /
+         pip_scale / bgm_audio / bgm_volume 含义不变）
+      - license_key: 可选，用于 WS 进度推送
+      - sync: 1 = 等待编辑完成后再返回 result_hash，0 = 提交后立即返回；
+        默认：旧参数（edit_type）同步，operations 异步
+
+    异步时返回 task_id；进度通过 /api/heygem/progress（或 /ws/progress/<task_id>）查询，
+    完成后从 /api/video/edit/download 下载。
     """
+    operations = request.form.get("operations", "").strip()
     edit_type = request.form.get("edit_type", "").strip()
-    if not edit_type:
-        return jsonify({"code": 400, "msg": "缺少 edit_type"}), 400
+    if not operations and not edit_type:
+        return jsonify({"code": 400, "msg": "缺少 operations 或 edit_type"}), 400
 
     # 获取主视频
     video_file = request.files.get("video")
     video_hash = request.form.get("video_hash", "").strip()
     video_ext = request.form.get("video_ext", ".mp4").strip()
+    if not video_file and not video_hash:
+        return jsonify({"code": 400, "msg": "缺少 video 文件或 video_hash"}), 400
 
     task_id = str(uuid.uuid4()).replace("-", "")[:16]
     work_dir = os.path.join(OUTPUT_DIR, f"edit_{task_id}")
     os.makedirs(work_dir, exist_ok=True)
+    _janitor.track(work_dir, "edit", FILE_TTL, owner=task_id)
 
     if video_file:
         video_path = os.path.join(work_dir, f"input{video_ext}")
         video_file.save(video_path)
-    elif video_hash:
+    else:
         video_path = _store_path(video_hash, video_ext)
-        if not os.path.exists(video_path):
+        if not _path_within(video_path, STORE_DIR) or not os.path.exists(video_path):
             return jsonify({"code": 404, "msg": "视频文件不存在，请先上传"}), 404
-    else:
-        return jsonify({"code": 400, "msg": "缺少 video 文件或 video_hash"}), 400
-
-    output_path = os.path.join(work_dir, f"output_{task_id}.mp4")
 
+    # 素材文件在请求线程内落盘 / 解析（worker 线程里已拿不到 request.files）
     try:
-        if edit_type == "subtitle":
-            _edit_subtitle(video_path, output_path, work_dir)
-        elif edit_type == "pip":
-            _edit_pip(video_path, output_path, work_dir)
-        elif edit_type == "bgm":
-            _edit_bgm(video_path, output_path, work_dir)
-        elif edit_type == "multi":
-            # 多步骤：先字幕，再画中画，再BGM
-            step1 = os.path.join(work_dir, "step1.mp4")
-            step2 = os.path.join(work_dir, "step2.mp4")
-            has_sub = request.form.get("subtitle_text", "").strip()
-            has_pip = request.files.get("pip_video")
-            has_bgm = request.files.get("bgm_audio")
-
-            current = video_path
-            if has_sub:
-                _edit_subtitle(current, step1, work_dir)
-                current = step1
-            if has_pip:
-                _edit_pip(current, step2, work_dir)
-                current = step2
-            if has_bgm:
-                _edit_bgm(current, output_path, work_dir)
-            elif current != video_path:
-                shutil.copy2(current, output_path)
-            else:
-                shutil.copy2(video_path, output_path)
-        else:
-            return jsonify({"code": 400, "msg": f"不支持的 edit_type: {edit_type}"}), 400
-
-        if not os.path.exists(output_path):
-            raise RuntimeError("ffmpeg 未生成输出文件")
-
-        # 将结果存入统一存储
-        result_hash = _md5_of_file(output_path)
-        store_result = _store_path(result_hash, ".mp4")
-        if not os.path.exists(store_result):
-            shutil.copy2(output_path, store_result)
-
-        logger.info(f"[VideoEdit] 完成: task={task_id} type={edit_type} result_hash={result_hash}")
+        ops = json.loads(operations) if operations else _legacy_edit_ops(edit_type)
+        if not isinstance(ops, list):
+            raise ValueError("operations 必须是列表")
+        for op in ops:
+            if not isinstance(op, dict):
+                continue
+            # 素材路径只能由服务器解析（客户端传入的 path 会被当作 ffmpeg -i 输入：任意文件 / URL / 协议）
+            op.pop("path", None)
+            if op.get("type") in ("overlay", "pip", "bgm"):
+                field = "bgm" if op["type"] == "bgm" else "pip"
+                op["path"] = _edit_input_path(op, work_dir, field, ".mp3" if field == "bgm" else ".mp4")
+        ops = normalize_ops(ops)
+    except ValueError as e:
+        return jsonify({"code": 400, "msg": str(e)}), 400
 
-        return jsonify({
-            "code": 0,
-            "data": {
-                "task_id": task_id,
-                "result_hash": result_hash,
-                "download_url": f"/api/video/edit/download?task_id={task_id}",
-            }
-        })
-
-    except Exception as e:
-        logger.error(f"[VideoEdit] 失败: {task_id}\n{traceback.format_exc()}")
-        return jsonify({"code": 500, "msg": f"编辑失败: {e}"}), 500
-
-
-def _edit_subtitle(video_path, output_path, work_dir):
-    """添加字幕（支持 title_text 顶部两行标题 + subtitle_text 底部字幕）"""
-    text = request.form.get("subtitle_text", "").strip()
-    title_text = request.form.get("title_text", "").strip()
-    if not text and not title_text:
-        shutil.copy2(video_path, output_path)
-        return
-
-    style_json = request.form.get("subtitle_style", "{}").strip()
-    try:
-        style = json.loads(style_json)
-    except Exception:
-        style = {}
-
-    fontsize = style.get("fontsize", 24)
-    fontcolor = style.get("fontcolor", "white")
-    borderw = style.get("borderw", 2)
-    y_pos = style.get("y", "h-th-40")
-
-    # 获取视频时长
-    probe = subprocess.run(
-        ["ffprobe", "-v", "quiet", "-show_entries", "format=duration",
-         "-of", "default=noprint_wrappers=1:nokey=1", video_path],
-        capture_output=True, text=True
-    )
+    output_path = os.path.join(work_dir, f"output_{task_id}.mp4")
+    task = _new_task(task_id, "", os.path.basename(video_path))
+    task.update(message="编辑排队中...", _kind="edit",
+                _license_key=request.form.get("license_key", "").strip())
+    with _tasks_lock:
+        _tasks[task_id] = task
     try:
-        duration = float(probe.stdout.strip())
-    except Exception:
-        duration = 30.0
-
-    # 构建 ASS 字幕文件（支持标题 + 正文双轨）
-    ass_path = os.path.join(work_dir, "sub.ass")
-    title_fontsize = style.get("title_fontsize", 36)
-    title_duration = float(style.get("title_duration", min(5.0, duration)))
-
-    with open(ass_path, "w", encoding="utf-8") as f:
-        f.write("[Script Info]\nScriptType: v4.00+\nPlayResX: 1920\nPlayResY: 1080\n\n")
-        f.write("[V4+ Styles]\nFormat: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, "
-                "OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, "
-                "Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding\n")
-        # 标题样式：顶部居中，大字
-        f.write(f"Style: Title,Arial,{title_fontsize},&H00FFFFFF,&H000000FF,&H00000000,&H80000000,"
-                f"1,0,0,0,100,100,0,0,1,3,1,8,20,20,30,1\n")
-        # 正文字幕样式：底部居中
-        f.write(f"Style: Sub,Arial,{fontsize},&H00FFFFFF,&H000000FF,&H00000000,&H80000000,"
-                f"0,0,0,0,100,100,0,0,3,{borderw},0,2,20,20,40,1\n")
-        f.write("\n[Events]\n")
-        f.write("Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n")
-
-        # 写标题（顶部两行，持续 title_duration 秒）
-        if title_text:
-            # 按标点或长度拆成两行
-            title_lines = _split_title_two_lines(title_text)
-            title_display = "\\N".join(title_lines)  # ASS 换行符
-            f.write(f"Dialogue: 1,{_ass_time(0)},{_ass_time(title_duration)},Title,,0,0,0,,{title_display}\n")
-
-        # 写底部字幕
-        if text:
-            lines = [l.strip() for l in text.split("\n") if l.strip()]
-            if not lines:
-                lines = [text]
-            seg_dur = duration / len(lines) if lines else duration
-            for i, line in enumerate(lines):
-                start = i * seg_dur
-                end = min((i + 1) * seg_dur, duration)
-                f.write(f"Dialogue: 0,{_ass_time(start)},{_ass_time(end)},Sub,,0,0,0,,{line}\n")
-
-    ass_escaped = ass_path.replace("\\", "/").replace(":", "\\:")
-    cmd = (
-        f'ffmpeg -y -i "{video_path}" '
-        f'-vf "ass=\'{ass_escaped}\'" '
-        f'-c:v libx264 -profile:v baseline -level 3.1 -pix_fmt yuv420p -movflags +faststart '
-        f'-c:a copy "{output_path}"'
-    )
-    logger.info(f"[Subtitle] {cmd}")
-    ret = subprocess.call(cmd, shell=True)
-    if ret != 0:
-        # fallback: 用 SRT + subtitles filter（不支持标题）
-        logger.warning(f"[Subtitle] ASS 字幕烧录失败，回退到 SRT")
-        srt_path = os.path.join(work_dir, "sub.srt")
-        lines = [l.strip() for l in (text or title_text).split("\n") if l.strip()] or [text or title_text]
-        seg_dur = duration / len(lines) if lines else duration
-        with open(srt_path, "w", encoding="utf-8") as f:
-            for i, line in enumerate(lines):
-                start = i * seg_dur
-                end = min((i + 1) * seg_dur, duration)
-                f.write(f"{i+1}\n")
-                f.write(f"{_srt_time(start)} --> {_srt_time(end)}\n")
-                f.write(f"{line}\n\n")
-        srt_escaped = srt_path.replace("\\", "/").replace(":", "\\:")
-        cmd2 = (
-            f'ffmpeg -y -i "{video_path}" '
-            f'-vf "subtitles=\'{srt_escaped}\':force_style=\'FontSize={fontsize},PrimaryColour=&Hffffff&,'
-            f'BorderStyle=3,Outline={borderw}\'" '
-            f'-c:v libx264 -profile:v baseline -level 3.1 -pix_fmt yuv420p -movflags +faststart '
-            f'-c:a copy "{output_path}"'
-        )
-        subprocess.call(cmd2, shell=True)
-
-
-def _split_title_two_lines(title: str) -> list:
-    """将标题按标点或中点拆成两行"""
-    split_chars = ['·', '|', '—', '，', ',', '：', ':', '、']
-    for ch in split_chars:
-        if ch in title:
-            parts = title.split(ch, 1)
-            return [p.strip() for p in parts if p.strip()]
-    # 没有标点，按长度对半分
-    mid = len(title) // 2
-    return [title[:mid].strip(), title[mid:].strip()] if len(title) > 6 else [title]
-
-
-def _ass_time(seconds):
-    """格式化为 ASS 时间 H:MM:SS.cc"""
-    h = int(seconds // 3600)
-    m = int((seconds % 3600) // 60)
-    s = int(seconds % 60)
-    cs = int((seconds - int(seconds)) * 100)
-    return f"{h}:{m:02d}:{s:02d}.{cs:02d}"
-
-
-def _srt_time(seconds):
-    h = int(seconds // 3600)
-    m = int((seconds % 3600) // 60)
-    s = int(seconds % 60)
-    ms = int((seconds - int(seconds)) * 1000)
-    return f"{h:02d}:{m:02d}:{s:02d},{ms:03d}"
-
-
-def _edit_pip(video_path, output_path, work_dir):
-    """画中画叠加（支持文件上传或 pip_video_hash 引用文件池）"""
-    pip_file = request.files.get("pip_video")
-    pip_video_hash = request.form.get("pip_video_hash", "").strip()
-    pip_video_ext = request.form.get("pip_video_ext", ".mp4").strip()
-
-    if pip_file:
-        pip_path = os.path.join(work_dir, "pip_input.mp4")
-        pip_file.save(pip_path)
-    elif pip_video_hash:
-        pip_path = _resolve_file(pip_video_hash, pip_video_ext)
-        if not pip_path:
-            # 也试下直接作为 URL 下载
-            pip_path = ""
-    else:
-        shutil.copy2(video_path, output_path)
-        return
-
-    if not pip_path or not os.path.exists(pip_path):
-        logger.warning(f"[PIP] PIP视频文件不存在: hash={pip_video_hash}")
-        shutil.copy2(video_path, output_path)
-        return
-
-    position = request.form.get("pip_position", "bottom-right").strip()
-    scale = float(request.form.get("pip_scale", "0.3"))
+        future = _edit_queue.submit(_run_edit_job, task_id, video_path, ops, output_path, work_dir)
+    except AdmissionError as e:
+        with _tasks_lock:
+            _tasks.pop(task_id, None)
+        return jsonify({"code": 429, "msg": f"服务器繁忙，请稍后再试: {e}"}), 429
 
-    pos_map = {
-        "top-left": "10:10",
-        "top-right": "main_w-overlay_w-10:10",
-        "bottom-left": "10:main_h-overlay_h-10",
-        "bottom-right": "main_w-overlay_w-10:main_h-overlay_h-10",
+    logger.info(f"[VideoEdit] 已排队: task={task_id} ops={[op['type'] for op in ops]}")
+    data = {
+        "task_id": task_id,
+        "download_url": f"/api/video/edit/download?task_id={task_id}",
     }
-    xy = pos_map.get(position, pos_map["bottom-right"])
-
-    cmd = (
-        f'ffmpeg -y -i "{video_path}" -i "{pip_path}" '
-        f'-filter_complex "[1:v]scale=iw*{scale}:ih*{scale}[pip];[0:v][pip]overlay={xy}" '
-        f'-c:v libx264 -profile:v baseline -level 3.1 -pix_fmt yuv420p -movflags +faststart '
-        f'-c:a copy "{output_path}"'
-    )
-    logger.info(f"[PIP] {cmd}")
-    subprocess.call(cmd, shell=True)
-
-
-def _edit_bgm(video_path, output_path, work_dir):
-    """添加背景音乐"""
-    bgm_file = request.files.get("bgm_audio")
-    if not bgm_file:
-        shutil.copy2(video_path, output_path)
-        return
-
-    bgm_path = os.path.join(work_dir, "bgm_input.mp3")
-    bgm_file.save(bgm_path)
-
-    volume = float(request.form.get("bgm_volume", "0.15"))
-
-    cmd = (
-        f'ffmpeg -y -i "{video_path}" -i "{bgm_path}" '
-        f'-filter_complex "[0:a]volume=1.0[a0];[1:a]volume={volume}[a1];'
-        f'[a0][a1]amix=inputs=2:duration=first:dropout_transition=2[aout]" '
-        f'-map 0:v -map "[aout]" -c:v copy -c:a aac -movflags +faststart "{output_path}"'
-    )
-    logger.info(f"[BGM] {cmd}")
-    subprocess.call(cmd, shell=True)
+    sync = request.form.get("sync", "").strip().lower()
+    if sync in ("1", "true") or (not sync and not operations):
+        try:
+            data["result_hash"] = future.result()
+        except Exception as e:
+            return jsonify({"code": 500, "msg": f"编辑失败: {e}"}), 500
+    else:
+        data["status"] = TaskStatus.QUEUED
+    return jsonify({"code": 0, "data": data})
 
 
 @app.route("/api/video/edit/download", methods=["GET"])
@@ -1893,67 +2314,62 @@ def download_edit_result():
     if not task_id:
         return jsonify({"code": 400, "msg": "缺少 task_id"}), 400
 
+    with _tasks_lock:
+        task = _tasks.get(task_id)
+    if task and task["status"] != TaskStatus.DONE:
+        return jsonify({"code": 400, "msg": f"任务尚未完成 (当前状态: {task['status']})"}), 400
+
     work_dir = os.path.join(OUTPUT_DIR, f"edit_{task_id}")
     output_path = os.path.join(work_dir, f"output_{task_id}.mp4")
 
     if not os.path.exists(output_path):
         return jsonify({"code": 404, "msg": "结果文件不存在"}), 404
 
-    return send_file(output_path, mimetype="video/mp4", as_attachment=False,
-                     download_name=f"edit_{task_id}.mp4")
+    return _send_result(output_path, f"edit_{task_id}.mp4", etag=(task or {}).get("_result_hash", ""))
 
 
 # ============================================================
 #  自动清理
 # ============================================================
+def _artifacts_in_use(rows):
+    """janitor 回调：返回一批到期产物中仍被引用的路径
+
+    - owner 任务仍在排队 / 处理中
+    - store 文件仍是未结束任务的输入，或仍被资产引用（引用计数 > 0）
+    """
+    busy = set()
+    with _tasks_lock:
+        live = {tid for tid, t in _tasks.items()
+                if t["status"] not in (TaskStatus.DONE, TaskStatus.ERROR)}
+    busy.update(r["path"] for r in rows if r["owner"] and r["owner"] in live)
+    store = [r["path"] for r in rows if r["kind"] == "store"]
+    if store:
+        busy |= _task_store.active_paths(store)
+        busy |= _assets.referenced_paths(store)
+    return busy
+
+
+def _init_janitor():
+    """首次启动时导入已有文件（之后只按索引清理，不再扫目录），启动 janitor 线程"""
+    _janitor.in_use = _artifacts_in_use
+    # store 由 janitor 按 kind=store 管理；预处理 / 特征 / 分段缓存与 cache_* 结果缓存按各自的字节预算淘汰
+    _skip_upload = {"store", "preprocess_cache", "feature_cache", "segment_cache"}
+    _janitor.adopt(UPLOAD_DIR, "upload", FILE_TTL, skip=lambda n: n in _skip_upload)
+    _janitor.adopt(OUTPUT_DIR, "output", FILE_TTL, skip=lambda n: n.startswith("cache_"))
+    _janitor.adopt(STORE_DIR, "store", FILE_TTL)
+    interval = float(_cfg.get("janitor", "interval_seconds", fallback="60"))
+    _janitor.start(interval, on_sweep=lambda seconds, deleted: (_metrics.observe_stage("cleanup", seconds),
+                                                                 _metrics.cleanup_deleted.inc(deleted)))
+    logger.info(f"[Server] janitor 已启动 (TTL={FILE_TTL}s, 间隔={interval:.0f}s, 索引={_janitor.stats()})")
+
+
 def _cleanup_old_files():
+    """过期任务记录与资产记录清理（文件由 janitor 按产物索引清理）"""
     while True:
         try:
             time.sleep(CLEANUP_INTERVAL)
             now = time.time()
-            cleaned = 0
-
-            # 不清理的固定子目录（store 由统一策略管理）
-            _protected_dirs = {"store"}
-            for base_dir in [UPLOAD_DIR, OUTPUT_DIR]:
-                if not os.path.isdir(base_dir):
-                    continue
-                for name in os.listdir(base_dir):
-                    if name in _protected_dirs:
-                        continue
-                    path = os.path.join(base_dir, name)
-                    try:
-                        mtime = os.path.getmtime(path)
-                        if now - mtime > FILE_TTL:
-                            if os.path.isdir(path):
-                                shutil.rmtree(path, ignore_errors=True)
-                            else:
-                                os.remove(path)
-                            cleaned += 1
-                    except Exception as e:
-                        logger.warning(f"[Cleanup] 清理失败 {path}: {e}")
-
-            # 清理 store 目录内过期文件（保留 1 天）
-            if os.path.isdir(STORE_DIR):
-                for name in os.listdir(STORE_DIR):
-                    if name.startswith("_tmp_"):
-                        # 临时文件超过 1 小时就清理
-                        path = os.path.join(STORE_DIR, name)
-                        try:
-                            if now - os.path.getmtime(path) > 3600:
-                                os.remove(path)
-                                cleaned += 1
-                        except Exception:
-                            pass
-                        continue
-                    path = os.path.join(STORE_DIR, name)
-                    try:
-                        mtime = os.path.getmtime(path)
-                        if now - mtime > FILE_TTL:
-                            os.remove(path)
-                            cleaned += 1
-                    except Exception:
-                        pass
+            _t_cleanup = time.perf_counter()
 
             expired_ids = []
             with _tasks_lock:
@@ -1963,31 +2379,25 @@ def _cleanup_old_files():
                             expired_ids.append(tid)
                 for tid in expired_ids:
                     del _tasks[tid]
+            for tid in expired_ids:
+                _progress_bus.discard(tid)
+            try:
+                _task_store.purge_finished(now - FILE_TTL)
+            except Exception as se:
+                logger.warning(f"[Cleanup] 任务日志清理异常: {se}")
 
-            # 清理过期资产（SQLite + 文件）
+            # 过期资产：删除记录、释放引用；无引用的存储文件在宽限期后回收
+            # （仍是排队任务输入、或上传登记尚未到期的文件留给 janitor）
             asset_cleaned = 0
             try:
-                with _db_lock:
-                    conn = _get_db()
-                    expired_rows = conn.execute(
-                        "SELECT id, file_path FROM assets WHERE expires_at < ?", (now,)
-                    ).fetchall()
-                    for row in expired_rows:
-                        try:
-                            if os.path.exists(row["file_path"]):
-                                os.remove(row["file_path"])
-                        except Exception:
-                            pass
-                        asset_cleaned += 1
-                    if expired_rows:
-                        conn.execute("DELETE FROM assets WHERE expires_at < ?", (now,))
-                        conn.commit()
-                    conn.close()
+                asset_cleaned = _assets.expire(now)
+                _assets.gc(in_use=lambda paths: _task_store.active_paths(paths) | _janitor.live(paths))
             except Exception as ae:
                 logger.warning(f"[Cleanup] 资产清理异常: {ae}")
 
-            if cleaned or expired_ids or asset_cleaned:
-                logger.info(f"[Cleanup] 清理完成: 文件/目录 {cleaned} 个, 任务记录 {len(expired_ids)} 条, 过期资产 {asset_cleaned} 个")
+            _metrics.observe_stage("cleanup_records", time.perf_counter() - _t_cleanup)
+            if expired_ids or asset_cleaned:
+                logger.info(f"[Cleanup] 清理完成: 任务记录 {len(expired_ids)} 条, 过期资产 {asset_cleaned} 个")
         except Exception as e:
             logger.error(f"[Cleanup] 清理线程异常: {e}")
 
@@ -1995,8 +2405,110 @@ def _cleanup_old_files():
 # ============================================================
 #  初始化与启动
 # ============================================================
+def _calibration_clips():
+    """[autotune] 校准片段：校准视频按各分辨率档位缩放、与音频一起截取 calibration_seconds 秒
+
+    返回 [(档位, 音频, 视频, 预期帧数)]，生成的片段缓存在 temp/autotune 下。
+    """
+    video = _cfg.get("autotune", "calibration_video", fallback="").strip()
+    audio = _cfg.get("autotune", "calibration_audio", fallback="example/audio.wav").strip()
+    if not video:
+        return []
+    video, audio = [p if os.path.isabs(p) else os.path.join(_BASE_DIR, p) for p in (video, audio)]
+    if not (os.path.exists(video) and os.path.exists(audio)):
+        logger.warning(f"[Autotune] 校准片段不存在，跳过校准: {video} / {audio}")
+        return []
+    seconds = float(_cfg.get("autotune", "calibration_seconds", fallback="4"))
+    _temp_dir = _cfg.get("temp", "temp_dir", fallback="./temp")
+    clip_dir = os.path.join(_temp_dir if os.path.isabs(_temp_dir) else os.path.join(_BASE_DIR, _temp_dir), "autotune")
+    os.makedirs(clip_dir, exist_ok=True)
+    clip_audio = os.path.join(clip_dir, f"audio_{seconds:g}s.wav")
+    if not os.path.exists(clip_audio):
+        subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-i", audio, "-t", str(seconds), clip_audio], check=True)
+    clips = []
+    for bucket in [b.strip() for b in _cfg.get("autotune", "calibrate_buckets", fallback="720p,1080p").split(",")]:
+        if not bucket:
+            continue
+        clip_video = os.path.join(clip_dir, f"video_{bucket}_{seconds:g}s.mp4")
+        if not os.path.exists(clip_video):
+            subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-i", video, "-t", str(seconds), "-an",
+                            "-vf", f"scale=-2:{bucket_height(bucket)}", "-c:v", "libx264", "-pix_fmt", "yuv420p",
+                            clip_video], check=True)
+        vinfo = _media_probe.probe(clip_video)
+        frames = max(vinfo["frames"], int(_media_probe.probe(clip_audio, video=False)["duration"] * vinfo["fps"]))
+        clips.append((bucket, clip_audio, clip_video, frames))
+    return clips
+
+
+def _engine_work_once(engine, audio, video, tag):
+    """在引擎上直接跑一个内部短任务（校准 / 就绪探测），结果文件随即删除；引擎报错时抛出"""
+    work_id = f"{tag}-{uuid.uuid4().hex[:12]}"
+    engine.task_dic[work_id] = ""
+    try:
+        engine.work(audio, video, work_id, 0, 0, 0, 0)
+        entry = engine.task_dic.get(work_id, "")
+    finally:
+        engine.task_dic.pop(work_id, None)
+    if isinstance(entry, (list, tuple)) and len(entry) > 2 and isinstance(entry[2], str) \
+            and os.path.isfile(entry[2]):
+        os.remove(entry[2])
+    if isinstance(entry, (list, tuple)) and entry and "error" in str(entry[0]).lower():
+        raise RuntimeError(str(entry[-1]))
+
+
+def _engine_ready_probe():
+    """就绪探测：用最短的校准片段跑一次推理，成功即引擎已能接任务（[engine] ready_probe = 0 关闭）
+
+    未配置校准素材（[autotune] calibration_video）时返回 None。
+    """
+    if _cfg.get("engine", "ready_probe", fallback="1").strip() == "0":
+        return None
+    try:
+        clips = _calibration_clips()
+    except Exception as e:
+        logger.warning(f"[Server] 准备就绪探测片段失败: {e}")
+        return None
+    if not clips:
+        return None
+    _bucket, audio, video, _frames = min(clips, key=lambda c: bucket_height(c[0]))
+
+    def _probe(engine):
+        _engine_work_once(engine, audio, video, "ready-probe")
+        return True
+    return _probe
+
+
+def _calibrate_engine(engine, device: str):
+    """在引擎就绪后、接任务前，为尚未校准的档位测各 batch_size 的吞吐（结果持久化，下次启动跳过）"""
+    if not AUTOTUNE_ENABLED:
+        return
+    dev_key = device_key(device)
+    try:
+        clips = [c for c in _calibration_clips() if not _batch_tuner.is_tuned(dev_key, c[0])]
+    except Exception as e:
+        logger.warning(f"[Autotune] 准备校准片段失败，跳过校准: {e}")
+        return
+
+    def _work_once(audio, video, frames, batch_size):
+        _apply_batch_size(batch_size)
+        _engine_work_once(engine, audio, video, "autotune")
+        return frames
+
+    for bucket, audio, video, frames in clips:
+        try:
+            _work_once(audio, video, frames, 1)  # 预热（首次运行含模型 / 缓存初始化，不计时）
+            best = _lifecycle.check(
+                f"autotune[{device}:{bucket}]",
+                lambda: _batch_tuner.calibrate(dev_key, bucket,
+                                               lambda bs: _work_once(audio, video, frames, bs)))
+            logger.info(f"[Autotune] {dev_key} {bucket}: batch_size={best}")
+        except Exception as e:
+            logger.warning(f"[Autotune] {dev_key} {bucket} 校准失败，使用默认值: {e}")
+    _apply_batch_size(_batch_tuner.default)
+
+
 def _init_service():
-    global _task_instance
+    global _task_instance, _scheduler, _progress_ring, _progress_pump, AUTOTUNE_ENABLED
     sys.argv = [sys.argv[0]]
 
     # 确保 temp/result 目录存在（config.ini 中配置的路径）
@@ -2012,10 +2524,122 @@ def _init_service():
     # 都依赖 CWD = /root/HeyGem/，不能再切换，否则 format_video 找不到 ./temp/
     logger.info(f"[Server] CWD 保持在: {os.getcwd()}")
 
+    # 进度共享内存须在创建引擎之前建好：引擎子进程通过环境变量继承共享内存名称
+    try:
+        _progress_ring = ProgressRing.create()
+        os.environ[SHM_ENV] = _progress_ring.name
+        _progress_pump = ProgressPump(_progress_ring, _on_engine_progress)
+        _progress_pump.start()
+        logger.info(f"[Server] 进度共享内存就绪: {_progress_ring.name} ({_progress_ring.slots} 槽位)")
+    except Exception as e:
+        _progress_ring = None
+        logger.warning(f"[Server] 进度共享内存不可用，回退进度文件: {e}")
+
     logger.info("[Server] 正在初始化数字人推理服务...")
-    _task_instance = service.trans_dh_service.TransDhTask()
-    time.sleep(10)
-    logger.info("[Server] 数字人推理服务初始化完成")
+    _lifecycle.check("capabilities", _lifecycle.capabilities)
+    if not _lifecycle.capabilities()["ffmpeg"]:
+        logger.warning("[Server] 未检测到 ffmpeg，合成任务将失败！请执行: sudo apt install -y ffmpeg")
+    devices = parse_devices(SCHEDULER_DEVICES, MAX_CONCURRENT)
+    if AUTOTUNE_ENABLED and len(devices) > 1:
+        # GlobalConfig 为进程级：多个 worker 并发 work() 时各自设置的 batch_size 会互相覆盖
+        AUTOTUNE_ENABLED = False
+        logger.warning(f"[Autotune] {len(devices)} 个 worker 共享进程级 batch_size，自动调优已关闭，"
+                       f"统一使用 [digital] batch_size={_batch_tuner.default}")
+
+    probe = _engine_ready_probe()
+    if probe is None and not _lifecycle.ready_file:
+        logger.warning("[Server] 未配置就绪探测（[autotune] calibration_video）或 [engine] ready_file，"
+                       "引擎就绪只能按子进程 CPU 稳定推断")
+
+    def _ready_engine(create):
+        """创建引擎并等待就绪信号（代替原先固定的 time.sleep(10)）；超时即启动失败，不按就绪处理"""
+        def _factory(device):
+            before = child_pids()
+            since = time.time()
+            engine = _lifecycle.check(f"engine_create[{device}]", lambda: create(device))
+            _lifecycle.check(f"engine_ready[{device}]",
+                             lambda: _lifecycle.wait_engine_ready(engine, before, probe=probe, since=since))
+            _calibrate_engine(engine, device)
+            return engine
+        return _factory
+
+    if len(devices) == 1:
+        # 单 worker：沿用原有方式创建引擎，不改动 CUDA_VISIBLE_DEVICES
+        _task_instance = _ready_engine(lambda _device: service.trans_dh_service.TransDhTask())(devices[0])
+        _engine_factory = lambda _device: _task_instance
+    else:
+        _engine_factory = _ready_engine(_create_engine)
+    _scheduler = TaskScheduler(
+        _dispatch_job, devices,
+        engine_factory=_engine_factory,
+        max_queued_frames=MAX_QUEUED_FRAMES,
+        max_queued_per_client=MAX_QUEUED_PER_CLIENT,
+    )
+    _lifecycle.check("scheduler_start", _scheduler.start)
+    _task_instance = _scheduler.workers[0].engine
+    _bind_metric_gauges()
+    _lifecycle.mark_ready()
+    logger.info(f"[Server] 数字人推理服务初始化完成 (worker={len(devices)}, devices={devices})")
+
+
+def _bind_metric_gauges():
+    """/metrics 抓取时再读取的瞬时值：各状态任务数、排队帧数、worker 占用"""
+    def _task_counts():
+        counts = {status: 0 for status in (TaskStatus.QUEUED, TaskStatus.PROCESSING,
+                                           TaskStatus.DONE, TaskStatus.ERROR)}
+        with _tasks_lock:
+            for task in _tasks.values():
+                counts[task["status"]] = counts.get(task["status"], 0) + 1
+        return counts
+
+    _metrics.tasks.set_function(_task_counts)
+    _metrics.queued_frames.set_function(lambda: _scheduler.stats()["queued_frames"])
+    _metrics.workers.set_function(lambda: len(_scheduler.workers))
+    _metrics.workers_busy.set_function(lambda: _scheduler.stats()["busy"])
+
+
+def _restore_tasks():
+    """从 tasks.db 恢复任务记录；重启前排队中/处理中的任务重新入队"""
+    records = _task_store.load()
+    if not records:
+        return
+    requeue, restored = [], {}
+    with _tasks_lock:
+        for rec in records:
+            task_id = rec["task_id"]
+            task = _new_task(task_id, rec.get("audio_name", ""), rec.get("video_name", ""))
+            task.update({k: v for k, v in rec.items() if k in task or k.startswith("_")})
+            if task["status"] not in (TaskStatus.DONE, TaskStatus.ERROR):
+                task.update(status=TaskStatus.QUEUED, progress=0, current_frame=0,
+                            started_at=0, message="服务重启，重新排队...")
+                task.pop("_work_id", None)
+                requeue.append(rec)
+            _tasks[task_id] = restored[task_id] = task
+    for rec in requeue:
+        task_id = rec["task_id"]
+        audio_path, video_path = rec.get("audio_path", ""), rec.get("video_path", "")
+        if not (audio_path and os.path.exists(audio_path) and video_path and os.path.exists(video_path)):
+            _update_task(task_id, status=TaskStatus.ERROR, message="服务重启后输入文件已丢失",
+                         error="input missing", finished_at=time.time())
+            continue
+        try:
+            _enqueue_task(task_id, audio_path, video_path, client=rec.get("client", ""),
+                          priority=_parse_priority(rec.get("priority", "")))
+        except Exception as e:
+            # 准入失败时 _enqueue_task 已移除内存与任务日志中的记录（_update_task 会直接跳过）：
+            # 把失败状态写回两处，客户端仍能查到任务及失败原因
+            with _tasks_lock:
+                task = _tasks.setdefault(task_id, restored[task_id])
+                task.update(status=TaskStatus.ERROR, message=f"重新排队失败: {e}",
+                            error=str(e), finished_at=time.time())
+                task_snapshot = dict(task)
+            _progress_bus.publish(task_id)
+            try:
+                _task_store.put(task_snapshot, audio_path=audio_path, video_path=video_path,
+                                client=rec.get("client", ""), priority=_parse_priority(rec.get("priority", "")))
+            except Exception as store_e:
+                logger.warning(f"[TaskStore] 写入失败: {task_id} ({store_e})")
+    logger.info(f"[Server] 已从任务日志恢复 {len(records)} 条记录，重新排队 {len(requeue)} 个")
 
 
 def _init_ws_client():
@@ -2032,6 +2656,13 @@ def _init_ws_client():
         on_task_callback=_handle_ws_task,
         reconnect_interval=5,
         max_reconnect_interval=30,
+        outbox_path=os.path.join(os.path.dirname(__file__), "ws_outbox.db"),
+        progress_window=float(_cfg.get("ws_client", "progress_window", fallback="2")),
+        progress_batch=int(_cfg.get("ws_client", "progress_batch", fallback="1")),
+        max_pending_progress=int(_cfg.get("ws_client", "max_pending_progress", fallback="256")),
+        max_pending_results=int(_cfg.get("ws_client", "max_pending_results", fallback="64")),
+        ack_grace=float(_cfg.get("ws_client", "ack_grace_seconds", fallback="5")),
+        dedup_ttl=float(_cfg.get("ws_client", "dedup_ttl_seconds", fallback="3600")),
     )
     _ws_client.start()
     logger.info("[Server] WebSocket 客户端已启动")
@@ -2045,22 +2676,24 @@ def get_args():
     parser.add_argument("--host", type=str, default="0.0.0.0", help="监听地址")
     parser.add_argument("--port", type=int, default=8383, help="监听端口")
     parser.add_argument("--max-concurrent", type=int, default=None,
-                        help=f"最大并发数 (默认读 config.ini: {MAX_CONCURRENT})")
+                        help=f"引擎 worker 数 (默认读 config.ini [scheduler] workers: {MAX_CONCURRENT})")
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = get_args()
 
-    # 强制单任务模式，忽略命令行 --max-concurrent 参数
-    if args.max_concurrent is not None and args.max_concurrent != 1:
-        logger.warning(f"[Server] 忽略 --max-concurrent={args.max_concurrent}，强制使用串行模式(MAX_CONCURRENT=1)")
+    # 命令行 --max-concurrent 覆盖 config.ini 中的 worker 数
+    if args.max_concurrent is not None and args.max_concurrent > 0:
+        MAX_CONCURRENT = args.max_concurrent
 
     _init_service()
+    _restore_tasks()
 
     # 启动 WebSocket 客户端
     _init_ws_client()
 
+    _init_janitor()
     cleanup_thread = threading.Thread(target=_cleanup_old_files, daemon=True)
     cleanup_thread.start()
     logger.info(f"[Server] 清理线程已启动 (TTL={FILE_TTL}s, 间隔={CLEANUP_INTERVAL}s)")
@@ -2069,6 +2702,10 @@ if __name__ == "__main__":
     logger.info("[Server] 接口列表:")
     logger.info("  POST /api/heygem/check_files   - 检查文件是否已在服务器(hash去重)")
     logger.info("  POST /api/heygem/upload_file   - 上传单个文件到存储")
+    logger.info("  POST /api/heygem/upload/create - 创建/恢复分片上传会话")
+    logger.info("  PUT  /api/heygem/upload/chunk  - 上传分片(断点续传)")
+    logger.info("  GET  /api/heygem/upload/status - 查询分片上传进度")
+    logger.info("  POST /api/heygem/upload/commit - 完成分片上传")
     logger.info("  POST /api/heygem/submit        - 通过hash提交合成任务")
     logger.info("  POST /api/heygem/upload         - 上传音视频并提交合成(兼容)")
     logger.info("  GET  /api/heygem/progress       - 查询任务进度")
@@ -2078,7 +2715,7 @@ if __name__ == "__main__":
     logger.info("  POST /api/asset/upload          - 上传音色/数字人")
     logger.info("  GET  /api/asset/list            - 查询音色/数字人列表")
     logger.info("  POST /api/asset/delete          - 删除音色/数字人")
-    logger.info("  POST /api/video/edit            - 视频编辑(字幕/画中画/BGM)")
+    logger.info("  POST /api/video/edit            - 视频编辑(操作列表单次编码，异步)")
     logger.info("  GET  /api/video/edit/download   - 下载编辑后视频")
     if _FLASK_SOCK_OK:
         logger.info("  WS   /ws/progress/<task_id>     - WebSocket 进度推送(PC端直连)")
@@ -0,0 +1,530 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+分段增量渲染（按静音切段 + 已渲染视频段缓存）
+==========================================
+原实现只有整条结果缓存（ResultCache，key = audio+video 全文件 hash）：口播稿只改了最后一句，
+整条音频 hash 变化，整段视频从头重新推理，已经渲染过的前面几十秒全部白算。
+
+本模块：
+  1. plan_segments：音频解码为 16kHz 单声道 PCM，按视频帧窗口计算能量，在足够长的静音中点切段
+     （切点落在帧边界上），过短的段并入前一段
+  2. 每段 key = md5(引擎/编码版本, 视频 hash, fps, 该段对齐的源视频帧区间, 该段 PCM)；
+     只改末尾一句时前面各段的 key 不变
+  3. SegmentCache：segments.db 索引 + 每段一个纯视频 mp4（无音频），按字节预算 LRU 淘汰
+  4. render_incremental：命中的段直接复用，连续未命中的段合并成一个区间，截取该区间音频与
+     对齐的源视频帧交给引擎渲染；引擎输出在段边界强制关键帧（FfmpegFrameSink keyframes），
+     按帧数 stream copy 切回各段写入缓存，最后 concat 拼接所有段并合并完整新音频
+  5. 完整渲染（没有任何段可复用）同样在段边界强制关键帧，结束后 store_render 切段写入缓存
+
+音频长于视频时引擎如何取帧（循环 / 往返）由 frame_map 配置；未配置时只对音频不长于视频的任务分段，
+此时输出第 i 帧固定对应源视频第 i 帧，与取帧方式无关。
+
+自检（桩引擎：改最后一句只重渲染最后一段的帧）：
+  python segment_cache.py
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 16000
+FRAME_MAPS = ("loop", "pingpong")
+
+
+class SegmentError(RuntimeError):
+    """切段 / 拼接失败（调用方回退完整渲染）"""
+
+
+class Segment(NamedTuple):
+    index: int
+    start: int  # 输出帧区间 [start, end)
+    end: int
+    key: str
+
+    @property
+    def frames(self) -> int:
+        return self.end - self.start
+
+
+class SegmentPlan(NamedTuple):
+    fps: float
+    total_frames: int
+    segments: List[Segment]
+    frame_map: str
+    source_frames: int
+
+    @property
+    def keyframes(self) -> List[int]:
+        """段边界帧号（完整渲染时在这些帧强制关键帧）"""
+        return [s.start for s in self.segments[1:]]
+
+
+# ── 音频 / 帧映射 ──
+
+def decode_pcm(audio_path: str, sample_rate: int = SAMPLE_RATE) -> bytes:
+    """音频解码为单声道 s16le PCM（切段与 hash 用，与原文件编码格式无关）"""
+    p = subprocess.run(["ffmpeg", "-loglevel", "error", "-i", audio_path, "-vn", "-ac", "1",
+                        "-ar", str(sample_rate), "-f", "s16le", "pipe:1"], capture_output=True)
+    if p.returncode != 0 or not p.stdout:
+        raise SegmentError(f"音频解码失败: {audio_path}: {p.stderr.decode('utf-8', 'replace')[-300:]}")
+    return p.stdout
+
+
+def source_frame(i: int, source_frames: int, frame_map: str) -> int:
+    """输出第 i 帧对应的源视频帧号"""
+    if i < source_frames:
+        return i
+    if frame_map == "pingpong" and source_frames > 1:
+        period = 2 * source_frames - 2
+        k = i % period
+        return k if k < source_frames else period - k
+    return i % source_frames
+
+
+def source_runs(start: int, end: int, source_frames: int, frame_map: str) -> List[Tuple[int, int, bool]]:
+    """输出帧区间 [start, end) 对应的源视频帧连续段 [(a, b, 倒放)]，区间均为 [a, b)"""
+    runs: List[Tuple[int, int, bool]] = []
+    i = start
+    while i < end:
+        s = source_frame(i, source_frames, frame_map)
+        step = 1
+        if i + 1 < end:
+            step = source_frame(i + 1, source_frames, frame_map) - s
+            step = step if step in (1, -1) else 1
+        n = 1
+        while i + n < end and source_frame(i + n, source_frames, frame_map) == s + step * n:
+            n += 1
+        runs.append((s, s + n, False) if step == 1 or n == 1 else (s - n + 1, s + 1, True))
+        i += n
+    return runs
+
+
+def silence_cuts(pcm: bytes, fps: float, silence_db: float = -40.0,
+                 min_silence: float = 0.3) -> List[int]:
+    """静音区间中点所在的帧号（按视频帧窗口计算 RMS，低于 silence_db dBFS 视为静音）"""
+    import numpy as np
+
+    samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+    n_frames = int(len(samples) / SAMPLE_RATE * fps)
+    if n_frames <= 0:
+        return []
+    edges = (np.arange(n_frames + 1) * SAMPLE_RATE / fps).astype(np.int64)
+    sq = np.concatenate([[0.0], np.cumsum(samples.astype(np.float64) ** 2)])
+    energy = (sq[edges[1:]] - sq[edges[:-1]]) / np.maximum(edges[1:] - edges[:-1], 1)
+    silent = 10 * np.log10(energy + 1e-12) < silence_db
+    cuts, run_start, min_run = [], None, max(1, int(round(min_silence * fps)))
+    for i, s in enumerate(list(silent) + [False]):
+        if s and run_start is None:
+            run_start = i
+        elif not s and run_start is not None:
+            # 开头 / 结尾的静音不切
+            if i - run_start >= min_run and run_start > 0 and i < n_frames:
+                cuts.append((run_start + i) // 2)
+            run_start = None
+    return cuts
+
+
+def plan_segments(audio_path: str, video_hash: str, fps: float, source_frames: int,
+                  version: str = "1", frame_map: str = "", silence_db: float = -40.0,
+                  min_silence: float = 0.3, min_segment: float = 2.0) -> Optional[SegmentPlan]:
+    """按静音切段并计算各段 key；无法分段（只有一段 / 取帧方式未知）时返回 None"""
+    if fps <= 0 or source_frames <= 0:
+        return None
+    frame_map = (frame_map or "").strip().lower()
+    pcm = decode_pcm(audio_path)
+    total = int(len(pcm) // 2 / SAMPLE_RATE * fps)
+    if total > source_frames and frame_map not in FRAME_MAPS:
+        logger.debug(f"[SegmentCache] 音频长于视频且未配置 frame_map，不分段: {audio_path}")
+        return None
+    bounds = [0]
+    for c in silence_cuts(pcm, fps, silence_db, min_silence):
+        # 过短的段并入前一段
+        if (c - bounds[-1]) / fps >= min_segment and (total - c) / fps >= min_segment:
+            bounds.append(c)
+    bounds.append(total)
+    if len(bounds) < 3:
+        return None
+    segments = []
+    for i, (a, b) in enumerate(zip(bounds, bounds[1:])):
+        h = hashlib.md5()
+        runs = source_runs(a, b, source_frames, frame_map)
+        h.update(json.dumps([version, video_hash, f"{fps:.6g}", runs]).encode())
+        lo = int(round(a * SAMPLE_RATE / fps)) * 2
+        hi = int(round(b * SAMPLE_RATE / fps)) * 2 if b < total else len(pcm)
+        h.update(pcm[lo:hi])
+        segments.append(Segment(i, a, b, h.hexdigest()))
+    return SegmentPlan(fps, total, segments, frame_map, source_frames)
+
+
+# ── ffmpeg 截取 / 切分 / 拼接 ──
+
+def _ffmpeg(cmd: List[str], what: str):
+    p = subprocess.run(["ffmpeg", "-loglevel", "error", "-y"] + cmd, capture_output=True, text=True)
+    if p.returncode != 0:
+        raise SegmentError(f"{what}失败: rc={p.returncode}, stderr={p.stderr[-500:]}")
+
+
+def count_frames(path: str) -> int:
+    """mp4 视频帧数（读容器索引，不解码）"""
+    import cv2
+
+    cap = cv2.VideoCapture(path)
+    try:
+        return int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) if cap.isOpened() else 0
+    finally:
+        cap.release()
+
+
+def cut_audio(audio_path: str, start: float, end: Optional[float], out_path: str):
+    """截取 [start, end) 秒音频为 wav（end=None 截到结尾）"""
+    trim = f"atrim=start={start:.6f}" + (f":end={end:.6f}" if end is not None else "")
+    _ffmpeg(["-i", audio_path, "-vn", "-af", f"{trim},asetpts=PTS-STARTPTS",
+             "-c:a", "pcm_s16le", out_path], "截取音频")
+
+
+def cut_video(video_path: str, runs: List[Tuple[int, int, bool]], fps: float, out_path: str):
+    """按源视频帧连续段截取并拼成一个视频（倒放段用 reverse 滤镜，段长受源视频长度限制）"""
+    parts, labels = [], []
+    for i, (a, b, rev) in enumerate(runs):
+        parts.append(f"[0:v]trim=start_frame={a}:end_frame={b},setpts=PTS-STARTPTS"
+                     f"{',reverse' if rev else ''}[v{i}]")
+        labels.append(f"[v{i}]")
+    graph = ";".join(parts) + f";{''.join(labels)}concat=n={len(runs)}:v=1:a=0[out]"
+    _ffmpeg(["-i", video_path, "-filter_complex", graph, "-map", "[out]", "-an", "-r", f"{fps:.6g}",
+             "-c:v", "libx264", "-preset", "veryfast", "-crf", "12", "-pix_fmt", "yuv420p", out_path],
+            "截取视频")
+
+
+def split_video(path: str, frames: List[int], out_dir: str) -> List[Tuple[str, int]]:
+    """按各段帧数 stream copy 切分（边界须为关键帧），返回 [(段文件, 实际帧数)]
+
+    前面各段帧数必须与预期一致；最后一段允许 ±2 帧（音频编码延迟 / -shortest 截断）。
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    pattern = os.path.join(out_dir, "part_%04d.mp4")
+    if len(frames) > 1:
+        points = []
+        for n in frames[:-1]:
+            points.append((points[-1] if points else 0) + n)
+        _ffmpeg(["-i", path, "-map", "0:v", "-c", "copy", "-f", "segment",
+                 "-segment_frames", ",".join(map(str, points)), "-reset_timestamps", "1",
+                 "-segment_format", "mp4", pattern], "切分视频段")
+    else:
+        _ffmpeg(["-i", path, "-map", "0:v", "-c", "copy", pattern % 0], "切分视频段")
+    parts = []
+    for i, expected in enumerate(frames):
+        p = pattern % i
+        n = count_frames(p) if os.path.exists(p) else 0
+        last = i == len(frames) - 1
+        if n <= 0 or (n != expected and not (last and abs(n - expected) <= 2)):
+            raise SegmentError(f"切分帧数不符: 第 {i} 段 {n} 帧，预期 {expected} 帧")
+        parts.append((p, n))
+    return parts
+
+
+def concat_segments(paths: List[str], audio_path: str, out_path: str):
+    """concat demuxer 拼接各段视频（stream copy）并合并完整音频"""
+    list_path = f"{out_path}.txt"
+    with open(list_path, "w", encoding="utf-8") as f:
+        for p in paths:
+            f.write("file '{}'\n".format(os.path.abspath(p).replace("'", "'\\''")))
+    try:
+        _ffmpeg(["-f", "concat", "-safe", "0", "-i", list_path, "-i", audio_path,
+                 "-map", "0:v", "-map", "1:a", "-c:v", "copy", "-c:a", "aac", "-shortest",
+                 "-movflags", "+faststart", out_path], "拼接视频段")
+    finally:
+        try:
+            os.remove(list_path)
+        except OSError:
+            pass
+
+
+# ── 段缓存 ──
+
+class SegmentCache:
+    """已渲染视频段缓存：单连接 + 自有锁（与 ResultCache 相同的用法）"""
+
+    def __init__(self, root: str, db_path: str = "", byte_budget: int = 0, protect_seconds: float = 600):
+        """
+        Args:
+            root: 段文件目录（按 key 前两位分子目录）
+            db_path: 索引 SQLite 文件路径（默认 root/segments.db）
+            byte_budget: 段文件总字节上限（0 = 不限制），超出按最近访问时间淘汰
+            protect_seconds: 最近这段时间内访问过的段不淘汰（拼接进行中的段不会被删）
+        """
+        self.root = root
+        self.byte_budget = byte_budget
+        self.protect_seconds = protect_seconds
+        self.hits = 0
+        self.misses = 0
+        self.rendered_frames = 0
+        self.reused_frames = 0
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path or os.path.join(root, "segments.db"),
+                                     check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+        CREATE TABLE IF NOT EXISTS segments (
+            seg_key TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            frames INTEGER NOT NULL,
+            size INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            last_access REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_segments_lru ON segments(last_access);
+        """)
+        logger.info(f"[SegmentCache] 段缓存就绪: {root} (budget={byte_budget})")
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.mp4")
+
+    def work_dir(self) -> str:
+        """临时目录（与段文件同一文件系统，切分结果可直接 rename 入缓存）"""
+        d = os.path.join(self.root, "tmp", uuid.uuid4().hex[:12])
+        os.makedirs(d, exist_ok=True)
+        return d
+
+    def lookup(self, key: str) -> Optional[Tuple[str, int]]:
+        """命中返回 (段文件, 帧数) 并刷新访问时间；文件已不存在的条目顺带删除"""
+        with self._lock:
+            row = self._conn.execute("SELECT path, frames FROM segments WHERE seg_key=?", (key,)).fetchone()
+            if row and os.path.exists(row["path"]):
+                self._conn.execute("UPDATE segments SET last_access=? WHERE seg_key=?", (time.time(), key))
+                self.hits += 1
+                return row["path"], row["frames"]
+            if row:
+                self._conn.execute("DELETE FROM segments WHERE seg_key=?", (key,))
+            self.misses += 1
+            return None
+
+    def put(self, key: str, src_path: str, frames: int) -> str:
+        """把切分好的段文件移入缓存（同文件系统 rename），返回条目路径"""
+        dst = self.entry_path(key)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        try:
+            os.replace(src_path, dst)
+        except OSError:
+            shutil.copy2(src_path, dst)
+        size = os.path.getsize(dst)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO segments (seg_key, path, frames, size, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(seg_key) DO UPDATE SET "
+                "path=excluded.path, frames=excluded.frames, size=excluded.size, last_access=excluded.last_access",
+                (key, dst, frames, size, now, now))
+        return dst
+
+    def evict(self) -> int:
+        """淘汰到字节预算以内，返回删除段数"""
+        if self.byte_budget <= 0:
+            return 0
+        removed = []
+        with self._lock:
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM segments").fetchone()[0]
+            if total <= self.byte_budget:
+                return 0
+            cutoff = time.time() - self.protect_seconds
+            for row in self._conn.execute(
+                    "SELECT seg_key, path, size FROM segments WHERE last_access<? ORDER BY last_access",
+                    (cutoff,)).fetchall():
+                if total <= self.byte_budget:
+                    break
+                self._conn.execute("DELETE FROM segments WHERE seg_key=?", (row["seg_key"],))
+                removed.append(row["path"])
+                total -= row["size"]
+        for path in removed:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        if removed:
+            logger.info(f"[SegmentCache] 淘汰 {len(removed)} 个段")
+        return len(removed)
+
+    def store_render(self, plan: SegmentPlan, video_path: str) -> int:
+        """完整渲染结果（段边界已强制关键帧）按段切分写入缓存，返回写入段数"""
+        work = self.work_dir()
+        try:
+            parts = split_video(video_path, [s.frames for s in plan.segments], work)
+            for seg, (p, n) in zip(plan.segments, parts):
+                self.put(seg.key, p, n)
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+        self.evict()
+        logger.info(f"[SegmentCache] 完整渲染切分入缓存: {len(plan.segments)} 段")
+        return len(plan.segments)
+
+    def render_incremental(self, plan: SegmentPlan, audio_path: str, video_path: str, out_path: str,
+                           render_span: Callable[[str, str, List[int]], str],
+                           on_plan: Optional[Callable[[int, int], None]] = None) -> Optional[Dict]:
+        """复用已缓存的段，只渲染未命中的区间并拼接到 out_path
+
+        render_span(音频, 视频, 区间内段边界帧号) 返回引擎输出的视频路径；
+        on_plan(待渲染帧数, 复用段数) 在开始渲染前回调（更新任务进度总帧数）。
+        没有任何段命中时返回 None（调用方走完整渲染 + store_render）。
+        """
+        found = {s.key: self.lookup(s.key) for s in plan.segments}
+        reused = sum(1 for v in found.values() if v)
+        if not reused:
+            return None
+        spans: List[List[Segment]] = []
+        for s in plan.segments:
+            if found[s.key]:
+                continue
+            if spans and spans[-1][-1].index == s.index - 1:
+                spans[-1].append(s)
+            else:
+                spans.append([s])
+        to_render = sum(s.frames for span in spans for s in span)
+        if on_plan:
+            on_plan(to_render, reused)
+        work = self.work_dir()
+        try:
+            for span in spans:
+                a, b = span[0].start, span[-1].end
+                tag = f"{span[0].index}-{span[-1].index}"
+                span_audio = os.path.join(work, f"span_{tag}.wav")
+                span_video = os.path.join(work, f"span_{tag}.mp4")
+                cut_audio(audio_path, a / plan.fps, b / plan.fps if b < plan.total_frames else None, span_audio)
+                cut_video(video_path, source_runs(a, b, plan.source_frames, plan.frame_map), plan.fps, span_video)
+                rendered = render_span(span_audio, span_video, [s.start - a for s in span[1:]])
+                try:
+                    parts = split_video(rendered, [s.frames for s in span], os.path.join(work, tag))
+                finally:
+                    try:
+                        os.remove(rendered)
+                    except OSError:
+                        pass
+                for seg, (p, n) in zip(span, parts):
+                    found[seg.key] = (self.put(seg.key, p, n), n)
+            concat_segments([found[s.key][0] for s in plan.segments], audio_path, out_path)
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+        self.evict()
+        self.rendered_frames += to_render
+        self.reused_frames += plan.total_frames - to_render
+        logger.info(f"[SegmentCache] 增量渲染: 复用 {reused}/{len(plan.segments)} 段, "
+                    f"渲染 {to_render}/{plan.total_frames} 帧")
+        return {"segments": len(plan.segments), "reused": reused,
+                "rendered_frames": to_render, "total_frames": plan.total_frames}
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM segments").fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": entries,
+            "bytes": total,
+            "byte_budget": self.byte_budget,
+            "rendered_frames": self.rendered_frames,
+            "reused_frames": self.reused_frames,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# 自检：桩引擎（逐帧复制输入视频，经 FfmpegFrameSink 编码）渲染三句口播，改最后一句后只重渲染最后一段
+if __name__ == "__main__":
+    import wave
+
+    import cv2
+    import numpy as np
+
+    from frame_sink import FfmpegFrameSink
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    FPS = 25
+    rendered = []
+
+    def make_audio(path, sentences):
+        """每句一段正弦（频率, 秒），句间 0.6 秒静音"""
+        chunks = []
+        for freq, dur in sentences:
+            t = np.arange(int(dur * SAMPLE_RATE)) / SAMPLE_RATE
+            chunks += [0.3 * np.sin(2 * np.pi * freq * t), np.zeros(int(0.6 * SAMPLE_RATE))]
+        pcm = (np.concatenate(chunks[:-1]) * 32767).astype(np.int16)
+        with wave.open(path, "wb") as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(SAMPLE_RATE)
+            w.writeframes(pcm.tobytes())
+
+    def stub_engine(audio, video, keyframes, out_path):
+        """桩引擎：输出帧数 = 音频时长 × fps，取输入视频对应帧（不足时停在最后一帧）"""
+        n_out = int(len(decode_pcm(audio)) // 2 / SAMPLE_RATE * FPS)
+        cap = cv2.VideoCapture(video)
+        sink = FfmpegFrameSink(out_path, 320, 240, FPS, audio_path=audio, preset="ultrafast",
+                               keyframes=keyframes)
+        img = None
+        for _ in range(n_out):
+            ok, frame = cap.read()
+            img = frame if ok else img
+            sink.write(img)
+        cap.release()
+        sink.close()
+        rendered.append(n_out)
+        return out_path
+
+    with tempfile.TemporaryDirectory() as d:
+        video = os.path.join(d, "src.mp4")
+        _ffmpeg(["-f", "lavfi", "-i", f"testsrc=size=320x240:rate={FPS}:duration=6",
+                 "-c:v", "libx264", "-pix_fmt", "yuv420p", video], "生成测试视频")
+        v1, v2 = os.path.join(d, "v1.wav"), os.path.join(d, "v2.wav")
+        make_audio(v1, [(300, 2.0), (500, 2.2), (700, 2.0)])
+        make_audio(v2, [(300, 2.0), (500, 2.2), (900, 2.6)])  # 只改最后一句（内容 + 时长）
+        ok = True
+        for frame_map in ("loop", "pingpong"):
+            cache = SegmentCache(os.path.join(d, f"segments_{frame_map}"))
+            plan1 = plan_segments(v1, "src", FPS, 150, frame_map=frame_map)
+            plan2 = plan_segments(v2, "src", FPS, 150, frame_map=frame_map)
+            print(f"[{frame_map}] v1 分段 {[(s.start, s.end) for s in plan1.segments]}, "
+                  f"v2 分段 {[(s.start, s.end) for s in plan2.segments]}")
+            # 第一次：无可复用段 → 完整渲染（段边界强制关键帧）后切分入缓存
+            out1 = os.path.join(d, f"{frame_map}_full.mp4")
+            src1 = os.path.join(d, f"{frame_map}_src1.mp4")
+            cut_video(video, source_runs(0, plan1.total_frames, 150, frame_map), FPS, src1)
+            assert cache.render_incremental(plan1, v1, video, out1, None) is None
+            stub_engine(v1, src1, plan1.keyframes, out1)
+            cache.store_render(plan1, out1)
+            # 第二次：改最后一句 → 只渲染最后一段
+            rendered.clear()
+            out2 = os.path.join(d, f"{frame_map}_inc.mp4")
+            res = cache.render_incremental(
+                plan2, v2, video, out2,
+                lambda a, v, kf: stub_engine(a, v, kf, os.path.join(d, f"span_{uuid.uuid4().hex}.mp4")))
+            last = plan2.segments[-1]
+            case_ok = (res["rendered_frames"] == sum(rendered) == last.frames
+                       and res["reused"] == len(plan2.segments) - 1
+                       and abs(count_frames(out2) - plan2.total_frames) <= 2)
+            # 第三次：v1 再提交（结果缓存被淘汰的情况）→ 全部命中，只拼接
+            rendered.clear()
+            res3 = cache.render_incremental(plan1, v1, video, os.path.join(d, f"{frame_map}_v1.mp4"), None)
+            case_ok = case_ok and res3["rendered_frames"] == 0 and not rendered
+            print(f"[{frame_map}] 改最后一句: 渲染 {res['rendered_frames']}/{res['total_frames']} 帧 "
+                  f"(复用 {res['reused']}/{res['segments']} 段, 输出 {count_frames(out2)} 帧); "
+                  f"原稿重提交: 渲染 {res3['rendered_frames']} 帧 -> {'OK' if case_ok else 'FAIL'}")
+            ok = ok and case_ok
+            print(f"[{frame_map}] 统计: {cache.stats()}")
+            cache.close()
+        print("自检通过" if ok else "自检失败")
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+GPU 任务调度器
+==============
+替代 run_server.py 中写死 MAX_CONCURRENT=1 的 semaphore + ThreadPoolExecutor：
+  1. 可配置数量的引擎 worker，每个 worker 绑定一个设备槽位（GPU 编号）
+  2. 两级优先级队列：interactive（客户端实时提交）总是先于 batch（批量任务）
+  3. 同一优先级内按客户端（license_key）轮转出队，单个客户端的批量任务不会饿死其他人
+  4. 准入控制：按预估帧数限制排队总量，超出时抛 AdmissionError（调用方返回 429）
+
+本模块不依赖 GPU / 推理引擎，可直接用 stub 引擎在 CPU 上验证：
+  python task_scheduler.py
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BATCH = "batch"
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_BATCH)  # 出队顺序
+
+
+class AdmissionError(RuntimeError):
+    """排队已满（总帧数或单客户端任务数超限），拒绝接收新任务"""
+
+
+class Job:
+    """一个排队中的合成任务"""
+
+    __slots__ = ("task_id", "client", "priority", "est_frames", "args", "kwargs", "submitted_at")
+
+    def __init__(self, task_id, client, priority, est_frames, args, kwargs):
+        self.task_id = task_id
+        self.client = client
+        self.priority = priority
+        self.est_frames = est_frames
+        self.args = args
+        self.kwargs = kwargs
+        self.submitted_at = time.time()
+
+
+class EngineWorker:
+    """引擎 worker：一个线程 + 一个绑定到固定设备槽位的引擎实例"""
+
+    def __init__(self, index: int, device: str):
+        self.index = index
+        self.device = device
+        self.engine = None
+        self.current_task: str = ""
+        self.processed = 0
+        self.thread: Optional[threading.Thread] = None
+
+    def info(self) -> dict:
+        return {
+            "index": self.index,
+            "device": self.device,
+            "busy": bool(self.current_task),
+            "task_id": self.current_task,
+            "processed": self.processed,
+        }
+
+
+class TaskScheduler:
+    """多 worker 任务调度器"""
+
+    def __init__(
+        self,
+        run_fn: Callable[[Job, EngineWorker], None],
+        devices: List[str],
+        engine_factory: Optional[Callable[[str], object]] = None,
+        max_queued_frames: int = 0,
+        max_queued_per_client: int = 0,
+    ):
+        """
+        Args:
+            run_fn: 执行任务的函数，参数为 (job, worker)，引擎实例通过 worker.engine 获取
+            devices: 每个 worker 绑定的设备槽位，长度即 worker 数（同一 GPU 可出现多次）
+            engine_factory: 按设备槽位创建引擎实例，None 表示 worker 不持有引擎
+            max_queued_frames: 排队任务预估帧数总和上限，0 表示不限制
+            max_queued_per_client: 单个客户端排队任务数上限，0 表示不限制
+        """
+        if not devices:
+            raise ValueError("devices 不能为空")
+        self.run_fn = run_fn
+        self.engine_factory = engine_factory
+        self.max_queued_frames = max_queued_frames
+        self.max_queued_per_client = max_queued_per_client
+        self.workers = [EngineWorker(i, str(d)) for i, d in enumerate(devices)]
+
+        # priority -> OrderedDict(client -> deque[Job])，OrderedDict 的顺序即轮转顺序
+        self._queues: Dict[str, "OrderedDict[str, deque]"] = {p: OrderedDict() for p in PRIORITIES}
+        self._jobs: Dict[str, Job] = {}
+        self._queued_frames = 0
+        self._cond = threading.Condition()
+        self._running = False
+
+    # ── 生命周期 ──
+
+    def start(self):
+        """创建各 worker 的引擎并启动 worker 线程（引擎初始化按顺序执行）"""
+        if self._running:
+            return
+        for w in self.workers:
+            if self.engine_factory is not None:
+                logger.info(f"[Scheduler] 初始化引擎: worker={w.index} device={w.device}")
+                w.engine = self.engine_factory(w.device)
+        self._running = True
+        for w in self.workers:
+            w.thread = threading.Thread(target=self._worker_loop, args=(w,),
+                                        name=f"engine-worker-{w.index}", daemon=True)
+            w.thread.start()
+        logger.info(f"[Scheduler] 已启动 {len(self.workers)} 个 worker: "
+                    f"{[w.device for w in self.workers]}")
+
+    def stop(self, wait: bool = True, timeout: Optional[float] = None):
+        """停止调度；正在执行的任务会跑完，排队中的任务保留在队列里"""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if wait:
+            for w in self.workers:
+                if w.thread:
+                    w.thread.join(timeout=timeout)
+
+    # ── 入队 / 出队 ──
+
+    def submit(self, task_id: str, *args, client: str = "", priority: str = PRIORITY_INTERACTIVE,
+               est_frames: int = 0, **kwargs) -> int:
+        """提交任务，返回当前排队位置（从 1 开始）
+
+        Raises:
+            AdmissionError: 超过准入上限
+        """
+        if priority not in PRIORITIES:
+            priority = PRIORITY_INTERACTIVE
+        est_frames = max(0, int(est_frames or 0))
+        with self._cond:
+            if task_id in self._jobs:
+                raise ValueError(f"任务已在队列中: {task_id}")
+            if (self.max_queued_frames > 0 and self._queued_frames > 0
+                    and self._queued_frames + est_frames > self.max_queued_frames):
+                raise AdmissionError(
+                    f"排队帧数已达上限 ({self._queued_frames}+{est_frames} > {self.max_queued_frames})")
+            if self.max_queued_per_client > 0:
+                n = len(self._queues[PRIORITY_INTERACTIVE].get(client, ())) + \
+                    len(self._queues[PRIORITY_BATCH].get(client, ()))
+                if n >= self.max_queued_per_client:
+                    raise AdmissionError(f"客户端排队任务数已达上限 ({n})")
+
+            job = Job(task_id, client, priority, est_frames, args, kwargs)
+            self._queues[priority].setdefault(client, deque()).append(job)
+            self._jobs[task_id] = job
+            self._queued_frames += est_frames
+            self._cond.notify()
+            return self._position_locked(job)
+
+    def cancel(self, task_id: str) -> bool:
+        """取消排队中的任务（已开始执行的任务无法取消）"""
+        with self._cond:
+            job = self._jobs.pop(task_id, None)
+            if job is None:
+                return False
+            clients = self._queues[job.priority]
+            q = clients.get(job.client)
+            if q is not None:
+                try:
+                    q.remove(job)
+                except ValueError:
+                    pass
+                if not q:
+                    del clients[job.client]
+            self._queued_frames -= job.est_frames
+            return True
+
+    def _pop_next_locked(self) -> Optional[Job]:
+        for priority in PRIORITIES:
+            clients = self._queues[priority]
+            if not clients:
+                continue
+            client, q = next(iter(clients.items()))
+            job = q.popleft()
+            if q:
+                clients.move_to_end(client)  # 轮转：该客户端排到本优先级末尾
+            else:
+                del clients[client]
+            self._jobs.pop(job.task_id, None)
+            self._queued_frames -= job.est_frames
+            return job
+        return None
+
+    def _worker_loop(self, worker: EngineWorker):
+        while True:
+            with self._cond:
+                job = None
+                while self._running:
+                    job = self._pop_next_locked()
+                    if job is not None:
+                        break
+                    self._cond.wait()
+                if job is None:
+                    return
+                worker.current_task = job.task_id
+            try:
+                self.run_fn(job, worker)
+            except Exception as e:
+                logger.error(f"[Scheduler] worker={worker.index} 任务异常: {job.task_id} ({e})",
+                             exc_info=True)
+            finally:
+                with self._cond:
+                    worker.current_task = ""
+                    worker.processed += 1
+
+    # ── 查询 ──
+
+    def _position_locked(self, job: Job) -> int:
+        """按出队规则推算任务前面还有多少个任务（不考虑之后新提交的任务）"""
+        ahead = 0
+        for priority in PRIORITIES:
+            clients = self._queues[priority]
+            if priority != job.priority:
+                ahead += sum(len(q) for q in clients.values())
+                continue
+            own = clients.get(job.client)
+            k = own.index(job) if own else 0
+            before = True
+            for client, q in clients.items():
+                if client == job.client:
+                    before = False
+                    continue
+                # 轮转：排在本客户端之前的客户端，每轮先出队
+                ahead += min(len(q), k + 1 if before else k)
+            ahead += k
+            break
+        return ahead + 1
+
+    def position(self, task_id: str) -> int:
+        """任务的排队位置（从 1 开始），不在队列中返回 0"""
+        with self._cond:
+            job = self._jobs.get(task_id)
+            return self._position_locked(job) if job else 0
+
+    def is_queued(self, task_id: str) -> bool:
+        with self._cond:
+            return task_id in self._jobs
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "workers": [w.info() for w in self.workers],
+                "busy": sum(1 for w in self.workers if w.current_task),
+                "queued": len(self._jobs),
+                "queued_frames": self._queued_frames,
+                "queued_by_priority": {
+                    p: sum(len(q) for q in self._queues[p].values()) for p in PRIORITIES
+                },
+            }
+
+
+def parse_devices(devices: str, workers: int) -> List[str]:
+    """把 config.ini 中的 devices（如 "0,1,2,3"）展开为 worker 数量个设备槽位
+
+    worker 多于设备时按轮转复用设备（大显存卡上跑多个 worker）。
+    """
+    slots = [d.strip() for d in (devices or "").split(",") if d.strip()] or ["0"]
+    workers = max(1, int(workers or 1))
+    return [slots[i % len(slots)] for i in range(workers)]
+
+
+# 示例用法：stub 引擎在 CPU 上验证并发、优先级和公平性
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+    class StubTransDhTask:
+        """模拟 TransDhTask：耗时与输入帧数成正比"""
+
+        def __init__(self, device, sec_per_frame=0.001):
+            self.device = device
+            self.sec_per_frame = sec_per_frame
+            self.task_dic = {}
+
+        def work(self, frames, work_id):
+            time.sleep(frames * self.sec_per_frame)
+            self.task_dic[work_id] = ("success", 100, f"/tmp/{work_id}-r.mp4")
+
+    order = []
+    order_lock = threading.Lock()
+
+    def run(job, worker):
+        worker.engine.work(job.est_frames, job.task_id)
+        with order_lock:
+            order.append((job.task_id, worker.device))
+
+    for n_workers in (1, 4):
+        order.clear()
+        sch = TaskScheduler(run, parse_devices("0,1,2,3", n_workers), engine_factory=StubTransDhTask,
+                            max_queued_frames=20000)
+        for i in range(12):
+            sch.submit(f"batch-a{i}", client="A", priority=PRIORITY_BATCH, est_frames=250)
+        for i in range(4):
+            sch.submit(f"batch-b{i}", client="B", priority=PRIORITY_BATCH, est_frames=250)
+        sch.submit("live-c0", client="C", est_frames=250)
+        print(f"workers={n_workers} 排队位置: live-c0={sch.position('live-c0')} "
+              f"batch-b0={sch.position('batch-b0')} batch-a11={sch.position('batch-a11')}")
+        t0 = time.time()
+        sch.start()
+        while sch.stats()["queued"] or sch.stats()["busy"]:
+            time.sleep(0.01)
+        sch.stop()
+        print(f"workers={n_workers} 耗时 {time.time() - t0:.2f}s, 前 6 个出队: {[t for t, _ in order[:6]]}")
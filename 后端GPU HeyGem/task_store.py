@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+合成任务持久化日志（SQLite WAL）
+================================
+run_server.py 的 _tasks 只在内存里，服务崩溃/重启后整个队列丢失，轮询进度的客户端全部 404。
+本模块把任务的每次状态变化（提交 / 开始 / 进度 / 完成 / 失败）写入 tasks.db（与 assets.db 同目录）：
+  1. 启动时 load() 恢复全部任务记录，未完成的任务由调用方重新入队
+  2. 状态变化立即落盘；纯进度更新按 progress_interval 节流，避免每帧写库
+  3. queue_position() 走 (status, priority_rank, seq) 索引做 COUNT，不再遍历全部任务
+
+基准测试（1 万个排队任务）：
+  python task_store.py
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+# 独立成列的任务字段；其余字段（_work_id / _cache_key / _license_key 等内部字段）存入 extra JSON
+_COLUMNS = (
+    "status", "progress", "total_frames", "current_frame", "message",
+    "audio_name", "video_name", "result_path", "error",
+    "created_at", "started_at", "finished_at",
+    "audio_path", "video_path", "client", "priority",
+)
+_TERMINAL = ("done", "error")
+# 优先级越小越先出队（与 task_scheduler.PRIORITIES 顺序一致）
+_PRIORITY_RANK = {"interactive": 0, "batch": 1}
+
+
+class TaskStore:
+    """任务日志：单连接 + 自有锁（与资产库的 _db_lock 互不影响）"""
+
+    def __init__(self, db_path: str, progress_interval: float = 2.0):
+        """
+        Args:
+            db_path: SQLite 文件路径
+            progress_interval: 同一任务纯进度更新的最小落盘间隔（秒），状态变化不受限制
+        """
+        self.db_path = db_path
+        self.progress_interval = progress_interval
+        self._lock = threading.Lock()
+        self._last_write: Dict[str, float] = {}
+        self._pending: Dict[str, dict] = {}  # 被节流的进度字段，下次落盘时合并写入
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+        CREATE TABLE IF NOT EXISTS tasks (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            task_id TEXT NOT NULL UNIQUE,
+            status TEXT NOT NULL,
+            priority TEXT NOT NULL DEFAULT 'interactive',
+            priority_rank INTEGER NOT NULL DEFAULT 0,
+            client TEXT NOT NULL DEFAULT '',
+            progress INTEGER DEFAULT 0,
+            total_frames INTEGER DEFAULT 0,
+            current_frame INTEGER DEFAULT 0,
+            message TEXT DEFAULT '',
+            audio_name TEXT DEFAULT '',
+            video_name TEXT DEFAULT '',
+            audio_path TEXT DEFAULT '',
+            video_path TEXT DEFAULT '',
+            result_path TEXT DEFAULT '',
+            error TEXT DEFAULT '',
+            extra TEXT DEFAULT '{}',
+            created_at REAL NOT NULL,
+            started_at REAL DEFAULT 0,
+            finished_at REAL DEFAULT 0,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_tasks_queue ON tasks(status, priority_rank, seq);
+        CREATE INDEX IF NOT EXISTS idx_tasks_finished ON tasks(finished_at);
+        """)
+        logger.info(f"[TaskStore] 任务日志就绪: {db_path}")
+
+    @staticmethod
+    def _split(fields: dict):
+        cols, extra = {}, {}
+        for k, v in fields.items():
+            if k in _COLUMNS:
+                cols[k] = v
+            elif k != "task_id":
+                extra[k] = v
+        if "priority" in cols:
+            cols["priority_rank"] = _PRIORITY_RANK.get(cols["priority"], 0)
+        return cols, extra
+
+    # ── 写入 ──
+
+    def put(self, task: dict, **fields):
+        """登记（或覆盖）一条完整任务记录：提交、缓存命中时调用"""
+        data = dict(task)
+        data.update(fields)
+        task_id = data["task_id"]
+        cols, extra = self._split(data)
+        cols.setdefault("created_at", time.time())
+        cols["extra"] = json.dumps(extra, ensure_ascii=False)
+        cols["updated_at"] = time.time()
+        names = ["task_id"] + list(cols)
+        sql = (f"INSERT INTO tasks ({', '.join(names)}) VALUES ({', '.join('?' * len(names))}) "
+               f"ON CONFLICT(task_id) DO UPDATE SET "
+               + ", ".join(f"{n}=excluded.{n}" for n in cols))
+        with self._lock:
+            self._conn.execute(sql, [task_id] + list(cols.values()))
+            self._last_write[task_id] = time.time()
+            self._pending.pop(task_id, None)
+
+    def update(self, task_id: str, **fields):
+        """记录一次状态/进度变化；不含 status 的纯进度更新按 progress_interval 节流"""
+        if not fields:
+            return
+        now = time.time()
+        with self._lock:
+            if "status" not in fields and now - self._last_write.get(task_id, 0) < self.progress_interval:
+                self._pending.setdefault(task_id, {}).update(fields)
+                return
+            merged = self._pending.pop(task_id, {})
+            merged.update(fields)
+            cols, extra = self._split(merged)
+            cols["updated_at"] = now
+            sets = [f"{k}=?" for k in cols]
+            params = list(cols.values())
+            if extra:
+                row = self._conn.execute("SELECT extra FROM tasks WHERE task_id=?", (task_id,)).fetchone()
+                if row is None:
+                    return
+                cur = json.loads(row["extra"] or "{}")
+                cur.update(extra)
+                sets.append("extra=?")
+                params.append(json.dumps(cur, ensure_ascii=False))
+            self._conn.execute(f"UPDATE tasks SET {', '.join(sets)} WHERE task_id=?", params + [task_id])
+            self._last_write[task_id] = now
+            if fields.get("status") in _TERMINAL:
+                self._last_write.pop(task_id, None)
+
+    def delete(self, task_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM tasks WHERE task_id=?", (task_id,))
+            self._last_write.pop(task_id, None)
+            self._pending.pop(task_id, None)
+
+    def purge_finished(self, before_ts: float) -> int:
+        """删除 before_ts 之前结束的任务记录，返回删除条数"""
+        with self._lock:
+            cur = self._conn.execute(
+                "DELETE FROM tasks WHERE status IN ('done', 'error') AND finished_at>0 AND finished_at<?",
+                (before_ts,))
+            return cur.rowcount
+
+    # ── 查询 ──
+
+    def queue_position(self, task_id: str) -> int:
+        """排队位置（从 1 开始），不在排队中返回 0
+
+        按 (优先级, 提交顺序) 走索引计数；调度器同优先级内的客户端轮转不计入，结果为近似值。
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT status, priority_rank, seq FROM tasks WHERE task_id=?", (task_id,)).fetchone()
+            if row is None or row["status"] != "queued":
+                return 0
+            n = self._conn.execute(
+                "SELECT (SELECT COUNT(*) FROM tasks WHERE status='queued' AND priority_rank<?) + "
+                "(SELECT COUNT(*) FROM tasks WHERE status='queued' AND priority_rank=? AND seq<?)",
+                (row["priority_rank"], row["priority_rank"], row["seq"])).fetchone()[0]
+            return n + 1
+
+    def active_paths(self, paths) -> set:
+        """paths 中仍被未结束任务（排队 / 处理中）用作输入的路径"""
+        paths = list(paths)
+        if not paths:
+            return set()
+        marks = ", ".join("?" * len(paths))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT audio_path, video_path FROM tasks WHERE status NOT IN ('done', 'error') "
+                f"AND (audio_path IN ({marks}) OR video_path IN ({marks}))", paths + paths).fetchall()
+        wanted = set(paths)
+        return {p for r in rows for p in (r["audio_path"], r["video_path"]) if p in wanted}
+
+    def load(self) -> List[dict]:
+        """按提交顺序读出全部任务记录（启动时恢复 _tasks 用）"""
+        with self._lock:
+            rows = self._conn.execute("SELECT * FROM tasks ORDER BY seq").fetchall()
+        tasks = []
+        for r in rows:
+            t = {"task_id": r["task_id"]}
+            for k in _COLUMNS:
+                t[k] = r[k]
+            try:
+                t.update(json.loads(r["extra"] or "{}"))
+            except ValueError:
+                pass
+            tasks.append(t)
+        return tasks
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# 基准测试：1 万个排队任务的提交、进度写入、排队位置查询与启动恢复耗时
+if __name__ == "__main__":
+    import tempfile
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    N = 10000
+    with tempfile.TemporaryDirectory() as d:
+        store = TaskStore(os.path.join(d, "tasks.db"))
+
+        t0 = time.perf_counter()
+        for i in range(N):
+            store.put({"task_id": f"t{i:05d}", "status": "queued", "created_at": time.time()},
+                      priority="batch" if i % 3 else "interactive", client=f"c{i % 50}",
+                      audio_path=f"/store/a{i}.wav", video_path=f"/store/v{i}.mp4", _cache_key=f"k{i}")
+        t_submit = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        for i in range(1000):
+            store.update(f"t{i:05d}", current_frame=i, progress=50)
+        t_progress = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        for i in range(0, N, 10):
+            store.queue_position(f"t{i:05d}")
+        t_pos = (time.perf_counter() - t0) / (N // 10)
+
+        for i in range(N // 2):
+            store.update(f"t{i:05d}", status="done", progress=100, finished_at=time.time())
+
+        t0 = time.perf_counter()
+        loaded = store.load()
+        t_load = time.perf_counter() - t0
+        store.close()
+
+    print(f"提交 {N} 个任务: {t_submit:.2f}s ({N / t_submit:.0f} 个/秒)")
+    print(f"1000 次进度更新（节流后）: {t_progress * 1000:.1f}ms")
+    print(f"queue_position 平均: {t_pos * 1e6:.0f}µs")
+    print(f"启动恢复 load() {len(loaded)} 条: {t_load * 1000:.0f}ms")
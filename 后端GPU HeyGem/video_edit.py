@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+视频后期编辑（单次编码 filter_complex + 有界任务队列）
+===================================================
+原 /api/video/edit 在 Flask 请求线程里同步执行 ffmpeg，multi 模式按 字幕 → 画中画 → BGM
+逐步生成 step1.mp4 / step2.mp4：每一步都完整解码 + 重新编码一次，长视频占住请求线程，
+画质随步数逐代下降。
+
+本模块：
+  1. 编辑请求是一个有序操作列表（subtitle / overlay / scale / bgm），compile_ops() 把它编译成
+     一张 filter_complex 图：视频链依次接 ass / scale / overlay，音频链接 volume + amix，
+     一次解码、一次编码；没有视频操作时视频流直接 copy，没有音频操作时音频流直接 copy
+  2. run_edit() 执行 ffmpeg（参数列表，不经 shell），解析 -progress 输出回报进度；
+     ASS 字幕烧录失败时回退 SRT + subtitles 滤镜重试一次
+  3. EditQueue：固定数量 worker + 排队上限，超出时抛 AdmissionError（调用方返回 429）
+
+一致性测试（单次编码 vs 逐步编码：帧数、音视频时长；需要 ffmpeg）：
+  python video_edit.py
+"""
+
+import json
+import logging
+import os
+import subprocess
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+from task_scheduler import AdmissionError
+
+logger = logging.getLogger(__name__)
+
+OP_TYPES = ("subtitle", "overlay", "scale", "bgm")
+
+# 与原 _edit_subtitle / _edit_pip 相同的输出编码参数
+VIDEO_CODEC_ARGS = ["-c:v", "libx264", "-profile:v", "baseline", "-level", "3.1", "-pix_fmt", "yuv420p"]
+
+PIP_POSITIONS = {
+    "top-left": "10:10",
+    "top-right": "main_w-overlay_w-10:10",
+    "bottom-left": "10:main_h-overlay_h-10",
+    "bottom-right": "main_w-overlay_w-10:main_h-overlay_h-10",
+}
+
+
+class EditError(RuntimeError):
+    """ffmpeg 执行失败"""
+
+
+# ── 操作列表 ──
+
+def normalize_ops(ops: List[dict]) -> List[dict]:
+    """校验并补全操作参数（非法时抛 ValueError）；无内容的字幕操作被丢弃"""
+    if not isinstance(ops, list):
+        raise ValueError("operations 必须是列表")
+    out = []
+    for i, op in enumerate(ops):
+        if not isinstance(op, dict):
+            raise ValueError(f"第 {i + 1} 个操作不是对象")
+        kind = op.get("type", "")
+        if kind == "pip":
+            kind = "overlay"
+        if kind not in OP_TYPES:
+            raise ValueError(f"不支持的操作类型: {kind}")
+        op = dict(op, type=kind)
+        if kind == "subtitle":
+            op["text"] = str(op.get("text", "")).strip()
+            op["title_text"] = str(op.get("title_text", "")).strip()
+            op["style"] = op.get("style") if isinstance(op.get("style"), dict) else {}
+            if not op["text"] and not op["title_text"]:
+                continue
+        elif kind == "overlay":
+            if not op.get("path"):
+                raise ValueError("overlay 缺少视频")
+            op["scale"] = float(op.get("scale", 0.3))
+            if op.get("position") not in PIP_POSITIONS:
+                op["position"] = "bottom-right"
+        elif kind == "scale":
+            op["width"] = int(op.get("width", -2))
+            op["height"] = int(op.get("height", -2))
+            if op["width"] == -2 and op["height"] == -2:
+                raise ValueError("scale 需要 width 或 height")
+        elif kind == "bgm":
+            if not op.get("path"):
+                raise ValueError("bgm 缺少音频")
+            op["volume"] = float(op.get("volume", 0.15))
+        out.append(op)
+    return out
+
+
+# ── 字幕文件 ──
+
+def split_title_two_lines(title: str) -> list:
+    """将标题按标点或中点拆成两行"""
+    split_chars = ['·', '|', '—', '，', ',', '：', ':', '、']
+    for ch in split_chars:
+        if ch in title:
+            parts = title.split(ch, 1)
+            return [p.strip() for p in parts if p.strip()]
+    # 没有标点，按长度对半分
+    mid = len(title) // 2
+    return [title[:mid].strip(), title[mid:].strip()] if len(title) > 6 else [title]
+
+
+def ass_time(seconds):
+    """格式化为 ASS 时间 H:MM:SS.cc"""
+    h = int(seconds // 3600)
+    m = int((seconds % 3600) // 60)
+    s = int(seconds % 60)
+    cs = int((seconds - int(seconds)) * 100)
+    return f"{h}:{m:02d}:{s:02d}.{cs:02d}"
+
+
+def srt_time(seconds):
+    h = int(seconds // 3600)
+    m = int((seconds % 3600) // 60)
+    s = int(seconds % 60)
+    ms = int((seconds - int(seconds)) * 1000)
+    return f"{h:02d}:{m:02d}:{s:02d},{ms:03d}"
+
+
+def write_ass(path: str, text: str, title_text: str, style: dict, duration: float):
+    """ASS 字幕文件：title_text 顶部两行标题 + text 底部字幕（按行均分时长）"""
+    fontsize = style.get("fontsize", 24)
+    borderw = style.get("borderw", 2)
+    title_fontsize = style.get("title_fontsize", 36)
+    title_duration = float(style.get("title_duration", min(5.0, duration)))
+
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("[Script Info]\nScriptType: v4.00+\nPlayResX: 1920\nPlayResY: 1080\n\n")
+        f.write("[V4+ Styles]\nFormat: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, "
+                "OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, "
+                "Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding\n")
+        # 标题样式：顶部居中，大字
+        f.write(f"Style: Title,Arial,{title_fontsize},&H00FFFFFF,&H000000FF,&H00000000,&H80000000,"
+                f"1,0,0,0,100,100,0,0,1,3,1,8,20,20,30,1\n")
+        # 正文字幕样式：底部居中
+        f.write(f"Style: Sub,Arial,{fontsize},&H00FFFFFF,&H000000FF,&H00000000,&H80000000,"
+                f"0,0,0,0,100,100,0,0,3,{borderw},0,2,20,20,40,1\n")
+        f.write("\n[Events]\n")
+        f.write("Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n")
+
+        if title_text:
+            title_display = "\\N".join(split_title_two_lines(title_text))  # ASS 换行符
+            f.write(f"Dialogue: 1,{ass_time(0)},{ass_time(title_duration)},Title,,0,0,0,,{title_display}\n")
+
+        if text:
+            lines = [l.strip() for l in text.split("\n") if l.strip()] or [text]
+            seg_dur = duration / len(lines)
+            for i, line in enumerate(lines):
+                start = i * seg_dur
+                end = min((i + 1) * seg_dur, duration)
+                f.write(f"Dialogue: 0,{ass_time(start)},{ass_time(end)},Sub,,0,0,0,,{line}\n")
+
+
+def write_srt(path: str, text: str, duration: float):
+    """ASS 烧录失败时的回退字幕（不支持标题样式）"""
+    lines = [l.strip() for l in text.split("\n") if l.strip()] or [text]
+    seg_dur = duration / len(lines)
+    with open(path, "w", encoding="utf-8") as f:
+        for i, line in enumerate(lines):
+            start = i * seg_dur
+            end = min((i + 1) * seg_dur, duration)
+            f.write(f"{i + 1}\n{srt_time(start)} --> {srt_time(end)}\n{line}\n\n")
+
+
+def _filter_path(path: str) -> str:
+    """滤镜参数中的文件路径（与原实现相同的转义）"""
+    return "'" + path.replace("\\", "/").replace(":", "\\:") + "'"
+
+
+# ── 探测 / 编译 / 执行 ──
+
+def probe_media(path: str) -> dict:
+    """时长与是否含音频 / 视频流（探测失败时按 30s、有音视频处理，与原实现一致）"""
+    info = {"duration": 30.0, "has_audio": True, "has_video": True}
+    try:
+        p = subprocess.run(
+            ["ffprobe", "-v", "quiet", "-print_format", "json",
+             "-show_entries", "format=duration:stream=codec_type", path],
+            capture_output=True, text=True, timeout=30)
+        data = json.loads(p.stdout or "{}")
+        kinds = {s.get("codec_type") for s in data.get("streams", [])}
+        if kinds:
+            info["has_audio"] = "audio" in kinds
+            info["has_video"] = "video" in kinds
+        info["duration"] = float(data.get("format", {}).get("duration", info["duration"]))
+    except Exception as e:
+        logger.warning(f"[VideoEdit] ffprobe 失败，按默认值处理: {path} ({e})")
+    return info
+
+
+def compile_ops(video_path: str, ops: List[dict], output_path: str, work_dir: str,
+                info: Optional[dict] = None, srt_fallback: bool = False) -> List[str]:
+    """把操作列表编译成一条 ffmpeg 命令（单个 filter_complex，一次编码）"""
+    info = info or probe_media(video_path)
+    duration = info["duration"]
+    inputs = ["-i", video_path]
+    n_inputs = 1
+    graph = []
+    v, a = "0:v", "0:a" if info["has_audio"] else ""
+    n = 0
+
+    for op in ops:
+        n += 1
+        kind = op["type"]
+        if kind == "subtitle":
+            if srt_fallback:
+                sub_path = os.path.join(work_dir, f"sub{n}.srt")
+                write_srt(sub_path, op["text"] or op["title_text"], duration)
+                fontsize = op["style"].get("fontsize", 24)
+                borderw = op["style"].get("borderw", 2)
+                graph.append(f"[{v}]subtitles={_filter_path(sub_path)}:force_style="
+                             f"'FontSize={fontsize},PrimaryColour=&Hffffff&,BorderStyle=3,Outline={borderw}'[v{n}]")
+            else:
+                sub_path = os.path.join(work_dir, f"sub{n}.ass")
+                write_ass(sub_path, op["text"], op["title_text"], op["style"], duration)
+                graph.append(f"[{v}]ass={_filter_path(sub_path)}[v{n}]")
+            v = f"v{n}"
+        elif kind == "scale":
+            graph.append(f"[{v}]scale={op['width']}:{op['height']}[v{n}]")
+            v = f"v{n}"
+        elif kind == "overlay":
+            inputs += ["-i", op["path"]]
+            s = op["scale"]
+            graph.append(f"[{n_inputs}:v]scale=iw*{s}:ih*{s}[pip{n}];"
+                         f"[{v}][pip{n}]overlay={PIP_POSITIONS[op['position']]}[v{n}]")
+            n_inputs += 1
+            v = f"v{n}"
+        elif kind == "bgm":
+            inputs += ["-i", op["path"]]
+            if a:
+                graph.append(f"[{a}]volume=1.0[a{n}m];[{n_inputs}:a]volume={op['volume']}[a{n}b];"
+                             f"[a{n}m][a{n}b]amix=inputs=2:duration=first:dropout_transition=2[a{n}]")
+            else:
+                # 主视频无音轨：BGM 直接作为音轨，时长截到视频长度
+                graph.append(f"[{n_inputs}:a]volume={op['volume']},atrim=0:{duration:.3f}[a{n}]")
+            n_inputs += 1
+            a = f"a{n}"
+
+    cmd = ["ffmpeg", "-y", "-hide_banner", "-nostats", "-progress", "pipe:1"] + inputs
+    if graph:
+        cmd += ["-filter_complex", ";".join(graph)]
+    video_filtered = v != "0:v"
+    audio_filtered = bool(a) and a != "0:a"
+    cmd += ["-map", f"[{v}]" if video_filtered else "0:v"]
+    if a:
+        cmd += ["-map", f"[{a}]" if audio_filtered else "0:a"]
+    cmd += VIDEO_CODEC_ARGS if video_filtered else ["-c:v", "copy"]
+    if a:
+        cmd += ["-c:a", "aac"] if audio_filtered else ["-c:a", "copy"]
+    cmd += ["-movflags", "+faststart", output_path]
+    return cmd
+
+
+def run_ffmpeg(cmd: List[str], duration: float, log_path: str,
+               on_progress: Optional[Callable[[float], None]] = None):
+    """执行 ffmpeg，按 -progress 输出的 out_time 回报 0~1 进度；失败抛 EditError"""
+    with open(log_path, "ab") as log:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=log, stdin=subprocess.DEVNULL)
+        last = -1.0
+        for raw in proc.stdout:
+            key, _, value = raw.decode("utf-8", "replace").strip().partition("=")
+            if key == "out_time_us" and on_progress and duration > 0:
+                try:
+                    pct = min(1.0, max(0.0, int(value) / 1e6 / duration))
+                except ValueError:
+                    continue
+                if pct - last >= 0.01:
+                    last = pct
+                    on_progress(pct)
+        rc = proc.wait()
+    if rc != 0:
+        with open(log_path, "rb") as f:
+            tail = f.read()[-800:].decode("utf-8", "replace")
+        raise EditError(f"ffmpeg 退出码 {rc}: {tail}")
+
+
+def run_edit(video_path: str, ops: List[dict], output_path: str, work_dir: str,
+             on_progress: Optional[Callable[[float], None]] = None) -> str:
+    """单次编码执行一组编辑操作，返回 output_path"""
+    info = probe_media(video_path)
+    log_path = os.path.join(work_dir, "ffmpeg.log")
+    cmd = compile_ops(video_path, ops, output_path, work_dir, info)
+    logger.info(f"[VideoEdit] {subprocess.list2cmdline(cmd)}")
+    try:
+        run_ffmpeg(cmd, info["duration"], log_path, on_progress)
+    except EditError:
+        if not any(op["type"] == "subtitle" for op in ops):
+            raise
+        logger.warning("[VideoEdit] ASS 字幕烧录失败，回退到 SRT")
+        cmd = compile_ops(video_path, ops, output_path, work_dir, info, srt_fallback=True)
+        run_ffmpeg(cmd, info["duration"], log_path, on_progress)
+    if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+        raise EditError("ffmpeg 未生成输出文件")
+    return output_path
+
+
+class EditQueue:
+    """编辑任务池：workers 个并发 ffmpeg，最多再排 max_pending 个"""
+
+    def __init__(self, workers: int = 2, max_pending: int = 16):
+        self.workers = max(1, workers)
+        self.max_pending = max(0, max_pending)
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="video-edit")
+        self._lock = threading.Lock()
+        self._outstanding = 0
+        self._running = 0
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        with self._lock:
+            if self._outstanding >= self.workers + self.max_pending:
+                raise AdmissionError(f"编辑任务排队已满 ({self._outstanding})")
+            self._outstanding += 1
+
+        def _run():
+            with self._lock:
+                self._running += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._outstanding -= 1
+
+        return self._pool.submit(_run)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"workers": self.workers, "running": self._running,
+                    "queued": self._outstanding - self._running, "max_pending": self.max_pending}
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+
+
+# 一致性测试：同一组操作逐步编码（原 multi 流程）与单次编码，比较帧数、音视频时长与耗时
+if __name__ == "__main__":
+    import re
+    import tempfile
+    import time
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+    def decoded(path, stream):
+        """完整解码一个流，返回 (帧数 / 音频包数, 时长秒)"""
+        p = subprocess.run(["ffmpeg", "-hide_banner", "-nostats", "-progress", "pipe:1", "-i", path,
+                            "-map", f"0:{stream}:0", "-f", "null", "-"], capture_output=True, text=True)
+        frames = re.findall(r"^frame=(\d+)", p.stdout, re.M)
+        times = re.findall(r"^out_time_us=(\d+)", p.stdout, re.M)
+        return (int(frames[-1]) if frames else 0), (int(times[-1]) / 1e6 if times else 0.0)
+
+    with tempfile.TemporaryDirectory() as d:
+        main = os.path.join(d, "main.mp4")
+        pip = os.path.join(d, "pip.mp4")
+        bgm = os.path.join(d, "bgm.wav")
+        subprocess.run(["ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", "testsrc=size=640x360:rate=25:d=8",
+                        "-f", "lavfi", "-i", "sine=f=300:d=8", "-c:v", "libx264", "-pix_fmt", "yuv420p",
+                        "-c:a", "aac", "-shortest", main], check=True)
+        subprocess.run(["ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", "testsrc2=size=320x240:rate=25:d=4",
+                        "-c:v", "libx264", "-pix_fmt", "yuv420p", pip], check=True)
+        subprocess.run(["ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", "sine=f=440:d=12", bgm], check=True)
+
+        cases = {
+            "subtitle": [{"type": "subtitle", "text": "第一行\n第二行", "title_text": "标题·副标题"}],
+            "bgm": [{"type": "bgm", "path": bgm, "volume": 0.2}],
+            "multi": [{"type": "subtitle", "text": "第一行\n第二行", "title_text": "标题·副标题"},
+                      {"type": "overlay", "path": pip, "position": "top-right", "scale": 0.5},
+                      {"type": "scale", "width": 480, "height": -2},
+                      {"type": "bgm", "path": bgm, "volume": 0.2}],
+        }
+        ref_v, ref_a = decoded(main, "v"), decoded(main, "a")
+        print(f"输入: 视频 {ref_v[0]} 帧 {ref_v[1]:.2f}s, 音频 {ref_a[1]:.2f}s")
+        for name, ops in cases.items():
+            ops = normalize_ops(ops)
+            work = os.path.join(d, name)
+            os.makedirs(work)
+
+            # 逐步编码：每个操作单独一次 ffmpeg（原 step1 → step2 → output 流程）
+            t0 = time.perf_counter()
+            current = main
+            for i, op in enumerate(ops):
+                step = os.path.join(work, f"step{i + 1}.mp4")
+                run_edit(current, [op], step, work)
+                current = step
+            t_multi = time.perf_counter() - t0
+
+            single = os.path.join(work, "single.mp4")
+            progress = []
+            t0 = time.perf_counter()
+            run_edit(main, ops, single, work, on_progress=progress.append)
+            t_single = time.perf_counter() - t0
+
+            mv, ma = decoded(current, "v"), decoded(current, "a")
+            sv, sa = decoded(single, "v"), decoded(single, "a")
+            same = mv[0] == sv[0] and abs(mv[1] - sv[1]) < 0.05 and abs(ma[1] - sa[1]) < 0.05
+            print(f"[{name}] 逐步 {len(ops)} 次编码 {t_multi:.2f}s: 视频 {mv[0]} 帧 {mv[1]:.2f}s 音频 {ma[1]:.2f}s | "
+                  f"单次编码 {t_single:.2f}s: 视频 {sv[0]} 帧 {sv[1]:.2f}s 音频 {sa[1]:.2f}s | "
+                  f"一致={same and sv[0] == ref_v[0]}, 进度回报 {len(progress)} 次 (末值 {progress[-1] if progress else 0:.2f})")
+
+        q = EditQueue(workers=1, max_pending=1)
+        gate = threading.Event()
+        futs = [q.submit(gate.wait), q.submit(gate.wait)]
+        try:
+            q.submit(gate.wait)
+            rejected = False
+        except AdmissionError:
+            rejected = True
+        print(f"队列: {q.stats()}, 第 3 个任务被拒绝={rejected}")
+        gate.set()
+        for fut in futs:
+            fut.result()
+        q.shutdown()
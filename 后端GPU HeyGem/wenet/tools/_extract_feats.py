@@ -263,8 +263,9 @@ def wav2mfcc_v2(wav_arr, sr=hparams['sample_rate'], n_mfcc=hparams['n_mfcc'],#
     from scipy.fftpack import dct
     wav_arr = preempahsis(wav_arr)
     #经过一次滤波
-    power_spec = spectrogram(wav_arr, n_fft=n_fft, hop_len=hop_len,
-                             win_len=win_len, window=window, center=center)['power']
+    spec = spectrogram(wav_arr, n_fft=n_fft, hop_len=hop_len,
+                       win_len=win_len, window=window, center=center)  # 只做一次 STFT
+    power_spec = spec['power']
     mel_spec = power_spec2mel(power_spec, sr=sr, n_fft=n_fft, num_mels=num_mels,
                               fmin=fmin, fmax=fmax)             # mel谱
     log_melspec = power2db(mel_spec, ref_db=ref_db)             #对数mel谱
@@ -276,8 +277,7 @@ def wav2mfcc_v2(wav_arr, sr=hparams['sample_rate'], n_mfcc=hparams['n_mfcc'],#
     # delta_deltas = librosa.feature.delta(mfcc, order=2)
     # mfcc_feature = np.concatenate((mfcc, deltas, delta_deltas), axis=0)
     # return mfcc_feature.T
-    x_stft = spectrogram(wav_arr, n_fft=n_fft, hop_len=hop_len,
-                             win_len=win_len, window=window, center=center)['stft']
+    x_stft = spec['stft']
     # print("log_melspec:", x_stft.shape)
     return log_melspec,x_stft
 
@@ -291,12 +291,12 @@ def wav2linear_v2(wav_arr, sr=hparams['sample_rate'], n_mfcc=hparams['n_mfcc'],
     from scipy.fftpack import dct
     wav_arr = preempahsis(wav_arr)
     # 经过一次滤波
-    power_spec = spectrogram(wav_arr, n_fft=n_fft, hop_len=hop_len,
-                             win_len=win_len, window=window, center=center)['power']
+    spec = spectrogram(wav_arr, n_fft=n_fft, hop_len=hop_len,
+                       win_len=win_len, window=window, center=center)  # 只做一次 STFT
+    power_spec = spec['power']
     linear = _amp_to_db(power_spec, ref_db=ref_db)  # 对数mel谱
     normalized_linear = _db_normalize(linear, min_db=hparams['min_db'])
-    x_stft = spectrogram(wav_arr, n_fft=n_fft, hop_len=hop_len,
-                             win_len=win_len, window=window, center=center)['stft']
+    x_stft = spec['stft']
 
 
     return normalized_linear,x_stft
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+音频特征提取与磁盘缓存
+======================
+wav2mfcc_v2 / wav2linear_v2 对同一段波形各自做预加重 + STFT；同一条 TTS 音频换不同数字人
+重复提交时，每个任务还要从头再算一遍。本模块：
+  1. extract_features：一次预加重、一次 STFT，同时得到 log-mel、归一化线性谱与复数 STFT
+  2. FeatureCache：按音频 MD5（文件内容或采样数组）+ 特征参数缓存到磁盘（每种特征一个 .npy，
+     读取时 mmap_mode='c'），按字节预算做 LRU 淘汰
+  3. install()：替换 _extract_feats.wav2mfcc_v2 / wav2linear_v2 为带缓存的版本（返回值不变），
+     引擎（compute_ctc_att_bnf）通过模块属性调用，无需改动编译模块
+
+基准测试与数值一致性检查：
+  python -m wenet.tools._feature_cache
+"""
+
+import functools
+import hashlib
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+import numpy as np
+
+from wenet.tools import _extract_feats as _ef
+
+logger = logging.getLogger(__name__)
+
+_KINDS = ("mel", "linear", "stft")
+
+
+def extract_features(wav_arr, sr=_ef.hparams['sample_rate'],
+                     n_fft=_ef.hparams['n_fft'], hop_len=_ef.hparams['hop_length'],
+                     win_len=_ef.hparams['win_length'], window=_ef.hparams['window'],
+                     num_mels=_ef.hparams['num_mels'], fmin=0.0, fmax=None,
+                     ref_db=_ef.hparams['ref_db'], center=_ef.hparams['center']) -> Dict[str, np.ndarray]:
+    """一次 STFT 同时得到 wav2mfcc_v2 与 wav2linear_v2 的全部输出
+
+    Returns:
+        {'mel': log_melspec [time, num_mels], 'linear': normalized_linear [time, 1+n_fft/2],
+         'stft': 复数 STFT [1+n_fft/2, time]}
+    """
+    wav_arr = _ef.preempahsis(wav_arr)
+    spec = _ef.spectrogram(wav_arr, n_fft=n_fft, hop_len=hop_len,
+                           win_len=win_len, window=window, center=center)
+    power_spec = spec['power']
+    mel_spec = _ef.power_spec2mel(power_spec, sr=sr, n_fft=n_fft, num_mels=num_mels,
+                                  fmin=fmin, fmax=fmax)
+    linear = _ef._amp_to_db(power_spec, ref_db=ref_db)
+    return {
+        'mel': _ef.power2db(mel_spec, ref_db=ref_db),
+        'linear': _ef._db_normalize(linear, min_db=_ef.hparams['min_db']),
+        'stft': spec['stft'],
+    }
+
+
+def audio_md5(wav) -> str:
+    """音频路径取文件内容 MD5，波形数组取 dtype + shape + 采样数据的 MD5"""
+    h = hashlib.md5()
+    if isinstance(wav, str):
+        with open(wav, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(chunk)
+    else:
+        arr = np.ascontiguousarray(wav)
+        h.update(f"{arr.dtype.str}{arr.shape}".encode())
+        h.update(arr.data)
+    return h.hexdigest()
+
+
+class FeatureCache:
+    """特征磁盘缓存：{cache_dir}/{audio_md5}_{params_hash}/{mel,linear,stft}.npy"""
+
+    def __init__(self, cache_dir: str, byte_budget: int = 0):
+        self.cache_dir = cache_dir
+        self.byte_budget = byte_budget
+        os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(md5: str, params: dict) -> str:
+        p = hashlib.md5(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:8]
+        return f"{md5}_{p}"
+
+    def load(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        path = os.path.join(self.cache_dir, key)
+        try:
+            feats = {k: np.load(os.path.join(path, f"{k}.npy"), mmap_mode='c') for k in _KINDS}
+        except (OSError, ValueError):
+            return None
+        try:
+            os.utime(path, None)  # LRU：目录 mtime 作为最近访问时间
+        except OSError:
+            pass
+        return feats
+
+    def save(self, key: str, feats: Dict[str, np.ndarray]):
+        path = os.path.join(self.cache_dir, key)
+        tmp = f"{path}.tmp{os.getpid()}_{threading.get_ident()}"
+        os.makedirs(tmp, exist_ok=True)
+        for k in _KINDS:
+            np.save(os.path.join(tmp, f"{k}.npy"), feats[k])
+        try:
+            os.replace(tmp, path)
+        except OSError:
+            # 其它进程已写入同一条目
+            for fn in os.listdir(tmp):
+                os.remove(os.path.join(tmp, fn))
+            os.rmdir(tmp)
+        self.evict()
+
+    def get_or_compute(self, wav_arr, md5: Optional[str] = None, **params) -> Dict[str, np.ndarray]:
+        key = self.make_key(md5 or audio_md5(wav_arr), params)
+        feats = self.load(key)
+        if feats is not None:
+            self.hits += 1
+            return feats
+        self.misses += 1
+        feats = extract_features(_ef.load_wav(wav_arr), **params)
+        try:
+            self.save(key, feats)
+        except OSError as e:
+            logger.warning(f"[FeatureCache] 写入缓存失败: {e}")
+        return feats
+
+    def evict(self) -> int:
+        """按目录 mtime 做 LRU，淘汰到字节预算以内"""
+        if self.byte_budget <= 0:
+            return 0
+        with self._lock:
+            entries, total = [], 0
+            for name in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, name)
+                if '.tmp' in name or not os.path.isdir(path):
+                    continue
+                size = sum(os.path.getsize(os.path.join(path, fn)) for fn in os.listdir(path))
+                entries.append((os.path.getmtime(path), size, path))
+                total += size
+            removed = 0
+            for _, size, path in sorted(entries):
+                if total <= self.byte_budget:
+                    break
+                for fn in os.listdir(path):
+                    os.remove(os.path.join(path, fn))
+                os.rmdir(path)
+                total -= size
+                removed += 1
+            return removed
+
+
+_cache: Optional[FeatureCache] = None
+_orig = {}
+
+
+def _cached(fn, kind):
+    sig = inspect.signature(fn)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        bound = sig.bind(*args, **kwargs)
+        bound.apply_defaults()
+        params = dict(bound.arguments)
+        wav_arr = params.pop('wav_arr')
+        params.pop('n_mfcc', None)  # 两个函数都不使用
+        feats = _cache.get_or_compute(wav_arr, **params)
+        return feats[kind], feats['stft']
+
+    return wrapper
+
+
+def install(cache_dir: str, byte_budget: int = 0) -> FeatureCache:
+    """把 _extract_feats.wav2mfcc_v2 / wav2linear_v2 替换为带磁盘缓存的版本"""
+    global _cache
+    _cache = FeatureCache(cache_dir, byte_budget)
+    for name, kind in (('wav2mfcc_v2', 'mel'), ('wav2linear_v2', 'linear')):
+        _orig.setdefault(name, getattr(_ef, name))
+        setattr(_ef, name, _cached(_orig[name], kind))
+    return _cache
+
+
+def _cmvn_loop_reference(mean_stat, var_stat, count):
+    """cmvn.py 向量化之前的逐维循环实现（一致性检查用）"""
+    import math
+    means, variance = list(mean_stat), list(var_stat)
+    for i in range(len(means)):
+        means[i] /= count
+        variance[i] = variance[i] / count - means[i] * means[i]
+        if variance[i] < 1.0e-20:
+            variance[i] = 1.0e-20
+        variance[i] = 1.0 / math.sqrt(variance[i])
+    return np.array([means, variance])
+
+
+# 基准测试：两个函数分别计算 vs 单次 STFT vs 缓存命中；并检查数值一致
+if __name__ == "__main__":
+    import tempfile
+
+    from wenet.utils.cmvn import _stats_to_cmvn
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    SECONDS, ROUNDS = 60, 3
+    rng = np.random.RandomState(0)
+    t = np.arange(SECONDS * 16000) / 16000.0
+    wav = (0.3 * np.sin(2 * np.pi * 220 * t) + 0.05 * rng.randn(t.size)).astype(np.float32)
+
+    def bench(fn):
+        t0 = time.perf_counter()
+        for _ in range(ROUNDS):
+            out = fn()
+        return (time.perf_counter() - t0) / ROUNDS, out
+
+    extract_features(wav[:16000])  # 预热（librosa mel 滤波器组 / numba 编译）
+    t_sep, (m_ref, s_ref, l_ref, s2_ref) = bench(lambda: _ef.wav2mfcc_v2(wav) + _ef.wav2linear_v2(wav))
+    t_one, feats = bench(lambda: extract_features(wav))
+    same = (np.array_equal(feats['mel'], m_ref) and np.array_equal(feats['linear'], l_ref)
+            and np.array_equal(feats['stft'], s_ref) and np.array_equal(s_ref, s2_ref))
+    print(f"{SECONDS}s 音频: wav2mfcc_v2 + wav2linear_v2 = {t_sep * 1000:.0f}ms, "
+          f"单次 STFT = {t_one * 1000:.0f}ms, 结果一致={same}")
+
+    with tempfile.TemporaryDirectory() as d:
+        cache = install(d)
+        _ef.wav2mfcc_v2(wav)
+        t_hit, (m_hit, s_hit) = bench(lambda: _ef.wav2mfcc_v2(wav))
+        l_hit, _ = _ef.wav2linear_v2(wav)
+        same = np.array_equal(m_hit, m_ref) and np.array_equal(s_hit, s_ref) and np.array_equal(l_hit, l_ref)
+        print(f"缓存命中 = {t_hit * 1000:.1f}ms, 结果一致={same}, hits={cache.hits} misses={cache.misses}")
+
+    dim, frames = 80, 123456.0
+    mean_stat = rng.rand(dim) * frames
+    var_stat = (rng.rand(dim) + 1) * frames * 2
+    var_stat[0] = mean_stat[0] ** 2 / frames  # 方差为 0 的维度走下限
+    t_loop, ref = bench(lambda: _cmvn_loop_reference(mean_stat, var_stat, frames))
+    t_vec, vec = bench(lambda: _stats_to_cmvn(mean_stat, var_stat, frames))
+    print(f"CMVN 统计: 循环 {t_loop * 1e6:.0f}µs / 向量化 {t_vec * 1e6:.0f}µs, "
+          f"一致={np.allclose(ref, vec, rtol=1e-12, atol=0)}")
@@ -14,11 +14,29 @@
 # limitations under the License.
 
 import json
-import math
+import logging
+import sys
 
 import numpy as np
 
 
+def _stats_to_cmvn(mean_stat, var_stat, count):
+    """ Turn accumulated stats into [means, inverse stds] in one vectorized pass
+
+    Args:
+        mean_stat: per-dim sum of features
+        var_stat: per-dim sum of squared features
+        count: number of frames
+
+    Returns:
+        a numpy array of [means, vars]
+    """
+    means = np.asarray(mean_stat, dtype=np.float64) / count
+    variance = np.asarray(var_stat, dtype=np.float64) / count - means * means
+    variance = 1.0 / np.sqrt(np.maximum(variance, 1.0e-20))
+    return np.stack([means, variance])
+
+
 def _load_json_cmvn(json_cmvn_file):
     """ Load the json format cmvn stats file and calculate cmvn
 
@@ -31,17 +49,8 @@ def _load_json_cmvn(json_cmvn_file):
     with open(json_cmvn_file) as f:
         cmvn_stats = json.load(f)
 
-    means = cmvn_stats['mean_stat']
-    variance = cmvn_stats['var_stat']
-    count = cmvn_stats['frame_num']
-    for i in range(len(means)):
-        means[i] /= count
-        variance[i] = variance[i] / count - means[i] * means[i]
-        if variance[i] < 1.0e-20:
-            variance[i] = 1.0e-20
-        variance[i] = 1.0 / math.sqrt(variance[i])
-    cmvn = np.array([means, variance])
-    return cmvn
+    return _stats_to_cmvn(cmvn_stats['mean_stat'], cmvn_stats['var_stat'],
+                          cmvn_stats['frame_num'])
 
 
 def _load_kaldi_cmvn(kaldi_cmvn_file):
@@ -55,8 +64,6 @@ def _load_kaldi_cmvn(kaldi_cmvn_file):
     Returns:
         a numpy array of [means, vars]
     """
-    means = []
-    variance = []
     with open(kaldi_cmvn_file, 'r') as fid:
         # kaldi binary file start with '\0B'
         if fid.read(2) == '\0B':
@@ -70,20 +77,8 @@ def _load_kaldi_cmvn(kaldi_cmvn_file):
         assert (arr[-2] == '0')
         assert (arr[-1] == ']')
         feat_dim = int((len(arr) - 2 - 2) / 2)
-        for i in range(1, feat_dim + 1):
-            means.append(float(arr[i]))
-        count = float(arr[feat_dim + 1])
-        for i in range(feat_dim + 2, 2 * feat_dim + 2):
-            variance.append(float(arr[i]))
-
-    for i in range(len(means)):
-        means[i] /= count
-        variance[i] = variance[i] / count - means[i] * means[i]
-        if variance[i] < 1.0e-20:
-            variance[i] = 1.0e-20
-        variance[i] = 1.0 / math.sqrt(variance[i])
-    cmvn = np.array([means, variance])
-    return cmvn
+        stats = np.array(arr[1:2 * feat_dim + 2], dtype=np.float64)
+    return _stats_to_cmvn(stats[:feat_dim], stats[feat_dim + 1:], stats[feat_dim])
 
 
 def load_cmvn(cmvn_file, is_json):
@@ -92,3 +87,4 @@ def load_cmvn(cmvn_file, is_json):
     else:
         cmvn = _load_kaldi_cmvn(cmvn_file)
     return cmvn[0], cmvn[1]
+
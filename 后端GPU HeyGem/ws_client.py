@@ -3,13 +3,32 @@
 """
 GPU 服务器 WebSocket 客户端
 连接到 API 端的 WebSocket 网关，接收任务并回传结果
+
+发送路径（原先每条进度 / 结果各自 ws.send：未连接时直接丢弃，断线时在途消息丢失）：
+  1. 出站队列 + 单一发送线程，优先级：控制消息（注册 / 上线 / pong / 活跃通知）> 任务结果 > 任务进度
+  2. 进度按任务合并：progress_window 秒内同一任务只发最新一条，done / error 立即发送；
+     progress_batch > 1 时多个任务的进度合成一条 gpu.task.progress.batch
+  3. 内存有界：排队进度超过 max_pending_progress 时先丢最旧的中间进度；
+     结果在内存里最多 max_pending_results 条，超出的只留在发件箱，发送线程空闲时再读回
+  4. 结果先写发件箱（outbox_path，SQLite WAL）再发送，收到网关 gpu.job.result.ack 后删除；
+     网关从未回过 ack（旧版 Dsp.php）时，发送成功且连接保持 ack_grace 秒视为送达；
+     重连后未确认的结果带 replay=true 重发（网关按 request_id 去重）；
+     断线前 ack_grace 秒内发出的终态进度（done / error）在重连后也重发一次
+  5. 已处理 request_id 去重：TtlDedup 按时间分桶，过期时整桶丢弃
+     （原 _processed_requests 字典依赖外部定期调用 cleanup_processed_cache，否则只增不减）
+
+断线测试（本地网关 stub 故意断开连接：结果不丢、任务不重复执行、进度被合并）：
+  python ws_client.py
 """
 
 import json
 import logging
+import sqlite3
 import threading
 import time
-from typing import Callable, Optional
+import uuid
+from collections import OrderedDict, deque
+from typing import Callable, Dict, List, Optional, Tuple
 
 try:
     import websocket
@@ -19,6 +38,254 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+_TERMINAL = ("done", "error")
+
+
+class TtlDedup:
+    """按时间分桶的去重集合：每 bucket_seconds 一个桶，整桶超过 ttl 后一次丢弃"""
+
+    def __init__(self, ttl: float = 3600, bucket_seconds: float = 60, clock: Callable[[], float] = time.time):
+        self.ttl = ttl
+        self.bucket_seconds = max(1.0, float(bucket_seconds))
+        self._clock = clock
+        self._buckets: deque = deque()  # (桶号, key 集合)，桶号递增
+        self._index: Dict[str, int] = {}  # key -> 桶号
+        self._lock = threading.Lock()
+
+    def _expire(self, now: float) -> int:
+        keep_from = int((now - self.ttl) // self.bucket_seconds)
+        n = 0
+        while self._buckets and self._buckets[0][0] < keep_from:
+            _, keys = self._buckets.popleft()
+            for k in keys:
+                self._index.pop(k, None)
+            n += len(keys)
+        return n
+
+    def add(self, key: str) -> bool:
+        """记录 key；未过期的重复 key 返回 False"""
+        now = self._clock()
+        with self._lock:
+            self._expire(now)
+            if key in self._index:
+                return False
+            bucket = int(now // self.bucket_seconds)
+            if not self._buckets or self._buckets[-1][0] != bucket:
+                self._buckets.append((bucket, set()))
+            self._buckets[-1][1].add(key)
+            self._index[key] = bucket
+            return True
+
+    def expire(self) -> int:
+        """丢弃过期的桶，返回清理的 key 数"""
+        with self._lock:
+            return self._expire(self._clock())
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            self._expire(self._clock())
+            return key in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+
+class ResultOutbox:
+    """未确认的任务结果（SQLite WAL，db_path 为空时只在内存）：发送前写入，ack 后删除，重连后补发"""
+
+    def __init__(self, db_path: Optional[str] = None, max_age: float = 86400):
+        self.db_path = db_path or ":memory:"
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        if db_path:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            request_id TEXT NOT NULL UNIQUE,
+            msg TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            sent_at REAL NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0
+        );
+        """)
+        self.prune()
+
+    def put(self, request_id: str, text: str):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO outbox (request_id, msg, created_at) VALUES (?, ?, ?)",
+                (request_id, text, time.time()))
+
+    def mark_sent(self, request_id: str):
+        with self._lock:
+            self._conn.execute("UPDATE outbox SET sent_at = ?, attempts = attempts + 1 WHERE request_id = ?",
+                               (time.time(), request_id))
+
+    def ack(self, request_id: str) -> bool:
+        with self._lock:
+            return self._conn.execute("DELETE FROM outbox WHERE request_id = ?", (request_id,)).rowcount > 0
+
+    def settle(self, sent_from: float, sent_before: float) -> int:
+        """隐式确认：在 [sent_from, sent_before] 内发出的结果视为已送达"""
+        with self._lock:
+            return self._conn.execute("DELETE FROM outbox WHERE sent_at > 0 AND sent_at >= ? AND sent_at <= ?",
+                                      (sent_from, sent_before)).rowcount
+
+    def reset_sent(self):
+        """连接断开：已发未确认的结果全部重新待发"""
+        with self._lock:
+            self._conn.execute("UPDATE outbox SET sent_at = 0 WHERE sent_at > 0")
+
+    def unsent(self, exclude=(), limit: int = 0) -> List[Tuple[str, str, int]]:
+        """待发送的结果 [(request_id, msg, attempts)]，按写入顺序"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT request_id, msg, attempts FROM outbox WHERE sent_at = 0 ORDER BY seq").fetchall()
+        rows = [r for r in rows if r[0] not in exclude]
+        return rows[:limit] if limit else rows
+
+    def prune(self) -> int:
+        with self._lock:
+            n = self._conn.execute("DELETE FROM outbox WHERE created_at < ?",
+                                   (time.time() - self.max_age,)).rowcount
+        if n:
+            logger.warning(f"[WS Client] 发件箱丢弃超过 {self.max_age:.0f}s 未确认的结果: {n} 条")
+        return n
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class OutboundQueue:
+    """出站队列：控制 > 结果 > 进度；进度按任务合并且有上限，结果超出内存上限时留在发件箱"""
+
+    def __init__(self, progress_window: float = 1.0, max_pending_progress: int = 256,
+                 max_pending_results: int = 64, clock: Callable[[], float] = time.monotonic):
+        self.progress_window = progress_window
+        self.max_pending_progress = max(1, max_pending_progress)
+        self.max_pending_results = max(1, max_pending_results)
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._control: deque = deque(maxlen=64)
+        self._results: deque = deque()  # (request_id, text)
+        self._result_ids = set()
+        self._progress: "OrderedDict[str, Tuple[dict, bool]]" = OrderedDict()  # task_id -> (msg, 终态)
+        self._last_sent: Dict[str, float] = {}  # task_id -> 最近一次发出进度的时间
+        self.spilled = False  # 有结果只在发件箱里（内存已满），需要读回
+        self.stats = {"coalesced": 0, "dropped_progress": 0, "spilled_results": 0}
+
+    def put_control(self, text: str):
+        with self._cond:
+            self._control.append(text)
+            self._cond.notify()
+
+    def put_result(self, request_id: str, text: str, front: bool = False) -> bool:
+        """结果入队；内存已满返回 False（结果仍在发件箱里）"""
+        with self._cond:
+            if request_id in self._result_ids:
+                return True
+            if len(self._results) >= self.max_pending_results and not front:
+                self.spilled = True
+                self.stats["spilled_results"] += 1
+                return False
+            (self._results.appendleft if front else self._results.append)((request_id, text))
+            self._result_ids.add(request_id)
+            self._cond.notify()
+            return True
+
+    def put_progress(self, task_id: str, msg: dict, only_if_absent: bool = False):
+        terminal = msg.get("status") in _TERMINAL
+        with self._cond:
+            if task_id in self._progress:
+                if only_if_absent:
+                    return
+                # 终态不会被后来的中间进度覆盖（乱序推送）
+                if self._progress[task_id][1] and not terminal:
+                    return
+                self.stats["coalesced"] += 1
+                self._progress[task_id] = (msg, terminal)
+                return
+            if len(self._progress) >= self.max_pending_progress:
+                self._drop_progress()
+            self._progress[task_id] = (msg, terminal)
+            self._cond.notify()
+
+    def _drop_progress(self):
+        """背压：丢最旧的中间进度（都是终态时丢最旧的终态）"""
+        victim = next((tid for tid, (_, terminal) in self._progress.items() if not terminal),
+                      next(iter(self._progress)))
+        del self._progress[victim]
+        self.stats["dropped_progress"] += 1
+
+    def _due_progress(self, now: float, limit: int) -> Tuple[List[dict], float]:
+        """到期的进度（终态或距上次发送超过窗口），以及最近一条未到期进度的剩余等待时间"""
+        due, wait = [], None
+        for task_id, (msg, terminal) in self._progress.items():
+            ready_at = self._last_sent.get(task_id, float("-inf")) + self.progress_window
+            if terminal or ready_at <= now:
+                due.append(task_id)
+                if len(due) >= limit:
+                    break
+            elif wait is None or ready_at - now < wait:
+                wait = ready_at - now
+        msgs = []
+        for task_id in due:
+            msg, terminal = self._progress.pop(task_id)
+            if terminal:
+                self._last_sent.pop(task_id, None)
+            else:
+                self._last_sent[task_id] = now
+            msgs.append(msg)
+        if len(self._last_sent) > 4 * self.max_pending_progress:
+            for task_id in [t for t, ts in self._last_sent.items() if now - ts > self.progress_window]:
+                del self._last_sent[task_id]
+        return msgs, wait
+
+    def get(self, timeout: float, progress_batch: int = 1):
+        """取下一条待发消息：("control", None, text) / ("result", request_id, text) / ("progress", None, [msg...])"""
+        deadline = self._clock() + timeout
+        with self._cond:
+            while True:
+                if self._control:
+                    return "control", None, self._control.popleft()
+                if self._results:
+                    request_id, text = self._results.popleft()
+                    self._result_ids.discard(request_id)
+                    return "result", request_id, text
+                now = self._clock()
+                msgs, wait = self._due_progress(now, max(1, progress_batch))
+                if msgs:
+                    return "progress", None, msgs
+                remaining = deadline - now
+                if remaining <= 0:
+                    return None
+                self._cond.wait(min(remaining, wait) if wait is not None else remaining)
+
+    def requeue(self, item):
+        """发送失败：结果放回队首，进度在没有更新值时放回"""
+        kind, key, payload = item
+        if kind == "result":
+            self.put_result(key, payload, front=True)
+        elif kind == "progress":
+            for msg in payload:
+                self.put_progress(msg["task_id"], msg, only_if_absent=True)
+
+    def result_ids(self) -> set:
+        with self._cond:
+            return set(self._result_ids)
+
+    def sizes(self) -> dict:
+        with self._cond:
+            return {"control": len(self._control), "results": len(self._results), "progress": len(self._progress)}
+
 
 class GpuWebSocketClient:
     """GPU 服务器 WebSocket 客户端"""
@@ -29,6 +296,13 @@ class GpuWebSocketClient:
         on_task_callback: Callable[[dict], None],
         reconnect_interval: int = 5,
         max_reconnect_interval: int = 30,
+        outbox_path: Optional[str] = None,
+        progress_window: float = 1.0,
+        progress_batch: int = 1,
+        max_pending_progress: int = 256,
+        max_pending_results: int = 64,
+        ack_grace: float = 5.0,
+        dedup_ttl: float = 3600,
     ):
         """
         初始化 WebSocket 客户端
@@ -38,21 +312,41 @@ class GpuWebSocketClient:
             on_task_callback: 收到任务时的回调函数，参数为任务消息字典
             reconnect_interval: 初始重连间隔（秒）
             max_reconnect_interval: 最大重连间隔（秒）
+            outbox_path: 未确认结果的发件箱（SQLite 文件），为空则只在内存（进程重启后不补发）
+            progress_window: 同一任务进度的最小发送间隔（秒），窗口内只发最新一条
+            progress_batch: 一帧最多合并几个任务的进度（1 = 逐条 gpu.task.progress）
+            max_pending_progress: 排队进度上限（任务数），超出先丢最旧的中间进度
+            max_pending_results: 内存中排队结果上限，超出的留在发件箱
+            ack_grace: 网关不回 ack 时，发送后连接保持多久视为送达（秒）
+            dedup_ttl: 已处理 request_id 的保留时长（秒）
         """
         self.ws_url = ws_url
         self.on_task_callback = on_task_callback
         self.reconnect_interval = reconnect_interval
         self.max_reconnect_interval = max_reconnect_interval
+        self.progress_batch = max(1, progress_batch)
+        self.ack_grace = ack_grace
 
         self.ws: Optional[websocket.WebSocketApp] = None
         self.running = False
         self.connected = False
         self.thread: Optional[threading.Thread] = None
+        self._sender: Optional[threading.Thread] = None
         self._current_reconnect_interval = reconnect_interval
 
-        # 已处理的 request_id 集合（防止重复处理）
-        self._processed_requests = {}
-        self._processed_lock = threading.Lock()
+        # 出站队列 + 发件箱；_online 在注册消息发出后置位，发送线程只在此期间发送
+        self._queue = OutboundQueue(progress_window, max_pending_progress, max_pending_results)
+        self._outbox = ResultOutbox(outbox_path)
+        self._online = threading.Event()
+        self._connected_at = 0.0
+        self._closed_at = 0.0
+        self._recent_terminal: deque = deque(maxlen=256)  # (发送时间, 终态进度消息)
+        self._gateway_acks = False  # 网关回过 gpu.job.result.ack 后只认显式确认
+        self._last_settle = 0.0
+        self._counters = {"sent": 0, "send_errors": 0, "replayed": 0, "acked": 0, "duplicates": 0}
+
+        # 已处理的 request_id（防止重复处理，按 TTL 分桶过期）
+        self._processed_requests = TtlDedup(ttl=dedup_ttl, bucket_seconds=max(1.0, dedup_ttl / 60))
 
     def start(self):
         """启动 WebSocket 客户端（后台线程）"""
@@ -63,15 +357,19 @@ class GpuWebSocketClient:
         self.running = True
         self.thread = threading.Thread(target=self._run_forever, daemon=True)
         self.thread.start()
+        self._sender = threading.Thread(target=self._send_loop, daemon=True)
+        self._sender.start()
         logger.info(f"[WS Client] 启动成功，连接到 {self.ws_url}")
 
     def stop(self):
         """停止 WebSocket 客户端"""
         self.running = False
+        self._online.clear()
         if self.ws:
             self.ws.close()
-        if self.thread:
-            self.thread.join(timeout=5)
+        for t in (self.thread, self._sender):
+            if t:
+                t.join(timeout=5)
         logger.info("[WS Client] 已停止")
 
     def send_result(
@@ -85,7 +383,7 @@ class GpuWebSocketClient:
         error_msg: str = "",
     ):
         """
-        发送任务结果给 API 端
+        发送任务结果给 API 端（先写发件箱，断线期间的结果在重连后补发）
 
         Args:
             request_id: 请求ID
@@ -96,10 +394,6 @@ class GpuWebSocketClient:
             error: 是否错误
             error_msg: 错误信息（失败时）
         """
-        if not self.connected or not self.ws:
-            logger.error(f"[WS Client] 未连接，无法发送结果: request_id={request_id}")
-            return
-
         msg = {
             "type": "gpu.job.result",
             "task_type": task_type,
@@ -114,13 +408,14 @@ class GpuWebSocketClient:
         else:
             msg["result"] = result or {}
 
-        try:
-            self.ws.send(json.dumps(msg, ensure_ascii=False))
-            logger.info(
-                f"[WS Client] 发送结果: request_id={request_id} task_type={task_type} error={error}"
-            )
-        except Exception as e:
-            logger.error(f"[WS Client] 发送结果失败: {e}")
+        outbox_id = request_id or f"local-{uuid.uuid4().hex}"
+        text = json.dumps(msg, ensure_ascii=False)
+        self._outbox.put(outbox_id, text)
+        self._queue.put_result(outbox_id, text)
+        logger.info(
+            f"[WS Client] 结果入队: request_id={request_id} task_type={task_type} error={error}"
+            f"{'' if self.connected else '（未连接，重连后发送）'}"
+        )
 
     def send_progress(
         self,
@@ -134,7 +429,8 @@ class GpuWebSocketClient:
         current_frame: int = 0,
     ):
         """
-        推送任务进度给客户端（经 Dsp.php 路由到指定 license_key 的客户端）
+        推送任务进度给客户端（经 Dsp.php 路由到指定 license_key 的客户端）；
+        同一任务 progress_window 内只发最新一条
 
         Args:
             task_id: 任务ID
@@ -146,8 +442,6 @@ class GpuWebSocketClient:
             total_frames: 总帧数
             current_frame: 当前已处理帧数
         """
-        if not self.connected or not self.ws:
-            return
         msg = {
             "type": "gpu.task.progress",
             "task_id": task_id,
@@ -160,24 +454,111 @@ class GpuWebSocketClient:
             "current_frame": current_frame,
             "ts": int(time.time()),
         }
-        try:
-            self.ws.send(json.dumps(msg, ensure_ascii=False))
-        except Exception as e:
-            logger.debug(f"[WS Client] send_progress 失败: {e}")
+        self._queue.put_progress(task_id, msg)
 
     def notify_task_active(self, task_id: str = "", task_type: str = ""):
         """通知 WS 服务器当前有活跃任务（gpu_power_manager 据此延长空闲计时）"""
         if not self.connected or not self.ws:
             return
-        try:
-            self.ws.send(json.dumps({
-                "type": "gpu.task.active",
-                "task_id": task_id,
-                "task_type": task_type,
-                "ts": int(time.time()),
-            }))
-        except Exception as e:
-            logger.debug(f"[WS Client] notify_task_active 失败: {e}")
+        self._queue.put_control(json.dumps({
+            "type": "gpu.task.active",
+            "task_id": task_id,
+            "task_type": task_type,
+            "ts": int(time.time()),
+        }))
+
+    def stats(self) -> dict:
+        """队列 / 发件箱 / 去重状态（健康检查用）"""
+        return {
+            "connected": self.connected,
+            "pending": self._queue.sizes(),
+            "outbox": len(self._outbox),
+            "dedup": len(self._processed_requests),
+            "gateway_acks": self._gateway_acks,
+            **self._queue.stats,
+            **self._counters,
+        }
+
+    # ── 发送线程 ──
+
+    def _send_loop(self):
+        """唯一的发送线程：连接在线时按优先级取消息发送，失败的消息放回队列"""
+        while self.running:
+            if not self._online.wait(timeout=0.5):
+                continue
+            self._settle_results()
+            if self._queue.spilled and not self._queue.sizes()["results"]:
+                self._refill_results()
+            item = self._queue.get(timeout=0.5, progress_batch=self.progress_batch)
+            if item is None:
+                continue
+            kind, key, payload = item
+            if kind == "progress":
+                text = json.dumps(payload[0] if len(payload) == 1 else {
+                    "type": "gpu.task.progress.batch", "items": payload, "ts": int(time.time()),
+                }, ensure_ascii=False)
+            else:
+                text = payload
+            ws = self.ws
+            try:
+                if ws is None or not self._online.is_set():
+                    raise ConnectionError("未连接")
+                ws.send(text)
+            except Exception as e:
+                self._counters["send_errors"] += 1
+                logger.debug(f"[WS Client] 发送失败，放回队列: {kind} ({e})")
+                self._queue.requeue(item)
+                self._online.wait(timeout=0.2)
+                time.sleep(0.05)
+                continue
+            self._counters["sent"] += 1
+            if kind == "result":
+                self._outbox.mark_sent(key)
+            elif kind == "progress":
+                now = time.time()
+                self._recent_terminal.extend((now, m) for m in payload if m.get("status") in _TERMINAL)
+
+    def _settle_results(self):
+        """网关不回 ack 时：当前连接上发出超过 ack_grace 秒的结果视为送达"""
+        now = time.time()
+        if self._gateway_acks or now - self._last_settle < 1.0:
+            return
+        self._last_settle = now
+        n = self._outbox.settle(self._connected_at, now - self.ack_grace)
+        self._counters["acked"] += n
+
+    def _refill_results(self):
+        """内存队列排空后把只在发件箱里的结果读回（先于进度发送）"""
+        self._queue.spilled = False
+        rows = self._outbox.unsent(exclude=self._queue.result_ids(), limit=self._queue.max_pending_results)
+        for request_id, text, _ in rows:
+            if not self._queue.put_result(request_id, text):
+                break
+
+    def _replay_results(self):
+        """重连：发件箱中未确认的结果重新入队（发过的带 replay=true）"""
+        self._outbox.prune()
+        self._outbox.reset_sent()
+        queued = self._queue.result_ids()
+        n = 0
+        for request_id, text, attempts in self._outbox.unsent(exclude=queued):
+            if attempts:
+                msg = json.loads(text)
+                msg["replay"] = True
+                text = json.dumps(msg, ensure_ascii=False)
+                n += 1
+            if not self._queue.put_result(request_id, text):
+                break
+        if n:
+            self._counters["replayed"] += n
+            logger.info(f"[WS Client] 重连后补发未确认结果: {n} 条")
+        # 断线前刚发出的终态进度可能没到网关：重发（已有更新值的任务不覆盖）
+        recent, self._recent_terminal = self._recent_terminal, deque(maxlen=self._recent_terminal.maxlen)
+        for sent_at, msg in recent:
+            if sent_at >= self._closed_at - self.ack_grace:
+                self._queue.put_progress(msg["task_id"], msg, only_if_absent=True)
+
+    # ── 连接 ──
 
     def _run_forever(self):
         """后台线程：持续运行 WebSocket 连接"""
@@ -214,10 +595,11 @@ class GpuWebSocketClient:
     def _on_open(self, ws):
         """WebSocket 连接成功"""
         self.connected = True
+        self._connected_at = time.time()
         self._current_reconnect_interval = self.reconnect_interval
         logger.info("[WS Client] 连接成功")
 
-        # 注册为 worker 并通知 GPU 上线
+        # 注册为 worker 并通知 GPU 上线（先于队列中的任何消息发出）
         register_msg = {
             "type": "register",
             "role": "worker",
@@ -237,6 +619,9 @@ class GpuWebSocketClient:
         ws.send(json.dumps(online_msg))
         logger.info("[WS Client] 已发送 gpu.power.online 上线通知")
 
+        self._replay_results()
+        self._online.set()
+
     def _on_message(self, ws, message):
         """收到 WebSocket 消息"""
         try:
@@ -252,7 +637,15 @@ class GpuWebSocketClient:
 
             # ping/pong
             if msg_type == "ping":
-                ws.send(json.dumps({"type": "pong"}))
+                self._queue.put_control(json.dumps({"type": "pong"}))
+                return
+
+            # 结果确认：从发件箱删除
+            if msg_type == "gpu.job.result.ack":
+                self._gateway_acks = True
+                for request_id in data.get("request_ids") or [data.get("request_id", "")]:
+                    if request_id and self._outbox.ack(request_id):
+                        self._counters["acked"] += 1
                 return
 
             # 单个任务
@@ -283,15 +676,13 @@ class GpuWebSocketClient:
         request_id = task_msg.get("request_id", "")
         task_type = task_msg.get("task_type", task_msg.get("type", ""))
 
-        # 幂等性检查
-        with self._processed_lock:
-            if request_id and request_id in self._processed_requests:
-                logger.warning(
-                    f"[WS Client] 任务已处理，跳过: request_id={request_id}"
-                )
-                return
-            if request_id:
-                self._processed_requests[request_id] = time.time()
+        # 幂等性检查（网关重连后会重新下发未收到结果的任务）
+        if request_id and not self._processed_requests.add(request_id):
+            self._counters["duplicates"] += 1
+            logger.warning(
+                f"[WS Client] 任务已处理，跳过: request_id={request_id}"
+            )
+            return
 
         logger.info(
             f"[WS Client] 处理任务: request_id={request_id} task_type={task_type}"
@@ -325,44 +716,163 @@ class GpuWebSocketClient:
     def _on_close(self, ws, close_status_code, close_msg):
         """WebSocket 连接关闭"""
         self.connected = False
+        self._closed_at = time.time()
+        self._online.clear()
         logger.warning(
             f"[WS Client] 连接关闭: code={close_status_code} msg={close_msg}"
         )
 
     def cleanup_processed_cache(self, ttl: int = 3600):
-        """清理过期的已处理记录（定期调用）"""
-        now = time.time()
-        with self._processed_lock:
-            expired = [
-                rid for rid, ts in self._processed_requests.items() if now - ts > ttl
-            ]
-            for rid in expired:
-                del self._processed_requests[rid]
-            if expired:
-                logger.info(f"[WS Client] 清理过期记录: {len(expired)} 条")
+        """清理过期的已处理记录（去重结构已按 TTL 分桶自动过期，保留供旧调用方使用）"""
+        self._processed_requests.ttl = ttl
+        n = self._processed_requests.expire()
+        if n:
+            logger.info(f"[WS Client] 清理过期记录: {n} 条")
 
 
-# 示例用法
+# 断线测试：本地网关 stub（flask-sock）每收到若干条消息就故意断开连接
 if __name__ == "__main__":
-    logging.basicConfig(
-        level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s"
-    )
-
-    def on_task(task_msg):
-        print(f"收到任务: {task_msg}")
-        # 模拟处理
-        time.sleep(2)
-        # 发送结果（需要在实际代码中调用 client.send_result）
-
-    client = GpuWebSocketClient(
-        ws_url="ws://localhost:9501/dsp", on_task_callback=on_task
-    )
-
-    client.start()
-
-    try:
-        while True:
-            time.sleep(10)
-            client.cleanup_processed_cache()
-    except KeyboardInterrupt:
+    import os
+    import socket
+    import tempfile
+
+    from flask import Flask
+    from flask_sock import Sock
+    from werkzeug.serving import make_server
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s [%(levelname)s] %(message)s")
+    logger.setLevel(logging.CRITICAL)  # 断线是故意的，不打印重连日志
+    for _name in ("werkzeug", "websocket"):
+        logging.getLogger(_name).setLevel(logging.CRITICAL)
+
+    class GatewayStub:
+        """记录收到的消息；drop_every 条后断开连接；send_acks 控制是否回 gpu.job.result.ack"""
+
+        def __init__(self, drop_every: int, send_acks: bool):
+            self.drop_every = drop_every
+            self.send_acks = send_acks
+            self.received: List[dict] = []
+            self.connections = 0
+            self.lock = threading.Lock()
+            app = Flask("gateway_stub")
+            Sock(app).route("/dsp")(self._handler)
+            with socket.socket() as s:
+                s.bind(("127.0.0.1", 0))
+                self.port = s.getsockname()[1]
+            self.server = make_server("127.0.0.1", self.port, app, threaded=True)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        def _handler(self, ws):
+            with self.lock:
+                self.connections += 1
+                first = self.connections == 1
+            if first:
+                # 首个连接下发 3 个任务（其中一个重复），验证去重
+                jobs = [{"request_id": f"job-{i}", "task_type": "echo"} for i in (1, 2, 2, 3)]
+                ws.send(json.dumps({"type": "gpu.job.dispatch.batch", "data": {"jobs": jobs}}))
+            n = 0
+            while True:
+                try:
+                    msg = json.loads(ws.receive())
+                except Exception:
+                    return
+                with self.lock:
+                    self.received.append(msg)
+                if msg.get("type") == "gpu.job.result" and self.send_acks and not msg.get("_no_ack"):
+                    ws.send(json.dumps({"type": "gpu.job.result.ack", "request_id": msg["request_id"]}))
+                n += 1
+                if self.drop_every and n >= self.drop_every:
+                    ws.sock.shutdown(socket.SHUT_RDWR)  # 模拟网络中断（不发 close 帧）
+                    ws.sock.close()
+                    return
+
+        def results(self):
+            with self.lock:
+                return [m for m in self.received if m.get("type") == "gpu.job.result"]
+
+        def of_type(self, t):
+            with self.lock:
+                return [m for m in self.received if m.get("type") == t]
+
+    def _wait(cond, timeout=20):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if cond():
+                return True
+            time.sleep(0.05)
+        return False
+
+    # 1. 去重结构：过期按整桶丢弃
+    clock = [1000.0]
+    dedup = TtlDedup(ttl=10, bucket_seconds=2, clock=lambda: clock[0])
+    assert dedup.add("a") and not dedup.add("a")
+    clock[0] += 5
+    dedup.add("b")
+    clock[0] += 8  # a 已超过 ttl + 一个桶宽，b 未到期
+    assert "a" not in dedup and "b" in dedup and len(dedup) == 1
+    print("TtlDedup: OK")
+
+    # 2. 进度合并 + 背压
+    q = OutboundQueue(progress_window=10, max_pending_progress=3)
+    for i in range(100):
+        q.put_progress("t1", {"task_id": "t1", "status": "synthesizing", "progress": i})
+    for t in ("t2", "t3", "t4"):
+        q.put_progress(t, {"task_id": t, "status": "synthesizing", "progress": 1})
+    q.put_progress("t4", {"task_id": "t4", "status": "done", "progress": 100})
+    kind, _, msgs = q.get(timeout=0.1, progress_batch=10)
+    assert [m["task_id"] for m in msgs] == ["t2", "t3", "t4"], msgs
+    assert q.stats["coalesced"] == 100 and q.stats["dropped_progress"] == 1, q.stats
+    q.put_progress("t2", {"task_id": "t2", "status": "synthesizing", "progress": 2})
+    assert q.get(timeout=0.1) is None  # t2 仍在合并窗口内
+    print(f"OutboundQueue: 101 条进度 → 3 条（合并 {q.stats['coalesced']}，背压丢弃 {q.stats['dropped_progress']}）OK")
+
+    def run_client(gateway, outbox, n_results, n_progress, timeout=30, tasks=4):
+        client = GpuWebSocketClient(f"ws://127.0.0.1:{gateway.port}/dsp",
+                                    on_task_callback=lambda m: client.send_result(m["request_id"], m["task_type"],
+                                                                                  result={"echo": True}),
+                                    reconnect_interval=0.2, max_reconnect_interval=0.5,
+                                    outbox_path=outbox, progress_window=0.2, ack_grace=0.5,
+                                    max_pending_results=8)  # 小内存队列：覆盖结果溢出到发件箱再读回
+        client.start()
+        for i in range(n_results):
+            client.send_result(f"r{i}", "bench", result={"i": i})
+            for p in range(n_progress):
+                client.send_progress(f"task{i % 4}", status="synthesizing", progress=p)
+            time.sleep(0.01)
+        for t in range(tasks):
+            client.send_progress(f"task{t}", status="done", progress=100)
+        ok = _wait(lambda: len(client._outbox) == 0 and not any(client._queue.sizes().values())
+                   and {m["task_id"] for m in gateway.of_type("gpu.task.progress") if m["status"] == "done"}
+                   == {f"task{t}" for t in range(tasks)}, timeout)
+        return client, ok
+
+    with tempfile.TemporaryDirectory() as d:
+        # 3. 网关回 ack，每 7 条消息断一次：结果一条不丢，任务不重复执行
+        gw = GatewayStub(drop_every=7, send_acks=True)
+        client, ok = run_client(gw, os.path.join(d, "outbox.db"), n_results=40, n_progress=50)
+        client.stop()
+        got = {m["request_id"] for m in gw.results()}
+        expect = {f"r{i}" for i in range(40)} | {"job-1", "job-2", "job-3"}
+        assert ok and got == expect, (ok, sorted(expect - got))
+        assert client._counters["duplicates"] >= 1
+        progress = gw.of_type("gpu.task.progress")
+        done = {m["task_id"] for m in progress if m["status"] == "done"}
+        assert done == {f"task{t}" for t in range(4)}, done
+        print(f"显式 ack + 断线 {gw.connections - 1} 次: 结果 {len(got)}/{len(expect)} 条送达"
+              f"（补发 {client._counters['replayed']}，溢出到发件箱 {client._queue.stats['spilled_results']}），"
+              f"进度 {40 * 50 + 4} 次推送 → 发出 {len(progress)} 条，重复任务跳过 {client._counters['duplicates']} 次 OK")
+
+        # 4. 旧网关不回 ack：发送后连接保持 ack_grace 秒视为送达；发件箱跨进程保留
+        gw = GatewayStub(drop_every=0, send_acks=False)
+        client, ok = run_client(gw, os.path.join(d, "outbox_legacy.db"), n_results=10, n_progress=0, tasks=0)
+        client.stop()
+        assert ok and {m["request_id"] for m in gw.results()} >= {f"r{i}" for i in range(10)}
+        outbox = ResultOutbox(os.path.join(d, "persist.db"))
+        outbox.put("x1", json.dumps({"type": "gpu.job.result", "request_id": "x1"}))
+        outbox.close()
+        client = GpuWebSocketClient(f"ws://127.0.0.1:{gw.port}/dsp", on_task_callback=lambda m: None,
+                                    reconnect_interval=0.2, outbox_path=os.path.join(d, "persist.db"), ack_grace=0.3)
+        client.start()
+        assert _wait(lambda: any(m["request_id"] == "x1" for m in gw.results()) and len(client._outbox) == 0)
         client.stop()
+        print("隐式确认 + 发件箱跨进程补发: OK")